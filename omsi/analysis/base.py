@@ -14,6 +14,7 @@ import weakref
 from collections import OrderedDict
 
 import numpy as np
+import h5py
 
 from omsi.workflow.executor.base import workflow_executor_base
 from omsi.dataformat.omsi_file.analysis import omsi_file_analysis
@@ -94,6 +95,14 @@ class analysis_base(parameter_manager):
     :ivar driver: Workflow driver to be used when executing multiple analyses, e.g., via execute_recursive or
         execute_all. Default value is None in which case a new default driver will be used each time we
         execute a workflow.
+    :ivar result_cache: The omsi.analysis.result_cache.analysis_result_cache used to reuse the outputs of
+        previous executions with the same inputs. Default value is None in which case DEFAULT_RESULT_CACHE is used.
+    :ivar block_checkpoint_directory: Directory used to checkpoint the data blocks completed by analyses that
+        parallelize their execution via mpi_helper.parallel_over_axes (see get_block_checkpoint). Default value
+        is None, i.e., no checkpointing. The directory is usually set by workflow executors with checkpointing.
+
+    :cvar DEFAULT_RESULT_CACHE: The result cache used by all analyses that do not define their own result_cache.
+        Default value is None, i.e., analyses are always executed.
 
 
     **Execution Functions:**
@@ -154,6 +163,11 @@ class analysis_base(parameter_manager):
     are most interested in.
     """
 
+    DEFAULT_RESULT_CACHE = None
+    """
+    The default result cache to be used
+    """
+
     _analysis_instances = OrderedDict()
     """
     Class variable used to track all instances of analysis_base. Only the keys of the
@@ -177,6 +191,8 @@ class analysis_base(parameter_manager):
         self.mpi_root = 0
         self.update_analysis = True
         self.driver = None
+        self.result_cache = None
+        self.block_checkpoint_directory = None
         self.continue_analysis_when_ready = False  # If we have tasks waiting for us then continue the those tasks when we are done with our execution
 
         # Add common analysis parameters
@@ -260,7 +276,7 @@ class analysis_base(parameter_manager):
             if isinstance(value, dependency_dict):
                 ana_data = analysis_data(name=key,
                                          data=value)
-            elif 'numpy' not in str(type(value)):
+            elif 'numpy' not in str(type(value)) and not isinstance(value, h5py.Dataset):
                 temp_value = np.asarray(value)
                 ana_data = analysis_data(name=key,
                                          data=temp_value,
@@ -462,6 +478,21 @@ class analysis_base(parameter_manager):
         if self.run_info is not None:
             self.run_info.mpi_comm = self.mpi_comm
             self.run_info.mpi_root = self.mpi_root
+
+        # 3.1) Reuse the outputs of a previous execution with the same inputs if possible
+        result_cache = self.get_result_cache()
+        if result_cache is not None:
+            cache_key = result_cache.get_key(self)
+            if self.run_info is not None:
+                cache_source = self.run_info(result_cache.load)(self, cache_key)
+            else:
+                cache_source = result_cache.load(self, cache_key)
+            if cache_source is not None:
+                self.record_cache_info(result_cache, cache_key, cache_source)
+                self.update_analysis = False
+                return self.get_cached_outputs()
+
+        if self.run_info is not None:
             self.enable_time_and_usage_profiling(self['profile_time_and_usage'])
             self.enable_memory_profiling(self['profile_memory'])
             analysis_output = self.run_info(self.execute_analysis)()
@@ -473,12 +504,68 @@ class analysis_base(parameter_manager):
         # Record the analysis output
         self.record_execute_analysis_outputs(analysis_output=analysis_output)
 
+        # Store the analysis output in the result cache
+        if result_cache is not None:
+            result_cache.store(self, cache_key)
+            self.record_cache_info(result_cache, cache_key)
+
         # Indicate the analysis is up-to-date
         self.update_analysis = False
 
         # Return the output of the analysis
         return analysis_output
 
+    def get_block_checkpoint(self):
+        """
+        Get the checkpoint to be used for the data blocks processed in parallel by the analysis.
+
+        :return: omsi.shared.checkpoint_helper.block_checkpoint object for self.block_checkpoint_directory
+            or None if block_checkpoint_directory is not set.
+        """
+        if self.block_checkpoint_directory is None:
+            return None
+        from omsi.shared.checkpoint_helper import block_checkpoint
+        return block_checkpoint(checkpoint_directory=self.block_checkpoint_directory,
+                                comm=self.mpi_comm,
+                                root=self.mpi_root)
+
+    def get_result_cache(self):
+        """
+        Get the result cache used by the execute function.
+
+        :return: self.result_cache if set, otherwise analysis_base.DEFAULT_RESULT_CACHE. May be None.
+        """
+        return self.result_cache if self.result_cache is not None else analysis_base.DEFAULT_RESULT_CACHE
+
+    def record_cache_info(self, result_cache, cache_key, cache_source=None):
+        """
+        Record the use of the result cache in the run_info of the analysis.
+
+        :param result_cache: The omsi.analysis.result_cache.analysis_result_cache used
+        :param cache_key: The cache key of the analysis
+        :param cache_source: String describing the source of the reused outputs or None if the
+            analysis has been executed
+        """
+        if self.run_info is None:
+            return
+        self.run_info[result_cache.CACHE_KEY] = unicode(cache_key)
+        self.run_info['cache_hit'] = cache_source is not None
+        if cache_source is not None:
+            self.run_info['cache_source'] = unicode(cache_source)
+        self.run_info['cache_hits'] = result_cache.hits
+        self.run_info['cache_misses'] = result_cache.misses
+
+    def get_cached_outputs(self):
+        """
+        Get the outputs of the analysis in the same form as returned by execute_analysis. This function is used
+        by the execute function to define the return value when the outputs are reused from the result cache.
+
+        :return: The single output or tuple of all outputs defined by data_names
+        """
+        if len(self.data_names) == 1:
+            return self[self.data_names[0]]
+        return tuple(self[data_name] for data_name in self.data_names)
+
     def execute_analysis(self):
         """
         Implement this function to implement the execution of the actual analysis.
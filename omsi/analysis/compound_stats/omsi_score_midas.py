@@ -7,6 +7,7 @@ MIDAS spectrum analysis
 
 from omsi.analysis.base import analysis_base
 import omsi.shared.mpi_helper as mpi_helper
+import omsi.shared.process_helper as process_helper
 from omsi.shared.log import log_helper
 try:
     import MIDAS
@@ -103,6 +104,22 @@ class omsi_score_midas(analysis_base):
                            default=3,
                            group=groups['settings'])
         # Parallel execution parameters
+        self.add_parameter(name='backend',
+                           help='Parallel backend used to execute the analysis. mpi: Use MPI when running with ' +
+                                'more than one MPI rank. processes: Use a pool of processes on the current node. ' +
+                                'serial: Execute the analysis in serial.',
+                           dtype=str,
+                           required=False,
+                           choices=process_helper.BACKENDS.values(),
+                           group=groups['parallel'],
+                           default=process_helper.BACKENDS['MPI'])
+        self.add_parameter(name='num_processes',
+                           help='Number of processes used by the processes backend. Set to 0 to use one ' +
+                                'process per CPU.',
+                           dtype=dtypes['int'],
+                           required=False,
+                           group=groups['parallel'],
+                           default=0)
         self.add_parameter(name='schedule',
                            help='Scheduling to be used for parallel MPI runs',
                            dtype=str,
@@ -110,6 +127,13 @@ class omsi_score_midas(analysis_base):
                            choices=mpi_helper.parallel_over_axes.SCHEDULES.values(),
                            group=groups['parallel'],
                            default=mpi_helper.parallel_over_axes.SCHEDULES['DYNAMIC'])
+        self.add_parameter(name='schedule_block_size',
+                           help='Number of spectra per task for DYNAMIC parallel scheduling. Set to 0 to use ' +
+                                'one chunk of the data per task.',
+                           dtype=dtypes['int'],
+                           required=False,
+                           group=groups['parallel'],
+                           default=1)
         self.add_parameter(name='collect',
                            help='Collect results to the MPI root rank when running in parallel',
                            dtype=dtypes['bool'],
@@ -191,16 +215,19 @@ class omsi_score_midas(analysis_base):
             enable_parallel = False
 
         #############################################################
-        # Parallel execution using MPI
+        # Parallel execution using MPI or a process pool
         #############################################################
         # We have more than a single core AND we have multiple spectra to process
-        if mpi_helper.get_size() > 1 and len(spectrum_indexes) > 1:
+        if process_helper.use_parallel_backend(self['backend'], self['num_processes'], comm=self.mpi_comm) and \
+                len(spectrum_indexes) > 1:
             # We were not asked to process a specific data subblock from a parallel process
             # but we need to initiate the parallel processing.
             if enable_parallel:
-                # Setup the parallel processing using mpi_helper.parallel_over_axes
+                # Setup the parallel processing using mpi_helper.parallel_over_axes or a process pool
                 split_axis = [0, ]
-                scheduler = mpi_helper.parallel_over_axes(
+                scheduler = process_helper.create_scheduler(
+                    backend=self['backend'],                                # Parallel backend
+                    num_processes=self['num_processes'],                    # Number of processes
                     task_function=self.execute_analysis,                    # Execute this function
                     task_function_params={'compound_list': compound_list},  # Reuse the compound_list
                     main_data=spectrum_indexes,                             # Process the spectra independently
@@ -208,7 +235,10 @@ class omsi_score_midas(analysis_base):
                     main_data_param_name='spectrum_indexes',                # data input param
                     root=self.mpi_root,                                     # The root MPI task
                     schedule=self['schedule'],                              # Parallel scheduling scheme
-                    comm=self.mpi_comm)                                     # MPI communicator
+                    comm=self.mpi_comm,                                     # MPI communicator
+                    block_size=(self['schedule_block_size'] if self['schedule_block_size'] > 0
+                                else mpi_helper.parallel_over_axes.BLOCK_SIZES['CHUNK']),
+                    checkpoint=self.get_block_checkpoint())                 # Checkpoint of completed blocks
                 # Execute the analysis in parallel
                 result = scheduler.run()
                 # Collect the output data to the root rank if requested
@@ -218,27 +248,13 @@ class omsi_score_midas(analysis_base):
                 # Compile the data from the parallel execution
                 hit_table = np.zeros((0, 0), dtype=MIDAS.scoring_C.HIT_TABLE_DTYPE)  # initialize hit_table as empty
                 pixel_index = np.zeros((0, 2), dtype='int')
-                use_dynamic_schedule = (self['schedule'] == mpi_helper.parallel_over_axes.SCHEDULES['DYNAMIC'])
 
-                # TODO NEED to update since collect now returns a single list not a list of lists
-                if not self['collect'] and (mpi_helper.get_rank() == self.mpi_root and use_dynamic_schedule):
-                    # We did not process any data on the root process when using dynamic scheduling
-                    # and we did not collect the data to the root either
-                    pass
-                #elif self['collect'] and mpi_helper.get_rank() == self.mpi_root:
-                #    temp_data = [ri[0] for rt in result[0] for ri in rt]
-                #    if len(temp_data) > 0:
-                #        hit_table = np.concatenate(tuple(temp_data), axis=-1)
-                #    temp_data = [ri[1] for rt in result[0] for ri in rt]
-                #    if len(temp_data) > 0:
-                #        pixel_index = np.concatenate(tuple(temp_data), axis=0) # axis=-1
-                else:
-                    temp_data = [ri[0] for ri in result[0]]
-                    if len(temp_data) > 0:
-                        hit_table = np.concatenate(tuple(temp_data), axis=-1)
-                    temp_data = [ri[1] for ri in result[0]]
-                    if len(temp_data) > 0:
-                        pixel_index = np.concatenate(tuple(temp_data), axis=0)
+                temp_data = [ri[0] for ri in result[0]]
+                if len(temp_data) > 0:
+                    hit_table = np.concatenate(tuple(temp_data), axis=-1)
+                temp_data = [ri[1] for ri in result[0]]
+                if len(temp_data) > 0:
+                    pixel_index = np.concatenate(tuple(temp_data), axis=0)
                 return hit_table, pixel_index
 
         #############################################################
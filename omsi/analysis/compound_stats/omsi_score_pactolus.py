@@ -7,7 +7,9 @@ MIDAS spectrum analysis
 
 from omsi.analysis.base import analysis_base
 import omsi.shared.mpi_helper as mpi_helper
+import omsi.shared.process_helper as process_helper
 from omsi.shared.log import log_helper
+from omsi.analysis.compound_stats.pactolus_tree_cache import pactolus_tree_cache
 try:
     from pactolus import score_frag_dag
 except ImportError:
@@ -76,7 +78,44 @@ class omsi_score_pactolus(analysis_base):
                            dtype=dtypes['ndarray'],
                            default=[0, 1, 2],
                            group=groups['settings'])
+        self.add_parameter(name='cache_trees',
+                           help='Copy the trees that may be scored once per compute node to a node-local store ' +
+                                'so that the trees are read from the shared file system only once per node.',
+                           dtype=dtypes['bool'],
+                           required=False,
+                           default=True,
+                           group=groups['settings'])
+        self.add_parameter(name='tree_cache_directory',
+                           help='Directory for the node-local tree store. Use an empty string to use /dev/shm ' +
+                                'if available and the default temporary directory otherwise.',
+                           dtype=dtypes['str'],
+                           required=False,
+                           default="",
+                           group=groups['settings'])
+        self.add_parameter(name='tree_cache_max_bytes',
+                           help='Maximum number of bytes of trees staged per compute node. Use 0 to stage ' +
+                                'the trees as long as they fit into the free space of the tree cache directory.',
+                           dtype=dtypes['int'],
+                           required=False,
+                           default=0,
+                           group=groups['settings'])
         # Parallel execution parameters
+        self.add_parameter(name='backend',
+                           help='Parallel backend used to execute the analysis. mpi: Use MPI when running with ' +
+                                'more than one MPI rank. processes: Use a pool of processes on the current node. ' +
+                                'serial: Execute the analysis in serial.',
+                           dtype=str,
+                           required=False,
+                           choices=process_helper.BACKENDS.values(),
+                           group=groups['parallel'],
+                           default=process_helper.BACKENDS['MPI'])
+        self.add_parameter(name='num_processes',
+                           help='Number of processes used by the processes backend. Set to 0 to use one ' +
+                                'process per CPU.',
+                           dtype=dtypes['int'],
+                           required=False,
+                           group=groups['parallel'],
+                           default=0)
         self.add_parameter(name='schedule',
                            help='Scheduling to be used for parallel MPI runs',
                            dtype=str,
@@ -84,6 +123,13 @@ class omsi_score_pactolus(analysis_base):
                            choices=mpi_helper.parallel_over_axes.SCHEDULES.values(),
                            group=groups['parallel'],
                            default=mpi_helper.parallel_over_axes.SCHEDULES['DYNAMIC'])
+        self.add_parameter(name='schedule_block_size',
+                           help='Number of spectra per task for DYNAMIC parallel scheduling. Set to 0 to use ' +
+                                'one chunk of the data per task.',
+                           dtype=dtypes['int'],
+                           required=False,
+                           group=groups['parallel'],
+                           default=1)
         self.add_parameter(name='collect',
                            help='Collect results to the MPI root rank when running in parallel',
                            dtype=dtypes['bool'],
@@ -92,7 +138,7 @@ class omsi_score_pactolus(analysis_base):
                            default=True)
         self.data_names = ['pixel_index', 'score', 'id', 'name', 'mass', 'n_peaks', 'n_match']
 
-    def execute_analysis(self, spectrum_indexes=None, file_lookup_table=None):
+    def execute_analysis(self, spectrum_indexes=None, file_lookup_table=None, scoring_lookup_table=None):
         """
         Execute the local peak finder for the given msidata.
 
@@ -104,6 +150,9 @@ class omsi_score_pactolus(analysis_base):
 
         :param file_lookup_table: The Pactolus lookup table with the list of tree files and their mass.
 
+        :param scoring_lookup_table: The Pactolus lookup table used for scoring. Same as file_lookup_table
+            but referring to the trees in the node-local tree cache (see pactolus_tree_cache.stage).
+
         :returns: A series of numpy arrays  with the score data for each pixel and a 2D array
             of pixel indices describing for each spectrum the (x,y) pixel location in the image.
 
@@ -135,23 +184,32 @@ class omsi_score_pactolus(analysis_base):
         neutralizations = self['neutralizations']
         max_depth = self['max_depth']
 
-        # Make the numpy array with the list of tree files and their MS1 masses
-        if file_lookup_table is None:
-            # TODO: Possible further optimization by reading only on self.mpi_root and then sending the list to all
-            log_helper.debug(__name__, 'Preparing file lookup table', comm=self.mpi_comm, root=self.mpi_root)
-            if os.path.isfile(self['trees']):
-                if self['trees'].endswith('.npy'):
-                    file_lookup_table = np.load(self['trees'])
-                else:
-                    in_treefile = open(self['trees'], 'r')
-                    tree_files = [line.rstrip('\n') for line in in_treefile]
-                    in_treefile.close()
-                    file_lookup_table = score_frag_dag.make_file_lookup_table_by_MS1_mass(tree_files=tree_files)
-            elif os.path.isdir(self['trees']):
-                file_lookup_table = score_frag_dag.make_file_lookup_table_by_MS1_mass(path=self['trees'])
+        # Make the numpy array with the list of tree files and their MS1 masses on the root and
+        # stage the trees in the node-local tree cache
+        if file_lookup_table is None or scoring_lookup_table is None:
+            tree_cache = pactolus_tree_cache(comm=self.mpi_comm,
+                                             root=self.mpi_root,
+                                             cache_directory=self['tree_cache_directory'],
+                                             max_bytes=self['tree_cache_max_bytes'])
+            try:
+                if file_lookup_table is None:
+                    file_lookup_table = tree_cache.get_file_lookup_table(self['trees'])
+                scoring_lookup_table = file_lookup_table
+                if self['cache_trees']:
+                    scoring_lookup_table = tree_cache.stage(file_lookup_table=file_lookup_table,
+                                                            precursor_mz=precursor_mz,
+                                                            ms1_mass_tol=ms1_mass_tol,
+                                                            neutralizations=neutralizations)
+                self.run_info['tree_load_time'] = tree_cache.tree_load_time
+                self.run_info['tree_cache_num_trees'] = tree_cache.num_trees
+                return self.execute_analysis(spectrum_indexes=spectrum_indexes,
+                                             file_lookup_table=file_lookup_table,
+                                             scoring_lookup_table=scoring_lookup_table)
+            finally:
+                tree_cache.cleanup()
 
         # Define the common pactolus paramters
-        pactolus_parameters = {'file_lookup_table': file_lookup_table,
+        pactolus_parameters = {'file_lookup_table': scoring_lookup_table,
                                'ms1_mass_tol': ms1_mass_tol,
                                'ms2_mass_tol': ms2_mass_tol,
                                'neutralizations': neutralizations,
@@ -171,27 +229,38 @@ class omsi_score_pactolus(analysis_base):
             enable_parallel = False
 
         #############################################################
-        # Parallel execution using MPI
+        # Parallel execution using MPI or a process pool
         #############################################################
         # We have more than a single core AND we have multiple spectra to process
-        if mpi_helper.get_size() > 1 and len(spectrum_indexes) > 1:
+        if process_helper.use_parallel_backend(self['backend'], self['num_processes'], comm=self.mpi_comm) and \
+                len(spectrum_indexes) > 1:
             # We were not asked to process a specific data subblock from a parallel process
             # but we need to initiate the parallel processing.
             if enable_parallel:
                 log_helper.debug(__name__, 'Preparing parallel execution', comm=self.mpi_comm, root=self.mpi_root)
-                # Setup the parallel processing using mpi_helper.parallel_over_axes
+                # Setup the parallel processing using mpi_helper.parallel_over_axes or a process pool
                 split_axis = [0, ]
-                scheduler = mpi_helper.parallel_over_axes(
+                scheduler = process_helper.create_scheduler(
+                    backend=self['backend'],                                # Parallel backend
+                    num_processes=self['num_processes'],                    # Number of processes
                     task_function=self.execute_analysis,                    # Execute this function
-                    task_function_params={'file_lookup_table': file_lookup_table},  # Reuse the file_lookup_table
+                    task_function_params={'file_lookup_table': file_lookup_table,   # Reuse the lookup tables
+                                          'scoring_lookup_table': scoring_lookup_table},
                     main_data=spectrum_indexes,                             # Process the spectra independently
                     split_axes=split_axis,                                  # Split along axes
                     main_data_param_name='spectrum_indexes',                # data input param
                     root=self.mpi_root,                                     # The root MPI task
                     schedule=self['schedule'],                              # Parallel scheduling scheme
-                    comm=self.mpi_comm)                                     # MPI communicator
+                    comm=self.mpi_comm,                                     # MPI communicator
+                    block_size=(self['schedule_block_size'] if self['schedule_block_size'] > 0
+                                else mpi_helper.parallel_over_axes.BLOCK_SIZES['CHUNK']),
+                    checkpoint=self.get_block_checkpoint())                 # Checkpoint of completed blocks
                 # Execute the analysis in parallel
                 result = scheduler.run()
+                self.run_info['scoring_time'] = float(np.sum(scheduler.block_times))
+                self.run_info['SCHEDULER_block_times'] = np.asarray(scheduler.block_times)
+                self.run_info['SCHEDULER_run_time'] = scheduler.run_time
+                self.run_info['SCHEDULER_schedule'] = scheduler.schedule
                 # Collect the output data to the root rank if requested
                 if self['collect']:
                     result = scheduler.collect_data()
@@ -205,51 +274,36 @@ class omsi_score_pactolus(analysis_base):
                 n_peaks = np.zeros((0,), dtype='i4')
                 n_match = np.zeros((0,), dtype='i4')
 
-                use_dynamic_schedule = (self['schedule'] == mpi_helper.parallel_over_axes.SCHEDULES['DYNAMIC'])
-
-                # TODO NEED to update since collect now returns a single list not a list of lists
-                if not self['collect'] and (mpi_helper.get_rank() == self.mpi_root and use_dynamic_schedule):
-                    # We did not process any data on the root process when using dynamic scheduling
-                    # and we did not collect the data to the root either
-                    pass
-                # elif self['collect'] and mpi_helper.get_rank() == self.mpi_root:
-                #    temp_data = [ri[0] for rt in result[0] for ri in rt]
-                #    if len(temp_data) > 0:
-                #        hit_table = np.concatenate(tuple(temp_data), axis=-1)
-                #    temp_data = [ri[1] for rt in result[0] for ri in rt]
-                #    if len(temp_data) > 0:
-                #        pixel_index = np.concatenate(tuple(temp_data), axis=0) # axis=-1
-                else:
-                    log_helper.debug(__name__, 'Compiling output')
-                    # Compile pixel_index
-                    temp_data = [ri[0] for ri in result[0]]
-                    if len(temp_data) > 0:
-                        pixel_index = np.concatenate(tuple(temp_data), axis=0)
-                    temp_data = [ri[1] for ri in result[0]]
-                    # Compile scores
-                    if len(temp_data) > 0:
-                        score = np.concatenate(tuple(temp_data), axis=0)
-                    # Compile id
-                    temp_data = [ri[2] for ri in result[0]]
-                    if len(temp_data) > 0:
-                        id_data = np.concatenate(tuple(temp_data), axis=0)
-                    # Compile name
-                    temp_data = [ri[3] for ri in result[0]]
-                    if len(temp_data) > 0:
-                        name = np.concatenate(tuple(temp_data), axis=0)
-                    # Compile mass
-                    temp_data = [ri[4] for ri in result[0]]
-                    if len(temp_data) > 0:
-                        mass = np.concatenate(tuple(temp_data), axis=0)
-                    # Compile n_peaks
-                    temp_data = [ri[5] for ri in result[0]]
-                    if len(temp_data) > 0:
-                        n_peaks = np.concatenate(tuple(temp_data), axis=0)
-                    # Compile n_match
-                    temp_data = [ri[6] for ri in result[0]]
-                    if len(temp_data) > 0:
-                        n_match = np.concatenate(tuple(temp_data), axis=0)
-                    log_helper.log_var(__name__, score=score)
+                log_helper.debug(__name__, 'Compiling output')
+                # Compile pixel_index
+                temp_data = [ri[0] for ri in result[0]]
+                if len(temp_data) > 0:
+                    pixel_index = np.concatenate(tuple(temp_data), axis=0)
+                temp_data = [ri[1] for ri in result[0]]
+                # Compile scores
+                if len(temp_data) > 0:
+                    score = np.concatenate(tuple(temp_data), axis=0)
+                # Compile id
+                temp_data = [ri[2] for ri in result[0]]
+                if len(temp_data) > 0:
+                    id_data = np.concatenate(tuple(temp_data), axis=0)
+                # Compile name
+                temp_data = [ri[3] for ri in result[0]]
+                if len(temp_data) > 0:
+                    name = np.concatenate(tuple(temp_data), axis=0)
+                # Compile mass
+                temp_data = [ri[4] for ri in result[0]]
+                if len(temp_data) > 0:
+                    mass = np.concatenate(tuple(temp_data), axis=0)
+                # Compile n_peaks
+                temp_data = [ri[5] for ri in result[0]]
+                if len(temp_data) > 0:
+                    n_peaks = np.concatenate(tuple(temp_data), axis=0)
+                # Compile n_match
+                temp_data = [ri[6] for ri in result[0]]
+                if len(temp_data) > 0:
+                    n_match = np.concatenate(tuple(temp_data), axis=0)
+                log_helper.log_var(__name__, score=score)
                 # Return the compiled output
                 return pixel_index, score, id_data, name, mass, n_peaks, n_match
 
@@ -262,6 +316,7 @@ class omsi_score_pactolus(analysis_base):
         # if len(pixel_index.shape) == 1:
         #    pixel_index = pixel_index[np.newaxis, :]
         hit_matrix = []
+        scoring_time = 0
 
         # Iterate through all the pixel we were asked to process in serial
         for current_index, spectrum_index in enumerate(spectrum_indexes):
@@ -292,6 +347,7 @@ class omsi_score_pactolus(analysis_base):
                                                                         params=pactolus_parameters)
             end_time = time.time()
             execution_time = end_time - start_time
+            scoring_time += execution_time
             time_str = "rank : " + str(mpi_helper.get_rank()) + " : pixel_index : " + \
                        str(fpl_peak_arrayindex[spectrum_index, 0:2]) + " : time in s : " + str(execution_time)
             time_str += " : num hits : " + str((current_hits > 0).sum())
@@ -303,6 +359,9 @@ class omsi_score_pactolus(analysis_base):
             # Save the hits for the current pixel
             hit_matrix.append(current_hits[0, :])
 
+        if enable_parallel:
+            self.run_info['scoring_time'] = scoring_time
+
         # Index the results based on the given metabolite database
         score = []
         id_data = []
@@ -0,0 +1,271 @@
+"""
+Module with a cache of the Pactolus fragmentation trees used by omsi_score_pactolus.
+
+Pactolus reads the HDF5 file of each fragmentation tree for every spectrum it scores. When running with
+many MPI ranks, scanning the trees directory and reading the trees from the shared file system on every rank
+for every spectrum overloads the file system. The tree cache avoids this as follows:
+
+    1) The file lookup table is created once on the MPI root and broadcast to all ranks (see
+       pactolus_tree_cache.get_file_lookup_table).
+    2) The trees that may be scored are copied once per compute node into a node-local store directory,
+       by default on the memory-backed /dev/shm file system so that all reads by Pactolus are served
+       from memory. The ranks of a node share the work of copying the trees, i.e., each node reads each tree
+       from the shared file system only once, independent of the number of spectra and ranks
+       (see pactolus_tree_cache.stage). Only as many trees are staged as fit into the free space of the
+       store (and the optional max_bytes limit). The remaining trees are read from their original location.
+"""
+import os
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import omsi.shared.mpi_helper as mpi_helper
+from omsi.shared.log import log_helper
+
+
+class pactolus_tree_cache(object):
+    """
+    Node-local cache of Pactolus fragmentation trees.
+
+    :ivar comm: The MPI communicator of the analysis
+    :ivar root: The MPI root rank that creates the file lookup table
+    :ivar cache_directory: The directory in which the node-local store is created. None to use /dev/shm if
+        available and the default temporary directory otherwise.
+    :ivar max_bytes: Maximum number of bytes of trees staged per compute node. None for no limit, in which
+        case the trees are staged as long as they fit into the free space of the cache directory.
+    :ivar node_comm: The MPI communicator with the ranks on the current compute node (None if MPI is
+        not available or no trees are staged)
+    :ivar store_directory: The node-local store directory with the cached trees (None if no trees are staged)
+    :ivar num_trees: The number of trees in the node-local store
+    :ivar num_bytes: The number of bytes of the trees copied to the node-local store by the current rank
+    :ivar tree_load_time: Time in seconds used to create the file lookup table and to stage the trees
+    """
+    def __init__(self, comm=None, root=0, cache_directory=None, max_bytes=None):
+        """
+        Initialize the tree cache.
+
+        :param comm: The MPI communicator of the analysis. Default value is None, in which case
+            MPI.COMM_WORLD is used.
+        :param root: The MPI root rank that creates the file lookup table
+        :param cache_directory: The directory in which the node-local store is created. Default value is None,
+            in which case /dev/shm is used if available and the default temporary directory otherwise.
+        :param max_bytes: Maximum number of bytes of trees staged per compute node. Default value is None,
+            in which case the trees are staged as long as they fit into the free space of the cache directory.
+        """
+        self.comm = comm
+        self.root = root
+        self.cache_directory = cache_directory if cache_directory else None
+        self.max_bytes = max_bytes if max_bytes else None
+        self.node_comm = None
+        self.store_directory = None
+        self.num_trees = 0
+        self.num_bytes = 0
+        self.tree_load_time = 0
+
+    def get_file_lookup_table(self, trees):
+        """
+        Create the Pactolus file lookup table with the list of tree files and their MS1 mass. The table is
+        created on the root and broadcast to all ranks. Must be called by all ranks of the communicator.
+
+        :param trees: 1) Path to the directory with the .h5 Pactolus fragmentation trees, 2) path to a text file
+            with a list of names of the tree files, or 3) path to the .npy file with the file lookup table
+
+        :return: Numpy array with the file lookup table
+        """
+        start_time = time.time()
+        file_lookup_table = None
+        if mpi_helper.get_rank(comm=self.comm) == self.root:
+            log_helper.debug(__name__, 'Preparing file lookup table')
+            if os.path.isfile(trees) and trees.endswith('.npy'):
+                file_lookup_table = np.load(trees)
+            else:
+                from pactolus import score_frag_dag
+                if os.path.isfile(trees):
+                    with open(trees, 'r') as in_treefile:
+                        tree_files = [line.rstrip('\n') for line in in_treefile]
+                    file_lookup_table = score_frag_dag.make_file_lookup_table_by_MS1_mass(tree_files=tree_files)
+                elif os.path.isdir(trees):
+                    file_lookup_table = score_frag_dag.make_file_lookup_table_by_MS1_mass(path=trees)
+        if mpi_helper.get_size(comm=self.comm) > 1:
+            file_lookup_table = mpi_helper.broadcast(file_lookup_table, comm=self.comm, root=self.root)
+        self.tree_load_time += time.time() - start_time
+        return file_lookup_table
+
+    @staticmethod
+    def select_trees(file_lookup_table, precursor_mz=None, ms1_mass_tol=0, neutralizations=None):
+        """
+        Select the trees that may be scored against spectra with the given precursor m/z values, i.e., trees
+        whose MS1 mass is within the MS1 mass tolerance of a precursor m/z adjusted by any neutralization.
+
+        :param file_lookup_table: Numpy array with the file lookup table with a 'ms1_mass' field
+        :param precursor_mz: The precursor m/z value(s) of the spectra. None to select all trees.
+        :param ms1_mass_tol: Max. difference in Da of the tree parent mass and the MS1 precursor mass
+        :param neutralizations: List of adjustments in Da used to neutralize peaks
+
+        :return: Numpy array with the indices of the selected trees
+        """
+        if precursor_mz is None:
+            return np.arange(file_lookup_table.shape[0])
+        precursor_mz = np.unique(np.asarray(precursor_mz, dtype='float64').ravel())
+        neutralizations = np.asarray(neutralizations if neutralizations is not None else [0],
+                                     dtype='float64').ravel()
+        # Select conservatively by applying each neutralization in both directions
+        adjustments = np.unique(np.concatenate((neutralizations, -neutralizations, [0])))
+        targets = np.sort((precursor_mz[:, np.newaxis] + adjustments[np.newaxis, :]).ravel())
+        if targets.size == 0:
+            return np.zeros((0,), dtype='int')
+        ms1_mass = np.asarray(file_lookup_table['ms1_mass'], dtype='float64')
+        # Compute the distance of each tree to the closest target mass
+        right = np.clip(np.searchsorted(targets, ms1_mass), 0, targets.size - 1)
+        left = np.clip(right - 1, 0, targets.size - 1)
+        distance = np.minimum(np.abs(targets[right] - ms1_mass), np.abs(targets[left] - ms1_mass))
+        return np.where(distance <= np.max(ms1_mass_tol))[0]
+
+    @staticmethod
+    def get_free_bytes(directory):
+        """
+        Get the number of bytes available to the user in the file system of the given directory.
+
+        :param directory: The directory
+
+        :return: Integer with the number of bytes or None if the free space cannot be determined
+        """
+        try:
+            file_system_stats = os.statvfs(directory)
+            return int(file_system_stats.f_bavail * file_system_stats.f_frsize)
+        except (AttributeError, OSError):
+            return None
+
+    @staticmethod
+    def copy_tree(source, destination):
+        """
+        Copy a tree file. The file is copied to a temporary file that is renamed when the copy is
+        complete so that a failed copy (e.g., if the file system is full) never leaves a truncated tree.
+
+        :param source: The name of the tree file
+        :param destination: The name of the copy
+
+        :raises IOError, OSError: If the copy fails. The partial copy is removed.
+        """
+        partial_destination = destination + '.part'
+        try:
+            shutil.copyfile(source, partial_destination)
+            os.rename(partial_destination, destination)
+        except (IOError, OSError):
+            if os.path.exists(partial_destination):
+                os.remove(partial_destination)
+            raise
+
+    def stage(self, file_lookup_table, precursor_mz=None, ms1_mass_tol=0, neutralizations=None):
+        """
+        Copy the trees that may be scored to the node-local store. The ranks of each node share the work of
+        copying the trees. The trees are staged in the order of the file lookup table as long as they fit
+        into the free space of the store and max_bytes. Must be called by all ranks of the communicator.
+
+        :param file_lookup_table: Numpy array with the file lookup table
+        :param precursor_mz: The precursor m/z value(s) of the spectra. None to stage all trees.
+        :param ms1_mass_tol: Max. difference in Da of the tree parent mass and the MS1 precursor mass
+        :param neutralizations: List of adjustments in Da used to neutralize peaks
+
+        :return: Copy of the file lookup table where the filenames of the staged trees refer to the
+            node-local store. Trees that are not staged keep their original filename.
+        """
+        if file_lookup_table.dtype.names is None or \
+                'filename' not in file_lookup_table.dtype.names or \
+                'ms1_mass' not in file_lookup_table.dtype.names:
+            log_helper.warning(__name__, "File lookup table does not define 'filename' and 'ms1_mass'. " +
+                               "Trees will not be cached.", root=self.root, comm=self.comm)
+            return file_lookup_table
+        start_time = time.time()
+        selected_trees = self.select_trees(file_lookup_table=file_lookup_table,
+                                           precursor_mz=precursor_mz,
+                                           ms1_mass_tol=ms1_mass_tol,
+                                           neutralizations=neutralizations)
+        filenames = [str(filename) for filename in file_lookup_table['filename']]
+
+        # Create the node-local store and select the trees that fit into the store
+        self.node_comm = mpi_helper.get_node_comm(comm=self.comm)
+        node_rank = mpi_helper.get_rank(comm=self.node_comm)
+        node_size = mpi_helper.get_size(comm=self.node_comm)
+        store_directory = None
+        if node_rank == 0:
+            cache_directory = self.cache_directory
+            if cache_directory is None and os.path.isdir('/dev/shm'):
+                cache_directory = '/dev/shm'
+            store_directory = tempfile.mkdtemp(prefix='pactolus_trees_', dir=cache_directory)
+            budget = [value for value in (self.get_free_bytes(store_directory), self.max_bytes) if value is not None]
+            if len(budget) > 0:
+                budget = min(budget)
+                staged_bytes = 0
+                fitting_trees = []
+                for tree_index in selected_trees:
+                    try:
+                        tree_bytes = os.path.getsize(filenames[tree_index])
+                    except OSError:
+                        continue
+                    if staged_bytes + tree_bytes <= budget:
+                        staged_bytes += tree_bytes
+                        fitting_trees.append(tree_index)
+                if len(fitting_trees) < len(selected_trees):
+                    log_helper.warning(__name__, "Only " + str(len(fitting_trees)) + " of " +
+                                       str(len(selected_trees)) + " trees fit into the tree cache " +
+                                       store_directory, root=None)
+                selected_trees = np.asarray(fitting_trees, dtype=selected_trees.dtype)
+        if node_size > 1:
+            store_directory, selected_trees = mpi_helper.broadcast((store_directory, selected_trees),
+                                                                   comm=self.node_comm,
+                                                                   root=0)
+        self.store_directory = store_directory
+
+        # Copy the trees. Each rank of the node copies a different subset of the trees.
+        cached_filenames = dict((tree_index, os.path.join(store_directory, str(tree_index) + '_' +
+                                                          os.path.basename(filenames[tree_index])))
+                                for tree_index in selected_trees)
+        self.num_bytes = 0
+        for tree_index in selected_trees[node_rank::node_size]:
+            try:
+                self.copy_tree(filenames[tree_index], cached_filenames[tree_index])
+                self.num_bytes += os.path.getsize(cached_filenames[tree_index])
+            except (IOError, OSError) as error:
+                log_helper.warning(__name__, "Caching of tree " + filenames[tree_index] + " failed: " + str(error),
+                                   root=None)
+        mpi_helper.barrier(comm=self.node_comm)
+
+        # Refer to the cached trees in the file lookup table
+        cached_trees = [tree_index for tree_index in selected_trees if os.path.exists(cached_filenames[tree_index])]
+        for tree_index in cached_trees:
+            filenames[tree_index] = cached_filenames[tree_index]
+        descr = file_lookup_table.dtype.descr
+        filename_dtype = file_lookup_table.dtype['filename']
+        if filename_dtype.kind in ('S', 'U'):
+            # Widen the filename field if necessary to fit the names of the cached trees
+            width = max([len(filename) for filename in filenames] +
+                        [filename_dtype.itemsize // (4 if filename_dtype.kind == 'U' else 1)])
+            descr = [(field[0], filename_dtype.kind + str(width)) + tuple(field[2:])
+                     if field[0] == 'filename' else field
+                     for field in descr]
+        scoring_lookup_table = np.zeros(file_lookup_table.shape, dtype=descr)
+        for name in file_lookup_table.dtype.names:
+            scoring_lookup_table[name] = file_lookup_table[name] if name != 'filename' else filenames
+        self.num_trees = len(cached_trees)
+        self.tree_load_time += time.time() - start_time
+        log_helper.info(__name__, "Cached " + str(self.num_trees) + " of " + str(file_lookup_table.shape[0]) +
+                        " trees in " + store_directory + " in " + str(time.time() - start_time) + "s",
+                        root=self.root, comm=self.comm)
+        return scoring_lookup_table
+
+    def cleanup(self):
+        """
+        Remove the node-local store and free the node communicator. Must be called by all ranks of
+        the communicator.
+        """
+        if self.store_directory is not None:
+            mpi_helper.barrier(comm=self.node_comm)
+            if mpi_helper.get_rank(comm=self.node_comm) == 0:
+                shutil.rmtree(self.store_directory, ignore_errors=True)
+            self.store_directory = None
+        if self.node_comm is not None:
+            self.node_comm.Free()
+            self.node_comm = None
@@ -0,0 +1,247 @@
+"""
+Batched, vectorized implementation of the local peak detection of
+omsi.analysis.findpeaks.third_party.findpeaks. The functions process a block of spectra
+given as a 2D numpy array (one spectrum per row) at once and produce the same peaks as
+applying findpeaks.smoothListGaussian, findpeaks.sliding_window_minimum, and
+findpeaks.peakdet to each spectrum individually. In addition, the module provides
+functions for computing the maximum intensities within integration windows around
+a set of peaks for a block of spectra, as needed to compute global peak cubes.
+"""
+import numpy as np
+from scipy.ndimage import minimum_filter1d
+from omsi.analysis.findpeaks.third_party.findpeaks import findpeaks
+
+
+# Blocks with fewer spectra are processed one spectrum at a time by peakdet since the
+# per-m/z overhead of the vectorized state machine does not pay off for small blocks.
+MIN_VECTORIZED_PEAKDET_SPECTRA = 16
+
+
+def gaussian_kernel(smoothwidth):
+    """
+    Compute the Gaussian smoothing kernel used by findpeaks.smoothListGaussian.
+
+    :param smoothwidth: The smooth width parameter
+
+    :returns: 1D float64 numpy array with the normalized kernel
+    """
+    x = np.array(range(-3*smoothwidth, 3*smoothwidth))
+    kernel = np.exp(-(x**2)/(2.0*float(smoothwidth)**2))
+    return kernel / kernel.sum()
+
+
+def smooth_gaussian(spectra, smoothwidth):
+    """
+    Smooth all spectra with a Gaussian kernel.
+
+    The convolution is performed with np.convolve for each spectrum (rather than with an
+    FFT or scipy.ndimage along the m/z axis of the block) because np.convolve is about as
+    fast and is the only way to guarantee results that are bitwise identical to
+    findpeaks.smoothListGaussian, which in turn is required for identical peaks.
+
+    :param spectra: 2D numpy array with one spectrum per row
+    :param smoothwidth: The smooth width parameter
+
+    :returns: 2D float64 numpy array with the smoothed spectra. As for np.convolve(..., 'same') the
+        length of the spectra is max(spectra.shape[1], 6*smoothwidth).
+    """
+    kernel = gaussian_kernel(smoothwidth)
+    smoothed = np.zeros(shape=(spectra.shape[0], max(spectra.shape[1], kernel.size)), dtype='float64')
+    for index in xrange(spectra.shape[0]):
+        smoothed[index, :] = np.convolve(spectra[index, :], kernel, 'same')
+    return smoothed
+
+
+def sliding_window_minimum(spectra, slwindow):
+    """
+    Compute the sliding window minimum of all spectra, i.e., the value at index i is
+    min(spectrum[max(i - slwindow + 1, 0):i+1]) as for findpeaks.sliding_window_minimum.
+
+    :param spectra: 2D numpy array with one spectrum per row
+    :param slwindow: The size of the sliding window
+
+    :returns: 2D numpy array with the sliding window minimum of each spectrum
+    """
+    if slwindow < 1:
+        raise ValueError('The sliding window must be at least 1')
+    # Place the window such that it ends at the current index. The 'nearest' mode repeats the first
+    # value, which does not change the minimum as the first value is always part of the window.
+    return minimum_filter1d(spectra, size=slwindow, axis=-1, mode='nearest', origin=(slwindow - 1) // 2)
+
+
+def peakdet(spectra, delta):
+    """
+    Detect the maximum peaks of all spectra using the same delta-based algorithm as findpeaks.peakdet.
+
+    A point is considered a maximum peak if it has the maximal value, and was preceded (to the left)
+    by a value lower by delta. The sequential search of findpeaks.peakdet is implemented as a state
+    machine that is advanced for all spectra of the block at once, i.e., we iterate over the m/z axis
+    and evaluate the state updates for all spectra with array operations. To use the same comparisons
+    for the search of maxima and minima, the values of spectra in the search-for-minimum state are
+    negated, which is exact in floating point arithmetic.
+
+    :param spectra: 2D numpy array with one spectrum per row
+    :param delta: The minimum peak height (must be positive)
+
+    :returns: Tuple of three 1D numpy arrays with the spectrum (row) index, the m/z index, and the
+        value of all peaks. The peaks are sorted by spectrum and by m/z index within a spectrum.
+    """
+    if delta <= 0:
+        raise ValueError('Input argument delta must be positive')
+    spectra = np.asarray(spectra, dtype='float64')
+    num_spectra, num_mz = spectra.shape
+    if num_spectra < MIN_VECTORIZED_PEAKDET_SPECTRA:
+        return peakdet_serial(spectra, delta)
+
+    spectra_t = np.ascontiguousarray(spectra.T)
+    sign = np.ones(num_spectra, dtype='float64')   # +1 = search for maximum, -1 = search for minimum
+    extreme = np.zeros(num_spectra, dtype='float64') - np.inf  # Current extreme value (with sign applied)
+    extreme_index = np.zeros(num_spectra, dtype='int64')   # Index of the current extreme value
+    values = np.zeros(num_spectra, dtype='float64')
+    threshold = np.zeros(num_spectra, dtype='float64')
+    mask = np.zeros(num_spectra, dtype='bool')
+    peak_spectrum = []
+    peak_index = []
+    peak_value = []
+    for mz_index in xrange(num_mz):
+        np.multiply(spectra_t[mz_index], sign, out=values)
+        np.greater(values, extreme, out=mask)
+        extreme_index[mask] = mz_index
+        np.fmax(extreme, values, out=extreme)
+        np.subtract(extreme, delta, out=threshold)
+        np.less(values, threshold, out=mask)
+        if mask.any():
+            switch = np.flatnonzero(mask)
+            found_max = switch[sign[switch] > 0]
+            if found_max.size > 0:
+                peak_spectrum.append(found_max)
+                peak_index.append(extreme_index[found_max])
+                peak_value.append(extreme[found_max])
+            sign[switch] *= -1
+            extreme[switch] = spectra_t[mz_index][switch] * sign[switch]
+            extreme_index[switch] = mz_index
+    if len(peak_spectrum) == 0:
+        return np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64'), np.zeros(0, dtype='float64')
+    peak_spectrum = np.concatenate(peak_spectrum)
+    order = np.argsort(peak_spectrum, kind='mergesort')
+    return peak_spectrum[order], np.concatenate(peak_index)[order], np.concatenate(peak_value)[order]
+
+
+def peakdet_serial(spectra, delta):
+    """
+    Detect the peaks of a block one spectrum at a time using findpeaks.peakdet.
+
+    :returns: Same as peakdet
+    """
+    peak_spectrum = []
+    peak_index = []
+    peak_value = []
+    for spectrum_index in xrange(spectra.shape[0]):
+        maxtab = findpeaks(None, spectra[spectrum_index, :], None, None, delta).peakdet()[0]
+        peak_spectrum += [spectrum_index] * len(maxtab)
+        peak_index += [peak[0] for peak in maxtab]
+        peak_value += [peak[1] for peak in maxtab]
+    return (np.asarray(peak_spectrum, dtype='int64'),
+            np.asarray(peak_index, dtype='int64'),
+            np.asarray(peak_value, dtype='float64'))
+
+
+def find_peaks(spectra, smoothwidth, slwindow, peakheight):
+    """
+    Find the local peaks of a block of spectra. This is the batched equivalent of applying
+    findpeaks.smoothListGaussian, subtracting findpeaks.sliding_window_minimum of the smoothed
+    spectrum, and then applying findpeaks.peakdet to each spectrum.
+
+    :param spectra: 2D numpy array with one spectrum per row
+    :param smoothwidth: The smooth width parameter
+    :param slwindow: The size of the sliding window used for background subtraction
+    :param peakheight: The minimum peak height
+
+    :returns: Tuple of three 1D numpy arrays with the spectrum (row) index, the m/z index, and the
+        value of all peaks (see peakdet).
+    """
+    smoothed = smooth_gaussian(spectra, smoothwidth)
+    smoothed -= sliding_window_minimum(smoothed, slwindow)
+    return peakdet(smoothed, peakheight)
+
+
+def get_peak_windows(mzdata, mz_peaks, integration_width):
+    """
+    Compute for each peak the window of m/z indices with np.abs(mzdata - mz_peak) < integration_width.
+
+    The windows are located via np.searchsorted and the window boundaries are then refined using the
+    exact same comparison as above so that the windows are identical to the ones selected via np.where.
+
+    :param mzdata: 1D numpy array with the m/z values sorted in ascending order
+    :param mz_peaks: 1D numpy array with the m/z values of the peaks
+    :param integration_width: The half width of the windows (in m/z)
+
+    :returns: Tuple of two 1D int64 numpy arrays with the start and (exclusive) stop index of each window.
+
+    :raises ValueError: If the m/z values are not sorted or if a window is empty.
+    """
+    mzdata = np.asarray(mzdata)
+    mz_peaks = np.asarray(mz_peaks)
+    if mzdata.size > 1 and np.any(mzdata[1:] < mzdata[:-1]):
+        raise ValueError('The m/z values must be sorted in ascending order')
+    num_mz = mzdata.size
+
+    def in_window(index):
+        """Evaluate the window criterion for the given m/z index of each peak (indices are clipped to the m/z axis)"""
+        index = np.clip(index, 0, max(num_mz - 1, 0))
+        return np.abs(mzdata[index] - mz_peaks) < integration_width
+
+    start = np.searchsorted(mzdata, mz_peaks - integration_width, side='left').astype('int64')
+    stop = np.searchsorted(mzdata, mz_peaks + integration_width, side='right').astype('int64')
+    # Correct the window boundaries for rounding differences between the two criteria. The window
+    # criterion is monotone along the sorted m/z axis, i.e., the windows are contiguous.
+    while True:
+        update = (start > 0) & in_window(start - 1)
+        if not update.any():
+            break
+        start[update] -= 1
+    while True:
+        update = (start < stop) & ~in_window(start)
+        if not update.any():
+            break
+        start[update] += 1
+    while True:
+        update = (stop < num_mz) & in_window(stop)
+        if not update.any():
+            break
+        stop[update] += 1
+    while True:
+        update = (stop > start) & ~in_window(stop - 1)
+        if not update.any():
+            break
+        stop[update] -= 1
+    if np.any(stop <= start):
+        raise ValueError('Empty integration window. The integration_width must be positive.')
+    return start, stop
+
+
+def window_maximum(spectra, start, stop):
+    """
+    Compute for all spectra the maximum within each of the given m/z index windows using a
+    single np.maximum.reduceat call. The windows may overlap.
+
+    :param spectra: 2D numpy array with one spectrum per row
+    :param start: 1D numpy array with the start index of each window
+    :param stop: 1D numpy array with the (exclusive) stop index of each window. All windows must be non-empty.
+
+    :returns: 2D numpy array of shape (number of spectra, number of windows) with the maximum values.
+    """
+    num_spectra, num_mz = spectra.shape
+    if len(start) == 0:
+        return np.zeros(shape=(num_spectra, 0), dtype=spectra.dtype)
+    # reduceat reduces over indices[i]:indices[i+1], i.e., the maximum of the windows are given by
+    # every other result. As indices must be smaller than num_mz, we clip windows that end at the end
+    # of the m/z axis and add the last m/z value of those windows separately.
+    indices = np.empty(2 * len(start), dtype='int64')
+    indices[0::2] = start
+    indices[1::2] = np.minimum(stop, num_mz - 1)
+    result = np.maximum.reduceat(spectra, indices, axis=1)[:, 0::2]
+    at_end = (np.asarray(stop) == num_mz) & (np.asarray(start) < num_mz - 1)
+    if at_end.any():
+        result[:, at_end] = np.maximum(result[:, at_end], spectra[:, num_mz - 1:num_mz])
+    return result
@@ -3,6 +3,7 @@ Global peak finder computing peaks and associated ion-images
 for the full MSI data.
 """
 from omsi.analysis.base import analysis_base
+import omsi.shared.mpi_helper as mpi_helper
 from omsi.shared.log import log_helper
 
 class omsi_findpeaks_global(analysis_base):
@@ -55,6 +56,18 @@ class omsi_findpeaks_global(analysis_base):
                            default=3,
                            group=groups['settings'],
                            required=True)
+        self.add_parameter(name='max_block_bytes',
+                           help='Maximum number of bytes of the blocks of spectra processed at once',
+                           dtype=dtypes['int'],
+                           default=256*1024*1024,
+                           group=groups['settings'],
+                           required=False)
+        self.add_parameter(name='num_io_threads',
+                           help='Number of threads used to prefetch blocks of data. Set to 0 to disable prefetching.',
+                           dtype=dtypes['int'],
+                           default=1,
+                           group=groups['parallel'],
+                           required=False)
         self.data_names = ['peak_cube',
                            'peak_mz']
 
@@ -188,9 +201,18 @@ class omsi_findpeaks_global(analysis_base):
     def execute_analysis(self):
         """
         Execute the global peak finding for the given msidata and mzdata.
+
+        The data is processed in two streaming passes over blocks of complete spectra that are aligned
+        with the chunking of the input data (see omsi.shared.data_blocks), i.e., the memory used is
+        bounded by max_block_bytes (and the size of the peak cube) rather than by the size of the data.
+        The first pass accumulates the mean spectrum, which is then used to detect the peaks. The second
+        pass computes for each block the maximum intensity within the integration window of each peak.
+        When running with MPI the blocks are distributed across all ranks and the peak cube is
+        collected on the root rank.
         """
         # Make sure all imports are here
-        from omsi.analysis.findpeaks.third_party.findpeaks import findpeaks
+        from omsi.analysis.findpeaks import findpeaks_batch
+        import omsi.shared.data_blocks as data_blocks
         import numpy as np
 
         # Copy parameters to local variables for convenience
@@ -200,80 +222,65 @@ class omsi_findpeaks_global(analysis_base):
         peakheight = self['peakheight']
         slwindow = self['slwindow']
         smoothwidth = self['smoothwidth']
+        max_block_bytes = self['max_block_bytes']
+        num_io_threads = self['num_io_threads']
 
-        # Load the input data
-        data = msidata[:]
         # Ensure the our MSI dataset has sufficient numbers of dimensions
         if len(msidata.shape) == 1:
-            data = data[:][np.newaxis, np.newaxis, :]
+            msidata = msidata[:][np.newaxis, np.newaxis, :]
         elif len(msidata.shape) == 2:
-            data = data[:][np.newaxis, :]
-
-        # Determine the data dimensions
-        shape_x, shape_y, shape_z = data.shape
-        # Linearize the spectral data
-        processed_msidata = data.reshape(shape_x*shape_y, shape_z)
-        # Compute the average spectrum
-        processed_msidata = np.mean(processed_msidata, axis=0)
-        # Find peaks in the average spectrum
-
-        # REMOVED 20140429
-        findpeaks_data = findpeaks(mzdata[:],
-                                   processed_msidata,
-                                   smoothwidth,
-                                   slwindow,
-                                   peakheight)
-        processed_msidata = findpeaks_data.smoothListGaussian()
+            msidata = msidata[:][np.newaxis, :]
 
-        # from the smoothed spectra subtract a sliding minima
+        # Use the copy of the data best suited for reading the full data
+        if hasattr(msidata, 'get_scan_dataset'):
+            msidata = msidata.get_scan_dataset(max_bytes=max_block_bytes)
 
-        # REMOVED 20140429
-        findpeaks_data = findpeaks(mzdata[:],
-                                   processed_msidata,
-                                   smoothwidth,
-                                   slwindow,
-                                   peakheight)
-        slmin = [x for x in findpeaks_data.sliding_window_minimum()]
-        processed_msidata = processed_msidata - slmin
+        # Determine the data dimensions and the blocks to be processed by the current rank
+        shape_x, shape_y, shape_z = msidata.shape
+        blocks = data_blocks.get_chunk_aligned_blocks(shape=(shape_x, shape_y, shape_z),
+                                                      chunks=data_blocks.get_chunk_shape(msidata),
+                                                      itemsize=np.dtype(msidata.dtype).itemsize,
+                                                      max_bytes=max_block_bytes)
+        use_mpi = mpi_helper.get_size(comm=self.mpi_comm) > 1
+        rank = mpi_helper.get_rank(comm=self.mpi_comm)
 
-        # find peaks in the smoothed, background subtracted spectra
-        findpeaks_data = findpeaks(mzdata[:],
-                                   processed_msidata,
-                                   smoothwidth,
-                                   slwindow,
-                                   peakheight)
-        [pkmax, pkmin] = findpeaks_data.peakdet()
-        xval_peak = [x[0] for x in pkmax]
-        yval_peak = [x[1] for x in pkmax]
-        pks = np.asarray(pkmax)
-        mz_peaks = mzdata[pks[:, 0].astype(int)]
-        flat_data = data.reshape(shape_x*shape_y, shape_z)
-        peak_cube = np.zeros((shape_x*shape_y, mz_peaks.shape[0]))
-        for i in range(len(mz_peaks)):
-            xx = np.where(np.abs(mzdata - mz_peaks[i]) < integration_width)
-            peak_cube[:, i] = np.amax(flat_data[:, xx[0]], 1)
-        peak_cube = peak_cube.reshape(shape_x, shape_y, len(mz_peaks))
-        # integrate peaks +/- integration_width bins around each of the peaks found in the total spectra
-        # TODO : THIS LOOP NEEDS TO BE CONVERTED TO A MAX INSTEAD OF A SUM
-        # im = data[:,:,xp]
-        # im = im*0.0;
-        # xp = np.array(xp)
-        # for i in range(-integration_width,integration_width):
-        #     idx = xp+i
-        #     try:
-        #         im = im + data[:,:,idx]
-        #     except IndexError:
-        #         pass
+        # Pass 1: Compute the average spectrum
+        mean_spectrum = data_blocks.reduce_data(data=msidata,
+                                                op='mean',
+                                                axis=(0, 1),
+                                                blocks=blocks,
+                                                num_threads=num_io_threads,
+                                                comm=self.mpi_comm if use_mpi else None,
+                                                root=self.mpi_root)
+        if use_mpi:
+            blocks = blocks[rank::mpi_helper.get_size(comm=self.mpi_comm)]
 
-        # Add the analysis results and parameters to the analysis data so that it can be accessed and written to file
-        # We here convert the single scalars to 1D numpy arrays to ensure consistency. The data write function can
-        # handle also a large range of python built_in types by converting them to numpy for storage in HDF5 but
-        # to ensure a consistent behavior we convert the values directly here
+        # Find peaks in the smoothed, background subtracted average spectrum
+        peak_index = findpeaks_batch.find_peaks(spectra=mean_spectrum[np.newaxis, :],
+                                                smoothwidth=smoothwidth,
+                                                slwindow=slwindow,
+                                                peakheight=peakheight)[1]
+        mz_peaks = mzdata[peak_index]
 
-        # Clean up the biggest chunks of memory we allocated when we potentially loaded the data from file
-        del data
-        del processed_msidata
-        del flat_data
+        # Pass 2: Compute the peak cube, i.e., the maximum intensity within
+        # +/- integration_width around each of the peaks found in the average spectrum
+        window_start, window_stop = findpeaks_batch.get_peak_windows(mzdata=mzdata,
+                                                                     mz_peaks=mz_peaks,
+                                                                     integration_width=integration_width)
+        block_results = []
+        for block, block_data in data_blocks.iterate_blocks(msidata, blocks, num_threads=num_io_threads):
+            block_maxima = findpeaks_batch.window_maximum(spectra=block_data.reshape((-1, shape_z)),
+                                                          start=window_start,
+                                                          stop=window_stop)
+            block_results.append((block[0:2], block_maxima.reshape(block_data.shape[0:2] + (len(mz_peaks), ))))
+        if use_mpi:
+            block_results = mpi_helper.gather(block_results, comm=self.mpi_comm, root=self.mpi_root)
+            if rank != self.mpi_root:
+                return None, mz_peaks
+            block_results = [result for rank_results in block_results for result in rank_results]
+        peak_cube = np.zeros((shape_x, shape_y, len(mz_peaks)))
+        for block, block_maxima in block_results:
+            peak_cube[block] = block_maxima
 
         # Save the analysis data to the __data_list so that the data can be
         # saved automatically by the omsi HDF5 file API
@@ -4,6 +4,7 @@ Local peak finding analysis module.
 
 from omsi.analysis.base import analysis_base
 import omsi.shared.mpi_helper as mpi_helper
+import omsi.shared.process_helper as process_helper
 from omsi.shared.log import log_helper
 
 class omsi_findpeaks_local(analysis_base):
@@ -62,6 +63,28 @@ class omsi_findpeaks_local(analysis_base):
                            required=True,
                            group=groups['settings'],
                            default=False)
+        self.add_parameter(name='max_block_bytes',
+                           help='Maximum number of bytes used for processing a block of spectra at once',
+                           dtype=int,
+                           default=256*1024*1024,
+                           group=groups['settings'],
+                           required=False)
+        self.add_parameter(name='backend',
+                           help='Parallel backend used to execute the analysis. mpi: Use MPI when running with ' +
+                                'more than one MPI rank. processes: Use a pool of processes on the current node. ' +
+                                'serial: Execute the analysis in serial.',
+                           dtype=str,
+                           required=False,
+                           choices=process_helper.BACKENDS.values(),
+                           group=groups['parallel'],
+                           default=process_helper.BACKENDS['MPI'])
+        self.add_parameter(name='num_processes',
+                           help='Number of processes used by the processes backend. Set to 0 to use one ' +
+                                'process per CPU.',
+                           dtype=dtypes['int'],
+                           required=False,
+                           group=groups['parallel'],
+                           default=0)
         self.add_parameter(name='schedule',
                            help='Scheduling to be used for parallel MPI runs',
                            dtype=str,
@@ -69,12 +92,31 @@ class omsi_findpeaks_local(analysis_base):
                            choices=mpi_helper.parallel_over_axes.SCHEDULES.values(),
                            group=groups['parallel'],
                            default=mpi_helper.parallel_over_axes.SCHEDULES['DYNAMIC'])
+        self.add_parameter(name='schedule_block_size',
+                           help='Number of spectra per task for DYNAMIC parallel scheduling. Set to 0 to use ' +
+                                'one chunk of the data per task.',
+                           dtype=dtypes['int'],
+                           required=False,
+                           group=groups['parallel'],
+                           default=1)
         self.add_parameter(name='collect',
                            help='Collect results to the MPI root rank when running in parallel',
                            dtype=dtypes['bool'],
                            required=False,
                            group=groups['parallel'],
                            default=True)
+        self.add_parameter(name='shard_file',
+                           help='HDF5 file used to collect the results when running in parallel. Each rank ' +
+                                'writes its results to a separate shard file next to the given file and the ' +
+                                'shards are combined via virtual datasets in the given file instead of ' +
+                                'gathering the results on the MPI root rank. The results on the root are then ' +
+                                'h5py.Datasets of the file, i.e., the file stays open for reading until the ' +
+                                'analysis is executed again or deleted. Requires HDF5 1.10 and h5py 2.9.',
+                           dtype=str,
+                           required=False,
+                           group=groups['parallel'],
+                           default=None)
+        self.__shard_file = None  # The open shard_file with the combined results on the MPI root
         self.data_names = ['peak_mz',
                            'peak_value',
                            'peak_arrayindex',
@@ -335,7 +377,8 @@ class omsi_findpeaks_local(analysis_base):
 
         """
         # Make sure needed imports are available
-        from omsi.analysis.findpeaks.third_party.findpeaks import findpeaks
+        from omsi.analysis.findpeaks import findpeaks_batch
+        import omsi.shared.data_blocks as data_blocks
         import numpy as np
 
         # Assign parameters to local variables for convenience
@@ -352,83 +395,105 @@ class omsi_findpeaks_local(analysis_base):
             import sys
 
         #############################################################
-        # Parallel execution using MPI
+        # Parallel execution using MPI or a process pool
         #############################################################
         # We have more than a single core AND we have multiple spectra to process
-        if mpi_helper.get_size() > 1 and len(self['msidata'].shape) > 1:
+        use_mpi = self['backend'] == process_helper.BACKENDS['MPI']
+        if process_helper.use_parallel_backend(self['backend'], self['num_processes'], comm=self.mpi_comm) and \
+                len(self['msidata'].shape) > 1:
             # We were not asked to process a specific data subblock from a parallel process
             # but we need to initiate the parallel processing.
             if msidata_subblock is None:
-                # Setup the parallel processing using mpi_helper.parallel_over_axes
+                # Setup the parallel processing using mpi_helper.parallel_over_axes or a process pool
                 split_axis = range(len(self['msidata'].shape)-1)  # The axes along which we can split the data
-                scheduler = mpi_helper.parallel_over_axes(task_function=self.execute_analysis,  # Execute this function
-                                                          task_function_params={},              # No added parameters
-                                                          main_data=msidata,                    # Process the msidata
-                                                          split_axes=split_axis,                # Split along axes
-                                                          main_data_param_name='msidata_subblock',  # data input param
-                                                          root=self.mpi_root,                   # The root MPI task
-                                                          schedule=self['schedule'],            # Parallel schedule
-                                                          comm=self.mpi_comm)                   # MPI communicator
+                block_size = self['schedule_block_size'] if self['schedule_block_size'] > 0 else \
+                    mpi_helper.parallel_over_axes.BLOCK_SIZES['CHUNK']
+                scheduler = process_helper.create_scheduler(backend=self['backend'],          # Parallel backend
+                                                            num_processes=self['num_processes'],  # Pool size
+                                                            task_function=self.execute_analysis,  # Execute this
+                                                            task_function_params={},              # No added params
+                                                            main_data=msidata,                    # Process msidata
+                                                            split_axes=split_axis,                # Split along axes
+                                                            main_data_param_name='msidata_subblock',  # input param
+                                                            root=self.mpi_root,                   # The root MPI task
+                                                            schedule=self['schedule'],            # Parallel schedule
+                                                            comm=self.mpi_comm,                   # MPI communicator
+                                                            block_size=block_size,                # Task granularity
+                                                            checkpoint=self.get_block_checkpoint())  # Checkpoint
                 # Execute the analysis in parallel
                 result = scheduler.run()
-                # Collect the output data to the root rank if requested
+                # Collect the block information to the root rank if requested. The results are collected
+                # after they have been compiled on each rank to avoid pickling all result arrays.
                 if self['collect']:
-                    result = scheduler.collect_data()
-
-                # TODO Record runtime information data from the scheduler in our provenance data
-                # self.run_info['SCHEDULER_blocks'] = scheduler.blocks
-                # self.run_info['SCHEDULER_block_times'] = scheduler.block_times
-                # self.run_info['SCHEDULER_run_time'] = scheduler.run_time
-                # self.run_info['SCHEDULER_schedule'] = scheduler.schedule
-
-                # Compile the data from the parallel execution
-                # Case Table:
-                #
-                # collect + worker       2
-                #           worker       2
-                # collect + root         3
-                #           root         1
-                use_dynamic_schedule = (self['schedule'] == mpi_helper.parallel_over_axes.SCHEDULES['DYNAMIC'])
-                # Case 1: root rank without collect data disabled
-                if mpi_helper.get_rank() == self.mpi_root and not self['collect']:
-                    # We did not process any data on the root if DYNAMIC scheduling was used
-                    if use_dynamic_schedule:
-                        return None, None, None, mzdata
-                    # We processed a data block using dynamic scheduling
-                    else:
-                        return result[0][0]
-                # Case 2: Compile the data on the worker
-                elif mpi_helper.get_rank() != self.mpi_root: # and use_dynamic_schedule:
-                    # Compile the results from all processing task (on workers) or from all workers (on the root)
+                    scheduler.collect_data(collect_results=False)
+
+                # Record runtime information data from the scheduler in our provenance data
+                self.run_info['SCHEDULER_block_times'] = np.asarray(scheduler.block_times)
+                self.run_info['SCHEDULER_run_time'] = scheduler.run_time
+                self.run_info['SCHEDULER_schedule'] = scheduler.schedule
+
+                # Compile the data from the parallel execution. All ranks (including the root) process
+                # data blocks, i.e., each rank compiles the results of its blocks. Each block was processed
+                # as a separate dataset, i.e., the pixel indices start at 0 for each block and need to be
+                # corrected by the start of the block along the split axes and the peak indices need to be
+                # corrected by the number of peaks of the preceding blocks.
+                num_peaks = np.cumsum([0] + [len(ri[0]) for ri in result[0]])
+                num_pixels = np.cumsum([0] + [len(ri[2]) for ri in result[0]])
+                if len(result[0]) > 0:
                     peak_mz = np.concatenate(tuple([ri[0] for ri in result[0]]), axis=-1)
                     peak_values = np.concatenate(tuple([ri[1] for ri in result[0]]), axis=-1)
-                    if len(result[1])>1: # Correct indices from the individual runs since they all start at 0
-                        peak_arrayindex = np.asarray([ [b[0], b[1], 0] for b in result[1] ])
-                        peak_arrayindex[:,2] = np.cumsum([0] + [ len(ri[0]) for ri in result[0] ])[:-1]
-                    else:
-                        peak_arrayindex = result[0][0][2]
-                    mzdata = result[0][0][3]
-                    return peak_mz, peak_values, peak_arrayindex, mzdata
-                # Case 3: Compile collected data on the root
-                elif mpi_helper.get_rank() == self.mpi_root: # and use_dynamic_schedule:
-                    # Compile the results from all processing task (on workers) or from all workers (on the root)
-                    peak_mz = np.concatenate(tuple([ri[0] for ri in result[0]]), axis=-1)
-                    peak_values = np.concatenate(tuple([ri[1] for ri in result[0]]), axis=-1)
-                    # Dynamic scheduling uses selections of (int,int,slice) while the static
-                    # scheduling uses (slice, slice, slice), hence we need to compile the peak_arrayindex
-                    # slightly differently depending on the scheduler used
-                    if use_dynamic_schedule:
-                        peak_arrayindex = np.asarray([ [b[0], b[1], 0] for b in result[1]])
-                        peak_arrayindex[:,2] = np.cumsum([0] + [ len(ri[0]) for ri in result[0]])[:-1]
-                    else:
-                        peak_arrayindex = np.concatenate(tuple([ri[2] for ri in result[0]]), axis=0)
-                        d = np.cumsum([0] + [len(ri[0]) for ri in result[0]])
-                        d2 = np.cumsum([0] + [len(ri[2]) for ri in result[0]])
-                        for di in range(len(d2)-1):
-                            peak_arrayindex[d2[di]:d2[di+1], 2] += d[di]
+                    peak_arrayindex = np.concatenate(tuple([ri[2] for ri in result[0]]), axis=0)
                     mzdata = result[0][0][3]
+                else:
+                    peak_mz = np.zeros(shape=(0,), dtype='int64')
+                    peak_values = np.zeros(shape=(0,), dtype='float64')
+                    peak_arrayindex = np.zeros(shape=(0, 3), dtype='int64')
+                    mzdata = mzdata[:]
+                for block_index, block_selection in enumerate(result[1]):
+                    block_pixels = slice(num_pixels[block_index], num_pixels[block_index+1])
+                    # The serial code treats 2D data as a single row of spectra, i.e., the last split
+                    # axis corresponds to column 1 of the peak_arrayindex
+                    for axis_index, column_index in zip(split_axis[::-1], [1, 0]):
+                        axis_selection = block_selection[axis_index]
+                        axis_start = axis_selection.start if isinstance(axis_selection, slice) else axis_selection
+                        peak_arrayindex[block_pixels, column_index] += (axis_start or 0)
+                    peak_arrayindex[block_pixels, 2] += num_peaks[block_index]
+                # All results of the process pool are already available in the current process
+                if not self['collect'] or not use_mpi:
                     return peak_mz, peak_values, peak_arrayindex, mzdata
 
+                # Collect the compiled data. The peak indices are corrected by the number of peaks of the
+                # preceding ranks so that the data of all ranks can be concatenated directly.
+                rank_num_peaks = self.mpi_comm.allgather(peak_mz.size)
+                peak_arrayindex[:, 2] += sum(rank_num_peaks[0:mpi_helper.get_rank(comm=self.mpi_comm)])
+                if self['shard_file']:
+                    # Close the file with the results of a previous execution before the file is updated
+                    if self.__shard_file is not None:
+                        self.__shard_file.close()
+                        self.__shard_file = None
+                    # Write the data of each rank to its shard and combine the shards via virtual datasets
+                    for data_name, data in zip(self.data_names[0:3], (peak_mz, peak_values, peak_arrayindex)):
+                        mpi_helper.write_virtual_dataset(data=data,
+                                                         filename=self['shard_file'],
+                                                         dataset_name=data_name,
+                                                         comm=self.mpi_comm,
+                                                         root=self.mpi_root)
+                    if mpi_helper.get_rank(comm=self.mpi_comm) == self.mpi_root:
+                        # Keep the combined data out-of-core. The outputs are the virtual datasets, i.e., the
+                        # file stays open (read-only) until the analysis is executed again or deleted. When the
+                        # analysis is saved, the data is copied blockwise to the analysis group.
+                        import h5py
+                        self.__shard_file = h5py.File(self['shard_file'], 'r')
+                        peak_mz, peak_values, peak_arrayindex = [self.__shard_file[data_name]
+                                                                 for data_name in self.data_names[0:3]]
+                else:
+                    # Gather the data into preallocated arrays on the root
+                    collected = [mpi_helper.gather_array(data, comm=self.mpi_comm, root=self.mpi_root)[0]
+                                 for data in (peak_mz, peak_values, peak_arrayindex)]
+                    if mpi_helper.get_rank(comm=self.mpi_comm) == self.mpi_root:
+                        peak_mz, peak_values, peak_arrayindex = collected
+                return peak_mz, peak_values, peak_arrayindex, mzdata
+
 
         #############################################################
         # Serial processing of the current data block
@@ -442,53 +507,46 @@ class omsi_findpeaks_local(analysis_base):
         # Determine the data dimensions
         shape_x = msidata.shape[0]
         shape_y = msidata.shape[1]
-
-        peak_mz = []      # The x values for all peaks, stored in a linear array
-        peak_values = []    # The y values for all peaks, stored in a linear array
+        num_mz = msidata.shape[2]
+
+        # Process the spectra in blocks that are aligned with the chunking of the data. The batch engine
+        # needs about 4 float64 values per m/z value and spectrum for the intermediate results.
+        blocks = data_blocks.get_chunk_aligned_blocks(shape=(shape_x, shape_y, num_mz),
+                                                      chunks=data_blocks.get_chunk_shape(msidata),
+                                                      itemsize=32,
+                                                      max_bytes=self['max_block_bytes'])
+        block_peaks = []
+        num_processed = 0
+        for block, block_data in data_blocks.iterate_blocks(msidata, blocks, num_threads=0):
+            if print_status:
+                sys.stdout.write("[" + str(int(100. * float(num_processed)/float(shape_x*shape_y))) + "%]" + "\r")
+                sys.stdout.flush()
+            block_x, block_y = np.meshgrid(np.arange(block[0].start, block[0].stop),
+                                           np.arange(block[1].start, block[1].stop),
+                                           indexing='ij')
+            block_pixels = (block_x * shape_y + block_y).reshape(-1)
+            spectrum_index, mz_index, values = findpeaks_batch.find_peaks(
+                spectra=block_data.reshape((block_pixels.size, block_data.shape[2])),
+                smoothwidth=smoothwidth,
+                slwindow=slwindow,
+                peakheight=peakheight)
+            block_peaks.append((block_pixels[spectrum_index], mz_index, values))
+            num_processed += block_pixels.size
+
+        # Compile the peaks of all blocks, sorted by pixel index and by m/z index within a pixel
+        peak_pixel = np.concatenate([peaks[0] for peaks in block_peaks])
+        order = np.argsort(peak_pixel, kind='mergesort')
+        peak_mz = np.concatenate([peaks[1] for peaks in block_peaks])[order]
+        peak_values = np.concatenate([peaks[2] for peaks in block_peaks])[order]
+        if peak_mz.size == 0:
+            peak_mz = np.asarray([])
+            peak_values = np.asarray([])
         # List describing for each pixel the start index where its peaks
         # are stored in the peaks_MZ and peaks_values array
         peak_arrayindex = np.zeros(shape=(shape_x*shape_y, 3), dtype='int64')
-        current_index = long(0)
-        pixel_index = 0
-        for xi in xrange(0, shape_x):
-            for yi in xrange(0, shape_y):
-                if print_status:
-                    sys.stdout.write("[" + str(int(100. * float(pixel_index)/float(shape_x*shape_y))) + "%]" + "\r")
-                    sys.stdout.flush()
-
-                # Load the spectrum
-                y = msidata[xi, yi, :]
-                # Find peaks in the spectrum
-                peak_finder = findpeaks(mzdata[:],
-                                        y,
-                                        smoothwidth,
-                                        slwindow,
-                                        peakheight)
-                y = peak_finder.smoothListGaussian()
-                # from the smoothed spectra subtract a sliding minima
-                peak_finder = findpeaks(mzdata[:],
-                                        y,
-                                        smoothwidth,
-                                        slwindow,
-                                        peakheight)
-                slmin = [x for x in peak_finder.sliding_window_minimum()]
-                y = y - slmin
-                # find peaks in the smoothed, background subtracted spectra
-                peak_finder = findpeaks(mzdata[:],
-                                        y,
-                                        smoothwidth,
-                                        slwindow,
-                                        peakheight)
-                [pkmax, pkmin] = peak_finder.peakdet()
-                xp = [x[0] for x in pkmax]
-                yp = [x[1] for x in pkmax]
-                peak_mz = peak_mz + xp
-                peak_values = peak_values + yp
-                peak_arrayindex[pixel_index, 0] = xi
-                peak_arrayindex[pixel_index, 1] = yi
-                peak_arrayindex[pixel_index, 2] = current_index
-                pixel_index += 1
-                current_index += len(yp)
+        peak_arrayindex[:, 0] = np.repeat(np.arange(shape_x), shape_y)
+        peak_arrayindex[:, 1] = np.tile(np.arange(shape_y), shape_x)
+        peak_arrayindex[1:, 2] = np.cumsum(np.bincount(peak_pixel, minlength=shape_x*shape_y))[:-1]
 
         # Add the analysis results and parameters to the anlaysis data so that it can be accessed and written to file
         # We here convert the single scalars to 1D numpy arrays to ensure consistency. The data write function can
@@ -497,7 +555,7 @@ class omsi_findpeaks_local(analysis_base):
 
         # Save the analysis data to the __data_list so that the data can be
         # saved automatically by the omsi HDF5 file API
-        return np.asarray(peak_mz), np.asarray(peak_values), peak_arrayindex, mzdata[:]
+        return peak_mz, peak_values, peak_arrayindex, mzdata[:]
 
 if __name__ == "__main__":
     from omsi.workflow.driver.cl_analysis_driver import cl_analysis_driver
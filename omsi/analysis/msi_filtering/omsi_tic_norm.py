@@ -7,6 +7,7 @@ import numpy as np
 
 from omsi.analysis.base import analysis_base
 from omsi.shared.log import log_helper
+import omsi.shared.data_blocks as data_blocks
 
 
 ###############################################################
@@ -52,6 +53,18 @@ class omsi_tic_norm(analysis_base):
                            required=False,
                            group=groups['settings'],
                            default=None)
+        self.add_parameter(name='max_block_bytes',
+                           help='Maximum number of bytes of the blocks of spectra processed at once',
+                           dtype=dtypes['int'],
+                           required=False,
+                           group=groups['settings'],
+                           default=256*1024*1024)
+        self.add_parameter(name='num_io_threads',
+                           help='Number of threads used to prefetch blocks of data. Set to 0 to disable prefetching.',
+                           dtype=dtypes['int'],
+                           required=False,
+                           group=groups['parallel'],
+                           default=1)
 
         self.data_names = ['norm_msidata', 'norm_mz']
         self.analysis_identifier = name_key
@@ -61,9 +74,12 @@ class omsi_tic_norm(analysis_base):
         Normalize the data based on the total intensity of a spectrum or the
         intensities of a select set of ions.
 
-        Calculations are performed using a memory map approach to avoid loading
-        all data into memory. TIC normalization can as such be performed even
-        on large files (assuming sufficient disk space).
+        The data is processed in two streaming passes over blocks of complete spectra that are aligned
+        with the chunking of the input data (see omsi.shared.data_blocks). The first pass computes the
+        normalization factors and the maximum intensity of each spectrum. The second pass normalizes
+        the data one block at a time and writes the result to a memory map in a temporary file, i.e.,
+        TIC normalization can be performed even on large files (assuming sufficient disk space).
+        Optionally, a thread pool is used to read the next blocks while the current block is processed.
 
         Keyword Arguments:
 
@@ -73,15 +89,23 @@ class omsi_tic_norm(analysis_base):
         :param maxCount: ...
         :param mzTol: ...
         :param infIons: List of informative ions
+        :param max_block_bytes: Maximum number of bytes of a data block
+        :param num_io_threads: Number of threads used to prefetch data blocks
 
         """
         # Setting Default Values and retrieving parameter data
-        nx, ny, nz = self['msidata'].shape
+        msidata = self['msidata']
+        nx, ny, nz = msidata.shape
         try:
             ion_list = self['infIons']
         except KeyError:
             ion_list = None
         mzdata = self['mzdata'][:]
+        max_block_bytes = self['max_block_bytes']
+        num_io_threads = self['num_io_threads']
+        # Use the copy of the data best suited for reading the full data
+        if hasattr(msidata, 'get_scan_dataset'):
+            msidata = msidata.get_scan_dataset(max_bytes=max_block_bytes)
 
         # Compute the mz values to be used for normalization
         if ion_list is not None:
@@ -89,23 +113,27 @@ class omsi_tic_norm(analysis_base):
             for ion in ion_list:
                 temp = np.where(abs(mzdata-ion) <= self['mzTol'])
                 idx_mz = np.concatenate([idx_mz, temp[0]])
-            idx_mz = idx_mz.astype(int)
+            idx_mz = np.unique(idx_mz.astype(int))
         else:
-            idx_mz = range(nz)
-
-        output_filename = TemporaryFile()  # Create a temporary file to compute the normalization out-of-core
-        idx = np.linspace(0, nx, 20, dtype='int')  # Divide the data into chunks in x to process the data in blocks
-
-        # Compute the normalization factors and column maxs first (computed one-block-at-a-time)
-        tic_norm_factors = np.zeros(shape=(nx, ny), dtype='float')
-        msi_spectrum_maxs = np.zeros(shape=(nx, ny), dtype=self['msidata'].dtype)
-        for i in range(len(idx)-1):  # Process the data one-block-at-a-time
-            current_data = self['msidata'][idx[i]:idx[i+1], :, idx_mz]
-            tic_norm_factors[idx[i]:idx[i+1], :] = np.sum(current_data, 2)
-            msi_spectrum_maxs[idx[i]:idx[i+1], :] = np.amax(current_data[:, :, idx_mz], 2)
-            del current_data
+            idx_mz = slice(None)
+
+        # Divide the data into blocks of complete spectra that are aligned with the chunking of the data
+        blocks = data_blocks.get_chunk_aligned_blocks(shape=(nx, ny, nz),
+                                                      chunks=data_blocks.get_chunk_shape(msidata),
+                                                      itemsize=np.dtype(msidata.dtype).itemsize,
+                                                      max_bytes=max_block_bytes)
+        log_helper.debug(__name__, "Number of data blocks: " + str(len(blocks)))
+
+        # Compute the normalization factors and spectrum maxs first (computed one-block-at-a-time)
+        tic_norm_factors, msi_spectrum_maxs = data_blocks.reduce_data(data=msidata,
+                                                                      op=['sum', 'max'],
+                                                                      axis=2,
+                                                                      last_axis_selection=idx_mz,
+                                                                      blocks=blocks,
+                                                                      num_threads=num_io_threads)
+        tic_norm_factors = tic_norm_factors.astype('float')
         non_zero_tic = tic_norm_factors > 0
-        mean_tic_norm = float(tic_norm_factors[non_zero_tic].mean())
+        mean_tic_norm = float(tic_norm_factors[non_zero_tic].mean()) if np.any(non_zero_tic) else 0.0
         tic_norm_factors[non_zero_tic] = 1.0 / (tic_norm_factors[non_zero_tic] / mean_tic_norm)
 
         # Determine the output data format
@@ -117,46 +145,27 @@ class omsi_tic_norm(analysis_base):
             outformat = 'uint32'
         log_helper.debug(__name__, "Output format: " + str(outformat))
 
+        # Create the output memory map. The memory map remains valid after the temporary file is closed.
+        output_file = TemporaryFile()
+        norm_msidata = np.memmap(output_file, dtype=outformat, mode='w+', shape=(nx, ny, nz))
+        output_file.close()
+
         # Normalize the data one-block-at-a-time
-        for i in range(len(idx)-1):
-            num_spectra_x = idx[i+1]-idx[i]
-            # Load the data for the current block amd reshape it
-            current_data = self['msidata'][idx[i]:idx[i+1], :, :].reshape(num_spectra_x*ny, nz)
-            tip = tic_norm_factors[idx[i]:idx[i+1], :].reshape(num_spectra_x*ny)
-            mip = msi_spectrum_maxs[idx[i]:idx[i+1], :].reshape(num_spectra_x*ny)
-            idx_thresh = np.where(np.logical_and(mip >= self['maxCount'], tip > 0))
-            current_out_norm = np.zeros(current_data.shape)
-            if len(idx_thresh[0]) > 0:
-                current_out_norm[idx_thresh[0], :] = \
-                    np.around(np.multiply(current_data[idx_thresh[0], :],
-                                          tip.astype(float)[idx_thresh[0]][:, np.newaxis]))
-                # Write the data to the temporary file
-                ofp = np.memmap(output_filename, dtype=outformat, mode='w+', shape=(nx, ny, nz))
-                ofp[idx[i]:idx[i+1], :, :] = current_out_norm.reshape(num_spectra_x, ny, nz)
-                del ofp
-
-        # for i in range(len(idx)-1): # Process the data one-block-at-a-time
-        #     print "Current block: " +  str((idx[i], idx[i+1]))
-        #     current_data = self['msidata'][idx[i]:idx[i+1], :, :]   # Load the data for the current block
-        #     num_spectra = idx[i+1]-idx[i]  # Number of spectra in the current data block
-        #     current_data = current_data.reshape(num_spectra*ny, nz)  # Reshape the data to a 2D array
-        #     tip = np.sum(current_data[:, idx_mz], 1)   # Compute the sum of intensities per spectrum
-        #     mip = np.amax(current_data[:, idx_mz], 1)  # Compute the maximum value per spectrum
-        #     idx_thresh = np.where((mip >= self['maxCount']) & (tip > 0))
-        #     current_out_norm = np.zeros(current_data.shape)  # The normalized data for the current block
-        #     if len(idx_thresh[0]) > 0:
-        #         # tic normalize the data for the current block
-        #         current_out_norm[idx_thresh[0], :] = np.divide(current_data[idx_thresh[0], :],
-        #                                                        tip.astype(float)[idx_thresh[0]][:, np.newaxis])
-        #         # Write the data to the temporary file
-        #         ofp = np.memmap(output_filename, dtype='float', mode='w+', shape=(nx, ny, nz))
-        #         ofp[idx[i]:idx[i+1], :, :] = current_out_norm.reshape(num_spectra, ny, nz)
-        #         del ofp
+        for block, current_data in data_blocks.iterate_blocks(msidata, blocks, num_threads=num_io_threads):
+            tip = tic_norm_factors[block[0], block[1]]
+            mip = msi_spectrum_maxs[block[0], block[1]]
+            idx_thresh = np.logical_and(mip >= self['maxCount'], tip > 0)
+            current_out_norm = np.zeros(current_data.shape, dtype=outformat)
+            if np.any(idx_thresh):
+                current_out_norm[idx_thresh, :] = \
+                    np.around(np.multiply(current_data[idx_thresh, :],
+                                          tip[idx_thresh][:, np.newaxis]))
+            norm_msidata[block] = current_out_norm
+            del current_data
 
         # Save the data
-        self['norm_msidata'] = np.memmap(output_filename, dtype=outformat, mode='w+', shape=(nx, ny, nz))
+        self['norm_msidata'] = norm_msidata
         self['norm_mz'] = mzdata
-        output_filename.close()
 
     def record_execute_analysis_outputs(self, analysis_output):
         """
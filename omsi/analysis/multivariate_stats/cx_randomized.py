@@ -0,0 +1,141 @@
+"""
+Approximate leverage scores for CX decompositions of MSI data that may not fit into memory.
+
+The data is viewed as a (num_bins x num_pixels) matrix A as in omsi_cx. The rank-k leverage scores
+are approximated from a randomized SVD of A (Halko, Martinsson, and Tropp, SIAM Review, 2011):
+the range of A is sketched via Y = (A A^T)^q A Omega for a Gaussian test matrix Omega with
+sketch_size columns, and the SVD of the small matrix B = Q^T A (with Q an orthonormal basis of
+the range of Y) approximates the SVD of A. All products with A are computed in streaming passes
+over chunk-aligned blocks of complete spectra (see omsi.shared.data_blocks), i.e., the memory
+used is bounded by the size of the blocks plus O((num_bins + num_pixels) * sketch_size).
+A total of num_power_iterations + 2 passes over the data are required.
+"""
+import time
+import numpy as np
+
+import omsi.shared.data_blocks as data_blocks
+from omsi.shared.log import log_helper
+
+
+def block_matrix(block_data, block_mask=None):
+    """
+    Get the spectra of a block as a (num_bins x num_pixels) float64 matrix, i.e., the columns of A.
+
+    :param block_data: Numpy array with the data of a block of complete spectra
+    :param block_mask: Optional boolean numpy array with the mask of the block (the shape of the block without the
+        last axis) indicating which spectra should be used
+
+    :returns: 2D float64 numpy array with one spectrum per column
+    """
+    if block_mask is not None:
+        spectra = block_data[block_mask]
+    else:
+        spectra = block_data.reshape((-1, block_data.shape[-1]))
+    return np.asarray(spectra, dtype='float64').transpose()
+
+
+def randomized_leverage_scores(data,
+                               rank,
+                               sketch_size=None,
+                               num_power_iterations=2,
+                               mask=None,
+                               random_state=None,
+                               max_bytes=256*1024*1024,
+                               num_threads=1):
+    """
+    Compute approximate rank-k row (image) and column (pixel) leverage scores of the (num_bins x num_pixels)
+    matrix A of the data in streaming passes over the data.
+
+    :param data: The data (e.g., h5py.Dataset, omsi_file_msidata, or numpy array). The last axis of the
+        data are the spectra.
+    :param rank: The rank k of the leverage scores
+    :param sketch_size: The number of columns of the random test matrix (sketch_size >= rank). Default is
+        None, in which case rank + 10 is used.
+    :param num_power_iterations: The number of power iterations q. Power iterations improve the accuracy
+        if the singular values of the data decay slowly, at the cost of one pass over the data each.
+    :param mask: Optional boolean numpy array with shape data.shape[:-1] indicating the spectra to be used
+    :param random_state: np.random.RandomState used for the random test matrix
+    :param max_bytes: The maximum number of bytes per block
+    :param num_threads: Number of threads used to prefetch blocks. Set to 0 to read blocks synchronously.
+
+    :returns: Tuple (row_leverage, column_leverage, info) with the 1D array of the num_bins row leverage
+        scores, the array of shape data.shape[:-1] with the column leverage score of each pixel (-1 for
+        masked out pixels), and a dict with the timing information of the passes ('sketch_time',
+        'power_iteration_times', 'projection_time', 'svd_time') and the number of passes ('num_passes').
+
+    :raises ValueError: If the mask does not select any spectra.
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+    # Use the data object best suited for a full pass over the data
+    if hasattr(data, 'get_scan_dataset'):
+        data = data.get_scan_dataset(max_bytes=max_bytes)
+    shape = tuple(int(dim) for dim in data.shape)
+    num_bins = shape[-1]
+    if mask is not None:
+        mask = np.asarray(mask[:], dtype='bool')
+        if not np.any(mask):
+            raise ValueError("The leverage scores require at least one selected spectrum.")
+    num_pixels = int(np.sum(mask)) if mask is not None else int(np.prod(shape[:-1]))
+    if sketch_size is None:
+        sketch_size = rank + 10
+    sketch_size = max(min(sketch_size, num_bins, num_pixels), min(rank, num_bins, num_pixels))
+    blocks = data_blocks.get_chunk_aligned_blocks(shape=shape,
+                                                  chunks=data_blocks.get_chunk_shape(data),
+                                                  itemsize=np.dtype(data.dtype).itemsize,
+                                                  max_bytes=max_bytes)
+    # Blocks without any selected spectra are not read
+    blocks = [block for block in blocks if mask is None or np.any(mask[block[:-1]])]
+    info = {'power_iteration_times': []}
+
+    # Pass 1: Sketch the range of A, Y = A Omega
+    start_time = time.time()
+    range_sketch = np.zeros((num_bins, sketch_size), dtype='float64')
+    for block, block_data in data_blocks.iterate_blocks(data, blocks, num_threads=num_threads):
+        a_block = block_matrix(block_data, mask[block[:-1]] if mask is not None else None)
+        range_sketch += np.dot(a_block, random_state.standard_normal((a_block.shape[1], sketch_size)))
+    info['sketch_time'] = time.time() - start_time
+
+    # Power iterations, Y = (A A^T) Q. The basis is orthonormalized before each iteration for stability.
+    for _ in xrange(num_power_iterations):
+        start_time = time.time()
+        range_basis = np.linalg.qr(range_sketch)[0]
+        range_sketch[:] = 0
+        for block, block_data in data_blocks.iterate_blocks(data, blocks, num_threads=num_threads):
+            a_block = block_matrix(block_data, mask[block[:-1]] if mask is not None else None)
+            range_sketch += np.dot(a_block, np.dot(a_block.T, range_basis))
+        info['power_iteration_times'].append(time.time() - start_time)
+        log_helper.debug(__name__, "Completed power iteration " + str(len(info['power_iteration_times'])))
+
+    # Final pass: Project the data onto the basis of the range, B = Q^T A
+    start_time = time.time()
+    range_basis = np.linalg.qr(range_sketch)[0]
+    del range_sketch
+    projected_blocks = []
+    for block, block_data in data_blocks.iterate_blocks(data, blocks, num_threads=num_threads):
+        a_block = block_matrix(block_data, mask[block[:-1]] if mask is not None else None)
+        projected_blocks.append((block, np.dot(range_basis.T, a_block)))
+    info['projection_time'] = time.time() - start_time
+
+    # Compute the SVD of B and the leverage scores
+    start_time = time.time()
+    u_small, _, v_matrix = np.linalg.svd(np.concatenate([projected for _, projected in projected_blocks], axis=1),
+                                         full_matrices=False)
+    row_leverage = np.sum(np.dot(range_basis, u_small[:, :rank]) ** 2, axis=1)
+    pixel_leverage = np.sum(v_matrix[:rank, :] ** 2, axis=0)
+    column_leverage = np.zeros(shape[:-1], dtype='float64')
+    if mask is not None:
+        column_leverage[:] = -1
+    pixel_offset = 0
+    for block, projected in projected_blocks:
+        block_leverage = pixel_leverage[pixel_offset:pixel_offset + projected.shape[1]]
+        pixel_offset += projected.shape[1]
+        if mask is not None:
+            block_out = column_leverage[block[:-1]]
+            block_out[mask[block[:-1]]] = block_leverage
+            column_leverage[block[:-1]] = block_out
+        else:
+            column_leverage[block[:-1]] = block_leverage.reshape(column_leverage[block[:-1]].shape)
+    info['svd_time'] = time.time() - start_time
+    info['num_passes'] = num_power_iterations + 2
+    return row_leverage, column_leverage, info
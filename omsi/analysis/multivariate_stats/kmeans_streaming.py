@@ -0,0 +1,353 @@
+"""
+Mini-batch k-means clustering of the spectra of MSI data that may not fit into memory.
+
+The centroids are computed with the mini-batch k-means algorithm (Sculley, WWW 2010). Each mini-batch
+is sampled from randomly selected chunk footprints of complete spectra, i.e., only whole chunks of
+the (spectrum-chunked) data are read. The final assignment of all spectra to the nearest centroid
+is computed in a streaming pass over chunk-aligned blocks of spectra (see omsi.shared.data_blocks)
+with the labels written to the output one block at a time. Independent restarts of the algorithm
+can be executed in parallel using a process pool.
+"""
+import os
+import time
+from multiprocessing import Pool
+import numpy as np
+
+import omsi.shared.data_blocks as data_blocks
+from omsi.shared.log import log_helper
+
+
+def block_spectra(block_data, block_mask=None, normalize=False):
+    """
+    Get the (optionally normalized) spectra of a block as a (num_spectra x num_bins) float64 matrix.
+
+    :param block_data: Numpy array with the data of a block of complete spectra
+    :param block_mask: Optional boolean numpy array with the mask of the block (the shape of the block without the
+        last axis) indicating which spectra should be used
+    :param normalize: Divide each spectrum by its maximum value + 1
+
+    :returns: 2D float64 numpy array with one spectrum per row
+    """
+    if block_mask is not None:
+        spectra = np.asarray(block_data[block_mask], dtype='float64')
+    else:
+        spectra = np.asarray(block_data, dtype='float64').reshape((-1, block_data.shape[-1]))
+    if normalize:
+        spectra /= (np.amax(spectra, axis=-1) + 1)[:, np.newaxis]
+    return spectra
+
+
+def assign_clusters(spectra, centers):
+    """
+    Assign each spectrum to the nearest center (as scipy.cluster.vq.vq).
+
+    :param spectra: 2D numpy array with one spectrum per row
+    :param centers: 2D numpy array with one center per row
+
+    :returns: Tuple of a 1D int array with the index of the nearest center for each spectrum and a 1D float
+        array with the squared Euclidean distance to the nearest center
+    """
+    squared_distances = np.sum(spectra * spectra, axis=1)[:, np.newaxis] - \
+        2.0 * np.dot(spectra, centers.T) + np.sum(centers * centers, axis=1)[np.newaxis, :]
+    labels = np.argmin(squared_distances, axis=1)
+    return labels, np.maximum(squared_distances[np.arange(spectra.shape[0]), labels], 0)
+
+
+def kmeans_plusplus(spectra, num_clusters, random_state):
+    """
+    Select initial centers from the given spectra using k-means++ seeding.
+
+    :param spectra: 2D numpy array with one spectrum per row
+    :param num_clusters: The number of centers
+    :param random_state: np.random.RandomState used for the seeding
+
+    :returns: 2D float64 numpy array with one center per row
+    """
+    centers = np.zeros((num_clusters, spectra.shape[1]), dtype='float64')
+    centers[0] = spectra[random_state.randint(spectra.shape[0])]
+    squared_distances = np.sum((spectra - centers[0]) ** 2, axis=1)
+    for center_index in xrange(1, num_clusters):
+        total = squared_distances.sum()
+        if total > 0:
+            selected = random_state.choice(spectra.shape[0], p=squared_distances / total)
+        else:
+            selected = random_state.randint(spectra.shape[0])
+        centers[center_index] = spectra[selected]
+        squared_distances = np.minimum(squared_distances, np.sum((spectra - centers[center_index]) ** 2, axis=1))
+    return centers
+
+
+def sample_spectra(data, sample_blocks, num_spectra, random_state, mask=None, normalize=False, num_threads=0):
+    """
+    Sample spectra from randomly selected blocks of the data.
+
+    Blocks are read in random order until the blocks read contain at least num_spectra selected spectra.
+    A random subset of num_spectra of the spectra of these blocks is returned.
+
+    :param data: The data (e.g., h5py.Dataset, omsi_file_msidata, or numpy array)
+    :param sample_blocks: List of candidate blocks of complete spectra (e.g., single chunk footprints)
+    :param num_spectra: The number of spectra to be sampled
+    :param random_state: np.random.RandomState used for the sampling
+    :param mask: Optional boolean numpy array with shape data.shape[:-1] indicating the spectra to be used
+    :param normalize: Divide each spectrum by its maximum value + 1
+    :param num_threads: Number of threads used to prefetch blocks
+
+    :returns: 2D float64 numpy array with one spectrum per row
+    """
+    # Determine the blocks to be read
+    block_order = random_state.permutation(len(sample_blocks))
+    selected_blocks = []
+    num_selected = 0
+    for block_index in block_order:
+        block = sample_blocks[block_index]
+        selected_blocks.append(block)
+        num_selected += int(np.sum(mask[block[:-1]])) if mask is not None else \
+            int(np.prod([sel.stop - sel.start for sel in block[:-1]]))
+        if num_selected >= num_spectra:
+            break
+    # Read the blocks and select the spectra
+    spectra = [block_spectra(block_data, mask[block[:-1]] if mask is not None else None, normalize)
+               for block, block_data in data_blocks.iterate_blocks(data, selected_blocks, num_threads=num_threads)]
+    spectra = np.concatenate(spectra, axis=0)
+    if spectra.shape[0] > num_spectra:
+        spectra = spectra[np.sort(random_state.choice(spectra.shape[0], num_spectra, replace=False))]
+    return spectra
+
+
+def minibatch_kmeans(data,
+                     num_clusters,
+                     sample_blocks,
+                     random_state,
+                     mask=None,
+                     normalize=False,
+                     batch_size=1024,
+                     max_batches=100,
+                     tolerance=1e-5,
+                     num_threads=1):
+    """
+    Compute the centers of a single run of mini-batch k-means.
+
+    The centers are initialized via k-means++ from a sample of 3*max(batch_size, num_clusters) spectra. Each mini-batch
+    is assigned to the nearest centers and each center is moved towards the mean of its assigned spectra
+    with a per-center learning rate of 1/(number of spectra assigned to the center so far). The iteration
+    stops when the squared shift of the centers relative to the squared norm of the centers is less than
+    tolerance or after max_batches mini-batches.
+
+    :param data: The data (e.g., h5py.Dataset, omsi_file_msidata, or numpy array)
+    :param num_clusters: The number of clusters
+    :param sample_blocks: List of candidate blocks of complete spectra mini-batches are sampled from
+    :param random_state: np.random.RandomState used for the initialization and the sampling
+    :param mask: Optional boolean numpy array with shape data.shape[:-1] indicating the spectra to be clustered
+    :param normalize: Divide each spectrum by its maximum value + 1
+    :param batch_size: The number of spectra per mini-batch
+    :param max_batches: The maximum number of mini-batches
+    :param tolerance: Tolerance for the relative shift of the centers
+    :param num_threads: Number of threads used to prefetch blocks
+
+    :returns: Tuple (centers, num_batches, converged) with the 2D float64 array with one center per row,
+        the number of mini-batches processed, and a bool indicating whether the tolerance was reached.
+    """
+    init_sample = sample_spectra(data, sample_blocks, 3 * max(batch_size, num_clusters), random_state,
+                                 mask=mask, normalize=normalize, num_threads=num_threads)
+    centers = kmeans_plusplus(init_sample, num_clusters, random_state)
+    del init_sample
+    counts = np.zeros(num_clusters, dtype='float64')
+    converged = False
+    num_batches = 0
+    for num_batches in xrange(1, max_batches + 1):
+        batch = sample_spectra(data, sample_blocks, batch_size, random_state,
+                               mask=mask, normalize=normalize, num_threads=num_threads)
+        labels = assign_clusters(batch, centers)[0]
+        batch_counts = np.bincount(labels, minlength=num_clusters).astype('float64')
+        batch_sums = np.zeros(centers.shape, dtype='float64')
+        np.add.at(batch_sums, labels, batch)
+        counts += batch_counts
+        updated = batch_counts > 0
+        previous_centers = centers.copy()
+        centers[updated] += (batch_sums[updated] - batch_counts[updated, np.newaxis] * centers[updated]) / \
+            counts[updated, np.newaxis]
+        center_norm = np.sum(centers * centers)
+        if center_norm > 0 and np.sum((centers - previous_centers) ** 2) / center_norm < tolerance:
+            converged = True
+            break
+    return centers, num_batches, converged
+
+
+def _minibatch_kmeans_restart(kwargs):
+    """
+    Execute minibatch_kmeans in a process of the process pool.
+
+    :param kwargs: Dict with the keyword arguments of minibatch_kmeans. The data is given either as numpy
+        array or via the keys 'filename' and 'dataset', in which case the dataset is opened read-only.
+        The file is usually still open for writing in the calling process, i.e., HDF5 file locking
+        (HDF5 >=1.10) is disabled in the process unless HDF5_USE_FILE_LOCKING is set explicitly
+        (see also omsi.shared.process_helper). The 'seed' key is used to create the random_state.
+
+    :returns: The output of minibatch_kmeans
+    """
+    kwargs = dict(kwargs)
+    kwargs['random_state'] = np.random.RandomState(kwargs.pop('seed'))
+    filename = kwargs.pop('filename', None)
+    dataset = kwargs.pop('dataset', None)
+    if filename is None:
+        return minibatch_kmeans(**kwargs)
+    import h5py
+    os.environ.setdefault('HDF5_USE_FILE_LOCKING', 'FALSE')
+    with h5py.File(filename, 'r') as hdf_file:
+        kwargs['data'] = hdf_file[dataset]
+        return minibatch_kmeans(**kwargs)
+
+
+def streaming_kmeans(data,
+                     num_clusters,
+                     out=None,
+                     mask=None,
+                     normalize=False,
+                     batch_size=1024,
+                     max_batches=100,
+                     tolerance=1e-5,
+                     num_restarts=1,
+                     random_state=None,
+                     max_bytes=256*1024*1024,
+                     num_threads=1,
+                     num_processes=1):
+    """
+    Cluster the spectra of the data with mini-batch k-means without loading the full data.
+
+    The best of num_restarts runs of minibatch_kmeans is selected based on the inertia (i.e., the sum of squared
+    distances of the spectra to their nearest center) on a common random sample of spectra. Then all spectra
+    are assigned to the nearest center of the best run in a streaming pass over chunk-aligned blocks of
+    complete spectra and the labels are written to out one block at a time.
+
+    :param data: The data (e.g., h5py.Dataset, omsi_file_msidata, or numpy array). The last axis of the
+        data are the spectra.
+    :param num_clusters: The number of clusters
+    :param out: Array-like with shape data.shape[:-1] to which the labels are written. Masked out spectra
+        are labeled -1. If None, then a numpy int array is allocated.
+    :param mask: Optional boolean numpy array with shape data.shape[:-1] indicating the spectra to be clustered
+    :param normalize: Divide each spectrum by its maximum value + 1
+    :param batch_size: The number of spectra per mini-batch
+    :param max_batches: The maximum number of mini-batches per restart
+    :param tolerance: Tolerance for the relative shift of the centers
+    :param num_restarts: The number of independent runs of mini-batch k-means
+    :param random_state: np.random.RandomState used for the sampling. Each restart uses a random state
+        seeded from random_state.
+    :param max_bytes: The maximum number of bytes per block of the final assignment pass
+    :param num_threads: Number of threads used to prefetch blocks. Set to 0 to read blocks synchronously.
+    :param num_processes: Number of processes used to execute the restarts in parallel. Parallel restarts
+        require that the data is a numpy array or an h5py.Dataset (which is then opened read-only by the
+        processes). Otherwise the restarts are executed serially.
+
+    :raises ValueError: If the mask does not select any spectra.
+
+    :returns: Tuple (centers, out, info) with the 2D array with one center per row, the labels, and a dict
+        with the following keys:
+
+        * 'restart_inertia' : List with the inertia of each restart on the common sample of spectra
+        * 'restart_num_batches' : List with the number of mini-batches of each restart
+        * 'restart_converged' : List of bools indicating whether each restart converged
+        * 'best_restart' : Index of the selected restart
+        * 'fit_time' : Time in seconds to compute the centers of all restarts
+        * 'assign_time' : Time in seconds to compute and write the labels
+        * 'inertia' : The inertia of all spectra for the selected centers
+    """
+    import h5py
+    if random_state is None:
+        random_state = np.random.RandomState()
+    # Use the data object best suited for a full pass over the data
+    if hasattr(data, 'get_scan_dataset'):
+        data = data.get_scan_dataset(max_bytes=max_bytes)
+    shape = tuple(int(dim) for dim in data.shape)
+    if mask is not None:
+        mask = np.asarray(mask[:], dtype='bool')
+        if not np.any(mask):
+            raise ValueError("k-means requires at least one selected spectrum.")
+    if out is None:
+        out = np.zeros(shape[:-1], dtype='int')
+    chunks = data_blocks.get_chunk_shape(data)
+    itemsize = np.dtype(data.dtype).itemsize
+    # Mini-batches are sampled from single chunk footprints of complete spectra
+    sample_blocks = data_blocks.get_chunk_aligned_blocks(shape=shape, chunks=chunks, itemsize=itemsize, max_bytes=1)
+    if mask is not None:
+        sample_blocks = [block for block in sample_blocks if np.any(mask[block[:-1]])]
+    info = {}
+
+    # Compute the centers for all restarts
+    start_time = time.time()
+    restart_kwargs = [{'num_clusters': num_clusters,
+                       'sample_blocks': sample_blocks,
+                       'seed': seed,
+                       'mask': mask,
+                       'normalize': normalize,
+                       'batch_size': batch_size,
+                       'max_batches': max_batches,
+                       'tolerance': tolerance,
+                       'num_threads': num_threads}
+                      for seed in random_state.randint(np.iinfo(np.int32).max, size=num_restarts)]
+    use_pool = num_processes > 1 and num_restarts > 1
+    if use_pool and isinstance(data, h5py.Dataset):
+        data.file.flush()
+        for kwargs in restart_kwargs:
+            kwargs['filename'] = data.file.filename
+            kwargs['dataset'] = data.name
+    elif use_pool and isinstance(data, np.ndarray):
+        for kwargs in restart_kwargs:
+            kwargs['data'] = data
+    else:
+        if use_pool:
+            log_helper.warning(__name__, "Parallel restarts require a numpy array or h5py.Dataset. " +
+                                         "Executing the restarts serially.")
+        use_pool = False
+        for kwargs in restart_kwargs:
+            kwargs['data'] = data
+    if use_pool:
+        process_pool = Pool(min(num_processes, num_restarts))
+        try:
+            restart_results = process_pool.map(_minibatch_kmeans_restart, restart_kwargs)
+        finally:
+            process_pool.close()
+            process_pool.join()
+    else:
+        restart_results = [_minibatch_kmeans_restart(kwargs) for kwargs in restart_kwargs]
+    info['fit_time'] = time.time() - start_time
+
+    # Select the best restart based on the inertia on a common sample
+    if len(restart_results) > 1:
+        evaluation_sample = sample_spectra(data, sample_blocks, 3 * max(batch_size, num_clusters), random_state,
+                                           mask=mask, normalize=normalize, num_threads=num_threads)
+        restart_inertia = [float(np.sum(assign_clusters(evaluation_sample, centers)[1]))
+                           for centers, _, _ in restart_results]
+    else:
+        restart_inertia = [np.nan]
+    best_restart = int(np.nanargmin(restart_inertia)) if len(restart_results) > 1 else 0
+    centers = restart_results[best_restart][0]
+    info['restart_inertia'] = restart_inertia
+    info['restart_num_batches'] = [num_batches for _, num_batches, _ in restart_results]
+    info['restart_converged'] = [converged for _, _, converged in restart_results]
+    info['best_restart'] = best_restart
+    log_helper.debug(__name__, "Selected k-means restart " + str(best_restart))
+
+    # Assign all spectra to the nearest center
+    start_time = time.time()
+    inertia = 0.0
+    blocks = data_blocks.get_chunk_aligned_blocks(shape=shape, chunks=chunks, itemsize=itemsize, max_bytes=max_bytes)
+    if mask is not None:
+        # Blocks without any selected spectra are not read
+        for block in blocks:
+            if not np.any(mask[block[:-1]]):
+                out[block[:-1]] = -1
+        blocks = [block for block in blocks if np.any(mask[block[:-1]])]
+    for block, block_data in data_blocks.iterate_blocks(data, blocks, num_threads=num_threads):
+        block_mask = mask[block[:-1]] if mask is not None else None
+        labels, squared_distances = assign_clusters(block_spectra(block_data, block_mask, normalize), centers)
+        inertia += float(np.sum(squared_distances))
+        if block_mask is not None:
+            block_labels = np.zeros(block_data.shape[:-1], dtype=out.dtype)
+            block_labels[:] = -1
+            block_labels[block_mask] = labels
+        else:
+            block_labels = labels.reshape(block_data.shape[:-1])
+        out[block[:-1]] = block_labels
+    info['assign_time'] = time.time() - start_time
+    info['inertia'] = inertia
+    return centers, out, info
@@ -0,0 +1,379 @@
+"""
+Streaming (mini-batch) non-negative matrix factorization (NMF) for MSI data that may not fit into memory.
+
+The data is viewed as a (num_bins x num_pixels) matrix V that is factorized as V ~ W H with the
+(num_bins x num_components) matrix of spectral components W and the (num_components x num_pixels)
+matrix of loadings H. The pixels are processed one block of complete spectra at a time, using
+blocks that are aligned with the chunking of the data (see omsi.shared.data_blocks). For each block
+the loadings are computed with W fixed and the sufficient statistics A = sum(H_b H_b^T) and
+B = sum(V_b H_b^T) are accumulated, which are used to update W after each block (online NMF
+with multiplicative updates). Once W has converged, the loadings H are computed in a final pass
+one block at a time and written directly to the output array.
+"""
+import time
+import numpy as np
+
+import omsi.shared.data_blocks as data_blocks
+from omsi.shared.log import log_helper
+
+EPSILON = 1e-12
+"""Small positive value used to avoid divisions by zero in the multiplicative updates"""
+
+INIT_METHODS = ('nndsvd', 'nndsvda', 'random')
+"""The supported initialization methods (see initialize_nmf)"""
+
+
+def truncated_svd(data, num_components):
+    """
+    Compute the leading singular values and vectors of a matrix from the eigendecomposition of the Gram
+    matrix of its smaller dimension. This avoids computing (and storing) the full set of singular vectors,
+    i.e., for a (m x n) matrix with m >= n the cost is O(m n^2) time and O(n^2 + m num_components) memory.
+
+    :param data: 2D numpy array
+    :param num_components: The maximum number of singular values to be computed
+
+    :returns: Tuple of the left singular vectors (as columns), the singular values in decreasing order, and
+        the right singular vectors (as rows). Singular values that are numerically zero are omitted, i.e.,
+        fewer than num_components values are returned if the (numerical) rank of the data is lower.
+    """
+    transpose = data.shape[0] < data.shape[1]
+    matrix = data.T if transpose else data
+    eig_values, eig_vectors = np.linalg.eigh(np.dot(matrix.T, matrix))
+    order = np.argsort(eig_values)[::-1][:num_components]
+    eig_values = eig_values[order]
+    eig_vectors = eig_vectors[:, order]
+    if eig_values.size > 0:
+        # Singular values below ~1e-6 of the largest one cannot be resolved from the Gram matrix
+        keep = eig_values > max(eig_values[0], 0) * 1e-12
+        eig_values = eig_values[keep]
+        eig_vectors = eig_vectors[:, keep]
+    s_values = np.sqrt(eig_values)
+    left_vectors = np.dot(matrix, eig_vectors) / s_values
+    if transpose:
+        return eig_vectors, s_values, left_vectors.T
+    return left_vectors, s_values, eig_vectors.T
+
+
+def nndsvd(data, num_components, fill_zeros=False, random_state=None):
+    """
+    Compute the nonnegative double singular value decomposition (NNDSVD) initialization of NMF
+    (Boutsidis and Gallopoulos, Pattern Recognition, 2008). Only the leading num_components singular
+    vectors are computed (see truncated_svd).
+
+    :param data: 2D numpy array with the (num_bins x num_pixels) data matrix
+    :param num_components: The number of components
+    :param fill_zeros: Replace the zeros of W and H by the average of the data divided by 100
+        (NNDSVDa variant). Zeros are never updated by multiplicative updates.
+    :param random_state: np.random.RandomState used to initialize components that are not determined
+        by the SVD (i.e., if num_components exceeds the rank of the data).
+
+    :returns: Tuple of the (num_bins x num_components) matrix W and the (num_components x num_pixels) matrix H
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+    data = np.asarray(data, dtype='float64')
+    u_matrix, s_values, v_matrix = truncated_svd(data, num_components)
+    w_matrix = np.zeros((data.shape[0], num_components), dtype='float64')
+    h_matrix = np.zeros((num_components, data.shape[1]), dtype='float64')
+    average = data.mean() if data.size > 0 else 0.0
+    for component in range(min(num_components, len(s_values))):
+        x_values = u_matrix[:, component]
+        y_values = v_matrix[component, :]
+        if component == 0:
+            # The leading singular vectors of a nonnegative matrix can be chosen nonnegative
+            w_matrix[:, 0] = np.sqrt(s_values[0]) * np.abs(x_values)
+            h_matrix[0, :] = np.sqrt(s_values[0]) * np.abs(y_values)
+            continue
+        x_pos, x_neg = np.maximum(x_values, 0), np.maximum(-x_values, 0)
+        y_pos, y_neg = np.maximum(y_values, 0), np.maximum(-y_values, 0)
+        x_pos_norm, x_neg_norm = np.linalg.norm(x_pos), np.linalg.norm(x_neg)
+        y_pos_norm, y_neg_norm = np.linalg.norm(y_pos), np.linalg.norm(y_neg)
+        pos_norm = x_pos_norm * y_pos_norm
+        neg_norm = x_neg_norm * y_neg_norm
+        if pos_norm > neg_norm:
+            u_values, v_values, sigma = x_pos / x_pos_norm, y_pos / y_pos_norm, pos_norm
+        elif neg_norm > 0:
+            u_values, v_values, sigma = x_neg / x_neg_norm, y_neg / y_neg_norm, neg_norm
+        else:
+            continue
+        scale = np.sqrt(s_values[component] * sigma)
+        w_matrix[:, component] = scale * u_values
+        h_matrix[component, :] = scale * v_values
+    # Components not determined by the SVD are initialized randomly
+    for component in range(len(s_values), num_components):
+        w_matrix[:, component] = random_state.rand(data.shape[0]) * np.sqrt(max(average, EPSILON) / num_components)
+        h_matrix[component, :] = random_state.rand(data.shape[1]) * np.sqrt(max(average, EPSILON) / num_components)
+    if fill_zeros:
+        w_matrix[w_matrix == 0] = average / 100.
+        h_matrix[h_matrix == 0] = average / 100.
+    return w_matrix, h_matrix
+
+
+def initialize_nmf(data, num_components, init='nndsvd', random_state=None, sample_size=None):
+    """
+    Compute the initial W and H matrices for NMF.
+
+    :param data: 2D numpy array with the (num_bins x num_pixels) data matrix
+    :param num_components: The number of components
+    :param init: The initialization method. One of INIT_METHODS:
+
+        * 'nndsvd' : Nonnegative double SVD (see nndsvd)
+        * 'nndsvda' : NNDSVD with zeros filled with the average of the data
+        * 'random' : Uniform random values in [0, sqrt(mean(data) / num_components)]
+
+    :param random_state: np.random.RandomState used for random initialization
+    :param sample_size: Maximum number of spectra used to compute the NNDSVD. If the data has more
+        spectra, then W is computed from a random sample of sample_size spectra and H is computed
+        from the data for the fixed W (see solve_h). None to use all spectra.
+
+    :returns: Tuple of the (num_bins x num_components) matrix W and the (num_components x num_pixels) matrix H
+
+    :raises ValueError: If an unsupported init method is given.
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+    if init in ('nndsvd', 'nndsvda') and sample_size is not None and data.shape[1] > sample_size:
+        sample = np.asarray(data[:, np.sort(random_state.choice(data.shape[1], sample_size, replace=False))],
+                            dtype='float64')
+        w_matrix = nndsvd(sample, num_components, fill_zeros=(init == 'nndsvda'), random_state=random_state)[0]
+        del sample
+        return w_matrix, solve_h(data, w_matrix)
+    if init == 'nndsvd':
+        return nndsvd(data, num_components, fill_zeros=False, random_state=random_state)
+    elif init == 'nndsvda':
+        return nndsvd(data, num_components, fill_zeros=True, random_state=random_state)
+    elif init == 'random':
+        scale = np.sqrt(max(float(np.mean(data)) if data.size > 0 else 0.0, EPSILON) / num_components)
+        return (random_state.rand(data.shape[0], num_components) * scale,
+                random_state.rand(num_components, data.shape[1]) * scale)
+    raise ValueError("Unsupported NMF initialization: " + str(init) + " Supported methods are: " + str(INIT_METHODS))
+
+
+def block_spectra(block_data, block_mask=None):
+    """
+    Get the spectra of a block as a (num_bins x num_pixels) float64 matrix.
+
+    :param block_data: Numpy array with the data of a block of complete spectra
+    :param block_mask: Optional boolean numpy array with the mask of the block (the shape of the block without the
+        last axis) indicating which spectra should be used
+
+    :returns: 2D float64 numpy array with one spectrum per column
+    """
+    if block_mask is not None:
+        spectra = block_data[block_mask]
+    else:
+        spectra = block_data.reshape((-1, block_data.shape[-1]))
+    return np.asarray(spectra, dtype='float64').transpose()
+
+
+def solve_h(spectra, w_matrix, num_iter=20, wtw=None):
+    """
+    Compute the nonnegative loadings H of the given spectra for fixed components W, i.e., approximately
+    minimize ||V - W H|| subject to H >= 0. H is initialized with the clipped unconstrained least squares
+    solution and refined with multiplicative updates.
+
+    :param spectra: 2D numpy array with the (num_bins x num_pixels) spectra V
+    :param w_matrix: 2D numpy array with the (num_bins x num_components) components W
+    :param num_iter: Number of multiplicative updates
+    :param wtw: Optional precomputed W^T W
+
+    :returns: 2D numpy array with the (num_components x num_pixels) loadings H
+    """
+    if wtw is None:
+        wtw = np.dot(w_matrix.T, w_matrix)
+    wtv = np.dot(w_matrix.T, spectra)
+    try:
+        h_matrix = np.linalg.solve(wtw + EPSILON * np.eye(wtw.shape[0]), wtv)
+    except np.linalg.LinAlgError:
+        h_matrix = np.linalg.lstsq(wtw, wtv, rcond=-1)[0]
+    h_matrix = np.maximum(h_matrix, EPSILON)
+    for _ in xrange(num_iter):
+        h_matrix *= wtv / (np.dot(wtw, h_matrix) + EPSILON)
+    return h_matrix
+
+
+def update_w(w_matrix, hht, vht, num_iter=1):
+    """
+    Update the components W for the accumulated statistics A = sum(H H^T) and B = sum(V H^T) with
+    multiplicative updates, i.e., approximately minimize 0.5 tr(W^T W A) - tr(W^T B) subject to W >= 0.
+
+    :param w_matrix: 2D numpy array with the (num_bins x num_components) components W. Updated in place.
+    :param hht: 2D numpy array with the (num_components x num_components) matrix A
+    :param vht: 2D numpy array with the (num_bins x num_components) matrix B
+    :param num_iter: Number of multiplicative updates
+
+    :returns: The updated W
+    """
+    for _ in xrange(num_iter):
+        w_matrix *= vht / (np.dot(w_matrix, hht) + EPSILON)
+    return w_matrix
+
+
+def streaming_nmf(data,
+                  num_components,
+                  out=None,
+                  mask=None,
+                  init='nndsvd',
+                  random_state=None,
+                  max_epochs=20,
+                  tolerance=1e-4,
+                  time_out=None,
+                  num_h_iter=20,
+                  num_w_iter=1,
+                  init_sample_size=2000,
+                  max_bytes=256*1024*1024,
+                  num_threads=1):
+    """
+    Compute the NMF of the data one chunk-aligned block of complete spectra at a time.
+
+    Each epoch is one pass over the blocks in random order. For each block, the loadings H_b
+    are computed with W fixed (see solve_h), the statistics A and B are updated, and W is updated
+    (see update_w). At the start of each epoch the statistics of the previous epochs are down-weighted
+    by a factor 0.5 so that stale loadings computed for earlier W are forgotten. The iteration stops
+    when the relative reconstruction error changes by less than tolerance between epochs, after
+    max_epochs epochs, or after time_out seconds. The final loadings are computed in an additional pass.
+
+    :param data: The data to be factorized (e.g., h5py.Dataset, omsi_file_msidata, or numpy array).
+        The last axis of the data are the spectra.
+    :param num_components: The number of components
+    :param out: Array-like with shape data.shape[:-1] + (num_components, ) (e.g., a numpy memmap or
+        h5py dataset) to which the loadings are written one block at a time. Masked out pixels are set to 0.
+        If None, then a numpy array is allocated.
+    :param mask: Optional boolean numpy array with shape data.shape[:-1] indicating the spectra to be used
+    :param init: The initialization method (see initialize_nmf). The initialization is computed from a
+        random sample of approximately init_sample_size spectra read from randomly selected blocks.
+    :param random_state: np.random.RandomState used for sampling, initialization, and the block order
+    :param max_epochs: Maximum number of passes over the data to compute W
+    :param tolerance: Tolerance for the relative change of the relative reconstruction error
+    :param time_out: Time in seconds after which no further epochs are started. None for no limit.
+    :param num_h_iter: Number of multiplicative updates used to compute the loadings of a block
+    :param num_w_iter: Number of multiplicative updates of W per block
+    :param init_sample_size: Number of spectra used for the initialization
+    :param max_bytes: The maximum number of bytes per block
+    :param num_threads: Number of threads used to prefetch blocks. Set to 0 to read blocks synchronously.
+
+    :raises ValueError: If the mask does not select any spectra.
+
+    :returns: Tuple (w_matrix, out, info) with the (num_bins x num_components) components, the loadings,
+        and a dict with the convergence and timing information of the run with the following keys:
+
+        * 'init_time' : Time in seconds to compute the initialization
+        * 'epoch_times' : List with the time in seconds for each epoch
+        * 'epoch_errors' : List with the relative reconstruction error ||V - W H|| / ||V|| estimated \
+            during each epoch (using the loadings computed for each block before the W update)
+        * 'num_epochs' : The number of epochs performed
+        * 'converged' : Boolean indicating whether the tolerance was reached
+        * 'h_time' : Time in seconds to compute and write the final loadings
+        * 'relative_error' : The relative reconstruction error of the final W and H
+        * 'num_blocks' : The number of blocks per pass
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+    # Use the data object best suited for a full pass over the data
+    if hasattr(data, 'get_scan_dataset'):
+        data = data.get_scan_dataset(max_bytes=max_bytes)
+    shape = tuple(int(dim) for dim in data.shape)
+    num_bins = shape[-1]
+    if mask is not None:
+        mask = np.asarray(mask[:], dtype='bool')
+    if out is None:
+        out = np.zeros(shape[:-1] + (num_components, ), dtype='float64')
+    all_blocks = data_blocks.get_chunk_aligned_blocks(shape=shape,
+                                                      chunks=data_blocks.get_chunk_shape(data),
+                                                      itemsize=np.dtype(data.dtype).itemsize,
+                                                      max_bytes=max_bytes)
+    # Blocks without any selected spectra are skipped
+    blocks = [block for block in all_blocks if mask is None or np.any(mask[block[:-1]])]
+    info = {'epoch_times': [],
+            'epoch_errors': [],
+            'num_epochs': 0,
+            'converged': False,
+            'num_blocks': len(blocks)}
+    log_helper.debug(__name__, "Number of data blocks: " + str(len(blocks)))
+
+    # Compute the initial W from a random sample of spectra
+    start_time = time.time()
+    sample = []
+    num_sampled = 0
+    for block, block_data in data_blocks.iterate_blocks(data, [blocks[index] for index in
+                                                               random_state.permutation(len(blocks))],
+                                                        num_threads=0):
+        spectra = block_spectra(block_data, mask[block[:-1]] if mask is not None else None)
+        sample.append(spectra)
+        num_sampled += spectra.shape[1]
+        if num_sampled >= init_sample_size:
+            break
+    if num_sampled == 0:
+        raise ValueError("NMF requires at least one selected spectrum.")
+    sample = np.concatenate(sample, axis=1)
+    if sample.shape[1] > init_sample_size:
+        sample = sample[:, np.sort(random_state.choice(sample.shape[1], init_sample_size, replace=False))]
+    w_matrix = initialize_nmf(sample, num_components, init=init, random_state=random_state)[0]
+    # Zeros are fixed points of the multiplicative updates
+    w_matrix[w_matrix <= 0] = max(float(sample.mean()), EPSILON) / 100.
+    del sample
+    info['init_time'] = time.time() - start_time
+
+    # Compute W by iterating over the blocks
+    hht = np.zeros((num_components, num_components), dtype='float64')
+    vht = np.zeros((num_bins, num_components), dtype='float64')
+    previous_error = None
+    for epoch in xrange(max_epochs):
+        epoch_start_time = time.time()
+        hht *= 0.5
+        vht *= 0.5
+        squared_norm = 0.0
+        squared_error = 0.0
+        epoch_blocks = [blocks[index] for index in random_state.permutation(len(blocks))]
+        for block, block_data in data_blocks.iterate_blocks(data, epoch_blocks, num_threads=num_threads):
+            spectra = block_spectra(block_data, mask[block[:-1]] if mask is not None else None)
+            wtw = np.dot(w_matrix.T, w_matrix)
+            h_matrix = solve_h(spectra, w_matrix, num_iter=num_h_iter, wtw=wtw)
+            current_hht = np.dot(h_matrix, h_matrix.T)
+            current_vht = np.dot(spectra, h_matrix.T)
+            # ||V - WH||^2 = ||V||^2 - 2 tr(W^T V H^T) + tr(W^T W H H^T)
+            current_norm = float(np.sum(spectra * spectra))
+            squared_norm += current_norm
+            squared_error += max(current_norm - 2.0 * np.sum(w_matrix * current_vht) + np.sum(wtw * current_hht), 0)
+            hht += current_hht
+            vht += current_vht
+            update_w(w_matrix, hht, vht, num_iter=num_w_iter)
+        current_error = np.sqrt(squared_error / squared_norm) if squared_norm > 0 else 0.0
+        info['epoch_times'].append(time.time() - epoch_start_time)
+        info['epoch_errors'].append(current_error)
+        info['num_epochs'] = epoch + 1
+        log_helper.debug(__name__, "NMF epoch " + str(epoch) + " relative error: " + str(current_error))
+        if previous_error is not None and \
+                abs(previous_error - current_error) <= tolerance * max(previous_error, EPSILON):
+            info['converged'] = True
+            break
+        previous_error = current_error
+        if time_out is not None and (time.time() - start_time) > time_out:
+            break
+
+    # Compute the final loadings and write them to the output
+    h_start_time = time.time()
+    wtw = np.dot(w_matrix.T, w_matrix)
+    squared_norm = 0.0
+    squared_error = 0.0
+    for block, block_data in data_blocks.iterate_blocks(data, blocks, num_threads=num_threads):
+        block_mask = mask[block[:-1]] if mask is not None else None
+        spectra = block_spectra(block_data, block_mask)
+        h_matrix = solve_h(spectra, w_matrix, num_iter=num_h_iter, wtw=wtw)
+        current_norm = float(np.sum(spectra * spectra))
+        squared_norm += current_norm
+        squared_error += max(current_norm - 2.0 * np.sum(w_matrix * np.dot(spectra, h_matrix.T)) +
+                             np.sum(wtw * np.dot(h_matrix, h_matrix.T)), 0)
+        out_block = block[:-1] + (slice(None), )
+        if block_mask is not None:
+            block_out = np.zeros(block_data.shape[:-1] + (num_components, ), dtype=out.dtype)
+            block_out[block_mask] = h_matrix.T
+        else:
+            block_out = h_matrix.T.reshape(block_data.shape[:-1] + (num_components, ))
+        out[out_block] = block_out
+    for block in all_blocks:
+        if mask is not None and not np.any(mask[block[:-1]]):
+            out[block[:-1] + (slice(None), )] = 0
+    info['h_time'] = time.time() - h_start_time
+    info['relative_error'] = np.sqrt(squared_error / squared_norm) if squared_norm > 0 else 0.0
+    return w_matrix, out, info
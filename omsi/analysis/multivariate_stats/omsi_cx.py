@@ -52,37 +52,91 @@ class omsi_cx(analysis_base):
                            default=None,
                            required=False,
                            group=groups['settings'])
+        self.add_parameter(name='method',
+                           help='The method used to compute the leverage scores. exact: Full SVD of the ' +
+                                'in-memory data. randomized: Approximate leverage scores from a randomized SVD ' +
+                                'computed in streaming passes over the data.',
+                           dtype=dtypes['str'],
+                           default='exact',
+                           choices=['exact', 'randomized'],
+                           required=False,
+                           group=groups['settings'])
+        self.add_parameter(name='sketchSize',
+                           help='Number of random vectors used to sketch the range of the data (randomized ' +
+                                'method only). Default is rank+10.',
+                           dtype=dtypes['int'],
+                           default=None,
+                           required=False,
+                           group=groups['settings'])
+        self.add_parameter(name='powerIterations',
+                           help='Number of power iterations, each requiring one pass over the data ' +
+                                '(randomized method only).',
+                           dtype=dtypes['int'],
+                           default=2,
+                           required=False,
+                           group=groups['settings'])
+        self.add_parameter(name='seed',
+                           help='Seed for the random number generator (randomized method only).',
+                           dtype=dtypes['int'],
+                           default=0,
+                           required=False,
+                           group=groups['settings'])
+        self.add_parameter(name='max_block_bytes',
+                           help='Maximum number of bytes of the blocks of spectra processed at once ' +
+                                '(randomized method only).',
+                           dtype=dtypes['int'],
+                           default=256*1024*1024,
+                           required=False,
+                           group=groups['settings'])
+        self.add_parameter(name='num_io_threads',
+                           help='Number of threads used to prefetch blocks of data (randomized method only). ' +
+                                'Set to 0 to disable prefetching.',
+                           dtype=dtypes['int'],
+                           default=1,
+                           required=False,
+                           group=groups['parallel'])
         self.data_names = ['infIndices', 'levScores']
         self.analysis_identifier = name_key
 
     def execute_analysis(self):
-        """ EDIT_ME:
+        """
+        Compute the rank-k leverage scores of the images (objectiveDim=0) or of the
+        pixels (objectiveDim=1) of the MSI data and the corresponding informative
+        indices, i.e., the images or pixels sorted by decreasing leverage score.
 
-            Replace this text with the appropriate documentation for the analysis.
-            Describe what your analysis does and how a user can use it. Note, a user will
-            call the function execute(...) which takes care of storing parameters, collecting
-            execution data etc., so that you only need to implement your analysis, the rest
-            is taken care of by analysis_base. omsi uses Sphynx syntax for the
-            documentation.
+        With method='exact' the leverage scores are computed from the full SVD of the
+        data in memory (see comp_lev_exact). With method='randomized' approximate
+        leverage scores are computed from a randomized SVD in streaming passes over
+        the data (see omsi.analysis.multivariate_stats.cx_randomized), with
+        sketchSize and powerIterations controlling the accuracy.
 
-            Keyword Arguments:
+        Keyword Arguments:
 
-            :param mydata: ...
-            :type mydata: ...
+        :param msidata: The MSI data
+        :param rank: The rank of the leverage scores
+        :param objectiveDim: 0 for image and 1 for pixel leverage scores
+        :param pixelMask: Optional boolean or integer mask of the spectra to be used
+        :param maskIndex: The index selecting the spectra if an integer mask is used
 
         """
         # getting the values into local variables
-        msidata = np.copy(self['msidata'][:])  # Copy all MSI data
-        original_shape = msidata.shape
         rank = self['rank']
         objective_dimensions = self['objectiveDim']
         mask_index = self['maskIndex']
         current_pixel_mask = self['pixelMask']
+        if current_pixel_mask is not None:
+            current_pixel_mask = current_pixel_mask[:]
         if mask_index is not None and current_pixel_mask is not None:
             temp_mask = np.zeros(shape=current_pixel_mask.shape, dtype=bool)
             temp_mask[current_pixel_mask == mask_index] = True
             current_pixel_mask = temp_mask
 
+        if self['method'] == 'randomized':
+            return self.__execute_randomized(current_pixel_mask)
+
+        msidata = self['msidata'][:]  # Load all MSI data
+        original_shape = msidata.shape
+
         # Mask the data if requested
         if current_pixel_mask is not None:
             msidata = msidata[current_pixel_mask, :]
@@ -122,6 +176,44 @@ class omsi_cx(analysis_base):
         # Safe the output results
         return out_informative_indices, out_leverage_scores
 
+    def __execute_randomized(self, current_pixel_mask):
+        """
+        Compute the approximate leverage scores using the randomized method.
+
+        Timing information of the passes over the data is recorded in the run_info of the analysis
+        with the prefix 'cx_'.
+
+        :param current_pixel_mask: Boolean mask of the spectra to be used or None
+
+        :returns: Tuple with the informative indices and leverage scores
+        """
+        from omsi.analysis.multivariate_stats import cx_randomized
+        row_leverage, column_leverage, cx_info = cx_randomized.randomized_leverage_scores(
+            data=self['msidata'],
+            rank=self['rank'],
+            sketch_size=self['sketchSize'],
+            num_power_iterations=self['powerIterations'],
+            mask=current_pixel_mask,
+            random_state=np.random.RandomState(self['seed']),
+            max_bytes=self['max_block_bytes'],
+            num_threads=self['num_io_threads'])
+        for key, value in cx_info.items():
+            self.run_info['cx_' + key] = np.asarray(value) if isinstance(value, list) else value
+
+        # Compute the informative indices in the same layout as for the exact method
+        if self['objectiveDim'] == self.dimension_index['pixelDim']:
+            out_leverage_scores = column_leverage
+            if current_pixel_mask is not None:
+                out_informative_indices = np.zeros(shape=column_leverage.shape, dtype='int')
+                out_informative_indices[:] = -1
+                out_informative_indices[current_pixel_mask] = column_leverage[current_pixel_mask].argsort()[::-1]
+            else:
+                out_informative_indices = column_leverage.reshape(-1).argsort()[::-1].reshape(column_leverage.shape)
+        else:
+            out_leverage_scores = row_leverage
+            out_informative_indices = row_leverage.argsort()[::-1]
+        return out_informative_indices, out_leverage_scores
+
     @classmethod
     def comp_lev_exact(cls,
                        A,
@@ -7,7 +7,15 @@ from omsi.analysis.base import analysis_base
 
 
 class omsi_kmeans(analysis_base):
-    """Class defining a basic nmf analysis for a 2D MSI data file or slice of the data"""
+    """
+    Class defining a basic kmeans analysis for a 2D MSI data file or slice of the data.
+
+    Two methods are supported:
+
+    * 'kmeans' : Load the full data into memory and cluster it using scipy.cluster.vq.kmeans
+    * 'minibatch' : Cluster the spectra using mini-batch k-means sampled from the data \
+        without loading the full data (see omsi.analysis.multivariate_stats.kmeans_streaming)
+    """
 
     def __init__(self, name_key="undefined"):
         """Initalize the basic data members"""
@@ -53,12 +61,62 @@ class omsi_kmeans(analysis_base):
                            default=None,
                            required=False,
                            group=groups['settings'])
+        self.add_parameter(name='method',
+                           help='The clustering method. kmeans: In-memory k-means. minibatch: Mini-batch ' +
+                                'k-means reading the data one block of spectra at a time.',
+                           dtype=dtypes['str'],
+                           default='kmeans',
+                           choices=['kmeans', 'minibatch'],
+                           required=False,
+                           group=groups['settings'])
+        self.add_parameter(name='batchSize',
+                           help='The number of spectra per mini-batch (minibatch method only).',
+                           dtype=dtypes['int'],
+                           default=1024,
+                           required=False,
+                           group=groups['settings'])
+        self.add_parameter(name='numBatches',
+                           help='The maximum number of mini-batches per repeat (minibatch method only).',
+                           dtype=dtypes['int'],
+                           default=100,
+                           required=False,
+                           group=groups['stop'])
+        self.add_parameter(name='seed',
+                           help='Seed for the random number generator (minibatch method only).',
+                           dtype=dtypes['int'],
+                           default=0,
+                           required=False,
+                           group=groups['settings'])
+        self.add_parameter(name='max_block_bytes',
+                           help='Maximum number of bytes of the blocks of spectra processed at once ' +
+                                '(minibatch method only).',
+                           dtype=dtypes['int'],
+                           default=256*1024*1024,
+                           required=False,
+                           group=groups['settings'])
+        self.add_parameter(name='num_io_threads',
+                           help='Number of threads used to prefetch blocks of data (minibatch method only). ' +
+                                'Set to 0 to disable prefetching.',
+                           dtype=dtypes['int'],
+                           default=1,
+                           required=False,
+                           group=groups['parallel'])
+        self.add_parameter(name='num_processes',
+                           help='Number of processes used to execute the repeats in parallel ' +
+                                '(minibatch method only).',
+                           dtype=dtypes['int'],
+                           default=1,
+                           required=False,
+                           group=groups['parallel'])
         self.data_names = ['clusters', 'centers']
 
     def execute_analysis(self):
         """
         Execute the kmeans clustering for the given msidata
         """
+        if self['method'] == 'minibatch':
+            return self.__execute_minibatch()
+
         from scipy.cluster.vq import kmeans, vq
 
         # Assign parameters to local variables for convenience
@@ -117,6 +175,34 @@ class omsi_kmeans(analysis_base):
 
         return cluster, centers
 
+    def __execute_minibatch(self):
+        """
+        Execute the mini-batch kmeans clustering for the given msidata.
+
+        The restarts (numRepeat) are executed in parallel using num_processes processes. Timing and
+        convergence information is recorded in the run_info of the analysis with the prefix 'kmeans_'.
+        """
+        from omsi.analysis.multivariate_stats import kmeans_streaming
+        if self['clusterImages']:
+            raise ValueError("The minibatch method does not support clustering of images.")
+        current_mask = self['mask']
+        centers, cluster, kmeans_info = kmeans_streaming.streaming_kmeans(data=self['msidata'],
+                                                                          num_clusters=self['numClusters'],
+                                                                          mask=current_mask,
+                                                                          normalize=self['normalize'],
+                                                                          batch_size=self['batchSize'],
+                                                                          max_batches=self['numBatches'],
+                                                                          tolerance=self['threshold'],
+                                                                          num_restarts=self['numRepeat'],
+                                                                          random_state=np.random.RandomState(
+                                                                              self['seed']),
+                                                                          max_bytes=self['max_block_bytes'],
+                                                                          num_threads=self['num_io_threads'],
+                                                                          num_processes=self['num_processes'])
+        for key, value in kmeans_info.items():
+            self.run_info['kmeans_' + key] = np.asarray(value) if isinstance(value, list) else value
+        return cluster, centers
+
 
 if __name__ == "__main__":
     from omsi.workflow.driver.cl_analysis_driver import cl_analysis_driver
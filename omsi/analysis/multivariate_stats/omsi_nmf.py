@@ -1,6 +1,9 @@
 """
 Module for performing non-negative matrix factorization (NMF) for MSI data.
 """
+import time
+from tempfile import TemporaryFile
+
 import numpy as np
 
 from omsi.analysis.base import analysis_base
@@ -13,6 +16,13 @@ class omsi_nmf(analysis_base):
     The function has primarily been tested we MSI datasets but should support
     arbitrary n-D arrays (n>=2). The last dimension of the input array must be the
     spectrum dimnensions.
+
+    Two methods are supported:
+
+    * 'pg' : Load the full data into memory and compute the NMF using the projected \
+        gradient solver of omsi.analysis.multivariate_stats.third_party.nmf
+    * 'streaming' : Compute the NMF one block of spectra at a time without loading the full \
+        data (see omsi.analysis.multivariate_stats.nmf_streaming)
     """
 
     def __init__(self, name_key="undefined"):
@@ -56,6 +66,54 @@ class omsi_nmf(analysis_base):
                            default=None,
                            required=False,
                            group=groups['settings'])
+        self.add_parameter(name='method',
+                           help='The NMF method. pg: In-memory projected gradient NMF. ' +
+                                'streaming: Mini-batch NMF processing the data one block of spectra at a time.',
+                           dtype=str,
+                           default='pg',
+                           choices=['pg', 'streaming'],
+                           required=False,
+                           group=groups['settings'])
+        self.add_parameter(name='init',
+                           help='The initialization method. nndsvd: Nonnegative double SVD. nndsvda: NNDSVD ' +
+                                'with zeros filled with the data average. random: Nonnegative random values.',
+                           dtype=str,
+                           default='nndsvd',
+                           choices=['nndsvd', 'nndsvda', 'random'],
+                           required=False,
+                           group=groups['settings'])
+        self.add_parameter(name='seed',
+                           help='Seed for the random number generator used for initialization and sampling.',
+                           dtype=int,
+                           default=0,
+                           required=False,
+                           group=groups['settings'])
+        self.add_parameter(name='numEpochs',
+                           help='Maximum number of passes over the data (streaming method only).',
+                           dtype=int,
+                           default=20,
+                           required=False,
+                           group=groups['stop'])
+        self.add_parameter(name='max_block_bytes',
+                           help='Maximum number of bytes of the blocks of spectra processed at once ' +
+                                '(streaming method only).',
+                           dtype=dtypes['int'],
+                           default=256*1024*1024,
+                           required=False,
+                           group=groups['settings'])
+        self.add_parameter(name='num_io_threads',
+                           help='Number of threads used to prefetch blocks of data (streaming method only). ' +
+                                'Set to 0 to disable prefetching.',
+                           dtype=dtypes['int'],
+                           default=1,
+                           required=False,
+                           group=groups['parallel'])
+        self.add_parameter(name='num_blas_threads',
+                           help='Number of threads used by BLAS. Set to 0 to use the default BLAS settings.',
+                           dtype=dtypes['int'],
+                           default=0,
+                           required=False,
+                           group=groups['parallel'])
         self.data_names = ['wo', 'ho']
 
     @classmethod
@@ -161,9 +219,61 @@ class omsi_nmf(analysis_base):
 
     def execute_analysis(self):
         """
-        Execute the nmf for the given msidata
+        Execute the nmf for the given msidata.
+
+        Convergence and timing information is recorded in the run_info of the analysis with
+        the prefix 'nmf_' (e.g., nmf_init_time, nmf_solve_time, and nmf_relative_error and, for the
+        streaming method, the per-epoch nmf_epoch_errors and nmf_epoch_times).
+        """
+        from omsi.analysis.multivariate_stats import nmf_streaming
+        from omsi.shared.blas_helper import blas_threads
+
+        # Assign parameters to local variables for convenience
+        current_msidata = self['msidata']
+        current_num_components = self['numComponents']
+        current_mask = self['mask']
+        if current_mask is not None:
+            current_mask = np.asarray(current_mask[:], dtype='bool')
+        random_state = np.random.RandomState(self['seed'])
+
+        with blas_threads(self['num_blas_threads']):
+            if self['method'] == 'streaming':
+                output_shape = tuple(current_msidata.shape[:-1]) + (current_num_components,)
+                # Create the output memory map. The memory map remains valid after the temporary file is closed.
+                output_file = TemporaryFile()
+                ho_matrix = np.memmap(output_file, dtype='float64', mode='w+', shape=output_shape)
+                output_file.close()
+                wo_matrix, ho_matrix, nmf_info = nmf_streaming.streaming_nmf(data=current_msidata,
+                                                                             num_components=current_num_components,
+                                                                             out=ho_matrix,
+                                                                             mask=current_mask,
+                                                                             init=self['init'],
+                                                                             random_state=random_state,
+                                                                             max_epochs=self['numEpochs'],
+                                                                             tolerance=self['tolerance'],
+                                                                             time_out=self['timeOut'],
+                                                                             max_bytes=self['max_block_bytes'],
+                                                                             num_threads=self['num_io_threads'])
+                self.run_info['nmf_solve_time'] = float(np.sum(nmf_info['epoch_times']))
+                for key in ['init_time', 'h_time', 'relative_error', 'num_epochs', 'converged', 'num_blocks']:
+                    self.run_info['nmf_' + key] = nmf_info[key]
+                self.run_info['nmf_epoch_errors'] = np.asarray(nmf_info['epoch_errors'])
+                self.run_info['nmf_epoch_times'] = np.asarray(nmf_info['epoch_times'])
+                return wo_matrix, ho_matrix
+            else:
+                return self.__execute_in_memory(random_state)
+
+    def __execute_in_memory(self, random_state):
+        """
+        Execute the in-memory projected gradient nmf. The NNDSVD initialization is computed from a random
+        sample of spectra (see nmf_streaming.initialize_nmf) to avoid the SVD of the full data.
+
+        :param random_state: np.random.RandomState used for the initialization
+
+        :returns: Tuple with the wo and ho matrix
         """
         from omsi.analysis.multivariate_stats.third_party.nmf import nmf
+        from omsi.analysis.multivariate_stats import nmf_streaming
 
         # Assign parameters to local variables for convenience
         current_msidata = self['msidata']
@@ -180,7 +290,7 @@ class omsi_nmf(analysis_base):
 
         # Mask the data if requested
         if current_mask is not None:
-            current_mask = current_mask[:]
+            current_mask = np.asarray(current_mask[:], dtype='bool')
             data = data[current_mask, :]
 
         # Determine the input shape after masking
@@ -192,12 +302,27 @@ class omsi_nmf(analysis_base):
         data = data.transpose()
 
         # Execute nmf
+        start_time = time.time()
+        winit, hinit = nmf_streaming.initialize_nmf(data,
+                                                    current_num_components,
+                                                    init=self['init'],
+                                                    random_state=random_state,
+                                                    sample_size=2000)
+        self.run_info['nmf_init_time'] = time.time() - start_time
+        start_time = time.time()
         (wo_matrix, ho_matrix) = nmf(data,
-                                     np.random.randn(num_bins, current_num_components),
-                                     np.random.randn(current_num_components, num_pixels),
+                                     winit,
+                                     hinit,
                                      current_tolerance,
                                      current_time_out,
                                      current_num_iter)
+        self.run_info['nmf_solve_time'] = time.time() - start_time
+        # ||V - WH||^2 = ||V||^2 - 2 tr(W^T V H^T) + tr(W^T W H H^T) without computing the full residual
+        squared_norm = float(np.sum(np.square(data, dtype='float64')))
+        squared_error = squared_norm - 2.0 * np.sum(wo_matrix * np.dot(data, ho_matrix.T)) + \
+            np.sum(np.dot(wo_matrix.T, wo_matrix) * np.dot(ho_matrix, ho_matrix.T))
+        self.run_info['nmf_relative_error'] = \
+            float(np.sqrt(max(squared_error, 0) / squared_norm)) if squared_norm > 0 else 0.0
 
         # Reshape the ho matrix to be a 3D image cube
         ho_matrix = ho_matrix.transpose()
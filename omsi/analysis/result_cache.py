@@ -0,0 +1,453 @@
+"""
+Module with an opt-in, content-addressed cache for the results of analyses.
+
+The outputs of an analysis are identified by a key that hashes i) the analysis class, ii) the version of the
+code of the analysis (i.e., a digest of the source file of the analysis class and of all omsi modules it
+imports, directly or indirectly), and iii) the values of all parameters of the analysis. Dependencies on
+other in-memory analyses are identified by the key of the analysis they depend on and dependencies on HDF5
+data by the file and object path plus either a modification stamp or a digest of the content of the data.
+
+Cached outputs are retrieved from a local cache directory (one HDF5 file per key) or from analyses stored
+in OMSI files. The key of an analysis is recorded in its run_info (see analysis_result_cache.CACHE_KEY)
+and is, hence, saved together with the analysis when the analysis is stored in an OMSI file.
+
+To enable the cache for all analyses set:
+
+>> from omsi.analysis.base import analysis_base
+>> from omsi.analysis.result_cache import analysis_result_cache
+>> analysis_base.DEFAULT_RESULT_CACHE = analysis_result_cache(cache_directory='/path/to/cache')
+
+"""
+import os
+import sys
+import ast
+import hashlib
+import inspect
+import tempfile
+
+import numpy as np
+import h5py
+
+import omsi.shared.mpi_helper as mpi_helper
+import omsi.shared.data_blocks as data_blocks
+from omsi.shared.log import log_helper
+
+
+class analysis_result_cache(object):
+    """
+    Cache of analysis outputs keyed by the content of the inputs of the analysis.
+
+    :ivar cache_directory: The directory where outputs are stored (one HDF5 file per key). May be None,
+        in which case outputs are only reused from the given OMSI files.
+    :ivar omsi_files: List of omsi_file, omsi_file_experiment, or omsi_file_analysis objects with analyses
+        that may be reused
+    :ivar input_identity: Defines how HDF5 input data is identified (see INPUT_IDENTITIES)
+    :ivar max_bytes: The maximum number of bytes read at once when computing the digest of HDF5 data
+    :ivar hits: The number of executions for which the outputs were reused
+    :ivar misses: The number of executions for which no outputs were found in the cache
+    :ivar stores: The number of outputs stored in the cache directory
+
+    :cvar INPUT_IDENTITIES: Options for identifying HDF5 input data. 'stamp' uses the file and object path,
+        the shape and type of the data, and a modification stamp (the cache key or end time of stored
+        analyses or the modification time of the file). 'digest' uses the file and object path and a
+        digest of the data itself, i.e., the data must be read each time the key is computed.
+    :cvar CACHE_KEY: Name of the run_info entry with the cache key of an analysis
+    """
+    INPUT_IDENTITIES = {'STAMP': 'stamp',
+                        'DIGEST': 'digest'}
+    CACHE_KEY = 'cache_key'
+
+    def __init__(self,
+                 cache_directory=None,
+                 omsi_files=None,
+                 input_identity='stamp',
+                 max_bytes=64*1024*1024):
+        """
+        Initialize the result cache.
+
+        :param cache_directory: The directory where outputs should be stored. The directory is created if necessary.
+        :param omsi_files: Optional omsi_file, omsi_file_experiment, or omsi_file_analysis object (or list of
+            such objects) with stored analyses whose outputs may be reused
+        :param input_identity: Defines how HDF5 input data is identified. One of INPUT_IDENTITIES.
+        :param max_bytes: The maximum number of bytes read at once when computing the digest of HDF5 data
+
+        :raises ValueError: If an invalid input_identity is given
+        """
+        if input_identity not in self.INPUT_IDENTITIES.values():
+            raise ValueError("Invalid input identity given: " + str(input_identity))
+        if omsi_files is not None and not isinstance(omsi_files, list):
+            omsi_files = [omsi_files, ]
+        self.cache_directory = cache_directory
+        self.omsi_files = omsi_files if omsi_files is not None else []
+        self.input_identity = input_identity
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.__code_versions = {}
+        if self.cache_directory is not None and not os.path.isdir(self.cache_directory):
+            try:
+                os.makedirs(self.cache_directory)
+            except OSError:
+                # The directory may have been created by another process in the meantime
+                if not os.path.isdir(self.cache_directory):
+                    raise
+
+    def get_code_version(self, analysis_class):
+        """
+        Get the version of the code of the given analysis class, i.e., the digest of the source file
+        that defines the class and of the source files of all omsi modules it imports (see get_source_files).
+
+        :param analysis_class: The analysis class
+
+        :return: String with the hex digest of the source files or the name of the module if the source
+            is not available
+        """
+        if analysis_class not in self.__code_versions:
+            try:
+                code_version = self.get_source_digest(self.get_source_files(inspect.getsourcefile(analysis_class)))
+            except (TypeError, IOError):
+                code_version = analysis_class.__module__
+            self.__code_versions[analysis_class] = code_version
+        return self.__code_versions[analysis_class]
+
+    @staticmethod
+    def get_source_files(source_file, package_name='omsi', package_root=None):
+        """
+        Get the source files of the given module and of all modules of the package it imports, directly or
+        indirectly. Imports are determined from the source code, i.e., imports inside of functions
+        (e.g., of helper modules used by execute_analysis) are included as well.
+
+        :param source_file: The source file of the module
+        :param package_name: The name of the package whose modules should be included
+        :param package_root: The directory that contains the package. Default value is None, in which case
+            the directory containing the omsi package is used.
+
+        :return: Sorted list of the absolute paths of the source files
+        """
+        if package_root is None:
+            package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+        def module_file(module_name):
+            """Get the source file of the given module of the package or None if it is not a module"""
+            if module_name.split('.')[0] != package_name:
+                return None
+            module_path = os.path.join(package_root, *module_name.split('.'))
+            for filename in [module_path + '.py', os.path.join(module_path, '__init__.py')]:
+                if os.path.isfile(filename):
+                    return filename
+            return None
+
+        source_files = set()
+        pending = [os.path.abspath(source_file)]
+        while len(pending) > 0:
+            filename = pending.pop()
+            if filename in source_files:
+                continue
+            source_files.add(filename)
+            try:
+                with open(filename, 'r') as module_source:
+                    tree = ast.parse(module_source.read(), filename)
+            except (IOError, SyntaxError):
+                continue
+            for node in ast.walk(tree):
+                imported_files = []
+                if isinstance(node, ast.Import):
+                    imported_files = [module_file(alias.name) for alias in node.names]
+                elif isinstance(node, ast.ImportFrom) and node.module is not None and node.level == 0:
+                    # The imported names may be modules or objects defined in the module
+                    imported_files = [module_file(node.module + '.' + alias.name) or module_file(node.module)
+                                      for alias in node.names]
+                pending += [imported_file for imported_file in imported_files if imported_file is not None]
+        return sorted(source_files)
+
+    @staticmethod
+    def get_source_digest(source_files):
+        """
+        Compute the digest of the content of the given source files.
+
+        :param source_files: List of the paths of the source files
+
+        :return: String with the hex digest
+
+        :raises IOError: If a source file cannot be read
+        """
+        digest = hashlib.sha1()
+        for filename in source_files:
+            with open(filename, 'rb') as source_file:
+                digest.update(hashlib.sha1(source_file.read()).hexdigest())
+        return digest.hexdigest()
+
+    def get_key(self, analysis):
+        """
+        Compute the cache key of the given analysis based on its current parameters.
+
+        :param analysis: The analysis object (omsi.analysis.base.analysis_base)
+
+        :return: String with the hex digest key
+        """
+        digest = hashlib.sha1()
+        digest.update(analysis.__class__.__module__ + '.' + analysis.__class__.__name__)
+        digest.update(self.get_code_version(analysis.__class__))
+        for param in sorted(analysis.parameters, key=lambda parameter: parameter['name']):
+            # Profiling does not affect the outputs of the analysis
+            if param['name'] in ['profile_time_and_usage', 'profile_memory']:
+                continue
+            digest.update(unicode(param['name']).encode('utf-8'))
+            self.update_digest(digest, param.get_data_or_default())
+        return digest.hexdigest()
+
+    def update_digest(self, digest, value):
+        """
+        Add the given parameter value to the digest.
+
+        :param digest: The hashlib digest object to be updated
+        :param value: The value of a parameter, e.g., a numpy array, dependency_dict, string, or list
+        """
+        from omsi.datastructures.dependency_data import dependency_dict
+        if isinstance(value, dependency_dict):
+            self.update_dependency_digest(digest, value)
+        elif isinstance(value, np.ndarray):
+            digest.update(value.dtype.str + str(value.shape))
+            if value.dtype.hasobject:
+                digest.update(repr(value.tolist()))
+            else:
+                digest.update(np.ascontiguousarray(value).tostring())
+        elif isinstance(value, h5py.Dataset):
+            self.update_data_digest(digest, value, value.file.filename, value.name)
+        elif isinstance(value, (list, tuple)):
+            digest.update(type(value).__name__ + str(len(value)))
+            for item in value:
+                self.update_digest(digest, item)
+        elif isinstance(value, dict):
+            digest.update('dict' + str(len(value)))
+            for item_key in sorted(value.keys()):
+                self.update_digest(digest, item_key)
+                self.update_digest(digest, value[item_key])
+        elif isinstance(value, basestring):
+            digest.update(unicode(value).encode('utf-8'))
+        else:
+            digest.update(repr(value))
+
+    def update_dependency_digest(self, digest, dependency):
+        """
+        Add the given dependency to the digest. Dependencies on analyses are identified by the key of the
+        analysis and dependencies on HDF5 data by their file and object path and a stamp or digest.
+
+        :param digest: The hashlib digest object to be updated
+        :param dependency: The omsi.datastructures.dependency_data.dependency_dict object
+        """
+        from omsi.analysis.base import analysis_base
+        omsi_object = dependency['omsi_object']
+        digest.update(unicode(dependency['dataname']).encode('utf-8'))
+        digest.update(unicode(dependency['selection']).encode('utf-8'))
+        if isinstance(omsi_object, analysis_base):
+            digest.update(self.get_key(omsi_object))
+        elif hasattr(omsi_object, 'managed_group'):
+            object_path = omsi_object.managed_group.name
+            if dependency['dataname']:
+                object_path += '/' + dependency['dataname']
+            data = dependency.get_data() if self.input_identity == self.INPUT_IDENTITIES['DIGEST'] else omsi_object
+            self.update_data_digest(digest, data, omsi_object.managed_group.file.filename, object_path)
+        else:
+            digest.update(repr(omsi_object))
+
+    def update_data_digest(self, digest, data, filename, object_path):
+        """
+        Add the given HDF5 data to the digest.
+
+        :param digest: The hashlib digest object to be updated
+        :param data: The data. In 'digest' mode the data is read (e.g., h5py.Dataset, omsi_file_msidata, or numpy
+            array). In 'stamp' mode, this may be any omsi_file API object or h5py.Dataset.
+        :param filename: The name of the HDF5 file with the data
+        :param object_path: The path of the data object in the HDF5 file
+        """
+        digest.update(os.path.abspath(filename) + ':' + object_path)
+        if self.input_identity == self.INPUT_IDENTITIES['STAMP']:
+            digest.update(self.get_stamp(data, filename))
+        elif isinstance(data, np.ndarray):
+            self.update_digest(digest, data)
+        elif not hasattr(data, 'shape'):
+            digest.update(self.get_stamp(data, filename))
+        elif len(data.shape) == 0:
+            self.update_digest(digest, np.asarray(data[()]))
+        else:
+            digest.update(np.dtype(data.dtype).str + str(data.shape))
+            blocks = data_blocks.get_chunk_aligned_blocks(shape=data.shape,
+                                                          chunks=data_blocks.get_chunk_shape(data),
+                                                          itemsize=np.dtype(data.dtype).itemsize,
+                                                          max_bytes=self.max_bytes)
+            for _, block_data in data_blocks.iterate_blocks(data, blocks, num_threads=0):
+                digest.update(np.ascontiguousarray(block_data).tostring())
+
+    @staticmethod
+    def get_stamp(data, filename):
+        """
+        Get the modification stamp of the given data object.
+
+        :param data: The omsi_file API object or h5py.Dataset
+        :param filename: The name of the HDF5 file with the data
+
+        :return: String with the stamp. For stored analyses, this is the cache key or end time recorded in the
+            runtime information of the analysis. Otherwise, the stamp is the shape and type of the data and
+            the modification time and size of the file.
+        """
+        if hasattr(data, 'get_all_runinfo_data'):
+            run_info = data.get_all_runinfo_data(load_data=False)
+            for stamp_key in [analysis_result_cache.CACHE_KEY, 'end_time']:
+                if stamp_key in run_info:
+                    return unicode(run_info[stamp_key][0]).encode('utf-8')
+        stamp = ''
+        if hasattr(data, 'shape') and hasattr(data, 'dtype'):
+            stamp += str(data.shape) + np.dtype(data.dtype).str
+        file_stat = os.stat(filename)
+        return stamp + ':' + repr(file_stat.st_mtime) + ':' + str(file_stat.st_size)
+
+    def get_cache_filename(self, key):
+        """
+        Get the name of the file in the cache directory for the given key.
+
+        :param key: The cache key
+
+        :return: String with the filename or None if no cache directory is used
+        """
+        if self.cache_directory is None:
+            return None
+        return os.path.join(self.cache_directory, key + '.h5')
+
+    def get_stored_analyses(self):
+        """
+        Get all analyses stored in the OMSI files of the cache.
+
+        :return: Generator yielding omsi_file_analysis objects
+        """
+        for omsi_object in self.omsi_files:
+            if hasattr(omsi_object, 'get_num_experiments'):
+                experiments = [omsi_object.get_experiment(exp_index)
+                               for exp_index in range(omsi_object.get_num_experiments())]
+            else:
+                experiments = [omsi_object]
+            for experiment in experiments:
+                if hasattr(experiment, 'get_num_analysis'):
+                    for ana_index in range(experiment.get_num_analysis()):
+                        yield experiment.get_analysis(ana_index)
+                elif hasattr(experiment, 'get_all_runinfo_data'):
+                    yield experiment
+
+    def lookup(self, key, analysis_type=None):
+        """
+        Find the outputs for the given key.
+
+        :param key: The cache key
+        :param analysis_type: Optional analysis type. If given, only stored analyses of this type are considered.
+
+        :return: Tuple of (filename, group path) of the HDF5 group with the outputs or None if the key is not cached
+        """
+        cache_filename = self.get_cache_filename(key)
+        if cache_filename is not None and os.path.exists(cache_filename):
+            return cache_filename, '/'
+        for stored_analysis in self.get_stored_analyses():
+            if analysis_type is not None and unicode(stored_analysis.get_analysis_type()[0]) != analysis_type:
+                continue
+            run_info = stored_analysis.get_all_runinfo_data(load_data=False)
+            if self.CACHE_KEY in run_info and unicode(run_info[self.CACHE_KEY][0]) == key:
+                return stored_analysis.managed_group.file.filename, stored_analysis.managed_group.name
+        return None
+
+    def load(self, analysis, key):
+        """
+        Load the cached outputs for the given key into the analysis. The lookup is performed on the
+        MPI root of the analysis and the location of the outputs is broadcast to all ranks.
+
+        :param analysis: The analysis object (omsi.analysis.base.analysis_base)
+        :param key: The cache key of the analysis
+
+        :return: String describing the source of the outputs (i.e., the file and group path) if the outputs
+            were loaded, and None if the key is not cached.
+        """
+        location = None
+        if mpi_helper.get_rank(comm=analysis.mpi_comm) == analysis.mpi_root:
+            location = self.lookup(key, analysis.get_analysis_type())
+        if mpi_helper.get_size(comm=analysis.mpi_comm) > 1:
+            location = analysis.mpi_comm.bcast(location, root=analysis.mpi_root)
+        if location is None:
+            self.misses += 1
+            return None
+        filename, group_path = location
+        self.load_outputs(analysis, filename, group_path)
+        self.hits += 1
+        log_helper.debug(__name__, "Reusing cached outputs for " + str(analysis) + " from " +
+                         filename + ':' + group_path, root=analysis.mpi_root, comm=analysis.mpi_comm)
+        return filename + ':' + group_path
+
+    @staticmethod
+    def load_outputs(analysis, filename, group_path):
+        """
+        Load the outputs stored in the given HDF5 group into the analysis.
+
+        :param analysis: The analysis object (omsi.analysis.base.analysis_base)
+        :param filename: The name of the HDF5 file
+        :param group_path: The path of the HDF5 group with the outputs, i.e., a group in the cache directory
+            or the group of an analysis stored in an OMSI file
+
+        :return: List with the names of the loaded outputs
+        """
+        from omsi.dataformat.omsi_file.format import omsi_format_analysis
+        from omsi.dataformat.omsi_file.format import omsi_format_dependencies
+        ignore_names = [omsi_format_analysis.analysis_identifier,
+                        omsi_format_analysis.analysis_type,
+                        omsi_format_analysis.analysis_parameter_group,
+                        omsi_format_analysis.analysis_runinfo_group,
+                        omsi_format_analysis.analysis_class,
+                        omsi_format_dependencies.dependencies_groupname]
+        with h5py.File(filename, 'r') as cache_file:
+            output_group = cache_file[group_path]
+            if 'data_names' in output_group.attrs:
+                data_names = [unicode(data_name) for data_name in output_group.attrs['data_names']]
+            else:
+                data_names = [unicode(data_name) for data_name in output_group.keys()
+                              if data_name not in ignore_names and isinstance(output_group[data_name], h5py.Dataset)]
+            if len(analysis.data_names) == 0:
+                analysis.data_names = list(data_names)
+            loaded_names = []
+            for data_name in data_names:
+                if data_name in analysis.data_names and data_name in output_group:
+                    analysis[data_name] = output_group[data_name][()]
+                    loaded_names.append(data_name)
+        return loaded_names
+
+    def store(self, analysis, key):
+        """
+        Store the outputs of the analysis in the cache directory. Only the MPI root of the analysis writes
+        the outputs. The outputs are not stored if they cannot be converted to HDF5 datasets, e.g., if outputs
+        are dependencies themselves.
+
+        :param analysis: The analysis object (omsi.analysis.base.analysis_base)
+        :param key: The cache key of the analysis
+
+        :return: Boolean indicating whether the outputs were stored
+        """
+        from omsi.datastructures.dependency_data import dependency_dict
+        cache_filename = self.get_cache_filename(key)
+        if cache_filename is None or mpi_helper.get_rank(comm=analysis.mpi_comm) != analysis.mpi_root:
+            return False
+        outputs = analysis.get_all_analysis_data()
+        if len(outputs) == 0 or any(isinstance(ana_data['data'], dependency_dict) for ana_data in outputs):
+            return False
+        # Write to a temporary file first, so that concurrent runs never see partially written outputs
+        handle, temp_filename = tempfile.mkstemp(suffix='.h5', dir=self.cache_directory)
+        os.close(handle)
+        try:
+            with h5py.File(temp_filename, 'w') as cache_file:
+                cache_file.attrs['data_names'] = np.asarray([str(ana_data['name']) for ana_data in outputs])
+                cache_file.attrs['analysis_type'] = str(analysis.get_analysis_type())
+                for ana_data in outputs:
+                    cache_file[ana_data['name']] = np.asarray(ana_data['data'])
+            os.rename(temp_filename, cache_filename)
+        except (TypeError, ValueError):
+            log_helper.warning(__name__, "Outputs of " + str(analysis) + " could not be cached: " +
+                               str(sys.exc_info()[1]))
+            os.remove(temp_filename)
+            return False
+        self.stores += 1
+        return True
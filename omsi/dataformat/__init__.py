@@ -3,10 +3,18 @@ Package for implementation and specification of file formats.
 """
 
 def mzml_available():
+    """
+    Check whether the mzml file reader is available. The reader
+    does not require additional optional libraries, i.e., this
+    is always True. Kept for backward compatibility.
+    """
+    return True
+
+def xmassmzml_available():
     """
     Check whether additional optional libraries are
     available that are required for the use of the
-    mzml file reader.
+    xmassmzml file reader.
     """
     try:
         import pyteomics
@@ -27,9 +35,8 @@ def imzml_available():
     except ImportError:
         return False
 
-__all__ = ["img_file", "bruckerflex_file", "omsi_file", "file_reader_base"]
-if mzml_available():
-    __all__.append("mzml_file")
+__all__ = ["img_file", "bruckerflex_file", "omsi_file", "file_reader_base", "mzml_file"]
+if xmassmzml_available():
     __all__.append("xmassmzml_file")
 if imzml_available():
     __all__.append("imzml_file")
@@ -84,6 +84,28 @@ class file_reader_base(object):
         """
         raise NotImplementedError('Iteration over spectra not supported by the file reader.')
 
+    def write_spectra(self, data, chunk_shape=None, max_bytes=512*1024*1024, spill_dir=None):
+        """
+        Write all spectra of the current data cube (see spectrum_iter) to the given dataset.
+
+        The spectra are collected in chunk-aligned tiles so that each chunk of the
+        dataset is written only once (see omsi_file.buffered_writer.omsi_buffered_writer).
+
+        :param data: The 3D output dataset (h5py.Dataset, omsi_file_msidata, or numpy array)
+            of the same shape as the current data cube.
+        :param chunk_shape: The chunking of the output dataset. Default is None, in which case
+            the chunking of the dataset is used.
+        :param max_bytes: The maximum number of bytes of the tiles kept in memory.
+        :param spill_dir: The directory for the spill file used for tiles that do not fit in memory.
+
+        :returns: The number of spectra written
+        """
+        from omsi.dataformat.omsi_file.buffered_writer import omsi_buffered_writer
+        writer = omsi_buffered_writer(data=data, chunk_shape=chunk_shape, max_bytes=max_bytes, spill_dir=spill_dir)
+        num_spectra = writer.write_spectra(self.spectrum_iter())
+        writer.close()
+        return num_spectra
+
     def close_file(self):
         """
         Close the file.
@@ -5,7 +5,6 @@ This module provides functionality for reading imzML mass spectrometry image fil
 # import basic packages
 import numpy as np
 import os
-from scipy import interpolate
 # USE xmltodict to expand support for metadata from the imzml files
 
 # import xml parser
@@ -13,6 +12,7 @@ from pyimzml.ImzMLParser import ImzMLParser
 from omsi.dataformat.file_reader_base import *
 from omsi.datastructures.metadata.metadata_data import metadata_dict, metadata_value
 from omsi.shared.log import log_helper
+from omsi.shared.spectrum_reprofile import spectrum_reprofiler
 try:
     import xmltodict
 except ImportError:
@@ -28,9 +28,10 @@ class imzml_file(file_reader_base):
                             'continuous': 'continuous',
                             'processed': 'processed'}
 
+    default_block_bytes = 64*1024*1024
+    """Default number of bytes used to determine the number of spectra to be read at once"""
 
-
-    def __init__(self, basename, requires_slicing=True, resolution=15):
+    def __init__(self, basename, requires_slicing=True, resolution=15, block_size=None):
         """
         Open an imzml file for data reading.
 
@@ -39,12 +40,19 @@ class imzml_file(file_reader_base):
         :type   basename:   string
 
         :param  requires_slicing:   Should the complete data be read into memory
-                             (this makes slicing easier). (default is True)
+                             (this makes slicing easier). (default is True). If set to False, then
+                             slicing via __getitem__ reads only the spectra touched by the selection
+                             from the memory-mapped .ibd file.
         :type   requires_slicing:   bool
 
         :param resolution: For processed data only, the minimum m/z spacing to use for creating the "full" reprofiled
                             data cube
         :type resolution: float
+
+        :param block_size: The maximum number of spectra to be read and resampled at once. This bounds the
+                            peak memory used for reading the data. If None, then the block size is chosen
+                            such that a block uses about imzml_file.default_block_bytes bytes.
+        :type block_size: int
         """
         # Determine the correct base
         if os.path.isdir(basename):
@@ -60,9 +68,10 @@ class imzml_file(file_reader_base):
 
         # Compute the mz axis, pixel coordinates data type etc.
         self.coordinates, self.mz, self.data_type, self.imzml_type, self.dataset_metadata, self.instrument_metadata, \
-        self.method_metadata = self.__compute_file_info(filename=self.basename, resolution=self.resolution)
+        self.method_metadata, self.spectrum_offsets = self.__compute_file_info(filename=self.basename,
+                                                                             resolution=self.resolution)
 
-        self.num_scans = self.coordinates.size
+        self.num_scans = self.coordinates.shape[0]
         log_helper.info(__name__, 'Read %s scans from imzML file.' % self.num_scans)
 
         # Compute step size
@@ -79,17 +88,30 @@ class imzml_file(file_reader_base):
 
         self.shape = (num_x,num_y, self.mz.size)
 
+        # Compute the index of the spectrum for each pixel (-1 if no spectrum is available for a pixel)
+        self.spectrum_map = -np.ones(shape=(num_x, num_y), dtype='int64')
+        self.spectrum_map[self.coordinates[:, 0] - self.x_pos_min, self.coordinates[:, 1] - self.y_pos_min] = \
+            np.arange(self.num_scans)
+
+        # Open the binary data file and determine the number of spectra to be processed at once
+        self.ibd_data = np.memmap(self.spectrum_offsets['ibd_filename'], dtype='uint8', mode='r')
+        self.reprofiler = spectrum_reprofiler(mz_axis=self.mz, mode='profile')
+        if block_size is None:
+            if self.imzml_type == self.available_imzml_types['processed']:
+                block_size = self.reprofiler.get_block_size(max_bytes=self.default_block_bytes)
+            else:
+                block_size = self.default_block_bytes // max(self.mz.size * np.dtype(self.data_type).itemsize, 1)
+        self.block_size = max(int(block_size), 1)
+
         # Read the data into memory
         self.data = None
         if requires_slicing:
-            self.__read_all(filename=basename)
+            self.__read_all()
 
         log_helper.info(__name__, "IMZML file type: " + str(self.imzml_type))
         log_helper.info(__name__, "IMZML data type: " + str(self.data_type))
 
-
-
-    def __read_all(self, filename):
+    def __read_all(self):
         """
         Internal helper function used to read all data. The
         function directly modifies the self.data entry.  Data is now a list of datacubes.
@@ -97,29 +119,11 @@ class imzml_file(file_reader_base):
 
         self.data = np.zeros(shape=self.shape, dtype=self.data_type)
         log_helper.info(__name__, 'Datacube shape is %s' % [self.data.shape])
-        reader = ImzMLParser(filename)
         log_helper.debug(__name__,'READING ALL DATA!! GIVE ME RAM (please)!')
-
-        # Compute the bin edges for reinterpolation if needed
-        if self.imzml_type == self.available_imzml_types['processed']:
-            shift = np.diff(self.mz).mean()
-            bin_edges = np.append(self.mz, self.mz[-1]+ shift)
-        else:
-            bin_edges = None
-        for ind in xrange(0, len(reader.coordinates)):
-            xidx, yidx = reader.coordinates[ind]
+        for spectrum_indices, spectra in self.__iter_spectrum_blocks(np.arange(self.num_scans)):
             # Coordinates may start at arbitrary locations, hence, we need to substract the minimum to recenter at (0,0)
-            xidx -= self.x_pos_min
-            yidx -= self.y_pos_min
-            # Read the spectrum
-            mz, intens = reader.getspectrum(ind)
-            # Reinterpolate intensities if we are in processed mode
-            if bin_edges is not None:
-                f = interpolate.interp1d(mz,intens,fill_value=0,bounds_error=False)
-                intens = f(self.mz)
-                #intens, bin_edges_new = np.histogram(mz, bins=bin_edges, weights=intens)
-            # Save the intensity values in our data cube
-            self.data[xidx, yidx, :] = intens
+            self.data[self.coordinates[spectrum_indices, 0] - self.x_pos_min,
+                      self.coordinates[spectrum_indices, 1] - self.y_pos_min, :] = spectra
 
     def spectrum_iter(self):
         """
@@ -128,22 +132,61 @@ class imzml_file(file_reader_base):
         :yield: yi,          a numpy 1D-array of floats containing spectral intensities at the given position
                                 and for the selected datacube type
         """
-        reader = ImzMLParser(self.basename)
-        for idx in xrange(0, len(reader.coordinates)):
-            xidx, yidx, zidx = reader.coordinates[idx]
-            # Coordinates may start at arbitrary locations, hence, we need to substract the minimum to recenter at (0,0)
-            xidx -= self.x_pos_min
-            yidx -= self.y_pos_min
-            mz, intens = reader.getspectrum(idx)
-            # Rehistogram the data if we are in procesed mode
-            if self.imzml_type == self.available_imzml_types['processed']:
-                # shift = np.diff(self.mz).mean()
-                # bin_edges = np.append(self.mz, self.mz[-1]+ shift)
-                f = interpolate.interp1d(mz,intens,fill_value=0,bounds_error=False)
-                intens = f(self.mz)
-                # intens, bin_edges_new = np.histogram(mz, bins=bin_edges, weights=intens)
+        for spectrum_indices, spectra in self.__iter_spectrum_blocks(np.arange(self.num_scans)):
+            for block_index, spectrum_index in enumerate(spectrum_indices):
+                # Coordinates may start at arbitrary locations, hence, we need to substract the minimum
+                # to recenter at (0,0)
+                xidx = int(self.coordinates[spectrum_index, 0] - self.x_pos_min)
+                yidx = int(self.coordinates[spectrum_index, 1] - self.y_pos_min)
+                yield (xidx, yidx), spectra[block_index, :]
+
+    def __iter_spectrum_blocks(self, spectrum_indices):
+        """
+        Internal generator function used to read a list of spectra in blocks of self.block_size spectra.
 
-            yield (xidx, yidx), np.asarray(intens)
+        :param spectrum_indices: 1D numpy array with the indices of the spectra to be read
+
+        :yield: Tuple of (block_indices, spectra) with the 1D array of the spectrum indices of the block
+            and the 2D array of shape (len(block_indices), self.mz.size) with the spectra of the block.
+        """
+        for start in xrange(0, len(spectrum_indices), self.block_size):
+            block_indices = spectrum_indices[start:(start + self.block_size)]
+            yield block_indices, self.__read_spectra(block_indices)
+
+    def __read_spectra(self, spectrum_indices):
+        """
+        Internal helper function used to read a set of spectra from the memory-mapped .ibd file.
+        Spectra of processed imzML files are resampled onto the common m/z axis using self.reprofiler.
+
+        :param spectrum_indices: 1D numpy array with the indices of the spectra to be read
+
+        :returns: 2D numpy array of shape (len(spectrum_indices), self.mz.size)
+        """
+        offsets = self.spectrum_offsets
+        intensities = [self.__read_array(offsets['intensity_offsets'][index],
+                                         offsets['intensity_lengths'][index],
+                                         offsets['intensity_dtype']) for index in spectrum_indices]
+        if self.imzml_type == self.available_imzml_types['processed']:
+            mzs = [self.__read_array(offsets['mz_offsets'][index],
+                                     offsets['mz_lengths'][index],
+                                     offsets['mz_dtype']) for index in spectrum_indices]
+            return self.reprofiler.reprofile(mzs=mzs, intensities=intensities)
+        spectra = np.zeros(shape=(len(spectrum_indices), self.mz.size), dtype=self.data_type)
+        for block_index, intensity in enumerate(intensities):
+            spectra[block_index, :] = intensity
+        return spectra
+
+    def __read_array(self, offset, length, dtype):
+        """
+        Internal helper function used to read a single binary array from the memory-mapped .ibd file.
+
+        :param offset: The offset of the array in bytes
+        :param length: The number of elements of the array
+        :param dtype: The numpy dtype of the array
+
+        :returns: 1D numpy array
+        """
+        return self.ibd_data[int(offset):(int(offset) + int(length) * dtype.itemsize)].view(dtype)
 
     @classmethod
     def __compute_file_info(cls, filename, resolution):
@@ -157,11 +200,11 @@ class imzml_file(file_reader_base):
         :return: Numpy array with mz axis
         :return: string with data type
         :return: imzml file type
-        :return:
+        :return: dataset, instrument, and method metadata_dict
+        :return: dict with the 'ibd_filename' and the 'mz_offsets', 'mz_lengths', 'mz_dtype', 'intensity_offsets',
+            'intensity_lengths', 'intensity_dtype' describing the location of the spectra in the .ibd file
         """
         reader = ImzMLParser(filename)
-        # Read the first spectrum
-        mz_axes, intens = reader.getspectrum(0)   # NOTE: mz_axes is a tuple
         # Read the coordinates
         coordinates = np.asarray(reader.coordinates)
 
@@ -170,25 +213,48 @@ class imzml_file(file_reader_base):
         # coordinates[:,1] = coordinates[:,1] - np.amin(coordinates,axis=0)[1]
         # coordinates[:,2] = coordinates[:,2] - np.amin(coordinates,axis=0)[2]
 
+        # Read the location of the spectra in the binary .ibd file
+        spectrum_offsets = {'ibd_filename': os.path.splitext(filename)[0] + '.ibd',
+                            'mz_offsets': np.asarray(reader.mzOffsets, dtype='int64'),
+                            'mz_lengths': np.asarray(reader.mzLengths, dtype='int64'),
+                            'mz_dtype': np.dtype(reader.mzPrecision),
+                            'intensity_offsets': np.asarray(reader.intensityOffsets, dtype='int64'),
+                            'intensity_lengths': np.asarray(reader.intensityLengths, dtype='int64'),
+                            'intensity_dtype': np.dtype(reader.intensityPrecision)}
+        if not os.path.isfile(spectrum_offsets['ibd_filename']):
+            spectrum_offsets['ibd_filename'] = reader.m.name
+        ibd_data = np.memmap(spectrum_offsets['ibd_filename'], dtype='uint8', mode='r')
+
+        def read_mz(index, start=0, stop=None):
+            """Read the m/z values [start:stop] of the spectrum with the given index from the .ibd file"""
+            mz_dtype = spectrum_offsets['mz_dtype']
+            stop = spectrum_offsets['mz_lengths'][index] if stop is None else stop
+            offset = spectrum_offsets['mz_offsets'][index] + start * mz_dtype.itemsize
+            return ibd_data[int(offset):int(offset + (stop - start) * mz_dtype.itemsize)].view(mz_dtype)
+
         # Determine the data type for the internsity values
-        dtype = np.asarray(intens).dtype.str
+        dtype = spectrum_offsets['intensity_dtype'].str
 
-        # Compute the mz axis and file type
+        # Compute the mz axis and file type. The file is continuous if all spectra share the same
+        # m/z array, which is the case if all spectra point to the same m/z array in the .ibd file
+        # or if all m/z arrays are the same.
+        mz_axes = np.array(read_mz(0))
         file_type = cls.available_imzml_types['continuous']
-        min_mz, max_mz = np.amin(mz_axes), np.amax(mz_axes)
-        for ind in range(coordinates.shape[0]):      #for ind, loc in enumerate(reader.coordinates):
-            mz, intens = reader.getspectrum(ind)
-            if mz == mz_axes:
-                pass
-            else:
+        if not np.all(spectrum_offsets['mz_offsets'] == spectrum_offsets['mz_offsets'][0]):
+            if not np.all(spectrum_offsets['mz_lengths'] == spectrum_offsets['mz_lengths'][0]):
                 file_type = cls.available_imzml_types['processed']
-                if min_mz > np.amin(mz):
-                    min_mz = np.amin(mz)
-                if max_mz < np.amax(mz):
-                    max_mz = np.amax(mz)
+            else:
+                for ind in xrange(1, coordinates.shape[0]):
+                    if not np.array_equal(read_mz(ind), mz_axes):
+                        file_type = cls.available_imzml_types['processed']
+                        break
         # Reinterpolate the mz-axis if we have a processed mode imzml file
         if file_type == cls.available_imzml_types['processed']:
-            f = np.ceil(1e6 * np.log(max_mz/min_mz)/resolution)
+            # The m/z values of each spectrum are sorted so we only need to read the first and last value
+            nonempty = np.flatnonzero(spectrum_offsets['mz_lengths'] > 0)
+            min_mz = min([read_mz(ind, 0, 1)[0] for ind in nonempty])
+            max_mz = max([read_mz(ind, spectrum_offsets['mz_lengths'][ind] - 1)[0] for ind in nonempty])
+            f = int(np.ceil(1e6 * np.log(max_mz/min_mz)/resolution))
             mz_axes = np.logspace(np.log10(min_mz), np.log10(max_mz), f)
             log_helper.info(__name__, "Reinterpolated m/z axis for processed imzML file")
 
@@ -204,6 +270,8 @@ class imzml_file(file_reader_base):
                                                  ontology=None)
 
         # Delete the parser and read the metadata
+        if hasattr(reader, 'm'):
+            reader.m.close()
         del reader
 
         # Parse the metadata for the file. We try to parse only the header and ignore the
@@ -245,7 +313,8 @@ class imzml_file(file_reader_base):
         except:
             log_helper.warning(__name__, "Extraction of additional imzML metadata failed")
 
-        return coordinates, np.asarray(mz_axes), dtype, file_type, dataset_metadata, instrument_metadata, method_metadata
+        return coordinates, np.asarray(mz_axes), dtype, file_type, dataset_metadata, instrument_metadata, \
+            method_metadata, spectrum_offsets
 
     @classmethod
     def test(cls):
@@ -255,18 +324,41 @@ class imzml_file(file_reader_base):
         pass
 
     def __getitem__(self, key):
-        """Enable slicing of img files"""
+        """
+        Enable slicing of imzml files.
+
+        If the object has not been initialized with requires_slicing=True, then only the spectra
+        touched by the selection are read from the memory-mapped .ibd file, in blocks of at most
+        self.block_size spectra.
+        """
         if self.data is not None:
-            if self.select_dataset is None:
-                return self.data[key]
-            else:
-                return self.data[self.select_dataset][key]
-        else:
-            raise ValueError("Slicing is currently only supported when the object has been initialized with readall")
+            return self.data[key]
+        if not isinstance(key, tuple):
+            key = (key, )
+        key = key + (slice(None), ) * (3 - len(key))
+        x_indices = np.arange(self.shape[0])[key[0]]
+        y_indices = np.arange(self.shape[1])[key[1]]
+        mz_indices = np.arange(self.shape[2])[key[2]]
+        result = np.zeros(shape=(np.size(x_indices), np.size(y_indices), np.size(mz_indices)), dtype=self.data_type)
+        selected_spectra = self.spectrum_map[np.ix_(np.atleast_1d(x_indices), np.atleast_1d(y_indices))]
+        result_positions = np.argwhere(selected_spectra >= 0)
+        # Read the spectra in the order in which they are stored in the file
+        order = np.argsort(selected_spectra[result_positions[:, 0], result_positions[:, 1]], kind='mergesort')
+        result_positions = result_positions[order]
+        spectrum_indices = selected_spectra[result_positions[:, 0], result_positions[:, 1]]
+        start = 0
+        for block_indices, spectra in self.__iter_spectrum_blocks(spectrum_indices):
+            block_positions = result_positions[start:(start + len(block_indices))]
+            result[block_positions[:, 0], block_positions[:, 1], :] = spectra[:, mz_indices].reshape(
+                (len(block_indices), -1))
+            start += len(block_indices)
+        return result.reshape(tuple([result.shape[axis]
+                                     for axis, indices in enumerate([x_indices, y_indices, mz_indices])
+                                     if np.ndim(indices) > 0]))
 
     def close_file(self):
         """Close the mzml file"""
-        pass
+        self.ibd_data = None
 
     @classmethod
     def is_valid_dataset(cls, name):
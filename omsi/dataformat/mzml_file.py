@@ -1,20 +1,31 @@
 """
 This module provides functionality for reading mzml mass spectrometry image files.
 
+The mzML file is parsed only once. During this single streaming pass the reader collects the
+scan types, coordinates, m/z ranges and the byte offsets of all spectra into a compact index of
+numpy arrays. The index is saved as a sidecar file next to the mzML file (see
+mzml_file.index_file_extension) so that later opens of the same file load the index directly
+and spectra are read by seeking straight to their location in the file.
+
 filename = '/Users/oruebel/Devel/openmsi-data/mzML_Data/N2A2_Serratia_spots_extract_TI.mzML'
 """
 import re
 import os
+import zlib
+import base64
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 
 import numpy as np
 
-from pyteomics import mzml
-
 from omsi.dataformat.file_reader_base import file_reader_base_multidata
 from omsi.datastructures.dependency_data import dependency_dict
 from omsi.datastructures.metadata.metadata_data import metadata_dict, metadata_value
 from omsi.datastructures.metadata.metadata_ontologies import METADATA_ONTOLOGIES
 from omsi.shared.log import log_helper
+from omsi.shared.spectrum_reprofile import spectrum_reprofiler
 
 
 class mzml_file(file_reader_base_multidata):
@@ -22,11 +33,26 @@ class mzml_file(file_reader_base_multidata):
     Interface for reading a single 2D mzml file with several distinct scan types.
 
     :ivar available_mzml_types: Dict of available mzml flavors.
+    :ivar index_file_extension: Extension appended to the name of the mzML file to create the name
+        of the sidecar file with the spectrum index.
+    :ivar index_version: Version of the layout of the spectrum index. Sidecar files with a
+        different version are ignored and recreated.
+    :ivar write_index_file: Boolean indicating whether the spectrum index should be saved as a
+        sidecar file. (default is True)
+    :ivar default_block_bytes: Approximate number of bytes used to read and reprofile blocks of spectra.
+    :ivar numpress_codecs: List of the names of the supported MS-Numpress compressions.
     """
 
     available_mzml_types = {'unknown': 'unknown',
                             'bruker': 'bruker',
                             'thermo': 'thermo'}
+    index_file_extension = '.omsi_index.npz'
+    index_version = 1
+    write_index_file = True
+    default_block_bytes = 64*1024*1024
+    numpress_codecs = ['MS-Numpress linear prediction compression',
+                       'MS-Numpress positive integer compression',
+                       'MS-Numpress short logged float compression']
 
     def __init__(self, basename, requires_slicing=True, resolution=5):
         """
@@ -55,18 +81,21 @@ class mzml_file(file_reader_base_multidata):
         # Call super constructor. This sets self.basename and self.readall
         super(mzml_file, self).__init__(basename=basename, requires_slicing=requires_slicing)
         self.resolution = resolution
-        self.mzml_type = self.__compute_filetype(filename=self.basename)
         self.data_type = 'uint32'  # TODO What data type should we use for the interpolated data?
-        self.num_scans = self.__compute_num_scans(filename=self.basename)
+        log_helper.debug(__name__, 'Compute spectrum index')
+        self.param_groups = self.__read_param_groups(filename=self.basename)
+        self.spectrum_index = self.__load_or_build_index(filename=self.basename, param_groups=self.param_groups)
+        self.mzml_type = self.spectrum_index['mzml_type']
+        self.num_scans = self.spectrum_index['offsets'].shape[0]
         log_helper.info(__name__, 'Read %s scans from mzML file.' % self.num_scans)
-        log_helper.debug(__name__, 'Compute scan types and indicies')
-        self.scan_types, self.scan_indices, self.scan_profiled = self.__compute_scan_types_and_indices(filename=self.basename)
+        self.scan_types = self.spectrum_index['scan_types']
+        self.scan_indices = self.spectrum_index['scan_indices']
+        self.scan_profiled = self.spectrum_index['scan_profiled']
         log_helper.debug(__name__, 'Compute scan dependencies')
         self.scan_dependencies = self.__compute_scan_dependencies(scan_types=self.scan_types,
                                                                   basename=basename)
         log_helper.info(__name__, 'Found %s different scan types in mzML file.' % len(self.scan_types))
-        log_helper.debug(__name__, 'Compute coordinates')
-        self.coordinates = self.__compute_coordinates()
+        self.coordinates = self.spectrum_index['coordinates']
         log_helper.debug(__name__, 'Parse scan parameters')
         self.scan_params = self.__parse_scan_parameters(self)
 
@@ -74,13 +103,24 @@ class mzml_file(file_reader_base_multidata):
         self.x_pos = np.unique(self.coordinates[:, 0])
         self.y_pos = np.unique(self.coordinates[:, 1])
         self.step_size = min([min(np.diff(self.x_pos)), min(np.diff(self.y_pos))])
+        # Compute the (x, y) index of each spectrum and for each scan type the spectrum of each pixel
+        self.pixel_indices = np.column_stack((np.searchsorted(self.x_pos, self.coordinates[:, 0]),
+                                              np.searchsorted(self.y_pos, self.coordinates[:, 1])))
+        self.spectrum_map = []
+        for scan_idx in range(len(self.scan_types)):
+            current_map = -np.ones(shape=(self.x_pos.shape[0], self.y_pos.shape[0]), dtype='int64')
+            spectrum_indices = np.flatnonzero(self.scan_indices == scan_idx)
+            current_map[self.pixel_indices[spectrum_indices, 0], self.pixel_indices[spectrum_indices, 1]] = \
+                spectrum_indices
+            self.spectrum_map.append(current_map)
 
         # Compute the mz axis
         log_helper.debug(__name__, 'Compute mz axes')
-        self.mz_all = self.__compute_mz_axis(filename=self.basename,
-                                             mzml_filetype=self.mzml_type,
-                                             scan_types=self.scan_types,
-                                             resolution=self.resolution)
+        self.mz_all = self.__compute_mz_axis()
+        # Re-interpolate the data in profiled mode and re-histogram the data in centroided mode
+        self.reprofilers = [spectrum_reprofiler(mz_axis=mz,
+                                                mode='profile' if self.scan_profiled[scan_idx] else 'centroid')
+                            for scan_idx, mz in enumerate(self.mz_all)]
 
         # Determine the shape of the dataset, result is a list of shapes for each datacube
         self.shape_all_data = [(self.x_pos.shape[0], self.y_pos.shape[0], mz.shape[0]) for mz in self.mz_all]
@@ -98,171 +138,170 @@ class mzml_file(file_reader_base_multidata):
         function directly modifies the self.data entry.  Data is now a list of datacubes
         """
 
-        self.data = [np.zeros(shape=self.shape_all_data[scan_idx], dtype=self.data_type) for scan_idx, scantype in enumerate(self.scan_types)]
-
+        self.data = [np.zeros(shape=self.shape_all_data[scan_idx], dtype=self.data_type)
+                     for scan_idx, scantype in enumerate(self.scan_types)]
         for scan_idx, scantype in enumerate(self.scan_types):
-            reader = mzml.read(self.basename)
-            spectrumid = 0
-            if not self.scan_profiled[scan_idx]:
-                shift = np.diff(self.mz_all[scan_idx]).mean()
-                bin_edges = np.append(self.mz_all[scan_idx], self.mz_all[scan_idx][-1]+ shift)
-            else:
-                bin_edges = None
-
-            for spectrum in reader:
-                if spectrum['scanList']['scan'][0]['filter string'] == scantype:
-                    x = spectrum['m/z array']
-                    try:
-                        y = spectrum['intensity array']
-                    except KeyError:
-                        raise KeyError
-                    if bin_edges is None:
-                        yi = np.interp(self.mz_all[scan_idx], x, y, 0, 0)  # Re-interpolate the data in profiled mode
-                    else:
-                         yi, _ = np.histogram(x, bins=bin_edges, weights=y)   # Re-histogram the data in centroided mode
-                    xidx = np.nonzero(self.x_pos == self.coordinates[spectrumid, 0])[0]
-                    yidx = np.nonzero(self.y_pos == self.coordinates[spectrumid, 1])[0]
-                    try:
-                        self.data[scan_idx][xidx, yidx, :] = yi
-                    except:
-                        log_helper.debug(__name__, spectrumid, scan_idx, scantype, self.mz_all[scan_idx].shape)
-            # TODO Note if the data is expected to be of float precision then self.data_type needs to be set accordingly
-                if spectrumid%1000 == 0:
-                    log_helper.info(__name__, 'Processed data for %s spectra to datacube for scan type %s' % (spectrumid, scantype))
-                spectrumid += 1
+            num_read = 0
+            for spectrum_indices, spectra in self.__iter_spectrum_blocks(scan_idx):
+                self.data[scan_idx][self.pixel_indices[spectrum_indices, 0],
+                                    self.pixel_indices[spectrum_indices, 1], :] = spectra
+                # TODO Note if the data is expected to be of float precision then self.data_type needs to be
+                #      set accordingly
+                num_read += len(spectrum_indices)
+                log_helper.info(__name__, 'Processed data for %s spectra to datacube for scan type %s' %
+                                (num_read, scantype))
 
     def spectrum_iter(self):
         """
         Generator function that yields a position and associated spectrum for a selected datacube type.
 
+        Only the spectra of the selected datacube type are read from file using the byte offsets
+        stored in the spectrum index.
+
         :yield: (xidx, yidx) a tuple of ints representing x and y position in the image
         :yield: yi,          a numpy 1D-array of floats containing spectral intensities at the given position \
                              and for the selected datacube type
 
         """
-        reader = mzml.read(self.basename)
         if self.select_dataset is None:
-           raise ValueError('Select a dataset to continue!')
+            raise ValueError('Select a dataset to continue!')
         dataset_index = self.select_dataset
-        for idx, spectrum in enumerate(reader):
-            current_scan_index = self.scan_indices[idx]
-
-            if current_scan_index == dataset_index:
-                # get the mz axis of the datacube the scan belongs to
-                mz = self.mz_all[self.scan_indices[idx]]
-                x = spectrum['m/z array']
-                try:
-                    y = spectrum['intensity array']
-                except KeyError:
-                    raise KeyError('Key "intensity array" not found in this mzml file')
+        for spectrum_indices, spectra in self.__iter_spectrum_blocks(dataset_index):
+            for block_index, spectrum_index in enumerate(spectrum_indices):
+                xidx, yidx = self.pixel_indices[spectrum_index]
+                yield (int(xidx), int(yidx)), spectra[block_index, :]
 
-                if self.scan_profiled[current_scan_index]:
-                    yi = np.interp(mz, x, y, 0, 0)      # Interpolate the data onto the new axes in profiles mode
-                else:
-                    shift = np.diff(mz).mean()
-                    bin_edges = np.append(mz, mz[-1]+ shift)
-                    yi, _ = np.histogram(x, bins=bin_edges, weights=y)   # Re-histogram the data in centroided mode
-                xidx = np.nonzero(self.x_pos == self.coordinates[idx, 0])[0][0]
-                yidx = np.nonzero(self.y_pos == self.coordinates[idx, 1])[0][0]
+    def get_spectrum(self, spectrum_index):
+        """
+        Read the raw m/z and intensity arrays of a single spectrum from file.
 
-                yield (xidx, yidx), yi
+        :param spectrum_index: Index of the spectrum in the mzML file.
+        :type spectrum_index: int
 
+        :returns: Tuple of two 1D numpy arrays with the m/z and intensity values of the spectrum.
+        """
+        for _, mz, intensity in self.__read_spectra([spectrum_index]):
+            return mz, intensity
 
-    @classmethod
-    def __compute_mz_axis(cls, filename, mzml_filetype, scan_types, resolution):
+    def __read_spectra(self, spectrum_indices):
+        """
+        Internal generator function used to read a series of spectra from file by seeking
+        directly to the byte offsets of the spectra stored in the spectrum index.
+
+        :param spectrum_indices: List or 1D numpy array of spectrum indices to be read.
+
+        :yield: Tuple of (spectrum_index, mz, intensity) for each spectrum
+        """
+        offsets = self.spectrum_index['offsets']
+        lengths = self.spectrum_index['lengths']
+        with open(self.basename, 'rb') as infile:
+            for spectrum_index in spectrum_indices:
+                infile.seek(int(offsets[spectrum_index]))
+                spectrum = self.__parse_spectrum_element(element_bytes=infile.read(int(lengths[spectrum_index])),
+                                                         param_groups=self.param_groups)
+                if 'intensity array' not in spectrum:
+                    raise KeyError('Key "intensity array" not found in this mzml file')
+                yield spectrum_index, spectrum['m/z array'], spectrum['intensity array']
+
+    def __iter_spectrum_blocks(self, scan_idx, spectrum_indices=None):
+        """
+        Internal generator function used to read and reprofile the spectra of a scan type in blocks.
+        The number of spectra per block is chosen such that a block uses about
+        mzml_file.default_block_bytes bytes of memory.
+
+        :param scan_idx: Index of the scan type / datacube of the spectra
+        :param spectrum_indices: 1D numpy array with the indices of the spectra to be read. All spectra
+            must be of the given scan type. If None, then all spectra of the scan type are read.
+
+        :yield: Tuple of (block_indices, spectra) with the 1D array of the spectrum indices of the block
+            and the 2D float64 array of shape (len(block_indices), len(self.mz_all[scan_idx])) with the
+            reprofiled spectra.
+        """
+        if spectrum_indices is None:
+            spectrum_indices = np.flatnonzero(self.scan_indices == scan_idx)
+        reprofiler = self.reprofilers[scan_idx]
+        block_size = reprofiler.get_block_size(max_bytes=self.default_block_bytes)
+        for start in xrange(0, len(spectrum_indices), block_size):
+            block_indices = spectrum_indices[start:(start + block_size)]
+            mzs = []
+            intensities = []
+            for _, mz, intensity in self.__read_spectra(block_indices):
+                mzs.append(mz)
+                intensities.append(intensity)
+            yield block_indices, reprofiler.reprofile(mzs=mzs, intensities=intensities)
+
+    def __compute_mz_axis(self):
         ## TODO completely refactor this to make it smartly handle profile or centroid datasets
         ## TODO: centroid datasets should take in a user parameter "Resolution" and resample data at that resolution
         ## TODO: profile datasets should work as is
         ## TODO: checks for profile data vs. centroid data on the variation in length of ['m/z array']
         """
-        Internal helper function used to compute the mz axis of each scantype
+        Internal helper function used to compute the mz axis of each scantype from the spectrum index.
         Returns a list of numpy arrays
         """
-        reader = mzml.read(filename)
-
-        if mzml_filetype == cls.available_mzml_types['thermo']:
-
-            mz_axes = [np.array([]) for _ in scan_types]
-            # all_centroid = True
-            for spectrum in reader:
-                scanfilt = spectrum['scanList']['scan'][0]['filter string']
-                scantype_idx = scan_types.index(scanfilt)
-                mz = spectrum['m/z array']
-                try:
-                    len_axes = len(mz_axes[scantype_idx])
-                except TypeError:
-                    len_axes = 1
-                if spectrum.has_key('profile spectrum'):
-                    # all_centroid = False
-                    if len(mz) > len_axes:
-                        mzdiff = np.diff(mz).min()
-                        mzmin = spectrum['scanList']['scan'][0]['scanWindowList']['scanWindow'][0]['scan window lower limit']
-                        mzmax = spectrum['scanList']['scan'][0]['scanWindowList']['scanWindow'][0]['scan window upper limit']
-                        mz_axes[scantype_idx] = np.arange(start=mzmin, stop=mzmax, step=mzdiff)
-                        mz_axes[scantype_idx] = np.append(arr=mz_axes[scantype_idx], values=mzmax)
+        if self.mzml_type == self.available_mzml_types['thermo']:
+            mz_axes = [np.array([]) for _ in self.scan_types]
+            scan_indices = self.scan_indices.tolist()
+            mz_count = self.spectrum_index['mz_count'].tolist()
+            for spectrum_index, scantype_idx in enumerate(scan_indices):
+                if scantype_idx < 0 or mz_count[spectrum_index] <= mz_axes[scantype_idx].shape[0]:
+                    continue
+                mzmin = float(self.spectrum_index['window_lower'][spectrum_index])
+                mzmax = float(self.spectrum_index['window_upper'][spectrum_index])
+                if self.spectrum_index['profiled'][spectrum_index]:
+                    mzdiff = float(self.spectrum_index['mz_min_diff'][spectrum_index])
+                    mz_axes[scantype_idx] = np.arange(start=mzmin, stop=mzmax, step=mzdiff)
+                    mz_axes[scantype_idx] = np.append(arr=mz_axes[scantype_idx], values=mzmax)
                 else:
-                    if len(mz) > len_axes:
-                        mzmin = spectrum['scanList']['scan'][0]['scanWindowList']['scanWindow'][0]['scan window lower limit']
-                        mzmax = spectrum['scanList']['scan'][0]['scanWindowList']['scanWindow'][0]['scan window upper limit']
-                        f = np.ceil(1e6 * np.log(mzmax/mzmin)/resolution)
-                        mz_axes[scantype_idx] = np.logspace(np.log10(mzmin), np.log10(mzmax), f)
-                        # ['count', 'index', 'highest observed m/z', 'm/z array', 'total ion current', 'ms level', 'spotID', 'lowest observed m/z', 'defaultArrayLength', 'intensity array', 'centroid spectrum', 'positive scan', 'MS1 spectrum', 'spectrum title', 'base peak intensity', 'scanList', 'id', 'base peak m/z']
-
+                    f = int(np.ceil(1e6 * np.log(mzmax/mzmin)/self.resolution))
+                    mz_axes[scantype_idx] = np.logspace(np.log10(mzmin), np.log10(mzmax), f)
             return mz_axes
 
         # assume bruker instruments have constant m/z axis from scan to scan
-        elif mzml_filetype == cls.available_mzml_types['bruker']:
-
-            mz_axes = [np.array([]) for _ in scan_types]
-
-            for spectrum in reader:
-                scanfilt = spectrum['scanList']['scan'][0]['filter string']
-                scantype_idx = scan_types.index(scanfilt)
-                # grossly inefficient reassignment of m/z array at each scan
-                mz_axes[scantype_idx] = spectrum['m/z array']
-
+        elif self.mzml_type == self.available_mzml_types['bruker']:
+            # Use the m/z array of the last scan of each scan type
+            mz_axes = []
+            for scantype_idx in range(len(self.scan_types)):
+                last_spectrum = np.flatnonzero(self.scan_indices == scantype_idx)[-1]
+                mz_axes.append(np.asarray(self.get_spectrum(last_spectrum)[0]))
             return mz_axes
 
         else:
             raise ValueError('Unknown mzml format')
 
     @classmethod
-    def __compute_filetype(cls, filename):
+    def __compute_filetype(cls, spectrum):
         """
         Internal helper function used to compute the filetype.
+
+        :param spectrum: Dict describing the first spectrum of the file as returned by __parse_spectrum_element
         """
-        spectrum = next(mzml.read(filename))
-        if 'spotID' in spectrum:
+        if 'spotID' in spectrum['attributes'] or 'spotID' in spectrum['params']:
             return cls.available_mzml_types['thermo']
-        elif 'id' in spectrum:
+        elif 'id' in spectrum['attributes']:
             return cls.available_mzml_types['bruker']
         else:
             return cls.available_mzml_types['unknown']
 
-    def __compute_coordinates(self):
+    @classmethod
+    def __compute_coordinates(cls, spectrum, mzml_type):
         """
-        Internal helper function used to compute the coordinates for each scan.
+        Internal helper function used to compute the coordinates of a scan.
 
-        :returns: 2D numpy integer array of shape (numScans,2) indicating for each scan its x and y coordinate
-        """
-        reader = mzml.read(self.basename)
-        coords = np.zeros(shape=(self.num_scans, 2), dtype='uint32')
-        if self.mzml_type == self.available_mzml_types['thermo']:
-            spectrumid = 0
-            for spectrum in reader:
-                spotid = spectrum['spotID']
-                coords[spectrumid, :] = map(int, spotid.split(',')[-1].split('x'))
-                spectrumid += 1
-        elif self.mzml_type == self.available_mzml_types['bruker']:
-            spectrumid = 0
-            for spectrum in reader:
-                spotdesc = spectrum['id'].split('_x002f_')[1]
-                matchobj = re.findall('\d+', spotdesc)
-                coords[spectrumid, 0] = int(matchobj[2])
-                coords[spectrumid, 1] = int(matchobj[3])
-                spectrumid += 1
-        return coords
+        :param spectrum: Dict describing the spectrum as returned by __parse_spectrum_element
+        :param mzml_type: The mzml flavor of the file
 
+        :returns: Tuple of integers with the x and y coordinate of the scan
+        """
+        if mzml_type == cls.available_mzml_types['thermo']:
+            spotid = spectrum['attributes'].get('spotID', spectrum['params'].get('spotID'))
+            x_coord, y_coord = map(int, spotid.split(',')[-1].split('x'))
+            return x_coord, y_coord
+        elif mzml_type == cls.available_mzml_types['bruker']:
+            spotdesc = spectrum['attributes']['id'].split('_x002f_')[1]
+            matchobj = re.findall('\d+', spotdesc)
+            return int(matchobj[2]), int(matchobj[3])
+        return 0, 0
 
     @classmethod
     def test(cls):
@@ -271,35 +310,342 @@ class mzml_file(file_reader_base_multidata):
         """
         pass
 
+    @classmethod
+    def __load_or_build_index(cls, filename, param_groups=None):
+        """
+        Internal helper function used to load the spectrum index from the sidecar file or to compute the
+        index in a single pass through the mzML file if no valid sidecar file exists.
+
+        :param filename: Name of the mzML file
+        :param param_groups: Dict of referenceable param groups as returned by __read_param_groups
+
+        :returns: Dict with the spectrum index (see __build_index)
+        """
+        if param_groups is None:
+            param_groups = cls.__read_param_groups(filename=filename)
+        index_filename = filename + cls.index_file_extension
+        file_stat = os.stat(filename)
+        if os.path.isfile(index_filename):
+            try:
+                with np.load(index_filename) as index_file:
+                    if int(index_file['version']) == cls.index_version and \
+                            int(index_file['file_size']) == file_stat.st_size and \
+                            float(index_file['file_mtime']) == file_stat.st_mtime:
+                        spectrum_index = dict([(key, index_file[key]) for key in index_file.files])
+                        spectrum_index['mzml_type'] = spectrum_index['mzml_type'].tolist()
+                        spectrum_index['scan_types'] = spectrum_index['scan_types'].tolist()
+                        spectrum_index['scan_profiled'] = spectrum_index['scan_profiled'].tolist()
+                        log_helper.debug(__name__, 'Loaded spectrum index from ' + index_filename)
+                        return spectrum_index
+                log_helper.info(__name__, 'Spectrum index ' + index_filename + ' is out of date.')
+            except (IOError, OSError, ValueError, KeyError) as e:
+                log_helper.warning(__name__, 'Failed to load spectrum index ' + index_filename + ' ' + str(e))
+
+        spectrum_index = cls.__build_index(filename=filename, param_groups=param_groups)
+        if cls.write_index_file and spectrum_index['offsets'].shape[0] > 0:
+            # Write to a temporary file first so that concurrent readers never see a partial index
+            temp_filename = index_filename + '.' + str(os.getpid()) + '.npz'
+            try:
+                index_data = dict(spectrum_index)
+                index_data['scan_types'] = np.asarray(spectrum_index['scan_types'], dtype=np.unicode_)
+                np.savez(temp_filename,
+                         version=cls.index_version,
+                         file_size=file_stat.st_size,
+                         file_mtime=file_stat.st_mtime,
+                         **index_data)
+                os.rename(temp_filename, index_filename)
+                log_helper.debug(__name__, 'Saved spectrum index to ' + index_filename)
+            except (IOError, OSError) as e:
+                log_helper.warning(__name__, 'Failed to save spectrum index ' + index_filename + ' ' + str(e))
+        return spectrum_index
+
+    @classmethod
+    def __build_index(cls, filename, param_groups):
+        """
+        Internal helper function used to compute the spectrum index in a single streaming pass
+        through the mzML file. Only the m/z arrays are decoded during the pass.
+
+        :param filename: Name of the mzML file
+        :param param_groups: Dict of referenceable param groups as returned by __read_param_groups
+
+        :returns: Dict with the following entries:
+
+            * 'mzml_type' : The mzml flavor of the file
+            * 'scan_types' : List of the unique scan filter strings
+            * 'scan_profiled' : List of bools indicating for each scan type whether it is in profile mode
+            * 'offsets', 'lengths' : 1D int64 arrays with the byte offset and length of each spectrum
+            * 'scan_indices' : 1D int32 array with the index of the scan type of each spectrum (-1 if unknown)
+            * 'coordinates' : 2D uint32 array of shape (num_scans, 2) with the x and y coordinate of each spectrum
+            * 'profiled' : 1D bool array indicating for each spectrum whether it is a profile spectrum
+            * 'mz_count' : 1D int64 array with the number of m/z values of each spectrum
+            * 'mz_min', 'mz_max', 'mz_min_diff' : 1D float64 arrays with the smallest and largest m/z value \
+              and the smallest m/z spacing of each spectrum
+            * 'window_lower', 'window_upper' : 1D float64 arrays with the scan window limits of each spectrum
+        """
+        mzml_type = None
+        scan_types = []
+        scan_type_lookup = {}
+        scan_profiled = []
+        index_lists = dict([(key, []) for key in ['offsets', 'lengths', 'scan_indices', 'coordinates', 'profiled',
+                                                  'mz_count', 'mz_min', 'mz_max', 'mz_min_diff',
+                                                  'window_lower', 'window_upper']])
+        for offset, element_bytes in cls.__iter_spectrum_elements(filename):
+            spectrum_index = len(index_lists['offsets'])
+            spectrum = cls.__parse_spectrum_element(element_bytes=element_bytes,
+                                                    param_groups=param_groups,
+                                                    arrays=['m/z array'])
+            if mzml_type is None:
+                mzml_type = cls.__compute_filetype(spectrum)
+            profiled = 'profile spectrum' in spectrum['params']
+            scanfilter = spectrum['scan'].get('filter string')
+            if scanfilter is None:
+                log_helper.debug(__name__, 'No filter string found for spectrum %s' % spectrum_index)
+                scan_index = -1
+            else:
+                if scanfilter not in scan_type_lookup:
+                    scan_type_lookup[scanfilter] = len(scan_types)
+                    scan_types.append(scanfilter)
+                    scan_profiled.append(profiled)
+                scan_index = scan_type_lookup[scanfilter]
+            mz = spectrum.get('m/z array', np.zeros(0))
+            index_lists['offsets'].append(offset)
+            index_lists['lengths'].append(len(element_bytes))
+            index_lists['scan_indices'].append(scan_index)
+            index_lists['coordinates'].append(cls.__compute_coordinates(spectrum, mzml_type))
+            index_lists['profiled'].append(profiled)
+            index_lists['mz_count'].append(mz.shape[0])
+            index_lists['mz_min'].append(mz.min() if mz.shape[0] > 0 else np.nan)
+            index_lists['mz_max'].append(mz.max() if mz.shape[0] > 0 else np.nan)
+            index_lists['mz_min_diff'].append(np.diff(mz).min() if mz.shape[0] > 1 else np.nan)
+            index_lists['window_lower'].append(float(spectrum['scan window'].get('scan window lower limit', np.nan)))
+            index_lists['window_upper'].append(float(spectrum['scan window'].get('scan window upper limit', np.nan)))
+            if spectrum_index % 10000 == 0:
+                log_helper.debug(__name__, 'Indexed %s spectra' % spectrum_index)
+
+        index_dtypes = {'offsets': 'int64', 'lengths': 'int64', 'scan_indices': 'int32', 'coordinates': 'uint32',
+                        'profiled': 'bool', 'mz_count': 'int64'}
+        spectrum_index = dict([(key, np.asarray(values, dtype=index_dtypes.get(key, 'float64')))
+                               for key, values in index_lists.items()])
+        spectrum_index['coordinates'] = spectrum_index['coordinates'].reshape((-1, 2))
+        spectrum_index['mzml_type'] = mzml_type if mzml_type is not None else cls.available_mzml_types['unknown']
+        spectrum_index['scan_types'] = scan_types
+        spectrum_index['scan_profiled'] = scan_profiled
+        return spectrum_index
+
     @staticmethod
-    def __compute_num_scans(filename=None):
+    def __iter_spectrum_elements(filename, block_size=16*1024*1024):
+        """
+        Internal generator function used to iterate over the raw XML of all spectrum elements in a file.
+        The file is read in blocks of block_size bytes, i.e., the file is never loaded completely.
+
+        :param filename: Name of the mzML file
+        :param block_size: Number of bytes to be read from file at once
+
+        :yield: Tuple of (offset, element_bytes) with the byte offset of the spectrum element
+            in the file and the bytes of the complete spectrum element.
+        """
+        start_tag = re.compile(b'<spectrum[\\s>]')
+        end_tag = b'</spectrum>'
+        buffer_data = b''
+        buffer_offset = 0  # Offset of buffer_data[0] in the file
+        position = 0
+        end_of_file = False
+        with open(filename, 'rb') as infile:
+            while True:
+                match = start_tag.search(buffer_data, position)
+                if match is not None:
+                    end = buffer_data.find(end_tag, match.end())
+                    if end >= 0:
+                        end += len(end_tag)
+                        yield buffer_offset + match.start(), buffer_data[match.start():end]
+                        position = end
+                        continue
+                    keep_from = match.start()
+                else:
+                    # Keep the tail of the buffer in case it contains part of a start tag
+                    keep_from = max(position, len(buffer_data) - len('<spectrum '))
+                if end_of_file:
+                    break
+                block = infile.read(block_size)
+                end_of_file = len(block) == 0
+                buffer_offset += keep_from
+                buffer_data = buffer_data[keep_from:] + block
+                position = 0
+
+    @classmethod
+    def __read_param_groups(cls, filename, block_size=1024*1024):
+        """
+        Internal helper function used to read the referenceable param groups from the header of the file.
+
+        :param filename: Name of the mzML file
+        :param block_size: Number of bytes to be read from file at once
+
+        :returns: Dict of group id to dict of param names and values.
+        """
+        header = b''
+        with open(filename, 'rb') as infile:
+            while True:
+                block = infile.read(block_size)
+                header += block
+                if len(block) == 0 or header.find(b'<run') >= 0:
+                    break
+        param_groups = {}
+        match = re.search(b'<referenceableParamGroupList.*?</referenceableParamGroupList>', header, re.DOTALL)
+        if match is not None:
+            group_list = ElementTree.fromstring(match.group(0))
+            for group in group_list.findall('referenceableParamGroup'):
+                param_groups[group.get('id')] = cls.__get_params(group, {})
+        return param_groups
+
+    @staticmethod
+    def __get_params(element, param_groups):
         """
-        Internal helper function used to compute the number of scans in the mzml file.
+        Internal helper function used to get the cvParam and userParam values of an XML element.
+
+        :param element: The ElementTree element
+        :param param_groups: Dict of referenceable param groups as returned by __read_param_groups
+
+        :returns: Dict of param names and values
         """
-        reader = mzml.read(filename)
-        return sum(1 for _ in reader)
+        params = {}
+        for child in element:
+            if child.tag == 'cvParam' or child.tag == 'userParam':
+                params[child.get('name')] = child.get('value', '')
+            elif child.tag == 'referenceableParamGroupRef':
+                params.update(param_groups.get(child.get('ref'), {}))
+        return params
+
+    @classmethod
+    def __parse_spectrum_element(cls, element_bytes, param_groups, arrays=None):
+        """
+        Internal helper function used to parse the raw XML of a single spectrum element.
+
+        :param element_bytes: The bytes of the spectrum element
+        :param param_groups: Dict of referenceable param groups as returned by __read_param_groups
+        :param arrays: List of names of the binary arrays to be decoded. None to decode all arrays.
+
+        :returns: Dict with the 'attributes' of the spectrum element, the 'params' of the spectrum, the
+            params of the first 'scan' and 'scan window', and the decoded 'm/z array' and 'intensity array'.
+        """
+        element = ElementTree.fromstring(element_bytes)
+        spectrum = {'attributes': dict(element.attrib),
+                    'params': cls.__get_params(element, param_groups),
+                    'scan': {},
+                    'scan window': {}}
+        scan = element.find('scanList/scan')
+        if scan is not None:
+            spectrum['scan'] = cls.__get_params(scan, param_groups)
+            scan_window = scan.find('scanWindowList/scanWindow')
+            if scan_window is not None:
+                spectrum['scan window'] = cls.__get_params(scan_window, param_groups)
+        for binary_array in element.findall('binaryDataArrayList/binaryDataArray'):
+            array_params = cls.__get_params(binary_array, param_groups)
+            for array_name in ['m/z array', 'intensity array']:
+                if array_name in array_params and (arrays is None or array_name in arrays):
+                    spectrum[array_name] = cls.__decode_binary_array(binary_array.findtext('binary'), array_params)
+        return spectrum
+
+    @staticmethod
+    def __decode_binary_array(text, params):
+        """
+        Internal helper function used to decode a base64 encoded binary data array.
+
+        :param text: The base64 encoded text of the binary element
+        :param params: Dict with the params of the binaryDataArray describing the encoding
+
+        :returns: 1D numpy array
+        """
+        data = base64.b64decode(text.strip()) if text else b''
+        numpress_params = [name for name in params if name.startswith('MS-Numpress')]
+        if len(numpress_params) > 0:
+            if numpress_params[0].endswith('followed by zlib compression'):
+                data = zlib.decompress(data)
+            for codec in mzml_file.numpress_codecs:
+                if numpress_params[0].startswith(codec):
+                    return mzml_file.decode_numpress(data, codec)
+            raise ValueError('Unknown MS-Numpress compression: ' + numpress_params[0])
+        if 'zlib compression' in params:
+            data = zlib.decompress(data)
+        dtype = '<f8'
+        for param_name, param_dtype in [('32-bit float', '<f4'), ('64-bit float', '<f8'),
+                                        ('32-bit integer', '<i4'), ('64-bit integer', '<i8')]:
+            if param_name in params:
+                dtype = param_dtype
+        return np.frombuffer(data, dtype=dtype)
 
-    def __compute_scan_types_and_indices(self, filename=None):
+    @staticmethod
+    def __decode_numpress_int(data, byte_index, half):
         """
-        Internal helper function used to compute a list of unique scan types in the mzml file.
-        Also computes a numpy 1d array of ints which index every scan to relevant datacube.
+        Internal helper function used to decode a single integer of the half-byte encoding of MS-Numpress.
+
+        :param data: bytearray with the encoded data
+        :param byte_index: Index of the current byte
+        :param half: 0 if the integer starts at the upper half-byte of the current byte, 1 otherwise
+
+        :returns: Tuple of (unsigned 32-bit integer, the new byte_index, the new half)
         """
-        reader = mzml.read(filename)
-        scantypes = []
-        scan_indices = []
-        scan_profiled = []
-        for idx, spectrum in enumerate(reader):
-            try:
-                scanfilter = spectrum['scanList']['scan'][0]['filter string']
-                if scanfilter not in scantypes:
-                    scantypes.append(scanfilter)
-                    scan_profiled.append(spectrum.has_key('profile spectrum'))
-                scan_indices.append(scantypes.index(scanfilter))
-            except:
-                log_helper.debug(__name__, idx)
+        def next_half_byte(byte_index, half):
+            if half == 0:
+                return data[byte_index] >> 4, byte_index, 1
+            return data[byte_index] & 0xf, byte_index + 1, 0
 
-        assert len(scan_indices) == self.num_scans
-        return scantypes, scan_indices, scan_profiled
+        head, byte_index, half = next_half_byte(byte_index, half)
+        value = 0
+        if head <= 8:
+            num_leading = head
+        else:
+            # Leading half-bytes are filled with ones
+            num_leading = head - 8
+            for leading_index in range(num_leading):
+                value |= 0xf0000000 >> (4 * leading_index)
+        for half_byte_index in range(8 - num_leading):
+            half_byte, byte_index, half = next_half_byte(byte_index, half)
+            value |= half_byte << (4 * half_byte_index)
+        return value, byte_index, half
+
+    @staticmethod
+    def decode_numpress(data, codec):
+        """
+        Decode binary data compressed with one of the MS-Numpress codecs.
+
+        :param data: The bytes of the compressed data (after base64 and, if used, zlib decoding)
+        :param codec: One of numpress_codecs
+
+        :returns: 1D numpy array of float64
+        """
+        data = bytearray(data)
+        if codec == 'MS-Numpress short logged float compression':
+            fixed_point = np.frombuffer(bytes(data[0:8]), dtype='<f8')[0]
+            return np.exp(np.frombuffer(bytes(data[8:]), dtype='<u2') / fixed_point) - 1
+        values = []
+        if codec == 'MS-Numpress linear prediction compression':
+            fixed_point = np.frombuffer(bytes(data[0:8]), dtype='<f8')[0]
+            if len(data) < 12:
+                return np.zeros(0, dtype='float64')
+            previous = np.frombuffer(bytes(data[8:12]), dtype='<u4')[0]
+            values.append(int(previous))
+            if len(data) < 16:
+                return np.asarray(values, dtype='float64') / fixed_point
+            current = np.frombuffer(bytes(data[12:16]), dtype='<u4')[0]
+            values.append(int(current))
+            byte_index, half = 16, 0
+        elif codec == 'MS-Numpress positive integer compression':
+            fixed_point = 1.0
+            byte_index, half = 0, 0
+        else:
+            raise ValueError('Unknown MS-Numpress compression: ' + str(codec))
+        while byte_index < len(data):
+            # The last half-byte is padding if it is zero
+            if byte_index == len(data) - 1 and half == 1 and (data[byte_index] & 0xf) == 0:
+                break
+            value, byte_index, half = mzml_file.__decode_numpress_int(data, byte_index, half)
+            if codec == 'MS-Numpress positive integer compression':
+                values.append(value)
+            else:
+                # The integer is the signed difference to the linear extrapolation of the last two values
+                difference = value - (1 << 32) if value >= (1 << 31) else value
+                values.append(2 * values[-1] - values[-2] + difference)
+        return np.asarray(values, dtype='float64') / fixed_point
 
     @staticmethod
     def __parse_scan_parameters(self):
@@ -425,14 +771,43 @@ class mzml_file(file_reader_base_multidata):
         return dependencies
 
     def __getitem__(self, key):
-        """Enable slicing of img files"""
+        """
+        Enable slicing of mzml files.
+
+        If the object has not been initialized with requires_slicing=True, then the selected spectra
+        are read directly from file using the spectrum index. In this case, only selections for the
+        currently selected dataset are supported.
+        """
         if self.data is not None:
             if self.select_dataset is None:
                 return self.data[key]
             else:
                 return self.data[self.select_dataset][key]
-        else:
-            raise ValueError("Slicing is currently only supported when the object has been initialized with readall")
+        if self.select_dataset is None:
+            raise ValueError('Select a dataset to continue!')
+        if not isinstance(key, tuple):
+            key = (key, )
+        key = key + (slice(None), ) * (3 - len(key))
+        x_indices = np.arange(self.shape[0])[key[0]]
+        y_indices = np.arange(self.shape[1])[key[1]]
+        mz_indices = np.arange(self.shape[2])[key[2]]
+        result = np.zeros(shape=(np.size(x_indices), np.size(y_indices), np.size(mz_indices)), dtype=self.data_type)
+        # Determine the spectra of the selected pixels and read them in the order in which they appear in the file
+        selected_spectra = self.spectrum_map[self.select_dataset][np.ix_(np.atleast_1d(x_indices),
+                                                                         np.atleast_1d(y_indices))]
+        result_positions = np.argwhere(selected_spectra >= 0)
+        order = np.argsort(selected_spectra[result_positions[:, 0], result_positions[:, 1]], kind='mergesort')
+        result_positions = result_positions[order]
+        spectrum_indices = selected_spectra[result_positions[:, 0], result_positions[:, 1]]
+        start = 0
+        for block_indices, spectra in self.__iter_spectrum_blocks(self.select_dataset, spectrum_indices):
+            block_positions = result_positions[start:(start + len(block_indices))]
+            result[block_positions[:, 0], block_positions[:, 1], :] = spectra[:, mz_indices].reshape(
+                (len(block_indices), -1))
+            start += len(block_indices)
+        return result.reshape(tuple([result.shape[axis]
+                                     for axis, indices in enumerate([x_indices, y_indices, mz_indices])
+                                     if np.ndim(indices) > 0]))
 
     def close_file(self):
         """Close the mzml file"""
@@ -452,27 +827,23 @@ class mzml_file(file_reader_base_multidata):
             return len(filelist) > 0
         else:
             try:
-                # Try to open the file and iterate over it
-                reader = mzml.read(name)
-                for _ in reader:
-                    pass
-                del reader
-                return True
+                # Check the root element in the header of the file
+                with open(name, 'rb') as infile:
+                    header = infile.read(4096)
+                return header.find(b'<mzML') >= 0 or header.find(b'<indexedmzML') >= 0
             except:
                 return False
 
     @classmethod
-    def size(cls, name, max_num_reads=1000):
+    def size(cls, name):
         """
         Classmethod used to check the estimated size for the given file/folder.
-        For mzml this is an estimate of the final size of the full 3D datacube.
-        For efficiency the number of scans is estimated based on the size of
-        the first 1000 scans.
+        For mzml this is the size of all full 3D datacubes in bytes. The size is
+        computed from the spectrum index of the file, which is saved as a sidecar
+        file so that it can be reused when opening the file.
 
         :param name: Name of the dir or file.
         :type name: unicode
-        :param max_num_reads: The maximum number of spectrum reads to be performed to estimate the file size
-        :type max_num_reads: int
 
         :returns: Integer indicating the size in byte or None if unknown.
         """
@@ -484,43 +855,9 @@ class mzml_file(file_reader_base_multidata):
         else:
             basename = name
         if basename is not None:
-            num_scans = -1
-            # Try to compute the number of scans by looking at the spectrumList count entry in the file
-            try:
-                size_line = os.popen('head -n 120 "' + basename + '" | grep "spectrumList count="').read()
-                if len(size_line) > 0:
-                    size_text = size_line.split('spectrumList count=')[1].split('"')[1]
-                    if size_text.isdigit():
-                        num_scans = int(size_text)
-            except:
-                pass
-            if num_scans < 0:
-                # Estimate the number of scans by reading the first 1000 spectra
-                index = 0
-                prev_tell = 0
-                sizes = []
-                reader = mzml.read(basename)
-                for _ in reader:
-                    if index >= max_num_reads:
-                        break
-                    current_tell = reader.file.file.tell()
-                    sizes.append(current_tell - prev_tell)
-                    prev_tell = current_tell
-                    index += 1
-                npsizes = np.asarray(sizes)
-                filesize = os.stat(basename).st_size
-                scansize = (npsizes.max() - npsizes.min()) / 2.
-                num_scans = int(filesize/scansize)
-            mz_axis_len = cls.__compute_mz_axis(filename=basename,
-                                                mzml_filetype=cls.__compute_filetype(filename=basename),
-                                                scan_types=cls.__compute_scan_types(filename=basename)).shape[0]
-            return num_scans*mz_axis_len
-
-            # temp_mzml_file = cls(basename=basename, requires_slicing=False)
-            # itemsize = np.dtype(temp_mzml_file.data_type).itemsize
-            # size = np.asarray(temp_mzml_file.shape).prod() * itemsize
-            # print ('MZML size', size)
-            # return size
+            temp_mzml_file = cls(basename=basename, requires_slicing=False)
+            itemsize = np.dtype(temp_mzml_file.data_type).itemsize
+            return int(sum([np.prod(shape) for shape in temp_mzml_file.shape_all_data])) * itemsize
         else:
             return None
 
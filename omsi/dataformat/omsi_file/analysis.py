@@ -228,7 +228,12 @@ class omsi_file_analysis(omsi_dependencies_manager,
                          omsi_file_common):
     """
     Class for managing analysis specific data in omsi hdf5 files
+
+    :cvar copy_block_bytes: Maximum number of bytes copied at once when analysis data that is stored in a
+        h5py.Dataset of another file is saved.
     """
+    copy_block_bytes = 64 * 1024 * 1024
+
     @classmethod
     def __create__(cls,
                    parent_group,
@@ -561,6 +566,28 @@ class omsi_file_analysis(omsi_dependencies_manager,
             else:
                 warnings.warn("WARNING: " + ana_data['name'] +
                               " dataset generated but not written. The given dataset was empty.")
+        # Link to or copy an existing HDF5 dataset (e.g., a virtual dataset with the results of multiple MPI ranks)
+        elif isinstance(ana_data['data'], h5py.Dataset):
+            source_data = ana_data['data']
+            if os.path.abspath(source_data.file.filename) == os.path.abspath(data_group.file.filename):
+                data_group[ana_data['name']] = source_data
+            else:
+                # Copy the data one block along the first axis at a time to avoid loading all data into memory
+                tempdata = data_group.require_dataset(name=ana_data['name'],
+                                                      shape=source_data.shape,
+                                                      dtype=source_data.dtype,
+                                                      chunks=True if source_data.size > 1000 else None)
+                if len(source_data.shape) == 0:
+                    tempdata[()] = source_data[()]
+                elif source_data.size > 0:
+                    row_bytes = max(source_data.size / source_data.shape[0] * source_data.dtype.itemsize, 1)
+                    block_rows = max(int(cls.copy_block_bytes // row_bytes), 1)
+                    for block_start in xrange(0, source_data.shape[0], block_rows):
+                        block_end = min(block_start + block_rows, source_data.shape[0])
+                        tempdata[block_start:block_end] = source_data[block_start:block_end]
+                else:
+                    warnings.warn("WARNING: " + ana_data['name'] +
+                                  " dataset generated but not written. The given dataset was empty.")
         # Create a new dataset to store the current numpy-type dataset
         elif 'numpy' in str(type(ana_data['data'])):
             # Decide whether we want to enable chunking for the current
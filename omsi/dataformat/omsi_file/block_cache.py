@@ -0,0 +1,298 @@
+"""
+Module with an in-process LRU cache for chunks of MSI datasets stored in OMSI HDF5 files.
+"""
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import h5py
+
+
+class omsi_block_cache(object):
+    """
+    In-process LRU cache for the chunks of h5py datasets.
+
+    Repeated selections on the same file (e.g., ``v_qslice`` and ``v_qspectrum`` requests of the
+    viewer) usually touch the same chunks over and over again. Rather than having HDF5 decompress the
+    same chunks for every request, the cache keeps decompressed chunks in memory, keyed by
+    (dataset, chunk index), and evicts the least recently used chunks once the byte budget is exceeded.
+
+    Datasets are identified by the real path of the file, the modification time of the file and the
+    path of the dataset within the file. In this way, the cache may be shared between different
+    h5py/omsi_file objects opened for the same file while chunks from modified files are never reused.
+
+    Selections are supported for integers, slices (incl. steps), and index lists. Lists are
+    treated as orthogonal (outer) selections consistent with h5py. Datasets that are not chunked
+    are read directly from file and are not cached.
+
+    Example use::
+
+        cache = omsi_block_cache(max_bytes=512*1024*1024)
+        omsi_block_cache.set_default_cache(cache)   # Use the cache for all omsi_file_msidata objects
+        ...
+        print cache.get_statistics()
+
+    :ivar max_bytes: The maximum number of bytes the cache may use for storing chunks
+    :ivar current_bytes: The number of bytes currently used by cached chunks
+    :ivar hits: Number of chunk requests that were served from the cache
+    :ivar misses: Number of chunk requests that required a read from file
+    :ivar evictions: Number of chunks evicted from the cache
+    """
+    default_cache = None
+    """The default cache used by omsi_file_msidata objects if no cache is given explicitly"""
+
+    def __init__(self, max_bytes=256*1024*1024):
+        """
+        Initialize the cache.
+
+        :param max_bytes: The maximum number of bytes to be used for caching. Default is 256MB.
+        """
+        super(omsi_block_cache, self).__init__()
+        self.max_bytes = int(max_bytes)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__blocks = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def set_default_cache(cls, cache):
+        """
+        Define the default cache to be used by all omsi_file_msidata objects that are created
+        without an explicit block cache.
+
+        :param cache: The omsi_block_cache object to be used or None to disable the default cache.
+        """
+        cls.default_cache = cache
+
+    @classmethod
+    def get_default_cache(cls):
+        """
+        Get the default cache.
+
+        :returns: omsi_block_cache object or None if no default cache is set.
+        """
+        return cls.default_cache
+
+    def get_statistics(self):
+        """
+        Get the statistics of the cache, e.g, to determine the size of the cache.
+
+        :returns: Dict with the number of 'hits', 'misses', 'evictions', the 'hit_rate',
+            the 'num_blocks' and 'current_bytes' currently stored and the 'max_bytes' of the cache.
+        """
+        num_requests = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (float(self.hits) / float(num_requests)) if num_requests > 0 else 0.0,
+                'num_blocks': len(self.__blocks),
+                'current_bytes': self.current_bytes,
+                'max_bytes': self.max_bytes}
+
+    def reset_statistics(self):
+        """
+        Reset the hit, miss, and eviction counters.
+        """
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self, dataset=None):
+        """
+        Remove cached blocks.
+
+        :param dataset: Optional h5py.Dataset. If given, only the blocks of the given dataset
+            are removed. Otherwise all blocks are removed.
+        """
+        with self.__lock:
+            if dataset is None:
+                self.__blocks.clear()
+                self.current_bytes = 0
+            else:
+                dataset_key = self.dataset_key(dataset)[0:2]
+                for block_key in [k for k in self.__blocks.keys() if k[0][0:2] == dataset_key]:
+                    self.current_bytes -= self.__blocks.pop(block_key).nbytes
+
+    @staticmethod
+    def dataset_key(dataset):
+        """
+        Get the key used to identify the given dataset in the cache.
+
+        :param dataset: The h5py.Dataset
+
+        :returns: Tuple of (real path of the file, dataset path, modification time of the file)
+        """
+        filename = os.path.realpath(dataset.file.filename)
+        try:
+            modification_time = os.stat(filename).st_mtime
+        except OSError:
+            modification_time = None
+        return filename, dataset.name, modification_time
+
+    @staticmethod
+    def selection_to_indices(key, axis_size):
+        """
+        Convert a single selection key to a numpy array of indices.
+
+        :param key: Integer, slice, list or numpy array with the selection for a single axis
+        :param axis_size: The size of the axis
+
+        :returns: Tuple of (indices, keep_axis) where indices is a 1D numpy array of int64 indices
+            and keep_axis is a boolean indicating whether the axis is kept in the output
+        """
+        if isinstance(key, slice):
+            return np.arange(*key.indices(axis_size), dtype='int64'), True
+        elif isinstance(key, (list, tuple, np.ndarray)):
+            indices = np.asarray(key)
+            if indices.dtype == np.bool_:
+                indices = np.flatnonzero(indices)
+            indices = indices.astype('int64').reshape(indices.size)
+            indices[indices < 0] += axis_size
+            return indices, True
+        else:
+            index = int(key)
+            if index < 0:
+                index += axis_size
+            if index < 0 or index >= axis_size:
+                raise IndexError("Index " + str(key) + " out of range for axis of size " + str(axis_size))
+            return np.asarray([index], dtype='int64'), False
+
+    def read(self, dataset, key):
+        """
+        Read the given selection from the dataset using the cache.
+
+        :param dataset: The h5py.Dataset to read from
+        :param key: Selection tuple with one integer, slice, or index list per dimension. Missing
+            trailing dimensions are completed with slice(None).
+
+        :returns: Numpy array with the selected data
+        """
+        if not isinstance(key, tuple):
+            key = (key, )
+        if dataset.chunks is None or len(key) > len(dataset.shape):
+            return dataset[key]
+        key = key + (slice(None), ) * (len(dataset.shape) - len(key))
+        chunks = dataset.chunks
+        dataset_key = self.dataset_key(dataset)
+
+        # Determine for each axis which chunks are touched and, for each touched chunk, which
+        # elements of the output are located in the chunk and at which local offsets
+        axis_keep = []
+        touched_chunks = []
+        chunk_groups = []
+        output_shape = []
+        for axis, axis_key in enumerate(key):
+            indices, keep_axis = self.selection_to_indices(axis_key, dataset.shape[axis])
+            chunk_ids = indices // chunks[axis]
+            unique_chunk_ids, chunk_position = np.unique(chunk_ids, return_inverse=True)
+            order = np.argsort(chunk_position, kind='mergesort')
+            split_points = np.cumsum(np.bincount(chunk_position, minlength=unique_chunk_ids.size))[0:-1]
+            output_positions = np.split(order, split_points)
+            chunk_groups.append([(positions, indices[positions] % chunks[axis]) for positions in output_positions])
+            axis_keep.append(keep_axis)
+            touched_chunks.append(unique_chunk_ids)
+            output_shape.append(indices.size)
+
+        # Copy the selected elements from each touched chunk to the output
+        result = np.empty(tuple(output_shape), dtype=dataset.dtype)
+        for chunk_position in np.ndindex(*[t.size for t in touched_chunks]):
+            chunk_index = tuple([int(touched_chunks[axis][chunk_position[axis]]) for axis in range(len(chunks))])
+            block = self.__get_block(dataset, dataset_key, chunk_index)
+            groups = [chunk_groups[axis][chunk_position[axis]] for axis in range(len(chunks))]
+            result[np.ix_(*[g[0] for g in groups])] = block[np.ix_(*[g[1] for g in groups])]
+
+        # Remove the dimensions of integer selections
+        return result.reshape(tuple([output_shape[axis] for axis in range(len(chunks)) if axis_keep[axis]]))
+
+    def __get_block(self, dataset, dataset_key, chunk_index):
+        """
+        Private helper function used to get a single chunk from the cache or the file.
+
+        :param dataset: The h5py.Dataset
+        :param dataset_key: The key of the dataset as returned by dataset_key(...)
+        :param chunk_index: Tuple with the index of the chunk along each axis
+
+        :returns: Read-only numpy array with the data of the chunk
+        """
+        block_key = (dataset_key, chunk_index)
+        with self.__lock:
+            block = self.__blocks.pop(block_key, None)
+            if block is not None:
+                self.__blocks[block_key] = block
+                self.hits += 1
+                return block
+            self.misses += 1
+        chunks = dataset.chunks
+        block = dataset[tuple([slice(chunk_index[axis] * chunks[axis],
+                                     min((chunk_index[axis] + 1) * chunks[axis], dataset.shape[axis]))
+                               for axis in range(len(chunks))])]
+        block.flags.writeable = False
+        if block.nbytes <= self.max_bytes:
+            with self.__lock:
+                if block_key not in self.__blocks:
+                    self.__blocks[block_key] = block
+                    self.current_bytes += block.nbytes
+                while self.current_bytes > self.max_bytes:
+                    _, evicted_block = self.__blocks.popitem(last=False)
+                    self.current_bytes -= evicted_block.nbytes
+                    self.evictions += 1
+        return block
+
+    @staticmethod
+    def chunk_cache_settings(dataset, max_nbytes=64*1024*1024, min_nbytes=1024*1024):
+        """
+        Compute settings for the HDF5 raw chunk cache of a dataset based on its chunking.
+
+        The cache is sized so that it can hold all chunks touched by the selection that the dataset
+        is best suited for, i.e., either a full spectrum (for datasets chunked along the m/z axis) or
+        a full image slice (for datasets chunked in space), as typically created via
+        omsi_file_msidata.create_optimized_chunking(...).
+
+        :param dataset: The h5py.Dataset
+        :param max_nbytes: Maximum size of the raw chunk cache in bytes
+        :param min_nbytes: Minimum size of the raw chunk cache in bytes (the HDF5 default is 1MB)
+
+        :returns: Tuple of (rdcc_nslots, rdcc_nbytes) or None if the dataset is not chunked.
+        """
+        if dataset.chunks is None:
+            return None
+        chunks = dataset.chunks
+        chunk_nbytes = int(np.prod(chunks)) * dataset.dtype.itemsize
+        num_chunks = [int(np.ceil(float(dataset.shape[axis]) / float(chunks[axis]))) for axis in range(len(chunks))]
+        num_chunks_spectrum = num_chunks[-1]
+        num_chunks_slice = int(np.prod(num_chunks[0:-1])) if len(num_chunks) > 1 else 1
+        rdcc_nbytes = chunk_nbytes * min(num_chunks_spectrum, num_chunks_slice)
+        rdcc_nbytes = int(max(min(rdcc_nbytes, max_nbytes), min_nbytes, chunk_nbytes))
+        # HDF5 recommends the number of slots to be a prime ~100 times the number of chunks in the cache
+        rdcc_nslots = omsi_block_cache.__next_prime(max(100 * (rdcc_nbytes // chunk_nbytes), 521))
+        return rdcc_nslots, rdcc_nbytes
+
+    @staticmethod
+    def open_with_chunk_cache(dataset, rdcc_nslots, rdcc_nbytes, rdcc_w0=0.75):
+        """
+        Reopen the given dataset with a dataset-specific HDF5 raw chunk cache.
+
+        :param dataset: The h5py.Dataset
+        :param rdcc_nslots: Number of chunk slots in the raw chunk cache hash table
+        :param rdcc_nbytes: Total size of the raw chunk cache in bytes
+        :param rdcc_w0: The chunk preemption policy
+
+        :returns: New h5py.Dataset object for the same dataset that uses the given chunk cache settings.
+        """
+        dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+        dapl.set_chunk_cache(rdcc_nslots, rdcc_nbytes, rdcc_w0)
+        dataset_id = h5py.h5d.open(dataset.parent.id, dataset.name.split('/')[-1], dapl=dapl)
+        return h5py.Dataset(dataset_id)
+
+    @staticmethod
+    def __next_prime(value):
+        """
+        Private helper function used to compute the smallest prime >= value.
+        """
+        value = int(value)
+        while True:
+            if value > 1 and all(value % divisor for divisor in xrange(2, int(value ** 0.5) + 1)):
+                return value
+            value += 1
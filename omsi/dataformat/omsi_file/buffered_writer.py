@@ -0,0 +1,213 @@
+"""
+Module with a chunk-aligned, buffered writer used to write 3D MSI datasets one spectrum at a time,
+e.g., when converting the spectra of a file reader (see file_reader_base.spectrum_iter) to HDF5.
+"""
+import os
+import tempfile
+from collections import OrderedDict
+import numpy as np
+from omsi.shared.log import log_helper
+
+
+class omsi_buffered_writer(object):
+    """
+    Buffered writer for writing a 3D (x, y, m/z) dataset one spectrum at a time.
+
+    Writing a chunked (and compressed) HDF5 dataset one spectrum at a time rewrites (and recompresses)
+    each chunk once for every spectrum it contains, e.g., up to 16 times for a (4, 4, 2048) chunking.
+    The buffered writer instead collects the spectra in tiles that cover one row of chunks along x,
+    i.e., chunk_shape[0] x positions with the full y and m/z extent of the dataset. Once all spectra
+    of a tile have been received, the tile is written at once so that each chunk is written only once.
+
+    The memory used by the tiles is bounded by max_bytes. If a new tile does not fit into memory,
+    then the least recently used tiles are moved to a spill file (a sparse numpy memmap in a temporary
+    file). A tile that is larger than max_bytes is allocated in the spill file directly. All remaining
+    tiles, e.g., tiles with missing spectra, are written when the writer is flushed or closed.
+
+    NOTE: Tiles are written as a whole, i.e., spectra that have not been written are set to 0.
+
+    Example use::
+
+        writer = omsi_buffered_writer(data=data_dataset, chunk_shape=(4, 4, 2048))
+        writer.write_spectra(input_file.spectrum_iter())
+        writer.close()
+
+    :ivar data: The output dataset (h5py.Dataset, omsi_file_msidata, or numpy array)
+    :ivar shape: Tuple with the shape of the output dataset
+    :ivar dtype: The numpy dtype of the tiles
+    :ivar tile_x: The number of x positions per tile
+    :ivar max_bytes: The maximum number of bytes used by tiles in memory
+    :ivar num_tiles_written: The number of tiles written so far
+    :ivar num_tiles_spilled: The number of tiles that have been moved to the spill file
+    """
+    def __init__(self, data, chunk_shape=None, max_bytes=512*1024*1024, spill_dir=None):
+        """
+        Initialize the buffered writer.
+
+        :param data: The 3D output dataset (h5py.Dataset, omsi_file_msidata, or numpy array)
+        :param chunk_shape: The chunking of the output dataset. Default is None, in which case the chunking
+            of the dataset is used (if available). If the data is not chunked then tiles of a single x
+            position are used.
+        :param max_bytes: The maximum number of bytes used by tiles in memory.
+        :param spill_dir: The directory for the spill file. Default is None, in which case the
+            default temporary directory is used.
+        """
+        super(omsi_buffered_writer, self).__init__()
+        self.data = data
+        self.shape = tuple(int(dim) for dim in data.shape)
+        if len(self.shape) != 3:
+            raise ValueError("The buffered writer requires a 3D dataset.")
+        self.dtype = np.dtype(data.dtype)
+        if chunk_shape is None:
+            chunk_shape = getattr(data, 'chunks', None)
+        if chunk_shape is None and hasattr(data, 'datasets') and len(data.datasets) > 0:
+            chunk_shape = data.datasets[0].chunks
+        self.tile_x = max(min(int(chunk_shape[0]), self.shape[0]), 1) if chunk_shape is not None else 1
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.num_tiles_written = 0
+        self.num_tiles_spilled = 0
+        self.__tiles = OrderedDict()  # Dict of tile index -> tile array (in memory or in the spill file)
+        self.__masks = {}  # Dict of tile index -> 2D bool array indicating which spectra have been written
+        self.__spilled = set()  # Indices of the tiles stored in the spill file
+        self.__written = set()  # Indices of the tiles that have already been written to the dataset
+        self.__memory_bytes = 0
+        self.__spill_file = None
+        self.__spill_filename = None
+
+    def write_spectrum(self, xindex, yindex, values):
+        """
+        Write a single spectrum.
+
+        :param xindex: The x index of the spectrum
+        :param yindex: The y index of the spectrum
+        :param values: 1D array with the values of the spectrum
+        """
+        xindex = int(xindex)
+        yindex = int(yindex)
+        tile_index = xindex // self.tile_x
+        # Spectra of tiles that have already been written (e.g., duplicates) are written directly
+        if tile_index in self.__written:
+            self.data[xindex, yindex, :] = values
+            return
+        tile = self.__get_tile(tile_index)
+        tile[xindex - tile_index * self.tile_x, yindex, :] = values
+        mask = self.__masks[tile_index]
+        mask[xindex - tile_index * self.tile_x, yindex] = True
+        if mask.all():
+            self.__write_tile(tile_index)
+
+    def write_spectra(self, spectra):
+        """
+        Write all spectra of the given iterable, e.g., file_reader_base.spectrum_iter()
+
+        :param spectra: Iterable of ((x, y, ...), values) tuples
+
+        :returns: The number of spectra written
+        """
+        num_spectra = 0
+        for spectrum in spectra:
+            self.write_spectrum(xindex=spectrum[0][0], yindex=spectrum[0][1], values=spectrum[1])
+            num_spectra += 1
+        return num_spectra
+
+    def flush(self):
+        """
+        Write all remaining tiles to the dataset.
+        """
+        for tile_index in list(self.__tiles.keys()):
+            self.__write_tile(tile_index)
+
+    def close(self):
+        """
+        Write all remaining tiles to the dataset and remove the spill file (if any).
+        """
+        self.flush()
+        if self.__spill_file is not None:
+            del self.__spill_file
+            self.__spill_file = None
+            os.remove(self.__spill_filename)
+            self.__spill_filename = None
+
+    def __tile_extent(self, tile_index):
+        """
+        Private helper function used to compute the start and end x index of a tile.
+
+        :returns: Tuple of the xstart and xend index of the tile
+        """
+        xstart = tile_index * self.tile_x
+        return xstart, min(xstart + self.tile_x, self.shape[0])
+
+    def __tile_bytes(self, tile_index):
+        """
+        Private helper function used to compute the number of bytes of a tile.
+        """
+        xstart, xend = self.__tile_extent(tile_index)
+        return (xend - xstart) * self.shape[1] * self.shape[2] * self.dtype.itemsize
+
+    def __get_tile(self, tile_index):
+        """
+        Private helper function used to get (and if necessary allocate) the tile with the given index.
+
+        :returns: The 3D tile array
+        """
+        if tile_index in self.__tiles:
+            return self.__tiles[tile_index]
+        xstart, xend = self.__tile_extent(tile_index)
+        if xstart >= self.shape[0] or xstart < 0:
+            raise IndexError("The x index is out of range for the dataset.")
+        tile_bytes = self.__tile_bytes(tile_index)
+        # Move the least recently allocated tiles to the spill file until the new tile fits into memory
+        while self.__memory_bytes + tile_bytes > self.max_bytes and \
+                len(self.__tiles) > len(self.__spilled):
+            oldest_index = [index for index in self.__tiles.keys() if index not in self.__spilled][0]
+            self.__spill_tile(oldest_index)
+        if tile_bytes > self.max_bytes:
+            tile = self.__get_spill_file()[xstart:xend, :, :]
+            self.__spilled.add(tile_index)
+            self.num_tiles_spilled += 1
+        else:
+            tile = np.zeros(shape=(xend - xstart, self.shape[1], self.shape[2]), dtype=self.dtype)
+            self.__memory_bytes += tile_bytes
+        self.__tiles[tile_index] = tile
+        self.__masks[tile_index] = np.zeros(shape=(xend - xstart, self.shape[1]), dtype='bool')
+        return tile
+
+    def __get_spill_file(self):
+        """
+        Private helper function used to get (and if necessary create) the spill file.
+
+        :returns: numpy memmap of the shape of the dataset
+        """
+        if self.__spill_file is None:
+            spill_fd, self.__spill_filename = tempfile.mkstemp(suffix='.spill', dir=self.spill_dir)
+            os.close(spill_fd)
+            log_helper.info(__name__, "Creating spill file: " + str(self.__spill_filename))
+            self.__spill_file = np.memmap(self.__spill_filename, dtype=self.dtype, mode='w+', shape=self.shape)
+        return self.__spill_file
+
+    def __spill_tile(self, tile_index):
+        """
+        Private helper function used to move an in-memory tile to the spill file.
+        """
+        xstart, xend = self.__tile_extent(tile_index)
+        spill_tile = self.__get_spill_file()[xstart:xend, :, :]
+        spill_tile[:] = self.__tiles[tile_index]
+        self.__tiles[tile_index] = spill_tile
+        self.__spilled.add(tile_index)
+        self.__memory_bytes -= self.__tile_bytes(tile_index)
+        self.num_tiles_spilled += 1
+
+    def __write_tile(self, tile_index):
+        """
+        Private helper function used to write a tile to the dataset and release it.
+        """
+        xstart, xend = self.__tile_extent(tile_index)
+        self.data[xstart:xend, :, :] = self.__tiles.pop(tile_index)
+        self.__masks.pop(tile_index)
+        if tile_index in self.__spilled:
+            self.__spilled.remove(tile_index)
+        else:
+            self.__memory_bytes -= self.__tile_bytes(tile_index)
+        self.__written.add(tile_index)
+        self.num_tiles_written += 1
@@ -0,0 +1,325 @@
+"""
+Module with a parallel, chunk-aligned engine for copying data between h5py datasets
+with different chunkings, e.g., to create optimized copies of MSI datasets.
+"""
+import sys
+import time
+import zlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from fractions import gcd
+import numpy as np
+import h5py
+from h5py._hl import filters as h5py_filters
+from omsi.shared.log import log_helper
+
+
+class omsi_copy_engine(object):
+    """
+    Engine for copying data between two h5py datasets of the same shape but different chunking.
+
+    The copy is performed in tiles that are aligned with both the source and the destination chunk grids,
+    i.e., the extent of a tile along each axis is the least common multiple of the source and destination
+    chunk size. In this way each source chunk is read (and decompressed) only once and each destination
+    chunk is written (and compressed) only once. The data of a tile is kept in a memory buffer that is
+    bounded by ``max_buffer_bytes``. If the aligned tile does not fit into the buffer, then the tile is
+    shrunk to a multiple of the destination chunking, i.e., destination chunks are still written only once
+    but source chunks at the tile boundaries may be read more than once.
+
+    Parallelism:
+
+        * If the raw chunks of the source can be accessed directly (no filters or gzip only), then the
+          source chunks are read as raw bytes and decompressed in a thread pool. Chunks that HDF5 stored
+          with an unexpected filter mask are read via h5py instead.
+        * Otherwise, the tiles are read via h5py, i.e., HDF5 decompresses each source chunk once.
+        * If the destination uses no filters or gzip only, then the destination chunks are compressed
+          in a thread pool and written as raw chunks. The compression of the chunks of the current tile
+          is overlapped with reading the next tile.
+        * Otherwise, the tiles are written via h5py, i.e., HDF5 compresses the destination chunks in the
+          calling thread without overlap.
+        * All writes to the HDF5 file are performed by a single writer (the calling thread).
+
+    :ivar source: The source h5py.Dataset
+    :ivar destination: The destination h5py.Dataset
+    :ivar num_workers: The number of threads used for compression/decompression
+    :ivar max_buffer_bytes: The maximum size of a tile buffer in bytes
+    """
+    def __init__(self,
+                 source,
+                 destination,
+                 num_workers=None,
+                 max_buffer_bytes=256*1024*1024):
+        """
+        Initialize the copy engine.
+
+        :param source: The source h5py.Dataset
+        :param destination: The destination h5py.Dataset. Must have the same shape as the source.
+        :param num_workers: The number of threads to be used. Default is None, in which
+            case the number of CPUs is used.
+        :param max_buffer_bytes: The maximum number of bytes to be used for a tile buffer
+        """
+        super(omsi_copy_engine, self).__init__()
+        if source.shape != destination.shape:
+            raise ValueError("The source and destination must have the same shape.")
+        self.source = source
+        self.destination = destination
+        self.num_workers = num_workers if num_workers is not None else multiprocessing.cpu_count()
+        self.max_buffer_bytes = max_buffer_bytes
+
+    def plan_tiles(self):
+        """
+        Compute the tiles used for copying the data.
+
+        :returns: Tuple of (tile_shape, tiles) where tile_shape is the shape of the tiles and tiles
+            is a list of tuples of slices, one per tile, in C-order.
+        """
+        shape = self.source.shape
+        itemsize = self.source.dtype.itemsize
+        # Contiguous (i.e., not chunked) data may be accessed using arbitrary blocks
+        source_chunks = self.source.chunks if self.source.chunks is not None else shape
+        destination_chunks = self.destination.chunks if self.destination.chunks is not None else shape
+
+        # Compute the tile shape aligned with both the source and destination chunks
+        tile_shape = [min(source_chunks[axis] * destination_chunks[axis] // gcd(source_chunks[axis],
+                                                                                destination_chunks[axis]),
+                          shape[axis])
+                      for axis in range(len(shape))]
+        # The chunking used to reduce the tile size if needed
+        if self.destination.chunks is not None:
+            destination_chunks = self.destination.chunks
+        elif self.source.chunks is not None:
+            destination_chunks = self.source.chunks
+        else:
+            destination_chunks = (1, ) * len(shape)
+        # Reduce the tile to a multiple of the destination chunking until it fits into the buffer
+        while np.prod(tile_shape) * itemsize > self.max_buffer_bytes:
+            ratios = [float(tile_shape[axis]) / float(destination_chunks[axis])
+                      if tile_shape[axis] > destination_chunks[axis] else 0
+                      for axis in range(len(shape))]
+            axis = int(np.argmax(ratios))
+            if ratios[axis] <= 0:
+                break
+            num_dest_chunks = int(np.ceil(float(tile_shape[axis]) / float(destination_chunks[axis])))
+            tile_shape[axis] = max(1, num_dest_chunks // 2) * destination_chunks[axis]
+
+        # Compute the list of tiles
+        num_tiles = [int(np.ceil(float(shape[axis]) / float(tile_shape[axis]))) for axis in range(len(shape))]
+        tiles = []
+        for tile_index in np.ndindex(*num_tiles):
+            tiles.append(tuple([slice(tile_index[axis] * tile_shape[axis],
+                                      min((tile_index[axis] + 1) * tile_shape[axis], shape[axis]))
+                                for axis in range(len(shape))]))
+        return tuple(tile_shape), tiles
+
+    @staticmethod
+    def supports_raw_chunks(dataset):
+        """
+        Check whether the raw chunks of the dataset can be compressed/decompressed by the engine, i.e.,
+        whether the dataset is chunked, uses a simple numeric dtype, and uses no filters other than gzip.
+
+        :param dataset: The h5py.Dataset
+
+        :returns: Boolean
+        """
+        if dataset.chunks is None or dataset.dtype.kind not in 'biuf':
+            return False
+        try:
+            dataset_filters = h5py_filters.get_filters(dataset.id.get_create_plist())
+        except Exception:
+            return False
+        return set(dataset_filters.keys()).issubset(set(['gzip']))
+
+    def __raw_read_supported(self):
+        """
+        Private helper function used to check whether raw chunks can be read from the source. Some
+        versions of h5py do not return the raw chunk data correctly, so we compare the raw data of
+        the first chunk against the data read via h5py.
+        """
+        if not self.supports_raw_chunks(self.source):
+            return False
+        try:
+            offset = (0, ) * len(self.source.shape)
+            chunk = self.__decode_chunk((offset, self.__read_raw_chunk(offset)))[1]
+            expected = self.source[tuple([slice(0, min(c, s)) for c, s in zip(self.source.chunks,
+                                                                                self.source.shape)])]
+            return chunk is not None and np.array_equal(chunk, expected)
+        except Exception:
+            return False
+
+    def __read_raw_chunk(self, offset):
+        """
+        Private helper function used to read the raw bytes of a source chunk.
+
+        :returns: Tuple of (filter mask, raw bytes of the chunk) or None if the chunk has not been allocated.
+            Each bit of the filter mask that is set indicates a filter of the pipeline that was skipped
+            when the chunk was stored.
+        """
+        try:
+            return self.source.id.read_direct_chunk(offset)
+        except Exception:
+            return None
+
+    def __decode_chunk(self, raw_chunk):
+        """
+        Private helper function used to decompress a raw source chunk.
+
+        :param raw_chunk: Tuple of (offset, tuple of (filter mask, raw bytes) or None)
+
+        :returns: Tuple of (offset, numpy array with the data of the chunk cropped to the dataset
+            bounds or None if the chunk was not allocated)
+        """
+        offset, raw_data = raw_chunk
+        if raw_data is None:
+            return offset, None
+        filter_mask, raw_data = raw_data
+        chunks = self.source.chunks
+        chunk_select = tuple([slice(0, min(chunks[axis], self.source.shape[axis] - offset[axis]))
+                              for axis in range(len(chunks))])
+        # gzip is the only filter of the pipeline (see supports_raw_chunks), i.e., bit 0 of the mask
+        # is set if HDF5 stored the chunk uncompressed because deflate did not reduce its size
+        deflate_mask = 1 if self.source.compression == 'gzip' else 0
+        if filter_mask & ~deflate_mask:
+            # Unexpected filter mask. Read the chunk via h5py instead.
+            return offset, self.source[tuple([slice(offset[axis], offset[axis] + chunk_select[axis].stop)
+                                              for axis in range(len(chunks))])]
+        if deflate_mask and not filter_mask & deflate_mask:
+            raw_data = zlib.decompress(raw_data)
+        chunk = np.frombuffer(raw_data, dtype=self.source.dtype).reshape(chunks)
+        return offset, chunk[chunk_select]
+
+    def __encode_chunk(self, chunk_data):
+        """
+        Private helper function used to pad and compress a destination chunk.
+
+        :param chunk_data: Tuple of (offset, numpy array with the data of the chunk)
+
+        :returns: Tuple of (offset, raw bytes of the chunk)
+        """
+        offset, data = chunk_data
+        chunks = self.destination.chunks
+        if data.shape != tuple(chunks):
+            padded = np.empty(chunks, dtype=self.destination.dtype)
+            padded.fill(self.destination.fillvalue)
+            padded[tuple([slice(0, extent) for extent in data.shape])] = data
+            data = padded
+        raw_data = np.ascontiguousarray(data, dtype=self.destination.dtype).tostring()
+        if self.destination.compression == 'gzip':
+            compression_level = self.destination.compression_opts
+            raw_data = zlib.compress(raw_data, compression_level if compression_level is not None else 4)
+        return offset, raw_data
+
+    def __read_tile_raw(self, tile, pool):
+        """
+        Private helper function used to read a tile by decompressing the raw source chunks in parallel.
+        """
+        buffer_shape = tuple([s.stop - s.start for s in tile])
+        tile_buffer = np.empty(buffer_shape, dtype=self.source.dtype)
+        tile_buffer.fill(self.source.fillvalue)
+        chunks = self.source.chunks
+        first_chunk = [s.start // c for s, c in zip(tile, chunks)]
+        last_chunk = [(s.stop - 1) // c for s, c in zip(tile, chunks)]
+        offsets = [tuple([(first_chunk[axis] + index[axis]) * chunks[axis] for axis in range(len(chunks))])
+                   for index in np.ndindex(*[l - f + 1 for f, l in zip(first_chunk, last_chunk)])]
+        raw_chunks = ((offset, self.__read_raw_chunk(offset)) for offset in offsets)
+        for offset, chunk in pool.imap(self.__decode_chunk, raw_chunks):
+            if chunk is None:
+                continue
+            # Copy the part of the chunk that overlaps with the tile
+            source_select = []
+            buffer_select = []
+            for axis in range(len(chunks)):
+                start = max(offset[axis], tile[axis].start)
+                stop = min(offset[axis] + chunk.shape[axis], tile[axis].stop)
+                source_select.append(slice(start - offset[axis], stop - offset[axis]))
+                buffer_select.append(slice(start - tile[axis].start, stop - tile[axis].start))
+            tile_buffer[tuple(buffer_select)] = chunk[tuple(source_select)]
+        return tile_buffer
+
+    def __split_tile(self, tile, tile_buffer):
+        """
+        Private helper function used to split a tile into destination chunks.
+        The tile must be aligned with the destination chunking.
+
+        :returns: List of tuples of (offset, numpy array with the data of the chunk)
+        """
+        chunks = self.destination.chunks
+        num_chunks = [int(np.ceil(float(s.stop - s.start) / float(c))) for s, c in zip(tile, chunks)]
+        chunk_data = []
+        for index in np.ndindex(*num_chunks):
+            buffer_select = tuple([slice(index[axis] * chunks[axis],
+                                         min((index[axis] + 1) * chunks[axis], tile_buffer.shape[axis]))
+                                   for axis in range(len(chunks))])
+            offset = tuple([tile[axis].start + buffer_select[axis].start for axis in range(len(chunks))])
+            chunk_data.append((offset, tile_buffer[buffer_select]))
+        return chunk_data
+
+    def __write_raw_chunks(self, raw_chunks):
+        """
+        Private helper function used to write a list of compressed chunks to the destination.
+
+        :param raw_chunks: List of tuples of (offset, raw bytes of the chunk)
+        """
+        for offset, raw_data in raw_chunks:
+            self.destination.id.write_direct_chunk(offset, raw_data)
+
+    def copy(self, print_status=False):
+        """
+        Copy the data from the source to the destination.
+
+        :param print_status: Print the progress of the copy to the command line
+
+        :returns: Dict with statistics about the copy, i.e., the 'num_tiles', the 'tile_shape', the
+            uncompressed 'bytes' copied, the 'time' in seconds, the 'throughput_mb_s' in MB/s, and
+            whether raw chunks were read ('raw_read') and written ('raw_write').
+        """
+        start_time = time.time()
+        tile_shape, tiles = self.plan_tiles()
+        raw_read = self.__raw_read_supported()
+        destination_aligned = self.destination.chunks is not None and \
+            all([(t % c == 0) or (t == s) for t, c, s in zip(tile_shape, self.destination.chunks,
+                                                                self.destination.shape)])
+        raw_write = destination_aligned and self.supports_raw_chunks(self.destination) and \
+            self.destination.dtype == self.source.dtype
+        if raw_write:
+            self.destination.file.flush()
+
+        thread_pool = ThreadPool(processes=max(1, self.num_workers))
+        try:
+            pending_writes = None
+            for tile_index, tile in enumerate(tiles):
+                # Read the tile
+                if raw_read:
+                    tile_buffer = self.__read_tile_raw(tile, thread_pool)
+                else:
+                    tile_buffer = self.source[tile]
+                # Write the tile. For raw writes the chunks of the tile are compressed asynchronously
+                # while the next tile is being read, i.e., at most two tiles are buffered at any time.
+                if raw_write:
+                    if pending_writes is not None:
+                        self.__write_raw_chunks(pending_writes.get())
+                    pending_writes = thread_pool.map_async(self.__encode_chunk,
+                                                           self.__split_tile(tile, tile_buffer))
+                else:
+                    self.destination[tile] = tile_buffer
+                if print_status:
+                    sys.stdout.write("[" + str(int(100. * float(tile_index + 1) / float(len(tiles)))) + "%]" + "\r")
+                    sys.stdout.flush()
+            if pending_writes is not None:
+                self.__write_raw_chunks(pending_writes.get())
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+        copy_time = time.time() - start_time
+        num_bytes = int(np.prod(self.source.shape)) * self.source.dtype.itemsize
+        statistics = {'num_tiles': len(tiles),
+                      'tile_shape': tile_shape,
+                      'bytes': num_bytes,
+                      'time': copy_time,
+                      'throughput_mb_s': (num_bytes / (1024. * 1024.)) / copy_time if copy_time > 0 else 0.0,
+                      'raw_read': raw_read,
+                      'raw_write': raw_write}
+        log_helper.info(__name__, "Copied " + str(num_bytes / (1024. * 1024.)) + " MB in " +
+                        str(copy_time) + "s (" + str(statistics['throughput_mb_s']) + " MB/s) using " +
+                        str(len(tiles)) + " tiles of shape " + str(tile_shape))
+        return statistics
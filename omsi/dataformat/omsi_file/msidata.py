@@ -2,6 +2,7 @@
 Module for managing MSI data in OMSI data files
 """
 
+import os
 import math
 from omsi.dataformat.omsi_file.format import omsi_format_msidata, \
     omsi_format_msidata_partial_cube, \
@@ -12,6 +13,8 @@ from omsi.dataformat.omsi_file.dependencies import omsi_dependencies_manager
 from omsi.dataformat.omsi_file.methods import omsi_methods_manager
 from omsi.dataformat.omsi_file.instrument import omsi_instrument_manager
 from omsi.dataformat.omsi_file.metadata_collection import omsi_metadata_collection_manager
+from omsi.dataformat.omsi_file.block_cache import omsi_block_cache
+from omsi.dataformat.omsi_file.copy_engine import omsi_copy_engine
 import numpy as np
 
 
@@ -300,8 +303,6 @@ class omsi_file_msidata(omsi_dependencies_manager,
 
     **Current limitations:**
 
-    * The estimates in def __best_dataset__(self,keys) are fairly crude at this point
-    * The __getitem__ function for the partial_spectra case is not implemented yet.
     * The __setitem__ function for the partial spectra case is not implemented yet (Note, it \
       should also support dynamic expansion of the cube by adding previously missing spectra).
     * For the partial cube case, assignement using __setitem__ function is only supported to \
@@ -336,6 +337,8 @@ class omsi_file_msidata(omsi_dependencies_manager,
                    prelaod_xy_index is set in the constructor, then this is a numpy dataset with the \
                    preloaded data. Otherwise, this is the h5py dataset pointing to the data on disk. \
                    Negative (-1) entries indicate that no spectrum has been recored for the given pixel.
+    :ivar block_cache: None or omsi.dataformat.omsi_file.block_cache.omsi_block_cache object used to cache \
+                   chunks of the MSI datasets in memory when reading data via the [..] operator.
 
     **Private object variables:**
 
@@ -344,6 +347,8 @@ class omsi_file_msidata(omsi_dependencies_manager,
                     set_fill_space function(..)
     :ivar _fill_mz: Define whether spectra should be remapped onto a global m/z axis. Set using the \
                     set_fill_spectra function(..)
+    :ivar _rdcc_max_nbytes: None if the HDF5 raw chunk cache has not been tuned via tune_chunk_cache(...). \
+                    Otherwise the maximum size of the raw chunk cache per dataset.
 
     """
     @classmethod
@@ -382,7 +387,8 @@ class omsi_file_msidata(omsi_dependencies_manager,
                  fill_space=True,
                  fill_spectra=True,
                  preload_mz=False,
-                 preload_xy_index=False):
+                 preload_xy_index=False,
+                 block_cache=None):
         """
         Initialize the omsi_msidata object.
 
@@ -409,6 +415,10 @@ class omsi_file_msidata(omsi_dependencies_manager,
 
         :param preload_xy_index: Should the xy index (if available) be preloaderd into memory or should the
                                  required data be loaded on the fly when needed.
+
+        :param block_cache: The omsi_block_cache to be used for caching chunks of the MSI data in memory.
+                            If None, then the default cache set via omsi_block_cache.set_default_cache(...)
+                            is used (which is None, i.e., no caching, unless set otherwise).
         """
         super(omsi_file_msidata, self).__init__(data_group)
         # The following initialization are performed by the super call
@@ -429,6 +439,8 @@ class omsi_file_msidata(omsi_dependencies_manager,
         self.mz_index = None
         self._fill_xy = fill_space
         self._fill_mz = fill_spectra
+        self.block_cache = block_cache if block_cache is not None else omsi_block_cache.get_default_cache()
+        self._rdcc_max_nbytes = None
         self.is_valid = False
         if self.format_type is not None:
             # Initalize the dataset
@@ -545,6 +557,8 @@ class omsi_file_msidata(omsi_dependencies_manager,
         # Update the data in all available version of the dataset
         for dset in self.datasets:
             dset[key] = value
+            if self.block_cache is not None:
+                self.block_cache.clear(dset)
 
     def __setitem_partialcube__(self, key, value):
         """
@@ -568,6 +582,8 @@ class omsi_file_msidata(omsi_dependencies_manager,
         # Update the data in all available version of the dataset
         for dset in self.datasets:
             dset[indexlist.tolist(), key[2]] = value.reshape(totalsize, self.__num_elements__(key[2]))
+            if self.block_cache is not None:
+                self.block_cache.clear(dset)
 
     def __setitem_partialspectra__(self, key, value):
         """
@@ -622,7 +638,7 @@ class omsi_file_msidata(omsi_dependencies_manager,
         # Get the dataset that is best suited for the selection
         dset = self.__best_dataset__(key)
         # Access data using h5py
-        return dset[key]
+        return self.__read_dataset__(dset, key)
 
     def __getitem_partialcube__(self, key):
         """
@@ -645,7 +661,7 @@ class omsi_file_msidata(omsi_dependencies_manager,
         cleanindexlist = cleanindexlist.reshape(cleanindexlist.size)
         # Load the data
         if cleanindexlist.size > 0:
-            data = dset[cleanindexlist, key[2]]
+            data = self.__read_dataset__(dset, (cleanindexlist, key[2]))
         else:
             data = np.empty(0, dtype=dset.dtype)
 
@@ -681,91 +697,259 @@ class omsi_file_msidata(omsi_dependencies_manager,
         """
         Private helper function used in case that the data is stored as full or partial cube with partial spectra.
 
+        The xy_index, xy_index_end, and mz_index are used as a CSR-like index, i.e., the values of the
+        spectrum at pixel (x,y) are stored in dataset[xy_index[x,y]:xy_index_end[x,y]] and the
+        corresponding indices into the global m/z axis are stored in mz_index[xy_index[x,y]:xy_index_end[x,y]].
+        Rather than loading the spectra one-at-a-time, we load all required value ranges using as few
+        bulk reads as possible (see `__read_partialspectra_ranges__`) and then scatter the values
+        into the output using NumPy.
+
+        The layout of the returned data depends on the fill settings:
+
+            * ``fill_space=True, fill_spectra=True`` : Dense numpy array as if the data were a 3D cube
+            * ``fill_space=False, fill_spectra=True`` : List of numpy arrays, one per selected pixel, \
+              with the spectra mapped to the selected part of the global m/z axis. Missing spectra are None.
+            * ``fill_spectra=False`` : Tuple of two lists with the values and the m/z indices of the \
+              selected peaks of each selected pixel. Missing spectra are None.
+
         :param key: Three elements of type index, list or slice defining the data selection
         """
-        raise NotImplementedError(
-            "Selection for partial spectra datasets is currently not implemented. See __getitem_partialspectra__(...)")
-
         # Get the dataset that is best suited for the selection
-        # d = self.__best_dataset__(key)
-        # Determine the data values to be loaded in xy
-        # indexList_start = self.xy_index[ key[0] , key[1] ]
-        # indexList_end   = self.xy_index_end[ key[0] , key[1] ]
-        # index_select = (indexList_start>=0)
-        # if not isinstance( indexList_start , int ) :
-        #   cleanIndexList_start = indexList_start[ index_select ]
-        #   cleanIndexList_end = indexList_end[ index_select ]
-        # else :
-        #    if indexList_start < 0 :
-        #        cleanIndexList_start = np.empty(0, dtype=int)
-        #        cleanIndexList_end   = np.empty(0, dtype=int)
-        #    else :
-        #       cleanIndexList_start = np.asarray( [ indexList_start ] , dtype=int )
-        #       cleanIndexList_end   = np.asarray( [ indexList_end ]   , dtype=int )
-
-        # Load the full specta for each x/y location
-        # mz_data = [[]] * cleanIndexList.shape[0]
-        # for i in xrange(0,cleanIndexList.shape[0]) :
-        #     mz_data[i] = self.mz_index[ cleanIndexList_start[i]:cleanIndexList_end[i] ]
-
-        # Determine which parts of the m/z data we actually need
-        # if isinstance(key[2] , int ) :
-        #   mz_select = [ i==key[2] for i in mz_data  ]
-        # if isinstance(key[2] , slice ) :
-        #   if key[2].step>1:
-        #       raise NotImplementedError("Selections with a stepping are currently not supported by the interface for the m/z dimension and particle_spectra data")
-        #   Select full specta
-        #   if (key[2].start is None or key[2].start == 0) and \
-        #       (key[2].end is None or key[2].end == mz_indexList.shape[1]) and \
-        #       (key[2].step is None or key[2].step == 1 ) :
-        #           mz_select = [ np.ones(dtype='bool', shape=i.shape ) for i in mz_data ]
-        #   Select an mz-range of the spectra
-        #   else :
-        #       mz_select = [ np.logical_and( i>=key[2].start , i<key[2].end ) for i in mz_data  ]
-        #       #mz_select = np.where( np.logical_and( mz_indexList>=key[2].start , mz_indexList<key[2].end )  , mz_indexList , -1 )
-        # elif isinstance(key[2] , list ) :
-        #   Treat the list the same way as an index selection if we only have one entry in the list
-        #   if len( key[2] ) == 1 :
-        #       mz_select = [ i==key[2][0] for i in mz_data  ]
-        #   Check if the list defines a continues selection
-        #   for i in xrange(1,len(key[2])) :
-        #       if key[2][i] != (key[2][i-1]+1) :
-        #           raise NotImplementedError("Selections using discontinoues lists are currently not supported by the interface for the m/z dimension and particle_spectra data.")
-        #           Implementing discontinoues lists for selection will require a different treatment also when filling the data
-        # Treat the list as a continues slice-based selection.
-        # mz_select = [ np.logical_and( i>=key[2][0] , i<key[2][-1] ) for i in mz_data  ]
-
-        # Load the requested spectra
-        # if self._fill_mz and self._fill_xy and (len( indexList_start.shape )==2)  :
-        #   Remap both the spatial and m/z coordinates so that the data behaves completely like a 3D cube
-        #   Compute how many elements we need to retrieve in the mz-axis
-        #   mzsize = self.__num_elements__(key[2])
-        #   ysize  = indexList_start.shape[0]
-        #   xsize  = indexList_start.shape[1]
-        #   filldata = np.zeros( shape=(xsize, ysize, mzsize) , dtype = d.dtype )
-        #   mzi = 0
-        #   for xi in xrange(0,xsize) :
-        #       for yi in xrange(0,ysize) :
-        #           if indexList_start[xi,yi] >= 0 :
-        #               filldata[xi,yi,mz_select[mzi]] = d[ indexList_start[i]:indexList_end[i] ][ mz_select[mzi] ]
-        #               mzi = mzi+1
-        # elif self._fill_mz: #This includes the case where both fill_mz and fill_xy are set but fill_xy is not needed.
-        #   mzsize = self.__num_elements__(key[2])
-        #   filldata = [np.zeros( mzsize) ] * len(mz_select)
-        #    for i in xrange(0, len(mz_select) ):
-        #       filldata[i][mz_select[i]] =  d[ cleanIndexList_start[i]:cleanIndexList_end[i] ][ mz_select[i] ]
-        #   return filldata
-        # elif self._fill_xy: #Only fill_xy is set but not the fill_mz
-        #    Remap only the spatial coordinates
-        #   raise NotImplementedError("fill_xy without fill_mz set is currently not supported by the API")
-        # else : #This is the case where neither fill_mz nor fill_xy are set
-        #    Just load the data and return both the data and mz indicies
-        #   filldata     =  [[]] * cleanIndexList.shape[0]
-        #   fillmzdata   =  [[]] * cleanIndexList.shape[0]
-        #   for i in xrange(0,cleanIndexList.shape[0]) :
-        #       filldata[i]   = d[ cleanIndexList_start[i]:cleanIndexList_end[i] ][mz_select[i]]
-        #       fillmzdata[i] = mz_data[i][mz_select[i]]
-        #   return filldata, fillmzdata
+        dset = self.__best_dataset__(key)
+
+        # Determine the spectra to be loaded in xy
+        index_start = np.asarray(self.xy_index[key[0], key[1]], dtype='int64')
+        index_end = np.asarray(self.xy_index_end[key[0], key[1]], dtype='int64')
+        xy_shape = index_start.shape
+        index_start = index_start.reshape(index_start.size)
+        index_end = index_end.reshape(index_end.size)
+        # Missing spectra are marked by start==end (or negative values in the index)
+        spectra_length = np.where(np.logical_and(index_start >= 0, index_end > index_start),
+                                  index_end - index_start,
+                                  0)
+
+        # Determine which elements of the global m/z axis are selected and map each m/z index to
+        # its column in the output (-1 for m/z values that are not selected)
+        num_mz = int(self.shape[2])
+        mz_select = np.arange(num_mz)[key[2]]
+        mz_select_is_scalar = (np.ndim(mz_select) == 0)
+        mz_select = np.atleast_1d(mz_select)
+        mz_unique, mz_inverse = np.unique(mz_select, return_inverse=True)
+        mz_column = np.empty(num_mz, dtype='int64')
+        mz_column.fill(-1)
+        mz_column[mz_unique] = np.arange(mz_unique.size)
+
+        # Load the values and m/z indices of all selected spectra
+        values, mz_indices = self.__read_partialspectra_ranges__(dset=dset,
+                                                                 index_start=index_start,
+                                                                 spectra_length=spectra_length)
+
+        # Compute for each loaded value the pixel and output column it belongs to
+        pixel_ids = np.repeat(np.arange(index_start.size), spectra_length)
+        columns = mz_column[mz_indices]
+        in_selection = columns >= 0
+
+        if self._fill_mz:
+            # Scatter the selected values into a dense array with one row per selected pixel
+            filldata = np.zeros((index_start.size, mz_unique.size), dtype=dset.dtype)
+            filldata[pixel_ids[in_selection], columns[in_selection]] = values[in_selection]
+            if mz_unique.size != mz_select.size or np.any(mz_unique != mz_select):
+                filldata = filldata[:, mz_inverse]
+            if mz_select_is_scalar:
+                filldata = filldata[:, 0]
+            if self._fill_xy:
+                return filldata.reshape(xy_shape + filldata.shape[1:])
+            else:
+                return [filldata[i] if spectra_length[i] > 0 else None
+                        for i in xrange(0, index_start.size)]
+        else:
+            # Return the selected peaks of each spectrum together with their m/z indices
+            peak_bounds = np.insert(np.cumsum(np.bincount(pixel_ids[in_selection],
+                                                          minlength=index_start.size)), 0, 0)
+            values = values[in_selection]
+            mz_indices = mz_indices[in_selection]
+            filldata = [None] * index_start.size
+            fillmzdata = [None] * index_start.size
+            for i in xrange(0, index_start.size):
+                if spectra_length[i] > 0:
+                    filldata[i] = values[peak_bounds[i]:peak_bounds[i+1]]
+                    fillmzdata[i] = mz_indices[peak_bounds[i]:peak_bounds[i+1]]
+            return filldata, fillmzdata
+
+    def __read_partialspectra_ranges__(self, dset, index_start, spectra_length, max_gap_ratio=0.5):
+        """
+        Private helper function used to load the values and m/z indices for a set of partial
+        spectra with as few HDF5 read operations as possible.
+
+        Touching ranges are merged into contiguous runs. If the runs cover a sufficiently large fraction
+        of their bounding range then the full bounding range is loaded with a single read. Otherwise
+        each contiguous run is loaded separately.
+
+        :param dset: The h5py dataset with the spectrum values
+        :param index_start: 1D numpy array with the start index of each spectrum in dset
+        :param spectra_length: 1D numpy array with the length of each spectrum. Spectra with
+            length 0 are ignored.
+        :param max_gap_ratio: Maximum fraction of the bounding range that we allow to be loaded in
+            addition to the requested data in order to use a single read.
+
+        :returns: Tuple of two 1D numpy arrays with the values and m/z indices of all spectra,
+            concatenated in the order of index_start.
+        """
+        total_length = int(spectra_length.sum())
+        if total_length == 0:
+            return np.empty(0, dtype=dset.dtype), np.empty(0, dtype='int64')
+
+        # Compute the position of all requested values in the file
+        valid = spectra_length > 0
+        starts = index_start[valid]
+        lengths = spectra_length[valid]
+        local_offsets = np.arange(total_length) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        file_positions = np.repeat(starts, lengths) + local_offsets
+
+        # Determine the contiguous runs of data that need to be loaded
+        order = np.argsort(starts, kind='mergesort')
+        sorted_starts = starts[order]
+        sorted_ends = sorted_starts + lengths[order]
+        new_run = np.ones(sorted_starts.size, dtype='bool')
+        new_run[1:] = sorted_starts[1:] > np.maximum.accumulate(sorted_ends)[:-1]
+        run_starts = sorted_starts[new_run]
+        run_ends = np.maximum.reduceat(sorted_ends, np.flatnonzero(new_run))
+        bounding_start = int(run_starts[0])
+        bounding_end = int(run_ends[-1])
+        num_requested = int((run_ends - run_starts).sum())
+
+        if run_starts.size == 1 or \
+                (bounding_end - bounding_start - num_requested) <= max_gap_ratio * (bounding_end - bounding_start):
+            # Load the full bounding range using a single read
+            values = self.__read_dataset__(dset, slice(bounding_start, bounding_end))
+            mz_indices = self.__read_dataset__(self.mz_index, slice(bounding_start, bounding_end))
+            buffer_positions = file_positions - bounding_start
+        else:
+            # Load each contiguous run and compute the position of the values in the concatenated buffer
+            values = np.concatenate([self.__read_dataset__(dset, slice(int(run_starts[i]), int(run_ends[i])))
+                                     for i in xrange(0, run_starts.size)])
+            mz_indices = np.concatenate([self.__read_dataset__(self.mz_index,
+                                                               slice(int(run_starts[i]), int(run_ends[i])))
+                                         for i in xrange(0, run_starts.size)])
+            run_buffer_offsets = np.cumsum(run_ends - run_starts) - (run_ends - run_starts)
+            run_id = np.searchsorted(run_starts, file_positions, side='right') - 1
+            buffer_positions = file_positions - run_starts[run_id] + run_buffer_offsets[run_id]
+
+        return values[buffer_positions], mz_indices[buffer_positions].astype('int64')
+
+    def __read_dataset__(self, dset, key):
+        """
+        Private helper function used to read a selection from a h5py dataset, using the block cache if available.
+
+        :param dset: The h5py dataset to read from
+        :param key: The selection
+        """
+        if self.block_cache is not None:
+            return self.block_cache.read(dset, key)
+        return dset[key]
+
+    def set_block_cache(self, block_cache):
+        """
+        Define the in-memory block cache to be used for reading data.
+
+        :param block_cache: omsi.dataformat.omsi_file.block_cache.omsi_block_cache object or None to disable caching
+        """
+        self.block_cache = block_cache
+
+    def tune_chunk_cache(self, max_nbytes=64*1024*1024):
+        """
+        Tune the HDF5 raw chunk cache (rdcc_nbytes / rdcc_nslots) of each version of the dataset
+        based on its chunking (see omsi_block_cache.chunk_cache_settings(...)). The datasets are
+        reopened with a dataset-specific chunk cache. Datasets created later via
+        create_optimized_chunking(...) are tuned as well.
+
+        :param max_nbytes: Maximum size of the raw chunk cache per dataset in bytes.
+
+        :returns: List of (rdcc_nslots, rdcc_nbytes) tuples with the settings used for each dataset
+                  (None for datasets that are not chunked).
+        """
+        self._rdcc_max_nbytes = max_nbytes
+        settings = []
+        for index, dset in enumerate(self.datasets):
+            dset_settings = omsi_block_cache.chunk_cache_settings(dset, max_nbytes=max_nbytes)
+            if dset_settings is not None:
+                self.datasets[index] = omsi_block_cache.open_with_chunk_cache(dset, *dset_settings)
+            settings.append(dset_settings)
+        return settings
+
+    def get_scan_dataset(self, max_bytes=256*1024*1024):
+        """
+        Get the data object best suited for reading the full data one block of complete spectra at a time,
+        e.g., for streaming reductions (see reduce(...)).
+
+        For the full_cube format this is the h5py dataset (i.e., the copy of the data) that requires the
+        fewest bytes to be read from disk among the copies for which a chunk-aligned block of complete
+        spectra fits into max_bytes (or the copy with the smallest such block if none fits). For all other
+        formats this is the msidata object itself, i.e., the data is read via the [..] operator.
+
+        :param max_bytes: The maximum number of bytes per block of complete spectra
+
+        :returns: h5py.Dataset or omsi_file_msidata object
+        """
+        if self.format_type != omsi_format_msidata.format_types['full_cube']:
+            return self
+        if len(self.datasets) == 1:
+            return self.datasets[0]
+        costs = []
+        for dset in self.datasets:
+            chunks = dset.chunks if dset.chunks is not None else (1, ) * (len(dset.shape) - 1) + (dset.shape[-1], )
+            block_bytes = np.prod(chunks[:-1]) * dset.shape[-1] * dset.dtype.itemsize
+            num_chunks = np.prod([math.ceil(float(dset.shape[i]) / float(chunks[i])) for i in range(len(chunks))])
+            storage_bytes = self.__chunk_storage_size__(dset, chunks) * num_chunks
+            costs.append((block_bytes > max_bytes, block_bytes if block_bytes > max_bytes else 0, storage_bytes))
+        return self.datasets[costs.index(min(costs))]
+
+    def reduce(self,
+               op,
+               axis=None,
+               q=None,
+               last_axis_selection=None,
+               max_bytes=256*1024*1024,
+               num_threads=1,
+               comm=None,
+               root=0,
+               num_bins=256):
+        """
+        Compute a streaming reduction of the data, e.g., the mean spectrum via reduce('mean', axis=(0, 1)).
+
+        The data is read one chunk-aligned block of complete spectra at a time from the copy of the data
+        that is best suited for reading the full data (see get_scan_dataset(...)) and the partial results
+        of the blocks are combined. Multiple reductions may be computed in a single pass over the data.
+        See omsi.shared.data_blocks.reduce_data(...) for details.
+
+        :param op: String with the reduction operation (sum, mean, min, max, count_nonzero, or percentile)
+            or list of strings to compute multiple reductions in one pass.
+        :param axis: Integer or tuple of integers with the axes to be reduced. Default is None, i.e., reduce all axes.
+        :param q: Percentile or sequence of percentiles in [0, 100]. Required for the 'percentile' operation.
+        :param last_axis_selection: Optional selection applied to the m/z axis before the reduction.
+        :param max_bytes: The maximum number of bytes per block
+        :param num_threads: Number of threads used to read (and decompress) blocks while the current block
+            is reduced. Set to 0 to read the blocks synchronously.
+        :param comm: MPI communicator. If set, then the blocks are distributed across all ranks. Default is None.
+        :param root: The MPI rank used to combine the partial results of all ranks.
+        :param num_bins: Number of histogram bins per element used for streaming approximate percentiles.
+
+        :returns: Numpy array (or numpy scalar) with the result or list of results if a list of operations is given.
+        """
+        from omsi.shared.data_blocks import reduce_data
+        if self.format_type != omsi_format_msidata.format_types['full_cube'] and \
+                not (self._fill_xy and self._fill_mz):
+            raise ValueError("Reductions of partial cube and partial spectra data require fill_space and fill_spectra")
+        return reduce_data(data=self,
+                           op=op,
+                           axis=axis,
+                           q=q,
+                           last_axis_selection=last_axis_selection,
+                           max_bytes=max_bytes,
+                           num_threads=num_threads,
+                           comm=comm,
+                           root=root,
+                           num_bins=num_bins)
 
     def set_fill_space(self, fill_space):
         """
@@ -1119,15 +1303,16 @@ class omsi_file_msidata(omsi_dependencies_manager,
                 compression=compression,
                 compression_opts=compression_opts)
 
-        # Determine the minimal dtype for the xy index
-        xy_index_dtype = 'uint16'
-        xyshape = spectra_length.shape[0] * spectra_length.shape[1]
-        if xyshape < np.iinfo('uint16').max:
-            xy_index_dtype = 'uint16'
-        elif xyshape < np.iinfo('uint32').max:
-            xy_index_dtype = 'uint32'
-        elif xyshape < np.iinfo('uint64').max:
-            xy_index_dtype = 'uint64'
+        # Determine the minimal dtype for the xy index. The xy index stores offsets into the
+        # flattened data so the dtype is determined by the total length of all spectra. We use
+        # signed types so that missing spectra can be marked with -1.
+        xy_index_dtype = 'int16'
+        if total_len_spectra < np.iinfo('int16').max:
+            xy_index_dtype = 'int16'
+        elif total_len_spectra < np.iinfo('int32').max:
+            xy_index_dtype = 'int32'
+        elif total_len_spectra < np.iinfo('int64').max:
+            xy_index_dtype = 'int64'
 
         # Create the xy index start dataset
         xy_index_dataset = data_group.require_dataset(
@@ -1168,7 +1353,7 @@ class omsi_file_msidata(omsi_dependencies_manager,
             name=omsi_format_msidata_partial_cube.shape_name,
             shape=(3, ),
             dtype='uint32')
-        shape_dataset[:] = np.asarray(mask.shape, dtype='uint32')
+        shape_dataset[:] = np.asarray((mask.shape[0], mask.shape[1], len_global_mz), dtype='uint32')
 
         # Create any dependencies
         _ = omsi_file_dependencies.__create__(parent_group=data_group,
@@ -1183,7 +1368,8 @@ class omsi_file_msidata(omsi_dependencies_manager,
                                   compression_opts=None,
                                   copy_data=True,
                                   print_status=False,
-                                  flush_io=True):
+                                  flush_io=True,
+                                  num_workers=None):
         """
         Helper function to allow one to create optimized copies of the dataset with different internal data
         layouts to speed up selections. The function expects that the original data has already been written
@@ -1203,6 +1389,8 @@ class omsi_file_msidata(omsi_dependencies_manager,
         :param print_status: Should the function print the status of the conversion process to the command line?
         :param flush_io: Call flush on the HDF5 file to ensure all HDF5 bufferes are flushed so that all data has
                        been written to file
+        :param num_workers: Number of threads used to compress/decompress the data during the copy. Default is
+                       None, in which case the number of CPUs is used. See copy_dataset(...).
 
         :returns: h5py dataset with the new copy of the data
         """
@@ -1252,12 +1440,17 @@ class omsi_file_msidata(omsi_dependencies_manager,
         if copy_data:
             self.copy_dataset(source=dset,
                               destination=data_dataset,
-                              print_status=print_status)
+                              print_status=print_status,
+                              num_workers=num_workers)
 
         if flush_io:
             self.managed_group.file.flush()
 
         # Add the dataset to the list of datasets
+        if self._rdcc_max_nbytes is not None:
+            dset_settings = omsi_block_cache.chunk_cache_settings(data_dataset, max_nbytes=self._rdcc_max_nbytes)
+            if dset_settings is not None:
+                data_dataset = omsi_block_cache.open_with_chunk_cache(data_dataset, *dset_settings)
         self.datasets.append(data_dataset)
 
         # Return the dataset. This is needed in case the caller decided to set
@@ -1267,171 +1460,73 @@ class omsi_file_msidata(omsi_dependencies_manager,
     def copy_dataset(self,
                      source,
                      destination,
-                     print_status=False):
+                     print_status=False,
+                     num_workers=None,
+                     max_buffer_bytes=256*1024*1024):
         """
-        Helper function used to copy a source msi dataset one chunk at a time to the destination dataset.
-        The data copy is done one destination chunk at a time to achieve chunk-aligned write.
+        Helper function used to copy a source msi dataset to the destination dataset.
+
+        The copy is performed by omsi.dataformat.omsi_file.copy_engine.omsi_copy_engine using tiles that
+        are aligned with both the source and the destination chunking, so that each source chunk is
+        decompressed once and each destination chunk is compressed and written once. Decompression and
+        compression are performed in a pool of threads while all writes are performed by the calling thread.
 
         :param source: The source h5py dataset
         :param destination: The h5py desitnation h5py dataset.
         :param print_status: Should the function print the status of the conversion process to the command line?
+        :param num_workers: Number of threads used for compression/decompression. Default is
+                           None, in which case the number of CPUs is used.
+        :param max_buffer_bytes: Maximum number of bytes used to buffer a tile of the data during the copy.
 
+        :returns: Dict with statistics about the copy, incl., the throughput in MB/s (see omsi_copy_engine.copy)
         """
-        # Write the data from the donor to the target dataset
+        copy_engine = omsi_copy_engine(source=source,
+                                       destination=destination,
+                                       num_workers=num_workers,
+                                       max_buffer_bytes=max_buffer_bytes)
+        copy_statistics = copy_engine.copy(print_status=print_status)
         if print_status:
-            import sys
-        if self.format_type == omsi_format_msidata.format_types['full_cube']:
-
-            chunks = destination.chunks
-            numchunksx = int(math.ceil(float(source.shape[0]) / float(chunks[0])))
-            numchunksy = int(math.ceil(float(source.shape[1]) / float(chunks[1])))
-            numchunksz = int(math.ceil(float(source.shape[2]) / float(chunks[2])))
-            numchunks = numchunksx * numchunksy * numchunksz
-            itertest = 0
-            for x_chunk_index in xrange(0, numchunksx):
-                xstart = x_chunk_index * chunks[0]
-                xend = min(xstart + chunks[0], source.shape[0])
-                for y_chunk_index in xrange(0, numchunksy):
-                    ystart = y_chunk_index * chunks[1]
-                    yend = min(ystart + chunks[1], source.shape[1])
-                    for z_chunk_index in xrange(0, numchunksz):
-                        zstart = z_chunk_index * chunks[2]
-                        zend = min(zstart + chunks[2], source.shape[2])
-                        destination[xstart:xend, ystart:yend, zstart:zend] = \
-                            source[xstart:xend, ystart:yend, zstart:zend]
-                        itertest += 1
-                        if print_status:
-                            sys.stdout.write("[" +
-                                             str(int(100. * float(itertest) / float(numchunks))) +
-                                             "%]" + "\r")
-                            sys.stdout.flush()
-
-        elif self.format_type == omsi_format_msidata.format_types['partial_cube']:
-
-            chunks = destination.chunks
-            numchunksx = int(math.ceil(float(source.shape[0]) / float(chunks[0])))
-            numchunksy = int(math.ceil(float(source.shape[1]) / float(chunks[1])))
-            numchunks = numchunksx * numchunksy
-            itertest = 0
-            for x_chunk_index in xrange(0, numchunksx):
-                xstart = x_chunk_index * chunks[0]
-                xend = min(xstart + chunks[0], source.shape[0])
-                for y_chunk_index in xrange(0, numchunksy):
-                    ystart = y_chunk_index * chunks[1]
-                    yend = min(ystart + chunks[1], source.shape[1])
-                    destination[xstart:xend, ystart:yend] = source[xstart:xend, ystart:yend]
-                    itertest += 1
-                    if print_status:
-                        sys.stdout.write("[" +
-                                         str(int(100. * float(itertest) / float(numchunks))) +
-                                         "%]" + "\r")
-                        sys.stdout.flush()
-
-        elif self.format_type == omsi_format_msidata.format_types['partial_spectra']:
-
-            chunks = destination.chunks
-            numchunksx = int(
-                math.ceil(float(source.shape[0]) / float(destination.chunks[0])))
-            numchunks = numchunksx
-            itertest = 0
-            for x_chunk_index in xrange(0, numchunksx):
-                xstart = x_chunk_index * chunks[0]
-                xend = min(xstart + chunks[0], source.shape[0])
-                destination[xstart:xend] = source[xstart:xend]
-                itertest += 1
-                if print_status:
-                    sys.stdout.write("[" +
-                                     str(int(100. * float(itertest) / float(numchunks))) +
-                                     "%]" + "\r")
-                    sys.stdout.flush()
+            print "Copied data at " + str(copy_statistics['throughput_mb_s']) + " MB/s"
+        return copy_statistics
 
     def __best_dataset__(self, keys, print_info=False):
         """
         Compute the index of the dataset that is best suited for executing the given selection
 
+        The cost of a selection for a given version of the dataset is computed as the exact number of
+        chunks the selection touches weighted by the average compressed size of the chunks of the
+        dataset (as reported by the HDF5 storage info). The number of touched chunks is computed
+        using NumPy based on the actual selection, i.e., stepped slices and index lists are accounted
+        for correctly. For the partial_cube and partial_spectra case, the spatial selection is mapped via
+        the xy_index (and xy_index_end) to the linearized spectrum index before computing the chunks.
+
+        Decisions are cached per (dataset, selection pattern) in omsi_file_msidata.__best_dataset_cache__
+        so that similar selections (e.g, images at different m/z from the viewer) do not need to recompute
+        the cost. The selection pattern describes only the kind and extent of the selection along each axis
+        (see __selection_pattern__), i.e., the decision is reused for selections at different positions.
+
         :param keys: List of three keys indicting which elements should be selected from the MSI dataset.
+        :param print_info: Print information about the selection and the suggested dataset
 
-        :returns: Integer indicating the index of the dataset to be used for the given selection.
+        :returns: The h5py dataset to be used for the given selection.
         """
         # If there is only one version of the dataset then use that one
         if len(self.datasets) == 1:
             return self.datasets[0]
-        # Get the basic properties of the selection
-        sizex = self.__num_elements__(keys[0])
-        sizey = self.__num_elements__(keys[1])
-        sizez = self.__num_elements__(keys[2])
-        offsetx = self.__offset__(keys[0])
-        offsety = self.__offset__(keys[1])
-        offsetz = self.__offset__(keys[2])
-
-        # Try to determine how many chunks need to be touched in order to fullfill the given selection
-        # Currently this is just an estimate assuming that we have spatially consecutive selections,
-        # i.e., if we have a stepping >1 in a slice or lists of non-neighboring elements, then this
-        # estimate will be wrong. This may result in a suggestion of a sub-optimal dataset with
-        # respect to performance.
-        # For the particle_cube case the estimate is also not accurate for spatial selections since
-        # both x and y are linearized in this case. However, the estimate should still distinguish
-        # properly between selection in space vs. spectra.
-        # For the partial spectra case, currently no chunking optimization is
-        # currently available.
-        suggestion = self.datasets[0]
-        if self.format_type == omsi_format_msidata.format_types['full_cube']:
 
-            currenttouch = -1
-            currentload = -1
-            for dset in self.datasets:
-                chunking = dset.chunks
-                chunkload = chunking[0] * chunking[1] * chunking[2]
-                # Account for the misalignment of the selection with chunk
-                # boundaries
-                adjusted_offset_x = offsetx - (math.floor(float(offsetx) / chunking[0]) * chunking[0])
-                adjusted_offset_y = offsety - (math.floor(float(offsety) / chunking[1]) * chunking[1])
-                adjusted_offset_z = offsetz - (math.floor(float(offsetz) / chunking[2]) * chunking[2])
-                # Determine how many chunks need to be touched, assuming that
-                # we have continues selection.
-                touchx = math.ceil(float(sizex + adjusted_offset_x) / chunking[0])
-                touchy = math.ceil(float(sizey + adjusted_offset_y) / chunking[1])
-                touchz = math.ceil(float(sizez + adjusted_offset_z) / chunking[2])
-                touchtotal = touchx * touchy * touchz
-                # Determine the amount of data that need to be loaded
-                loadtotal = touchtotal * chunkload
-                # If less chunks have to be touched for this dataset then use
-                # that one instead
-                if loadtotal < currentload or currentload < 0:
-                    suggestion = dset
-                    currenttouch = touchtotal
-                    currentload = loadtotal
-
-        elif self.format_type == omsi_format_msidata.format_types['partial_cube']:
-
-            currenttouch = -1
-            currentload = -1
-            for dset in self.datasets:
-                chunking = dset.chunks
-                chunkload = chunking[0] * chunking[1]
-                # Account for the misalignment of the selection with chunk boundaries
-                adjusted_offset_x = offsetx - (math.floor(float(offsetx) / chunking[0]) * chunking[0])
-                adjusted_offset_y = offsety - (math.floor(float(offsety) / chunking[0]) * chunking[0])
-                adjusted_offset_z = offsetz - (math.floor(float(offsetz) / chunking[1]) * chunking[1])
-                # Determine how many chunks need to be touched, assuming that
-                # we have continues selection.
-                touchx = math.ceil(float(sizex + adjusted_offset_x) / chunking[0])
-                touchy = math.ceil(float(sizey + adjusted_offset_y) / chunking[0])
-                touchz = math.ceil(float(sizez + adjusted_offset_z) / chunking[1])
-                touchtotal = touchx * touchy * touchz
-                # Determine the amount of data that need to be loaded
-                loadtotal = touchtotal * chunkload
-                # If less chunks have to be touched for this dataset then use that one instead
-                if loadtotal < currentload or currentload < 0:
-                    suggestion = dset
-                    currenttouch = touchtotal
-                    currentload = loadtotal
-
-        elif self.format_type == omsi_format_msidata.format_types['partial_spectra']:
-
-            # ToDo currently no optimization is implemented for the partial
-            # spectra case
-            pass
+        # Check if we have made a decision for the same selection pattern before
+        cache_key = self.__selection_pattern__(keys)
+        suggestion_index = None
+        if cache_key is not None:
+            suggestion_index = omsi_file_msidata.__best_dataset_cache__.get(cache_key, None)
+        if suggestion_index is None or suggestion_index >= len(self.datasets):
+            costs = self.__selection_cost__(keys)
+            suggestion_index = int(np.argmin(costs))
+            if cache_key is not None:
+                if len(omsi_file_msidata.__best_dataset_cache__) >= omsi_file_msidata.__best_dataset_cache_size__:
+                    omsi_file_msidata.__best_dataset_cache__.clear()
+                omsi_file_msidata.__best_dataset_cache__[cache_key] = suggestion_index
+        suggestion = self.datasets[suggestion_index]
 
         if print_info:
             print "Selection: " + str(keys)
@@ -1440,6 +1535,140 @@ class omsi_file_msidata(omsi_dependencies_manager,
 
         return suggestion
 
+    __best_dataset_cache__ = {}
+    """Class-level cache of the decisions of __best_dataset__ keyed by (file, group, datasets, selection pattern)"""
+    __best_dataset_cache_size__ = 10000
+    """Maximum number of entries in __best_dataset_cache__"""
+    __chunk_storage_size_cache__ = {}
+    """Class-level cache of the average chunk size on disk keyed by (file, modification time, dataset)"""
+
+    def __selection_pattern__(self, keys):
+        """
+        Private helper function used to compute a hashable description of a selection
+        used as key for caching the decisions of __best_dataset__.
+
+        The description records for each axis only the kind of the selection (i.e., index, slice, or list)
+        and its extent (i.e., the number of selected elements and the step or span of the selection) but not
+        the position of the selection, since the position has only little effect on the cost of a selection.
+
+        :param keys: List of three keys indicting which elements should be selected from the MSI dataset.
+
+        :returns: Tuple describing the dataset and selection or None if the selection can not be hashed.
+        """
+        pattern = []
+        for axis, key in enumerate(keys):
+            if isinstance(key, slice):
+                start, stop, step = key.indices(int(self.shape[axis]))
+                pattern.append(('s', len(xrange(start, stop, step)), abs(step)))
+            elif isinstance(key, (list, tuple, np.ndarray)):
+                key_array = np.asarray(key)
+                if key_array.dtype == np.bool_:
+                    key_array = np.nonzero(key_array)[0]
+                span = int(key_array.max() - key_array.min() + 1) if key_array.size > 0 else 0
+                pattern.append(('l', key_array.size, span))
+            else:
+                try:
+                    int(key)
+                except (TypeError, ValueError):
+                    return None
+                pattern.append(('i', ))
+        return (self.file.filename,
+                self.name,
+                tuple([(dset.name, dset.chunks) for dset in self.datasets]),
+                tuple(pattern))
+
+    def __selection_cost__(self, keys):
+        """
+        Private helper function used to compute the cost of a selection for each version of the dataset.
+
+        :param keys: List of three keys indicting which elements should be selected from the MSI dataset.
+
+        :returns: 1D numpy array with the cost for each dataset in self.datasets
+        """
+        # Compute the indices selected along each axis of the stored datasets
+        if self.format_type == omsi_format_msidata.format_types['full_cube']:
+            axis_indices = [omsi_block_cache.selection_to_indices(keys[axis], self.shape[axis])[0]
+                            for axis in range(3)]
+        elif self.format_type == omsi_format_msidata.format_types['partial_cube']:
+            spectrum_indices = np.asarray(self.xy_index[keys[0], keys[1]], dtype='int64')
+            spectrum_indices = spectrum_indices.reshape(spectrum_indices.size)
+            axis_indices = [spectrum_indices[spectrum_indices >= 0],
+                            omsi_block_cache.selection_to_indices(keys[2], int(self.shape[2]))[0]]
+        else:
+            index_start = np.asarray(self.xy_index[keys[0], keys[1]], dtype='int64')
+            index_end = np.asarray(self.xy_index_end[keys[0], keys[1]], dtype='int64')
+            index_start = index_start.reshape(index_start.size)
+            index_end = index_end.reshape(index_end.size)
+            valid = np.logical_and(index_start >= 0, index_end > index_start)
+            axis_indices = [(index_start[valid], index_end[valid])]
+
+        costs = np.zeros(len(self.datasets), dtype='float64')
+        for dset_index, dset in enumerate(self.datasets):
+            chunks = dset.chunks
+            if chunks is None:
+                # Contiguous data is stored in C order so we approximate the chunking by the rows of the data
+                chunks = (1, ) * (len(dset.shape) - 1) + (dset.shape[-1], )
+            if self.format_type == omsi_format_msidata.format_types['partial_spectra']:
+                # Compute the number of chunks touched by the union of all [start, end) ranges
+                range_start, range_end = axis_indices[0]
+                num_touched = 0
+                if range_start.size > 0:
+                    chunk_start = range_start // chunks[0]
+                    chunk_end = (range_end - 1) // chunks[0] + 1
+                    order = np.argsort(chunk_start, kind='mergesort')
+                    chunk_start = chunk_start[order]
+                    chunk_end = np.maximum.accumulate(chunk_end[order])
+                    # Remove the overlap with the previous range(s)
+                    overlap_start = np.maximum(chunk_start[1:], chunk_end[0:-1])
+                    num_touched = (chunk_end[0] - chunk_start[0]) + \
+                        np.maximum(chunk_end[1:] - overlap_start, 0).sum()
+            else:
+                num_touched = 1
+                for axis, indices in enumerate(axis_indices):
+                    num_touched *= np.unique(indices // chunks[axis]).size
+            costs[dset_index] = float(num_touched) * self.__chunk_storage_size__(dset, chunks)
+        return costs
+
+    def __chunk_storage_size__(self, dset, chunks):
+        """
+        Private helper function used to determine the average size of a chunk of a dataset on disk.
+        For compressed datasets this is the average compressed size of the allocated chunks as
+        reported by the HDF5 storage info. For uncompressed datasets or datasets without allocated
+        storage this is the uncompressed size of a chunk.
+
+        :param dset: The h5py dataset
+        :param chunks: The chunking of the dataset
+
+        :returns: Float with the average number of bytes of a chunk
+        """
+        chunk_nbytes = float(np.prod(chunks) * dset.dtype.itemsize)
+        if dset.chunks is None or dset.compression is None:
+            return chunk_nbytes
+        # Querying the number of chunks requires a traversal of the chunk index, so we cache the result
+        # until the file is modified
+        try:
+            modification_time = os.path.getmtime(dset.file.filename)
+        except OSError:
+            modification_time = None
+        cache_key = (dset.file.filename, modification_time, dset.name)
+        average_size = omsi_file_msidata.__chunk_storage_size_cache__.get(cache_key, None)
+        if average_size is None:
+            average_size = 0
+            storage_size = dset.id.get_storage_size()
+            if storage_size > 0:
+                try:
+                    num_chunks = dset.id.get_num_chunks()
+                except (AttributeError, RuntimeError, TypeError):
+                    # Older versions of h5py/HDF5 do not support the chunk query so we assume all chunks are allocated
+                    num_chunks = np.prod([math.ceil(float(dset.shape[i]) / float(chunks[i]))
+                                          for i in range(len(chunks))])
+                if num_chunks > 0:
+                    average_size = float(storage_size) / float(num_chunks)
+            if len(omsi_file_msidata.__chunk_storage_size_cache__) >= omsi_file_msidata.__best_dataset_cache_size__:
+                omsi_file_msidata.__chunk_storage_size_cache__.clear()
+            omsi_file_msidata.__chunk_storage_size_cache__[cache_key] = average_size
+        return average_size if average_size > 0 else chunk_nbytes
+
     @staticmethod
     def __offset__(key):
         """
@@ -1483,7 +1712,7 @@ class omsi_file_msidata(omsi_dependencies_manager,
             step = key.step
             if key.step is None:
                 step = 1
-            return math.ceil(float(end - start) / float(step))
+            return int(math.ceil(float(end - start) / float(step)))
         else:
             raise ValueError("Unexpected key value " + str(key) + " " + str(type(key)))
 
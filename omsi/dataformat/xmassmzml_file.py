@@ -15,6 +15,7 @@ from omsi.datastructures.dependency_data import dependency_dict
 from omsi.datastructures.metadata.metadata_data import metadata_dict, metadata_value
 from omsi.datastructures.metadata.metadata_ontologies import METADATA_ONTOLOGIES
 from omsi.shared.log import log_helper
+from omsi.shared.spectrum_reprofile import spectrum_reprofiler
 
 
 class xmassmzml_file(file_reader_base_multidata):
@@ -66,6 +67,8 @@ class xmassmzml_file(file_reader_base_multidata):
         # Compute the mz axis
         log_helper.debug(__name__, 'Compute mz axes')
         self.mz = self.__compute_mz_axis(filename=self.basename)
+        # Interpolate the data onto the new axes in profiles mode
+        self.reprofiler = spectrum_reprofiler(mz_axis=self.mz, mode='profile')
         log_helper.debug(__name__, 'mz axes computed')
 
         # Determine the shape of the dataset, result is a list of shapes for each datacube
@@ -89,38 +92,10 @@ class xmassmzml_file(file_reader_base_multidata):
         Internal helper function used to read all data. The
         function directly modifies the self.data entry.  Data is now a list of datacubes
         """
-
-        # self.data = np.zeros(shape=self.shape_all_data[scan_idx], dtype=self.data_type) for scan_idx, scantype in enumerate(self.scan_types)
         data = np.zeros(self.shape)
-        reader = mzml.read(self.basename)
-        spectrumid = 0
-        # if not self.scan_profiled[scan_idx]:
-        #     shift = np.diff(self.mz_all[scan_idx]).mean()
-        #     bin_edges = np.append(self.mz_all[scan_idx], self.mz_all[scan_idx][-1]+ shift)
-        # else:
-        #     bin_edges = None
-
-        for spectrum in reader:
-            # if spectrum['scanList']['scan'][0]['filter string'] == scantype:
-            x = spectrum['m/z array']
-                # try:
-            y = spectrum['intensity array']
-                # except KeyError:
-                    # raise KeyError
-                # if bin_edges is None:
-            yi = np.interp(self.mz_all[scan_idx], x, y, 0, 0)  # Re-interpolate the data in profiled mode
-                # else:
-                     # yi, _ = np.histogram(x, bins=bin_edges, weights=y)   # Re-histogram the data in centroided mode
-                # xidx = np.nonzero(self.x_pos == self.coordinates[spectrumid, 0])[0]
-                # yidx = np.nonzero(self.y_pos == self.coordinates[spectrumid, 1])[0]
-                # try:
-            data[self.coordinates[spectrumid, 0], self.coordinates[spectrumid, 1], :] = yi
-                # except:
-                    # log_helper.debug(__name__, spectrumid, scan_idx, scantype, self.mz_all[scan_idx].shape)
+        for spectrum_indices, spectra in self.__iter_spectrum_blocks():
+            data[self.coordinates[spectrum_indices, 0], self.coordinates[spectrum_indices, 1], :] = spectra
         # TODO Note if the data is expected to be of float precision then self.data_type needs to be set accordingly
-            # if spectrumid%1000 == 0:
-                # log_helper.info(__name__, 'Processed data for %s spectra to datacube for scan type %s' % (spectrumid, scantype))
-            spectrumid += 1
         return data
 
     def spectrum_iter(self):
@@ -132,27 +107,41 @@ class xmassmzml_file(file_reader_base_multidata):
                              and for the selected datacube type
 
         """
-        reader = mzml.read(self.basename)
         if self.select_dataset is None:
            raise ValueError('Select a dataset to continue!')
-        dataset_index = self.select_dataset
+        for spectrum_indices, spectra in self.__iter_spectrum_blocks():
+            xindices = np.searchsorted(self.x_pos, self.coordinates[spectrum_indices, 0])
+            yindices = np.searchsorted(self.y_pos, self.coordinates[spectrum_indices, 1])
+            for block_index in range(len(spectrum_indices)):
+                yield (xindices[block_index], yindices[block_index]), spectra[block_index, :]
+
+    def __iter_spectrum_blocks(self):
+        """
+        Internal generator function used to read all spectra and interpolate them onto the m/z axis
+        in blocks using the shared spectrum_reprofiler.
+
+        :yield: Tuple of (spectrum_indices, spectra) with the 1D array of the indices of the spectra
+            in the block and the 2D float64 array with the reprofiled spectra of the block.
+        """
+        reader = mzml.read(self.basename)
+        block_size = self.reprofiler.get_block_size()
+        spectrum_indices = []
+        mzs = []
+        intensities = []
         for idx, spectrum in enumerate(reader):
-            mz = self.mz_all[0]
-            x = spectrum['m/z array']
+            mzs.append(spectrum['m/z array'])
             try:
-                y = spectrum['intensity array']
+                intensities.append(spectrum['intensity array'])
             except KeyError:
                 raise KeyError('Key "intensity array" not found in this mzml file')
-
-            yi = np.interp(mz, x, y, 0, 0)      # Interpolate the data onto the new axes in profiles mode
-            # else:
-            #     shift = np.diff(mz).mean()
-            #     bin_edges = np.append(mz, mz[-1]+ shift)
-            #     yi, _ = np.histogram(x, bins=bin_edges, weights=y)   # Re-histogram the data in centroided mode
-            xidx = np.nonzero(self.x_pos == self.coordinates[idx, 0])[0][0]
-            yidx = np.nonzero(self.y_pos == self.coordinates[idx, 1])[0][0]
-
-            yield (xidx, yidx), yi
+            spectrum_indices.append(idx)
+            if len(spectrum_indices) == block_size:
+                yield np.asarray(spectrum_indices), self.reprofiler.reprofile(mzs=mzs, intensities=intensities)
+                spectrum_indices = []
+                mzs = []
+                intensities = []
+        if len(spectrum_indices) > 0:
+            yield np.asarray(spectrum_indices), self.reprofiler.reprofile(mzs=mzs, intensities=intensities)
 
 
     @classmethod
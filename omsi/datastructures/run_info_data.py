@@ -7,6 +7,7 @@ import platform
 import datetime
 import sys
 import time
+import threading
 import omsi.shared.mpi_helper as mpi_helper
 from omsi.shared.log import log_helper
 
@@ -40,6 +41,12 @@ except ImportError:
 # TODO Expand the data that is being recorded, e.g. psutil data etc.
 # TODO Add options to record inputs and outputs of functions and the function itself
 
+# Stack of the run_info_dict recordings that are currently active in the process. The peak memory usage
+# is a property of the process that is reset by every recording. The enclosing recordings, therefore, keep
+# track of the peak of their nested recordings (see record_preexecute and record_postexecute).
+_ACTIVE_RECORDINGS = []
+_ACTIVE_RECORDINGS_LOCK = threading.Lock()
+
 
 class run_info_dict(dict):
     """
@@ -69,6 +76,8 @@ class run_info_dict(dict):
         self.__profile_memory = False
         self.__time_and_use_profiler = None
         self.__memory_profiler = None
+        self.__recording = False
+        self.__nested_peak_memory = None
         self.mpi_comm = mpi_helper.get_comm_world()
         self.mpi_root = 0
         self.gather_data = True
@@ -88,14 +97,17 @@ class run_info_dict(dict):
             self.record_preexecute()    # Record system provenance and pre-execution data
             start_time = time.time()    # Start the execution timer
             # Execute the function
-            if not self.get_profile_memory():
-                result = func(*args, **kwargs)  # Execute the function without memory profiling
-            else:
-                self.__memory_profiler = memory_profiler.LineProfiler()
-                result = self.__memory_profiler(func)(*args, **kwargs)  # Execute the function with memory profiling
-            # Post-execute recording
-            execution_time = time.time() - start_time                   # Compute the execution time
-            self.record_postexecute(execution_time=execution_time)      # Record post-execution data
+            try:
+                if not self.get_profile_memory():
+                    result = func(*args, **kwargs)  # Execute the function without memory profiling
+                else:
+                    self.__memory_profiler = memory_profiler.LineProfiler()
+                    result = self.__memory_profiler(func)(*args, **kwargs)  # Execute with memory profiling
+                # Post-execute recording
+                execution_time = time.time() - start_time                   # Compute the execution time
+                self.record_postexecute(execution_time=execution_time)      # Record post-execution data
+            finally:
+                self.__end_recording()                                      # Release the recording on error
             self.clean_up()                                             # Clean up empty data
             if self.gather_data:
                 self.gather()                                           # Gather the data from all MPI ranks
@@ -265,6 +277,19 @@ class run_info_dict(dict):
         except:
             warnings.warn("Recording of psutil-based runtime information failed: "+str(sys.exc_info()))
 
+        # Record the memory usage and reset the peak memory usage of the process so that each recording
+        # measures its own peak. Before the reset, the peak so far is saved by the enclosing recording
+        # (e.g., the run_info of a workflow executor that executes the analysis) so that its peak is not truncated.
+        self['start_memory'] = self.get_memory_usage()
+        with _ACTIVE_RECORDINGS_LOCK:
+            if len(_ACTIVE_RECORDINGS) > 0 and _ACTIVE_RECORDINGS[-1] is not self:
+                _ACTIVE_RECORDINGS[-1].__add_nested_peak_memory(self.get_peak_memory_usage())
+            self.reset_peak_memory_usage()
+            self.__nested_peak_memory = None
+            if not self.__recording:
+                _ACTIVE_RECORDINGS.append(self)
+                self.__recording = True
+
         # Record the start time for the analysis
         self['start_time'] = unicode(datetime.datetime.now())
 
@@ -304,6 +329,10 @@ class run_info_dict(dict):
             self['execution_time'] = unicode(stop_time - start_time)    # TODO: This only gives execution time in full seconds right now
         else:
             self['execution_time'] = None
+        # Record the peak memory usage of the process during the execution, including nested recordings
+        self['max_memory'] = self.__get_recorded_peak_memory()
+        self.__end_recording()
+
         # Attempt to record psutil data
         try:
             import psutil
@@ -334,6 +363,54 @@ class run_info_dict(dict):
             self['profile_mem'] = unicode(self.__memory_profiler.code_map)
             self['profile_mem_stats'] = mem_stats_io.getvalue()
 
+    def __add_nested_peak_memory(self, peak_memory):
+        """
+        Internal helper function used to record the peak memory usage observed by a nested recording
+        (or before the peak memory usage was reset by a nested recording).
+
+        :param peak_memory: Integer with the number of bytes or None if unknown
+        """
+        if peak_memory is not None:
+            self.__nested_peak_memory = max(peak_memory, self.__nested_peak_memory) \
+                if self.__nested_peak_memory is not None else peak_memory
+
+    def __get_recorded_peak_memory(self):
+        """
+        Internal helper function used to get the peak memory usage since record_preexecute, i.e, the
+        maximum of the current peak memory usage of the process and the peak of all nested recordings.
+
+        :return: Integer with the number of bytes or None if the peak memory usage cannot be determined
+        """
+        peak_memory = self.get_peak_memory_usage()
+        if self.__nested_peak_memory is None:
+            return peak_memory
+        return max(peak_memory, self.__nested_peak_memory) if peak_memory is not None else self.__nested_peak_memory
+
+    def __end_recording(self):
+        """
+        Internal helper function used to mark the recording started by record_preexecute as completed.
+        The peak memory usage of the recording is passed on to the enclosing recording.
+        """
+        with _ACTIVE_RECORDINGS_LOCK:
+            if self.__recording:
+                # Compare by identity since run_info_dict objects with the same data compare equal
+                recording_index = [id(recording) for recording in _ACTIVE_RECORDINGS].index(id(self))
+                if recording_index > 0:
+                    _ACTIVE_RECORDINGS[recording_index - 1].__add_nested_peak_memory(
+                        self.__get_recorded_peak_memory())
+                _ACTIVE_RECORDINGS.pop(recording_index)
+                self.__recording = False
+
+    @staticmethod
+    def get_num_active_recordings():
+        """
+        Get the number of recordings that are currently active in the process, i.e., for which
+        record_preexecute has been called but record_postexecute has not.
+
+        :return: Integer
+        """
+        return len(_ACTIVE_RECORDINGS)
+
     def clean_up(self):
         """
         Clean up the runinfo object. In particular remove empty keys that
@@ -465,3 +542,60 @@ class run_info_dict(dict):
         return time.mktime(time.strptime(time_string,
                                          time_format if time_format is not None else run_info_dict.DEFAULT_TIME_FORMAT))
 
+    @staticmethod
+    def get_memory_usage():
+        """
+        Get the current memory usage (resident set size) of the process.
+
+        :return: Integer with the number of bytes or None if the memory usage cannot be determined
+        """
+        try:
+            with open('/proc/self/status', 'r') as status_file:
+                for line in status_file:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, ValueError):
+            pass
+        try:
+            import psutil
+            return int(psutil.Process().memory_info()[0])
+        except ImportError:
+            return None
+
+    @staticmethod
+    def reset_peak_memory_usage():
+        """
+        Reset the peak memory usage of the process to the current memory usage. This is only supported
+        on Linux (>=4.0).
+
+        :return: Boolean indicating whether the peak memory usage has been reset. If False, then
+            get_peak_memory_usage returns the peak memory usage since the start of the process.
+        """
+        try:
+            with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+                clear_refs_file.write('5')
+            return True
+        except IOError:
+            return False
+
+    @staticmethod
+    def get_peak_memory_usage():
+        """
+        Get the peak memory usage (resident set size) of the process.
+
+        :return: Integer with the number of bytes or None if the peak memory usage cannot be determined
+        """
+        try:
+            with open('/proc/self/status', 'r') as status_file:
+                for line in status_file:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, ValueError):
+            pass
+        try:
+            import resource
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # ru_maxrss is given in bytes on OSX and in kilobytes on Linux
+            return int(max_rss) if sys.platform == 'darwin' else int(max_rss) * 1024
+        except ImportError:
+            return None
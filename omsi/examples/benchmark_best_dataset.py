@@ -0,0 +1,130 @@
+"""
+Simple micro-benchmark script used to show which copy of an MSI dataset is selected by
+omsi_file_msidata.__best_dataset__ for slice, spectrum, and region-of-interest (ROI) workloads,
+how long the decision takes (with and without the decision cache), and how long the
+read takes for each available copy of the data.
+
+Usage: python benchmark_best_dataset.py [xdim ydim mzdim repeats]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from omsi.dataformat.omsi_file.main_file import omsi_file
+from omsi.dataformat.omsi_file.msidata import omsi_file_msidata
+
+
+def generate_test_file(filename, xdim, ydim, mzdim, partial_cube=False):
+    """
+    Generate a test file with a spectrum-chunked and an image-chunked copy of a random dataset.
+
+    :param filename: Name of the output file
+    :param xdim: Number of pixels in x
+    :param ydim: Number of pixels in y
+    :param mzdim: Number of m/z values
+    :param partial_cube: Store the data as partial_cube (with a circular mask) rather than full_cube
+    """
+    omsi_out_file = omsi_file(filename)
+    exp = omsi_out_file.create_experiment()
+    random_state = np.random.RandomState(0)
+    if partial_cube:
+        x_coords, y_coords = np.mgrid[0:xdim, 0:ydim]
+        mask = ((x_coords - xdim / 2.) ** 2 + (y_coords - ydim / 2.) ** 2) < (min(xdim, ydim) / 2.) ** 2
+        _, mz_dataset, _, _, data_group = exp.create_msidata_partial_cube(data_shape=(xdim, ydim, mzdim),
+                                                                          mask=mask,
+                                                                          data_type='float32',
+                                                                          chunks=(4, 4, 2048),
+                                                                          compression='gzip',
+                                                                          compression_opts=4)
+        msidata = omsi_file_msidata(data_group)
+        for x_index in xrange(0, xdim):
+            y_indices = np.flatnonzero(mask[x_index, :])
+            if y_indices.size > 0:
+                msidata.datasets[0][msidata.xy_index[x_index, y_indices[0]]:
+                                    msidata.xy_index[x_index, y_indices[-1]] + 1, :] = \
+                    random_state.rand(y_indices.size, mzdim).astype('float32')
+    else:
+        data_dataset, mz_dataset, data_group = exp.create_msidata_full_cube(data_shape=(xdim, ydim, mzdim),
+                                                                            data_type='float32',
+                                                                            chunks=(4, 4, 2048),
+                                                                            compression='gzip',
+                                                                            compression_opts=4)
+        for x_index in xrange(0, xdim):
+            data_dataset[x_index, :, :] = random_state.rand(ydim, mzdim).astype('float32')
+        msidata = omsi_file_msidata(data_group)
+    mz_dataset[:] = np.arange(mzdim)
+    msidata.create_optimized_chunking(chunks=(20, 20, 100),
+                                      compression='gzip',
+                                      compression_opts=4)
+    omsi_out_file.close_file()
+
+
+def run_workloads(filename, workloads):
+    """
+    Run the given workloads against the first msidata object of the given file and print the results.
+
+    :param filename: Name of the file
+    :param workloads: Dict of workload name to list of selections
+    """
+    omsi_input_file = omsi_file(filename, 'r')
+    msidata = omsi_input_file.get_experiment(0).get_msidata(0, preload_xy_index=True)
+    print "Format: " + str(msidata.format_type) + \
+        "   Available chunkings: " + str([dset.chunks for dset in msidata.datasets])
+    for workload_name in ['slice', 'spectrum', 'roi']:
+        selections = workloads[workload_name]
+        # Time the decisions without and with the decision cache
+        omsi_file_msidata.__best_dataset_cache__.clear()
+        start_time = time.time()
+        choices = [msidata.__best_dataset__(selection) for selection in selections]
+        uncached_time = (time.time() - start_time) / len(selections)
+        start_time = time.time()
+        _ = [msidata.__best_dataset__(selection) for selection in selections]
+        cached_time = (time.time() - start_time) / len(selections)
+        print "  " + workload_name + ": chosen chunking=" + str(sorted(set([c.chunks for c in choices]))) + \
+            "  decision [ms]: uncached=" + str(uncached_time * 1000.) + " cached=" + str(cached_time * 1000.)
+        # Time the reads for each available copy of the data
+        for dset in msidata.datasets:
+            msidata_copy = omsi_file_msidata(msidata.managed_group, preload_xy_index=True)
+            msidata_copy.datasets = [dset]
+            start_time = time.time()
+            for selection in selections:
+                _ = msidata_copy[selection]
+            print "      read [ms] using chunking " + str(dset.chunks) + ": " + \
+                str((time.time() - start_time) / len(selections) * 1000.)
+    omsi_input_file.close_file()
+
+
+def main(argv=None):
+    """Then main function"""
+    if argv is None:
+        argv = sys.argv
+    xdim = int(argv[1]) if len(argv) > 1 else 60
+    ydim = int(argv[2]) if len(argv) > 2 else 60
+    mzdim = int(argv[3]) if len(argv) > 3 else 5000
+    repeats = int(argv[4]) if len(argv) > 4 else 10
+
+    random_state = np.random.RandomState(1)
+    workloads = {'slice': [(slice(None), slice(None), int(random_state.randint(0, mzdim)))
+                           for _ in xrange(repeats)],
+                 'spectrum': [(int(random_state.randint(0, xdim)), int(random_state.randint(0, ydim)), slice(None))
+                              for _ in xrange(repeats)],
+                 'roi': []}
+    for _ in xrange(repeats):
+        x_start = int(random_state.randint(0, xdim - 5))
+        y_start = int(random_state.randint(0, ydim - 5))
+        mz_start = int(random_state.randint(0, mzdim - 500))
+        workloads['roi'].append((slice(x_start, x_start + 5), slice(y_start, y_start + 5),
+                                 slice(mz_start, mz_start + 500)))
+
+    temp_dir = tempfile.mkdtemp()
+    for partial_cube in [False, True]:
+        filename = os.path.join(temp_dir, 'best_dataset.h5')
+        generate_test_file(filename, xdim, ydim, mzdim, partial_cube=partial_cube)
+        run_workloads(filename, workloads)
+        os.remove(filename)
+    os.rmdir(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
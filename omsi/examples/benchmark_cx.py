@@ -0,0 +1,74 @@
+"""
+Simple benchmark script used to compare the accuracy and speed of the exact leverage scores
+(computed by omsi_cx.comp_lev_exact from the full SVD of the in-memory data) vs. the approximate
+leverage scores of omsi.analysis.multivariate_stats.cx_randomized (computed in streaming passes
+over an HDF5 dataset) for different sketch sizes and numbers of power iterations.
+
+Usage: python benchmark_cx.py [num_pixels num_bins rank]
+"""
+import sys
+import time
+import tempfile
+import numpy as np
+import h5py
+from omsi.analysis.multivariate_stats.omsi_cx import omsi_cx
+from omsi.analysis.multivariate_stats import cx_randomized
+
+
+def generate_data(num_pixels, num_bins, seed=0):
+    """
+    Generate nonnegative data with polynomially decaying singular values plus noise.
+
+    :returns: 2D float32 numpy array with one spectrum per row
+    """
+    random_state = np.random.RandomState(seed)
+    num_factors = min(num_pixels, num_bins, 100)
+    weights = 1.0 / np.arange(1, num_factors + 1) ** 1.5
+    data = np.dot(random_state.rand(num_pixels, num_factors) * weights, random_state.rand(num_factors, num_bins))
+    data += random_state.rand(num_pixels, num_bins) * 0.01
+    return data.astype('float32')
+
+
+def main(argv=None):
+    """Then main function"""
+    if argv is None:
+        argv = sys.argv
+    num_pixels = int(argv[1]) if len(argv) > 1 else 4000
+    num_bins = int(argv[2]) if len(argv) > 2 else 2000
+    rank = int(argv[3]) if len(argv) > 3 else 10
+
+    data = generate_data(num_pixels, num_bins)
+    named_temporary_file = tempfile.NamedTemporaryFile()
+    h5py_file = h5py.File(named_temporary_file.name, 'w')
+    dataset = h5py_file.create_dataset('data', data=data[:, np.newaxis, :], chunks=(64, 1, num_bins))
+
+    start_time = time.time()
+    matrix = dataset[:].reshape((num_pixels, num_bins)).transpose()
+    exact_rows = omsi_cx.comp_lev_exact(matrix, rank, 0)
+    exact_columns = omsi_cx.comp_lev_exact(matrix, rank, 1)
+    exact_time = time.time() - start_time
+    del matrix
+    exact_top = set(exact_rows.argsort()[::-1][0:rank])
+
+    print "Pixels: " + str(num_pixels) + "  bins: " + str(num_bins) + "  rank: " + str(rank)
+    print "exact (two full SVDs) [s]: " + str(exact_time)
+    print "sketch  power  time [s]  row rel. error  column rel. error  top-" + str(rank) + " image overlap"
+    for sketch_size in [rank + 5, rank + 10, 2 * rank + 10]:
+        for num_power_iterations in [0, 1, 2]:
+            start_time = time.time()
+            rows, columns, _ = cx_randomized.randomized_leverage_scores(data=dataset,
+                                                                        rank=rank,
+                                                                        sketch_size=sketch_size,
+                                                                        num_power_iterations=num_power_iterations,
+                                                                        random_state=np.random.RandomState(0))
+            randomized_time = time.time() - start_time
+            row_error = np.linalg.norm(rows - exact_rows) / np.linalg.norm(exact_rows)
+            column_error = np.linalg.norm(columns.reshape(-1) - exact_columns) / np.linalg.norm(exact_columns)
+            overlap = len(exact_top & set(rows.argsort()[::-1][0:rank])) / float(rank)
+            print "%6i  %5i  %8.3f  %14.4f  %17.4f  %.2f" % (sketch_size, num_power_iterations, randomized_time,
+                                                            row_error, column_error, overlap)
+    h5py_file.close()
+
+
+if __name__ == "__main__":
+    main()
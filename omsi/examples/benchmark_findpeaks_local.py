@@ -0,0 +1,78 @@
+"""
+Simple benchmark script used to compare the throughput (spectra/second) of the local peak finding
+one spectrum at a time using the third-party findpeaks module (as previously done by
+omsi_findpeaks_local) vs. the batched engine in omsi.analysis.findpeaks.findpeaks_batch.
+
+Usage: python benchmark_findpeaks_local.py [num_spectra mz_axis_length peaks_per_spectrum block_size]
+"""
+import sys
+import time
+import numpy as np
+from omsi.analysis.findpeaks.third_party.findpeaks import findpeaks
+from omsi.analysis.findpeaks import findpeaks_batch
+
+
+def generate_spectra(num_spectra, mz_axis_length, peaks_per_spectrum, seed=0):
+    """
+    Generate a 2D array of random spectra with noise and a number of Gaussian-like peaks.
+
+    :returns: 2D float32 numpy array with one spectrum per row
+    """
+    random_state = np.random.RandomState(seed)
+    spectra = (random_state.rand(num_spectra, mz_axis_length) * 5).astype('float32')
+    peak_shape = np.exp(-np.arange(-10, 11) ** 2 / 20.)
+    for index in xrange(num_spectra):
+        for center in random_state.randint(10, mz_axis_length - 11, peaks_per_spectrum):
+            spectra[index, center - 10:center + 11] += peak_shape * random_state.rand() * 100
+    return spectra
+
+
+def time_function(function, num_spectra):
+    """
+    Time the given function and return the throughput in spectra per second.
+    """
+    start_time = time.time()
+    function()
+    return num_spectra / (time.time() - start_time)
+
+
+def main(argv=None):
+    """Then main function"""
+    if argv is None:
+        argv = sys.argv
+    num_spectra = int(argv[1]) if len(argv) > 1 else 500
+    mz_axis_length = int(argv[2]) if len(argv) > 2 else 20000
+    peaks_per_spectrum = int(argv[3]) if len(argv) > 3 else 100
+    block_size = int(argv[4]) if len(argv) > 4 else 256
+    smoothwidth = 3
+    slwindow = 100
+    peakheight = 10
+
+    spectra = generate_spectra(num_spectra, mz_axis_length, peaks_per_spectrum)
+    mz_axis = np.linspace(100., 1000., mz_axis_length)
+    num_peaks = {}
+
+    def per_spectrum():
+        num_peaks['per_spectrum'] = 0
+        for index in xrange(num_spectra):
+            y = findpeaks(mz_axis, spectra[index, :], smoothwidth, slwindow, peakheight).smoothListGaussian()
+            y = y - [x for x in findpeaks(mz_axis, y, smoothwidth, slwindow, peakheight).sliding_window_minimum()]
+            num_peaks['per_spectrum'] += len(findpeaks(mz_axis, y, smoothwidth, slwindow, peakheight).peakdet()[0])
+
+    def batched():
+        num_peaks['batched'] = 0
+        for start in xrange(0, num_spectra, block_size):
+            stop = min(start + block_size, num_spectra)
+            num_peaks['batched'] += findpeaks_batch.find_peaks(spectra[start:stop], smoothwidth,
+                                                               slwindow, peakheight)[0].size
+
+    print "Spectra: " + str(num_spectra) + "  m/z axis length: " + str(mz_axis_length) + \
+        "  peaks per spectrum: " + str(peaks_per_spectrum) + "  block size: " + str(block_size)
+    print "per-spectrum findpeaks  [spectra/s]: " + str(time_function(per_spectrum, num_spectra))
+    print "batched findpeaks_batch [spectra/s]: " + str(time_function(batched, num_spectra))
+    print "Number of peaks: " + str(num_peaks['per_spectrum']) + " (per-spectrum)  " + \
+        str(num_peaks['batched']) + " (batched)"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Simple benchmark script used to compare the performance of slice and spectrum selections
+for centroided MSI data stored as a partial_spectra dataset vs. the same data stored
+as a padded full_cube.
+
+Usage: python benchmark_partial_spectra.py [xdim ydim mzdim peaks_per_spectrum repeats]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from omsi.dataformat.omsi_file.main_file import omsi_file
+
+
+def generate_centroided_data(xdim, ydim, mzdim, peaks_per_spectrum, seed=0):
+    """
+    Generate a random centroided dataset.
+
+    :param xdim: Number of pixels in x
+    :param ydim: Number of pixels in y
+    :param mzdim: Length of the global m/z axis
+    :param peaks_per_spectrum: Average number of peaks per spectrum
+    :param seed: Seed for the random number generator
+
+    :returns: Tuple of (spectra_length, mz_index, values) where spectra_length is a 2D array with
+        the number of peaks per pixel and mz_index and values are the 1D arrays with the
+        concatenated m/z indices and intensities of all spectra.
+    """
+    random_state = np.random.RandomState(seed)
+    spectra_length = random_state.poisson(peaks_per_spectrum, size=(xdim, ydim))
+    spectra_length = np.minimum(spectra_length, mzdim)
+    mz_index = np.concatenate([np.sort(random_state.choice(mzdim, length, replace=False))
+                               for length in spectra_length.reshape(spectra_length.size) if length > 0])
+    values = (random_state.rand(mz_index.size) * 1000).astype('float32')
+    return spectra_length, mz_index, values
+
+
+def write_test_files(full_cube_filename,
+                     partial_spectra_filename,
+                     spectra_length,
+                     mz_index,
+                     values,
+                     mzdim):
+    """
+    Write the same data as full_cube and partial_spectra to two separate OMSI files.
+    """
+    xdim, ydim = spectra_length.shape
+    # Write the full cube
+    omsi_out_file = omsi_file(full_cube_filename)
+    exp = omsi_out_file.create_experiment()
+    data_dataset, mz_dataset, _ = exp.create_msidata_full_cube(data_shape=(xdim, ydim, mzdim),
+                                                               data_type='float32',
+                                                               chunks=(4, 4, 2048),
+                                                               compression='gzip',
+                                                               compression_opts=4)
+    mz_dataset[:] = np.arange(mzdim)
+    spectrum_end = np.cumsum(spectra_length.reshape(spectra_length.size))
+    spectrum_start = spectrum_end - spectra_length.reshape(spectra_length.size)
+    for x_index in xrange(0, xdim):
+        row = np.zeros((ydim, mzdim), dtype='float32')
+        for y_index in xrange(0, ydim):
+            linear_index = x_index * ydim + y_index
+            select = slice(spectrum_start[linear_index], spectrum_end[linear_index])
+            row[y_index, mz_index[select]] = values[select]
+        data_dataset[x_index, :, :] = row
+    omsi_out_file.close_file()
+
+    # Write the partial spectra
+    omsi_out_file = omsi_file(partial_spectra_filename)
+    exp = omsi_out_file.create_experiment()
+    data_dataset, mz_index_dataset, mz_dataset, _, _, _ = \
+        exp.create_msidata_partial_spectra(spectra_length=spectra_length,
+                                           len_global_mz=mzdim,
+                                           data_type='float32',
+                                           chunks=(4, 4, 2048),
+                                           compression='gzip',
+                                           compression_opts=4)
+    mz_dataset[:] = np.arange(mzdim)
+    data_dataset[:] = values
+    mz_index_dataset[:] = mz_index
+    omsi_out_file.close_file()
+
+
+def time_selections(filename, selections):
+    """
+    Time the given list of selections against the first msidata object in the given file.
+
+    :returns: 1D numpy array with the time in seconds for each selection
+    """
+    omsi_input_file = omsi_file(filename, 'r')
+    msidata = omsi_input_file.get_experiment(0).get_msidata(0)
+    timings = np.zeros(len(selections), dtype='float64')
+    for index, selection in enumerate(selections):
+        start_time = time.time()
+        _ = msidata[selection]
+        timings[index] = time.time() - start_time
+    omsi_input_file.close_file()
+    return timings
+
+
+def main(argv=None):
+    """Then main function"""
+    if argv is None:
+        argv = sys.argv
+    xdim = int(argv[1]) if len(argv) > 1 else 100
+    ydim = int(argv[2]) if len(argv) > 2 else 100
+    mzdim = int(argv[3]) if len(argv) > 3 else 20000
+    peaks_per_spectrum = int(argv[4]) if len(argv) > 4 else 200
+    repeats = int(argv[5]) if len(argv) > 5 else 20
+
+    temp_dir = tempfile.mkdtemp()
+    full_cube_filename = os.path.join(temp_dir, 'full_cube.h5')
+    partial_spectra_filename = os.path.join(temp_dir, 'partial_spectra.h5')
+    spectra_length, mz_index, values = generate_centroided_data(xdim, ydim, mzdim, peaks_per_spectrum)
+    write_test_files(full_cube_filename=full_cube_filename,
+                     partial_spectra_filename=partial_spectra_filename,
+                     spectra_length=spectra_length,
+                     mz_index=mz_index,
+                     values=values,
+                     mzdim=mzdim)
+
+    random_state = np.random.RandomState(1)
+    workloads = {'slice': [(slice(None), slice(None), int(random_state.randint(0, mzdim)))
+                           for _ in xrange(repeats)],
+                 'spectrum': [(int(random_state.randint(0, xdim)), int(random_state.randint(0, ydim)), slice(None))
+                              for _ in xrange(repeats)]}
+
+    print "Data shape: " + str((xdim, ydim, mzdim)) + "  peaks: " + str(mz_index.size)
+    print "File size full_cube [MB]:       " + str(os.stat(full_cube_filename).st_size / (1024. * 1024.))
+    print "File size partial_spectra [MB]: " + str(os.stat(partial_spectra_filename).st_size / (1024. * 1024.))
+    for workload_name in ['slice', 'spectrum']:
+        for format_name, filename in [('full_cube', full_cube_filename),
+                                      ('partial_spectra', partial_spectra_filename)]:
+            timings = time_selections(filename, workloads[workload_name])
+            print workload_name + " " + format_name + \
+                " [ms]: mean=" + str(timings.mean() * 1000.) + \
+                " median=" + str(np.median(timings) * 1000.) + \
+                " max=" + str(timings.max() * 1000.)
+
+    os.remove(full_cube_filename)
+    os.remove(partial_spectra_filename)
+    os.rmdir(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Simple benchmark script used to compare the throughput (spectra/second) of reprofiling ragged
+spectra onto a common m/z axis one spectrum at a time (as previously done by the file readers)
+vs. the batched kernel in omsi.shared.spectrum_reprofile.
+
+Usage: python benchmark_reprofile.py [num_spectra mz_axis_length peaks_per_spectrum]
+"""
+import sys
+import time
+import numpy as np
+from scipy import interpolate
+from omsi.shared.spectrum_reprofile import spectrum_reprofiler
+
+
+def generate_spectra(num_spectra, peaks_per_spectrum, mz_min=100., mz_max=1000., seed=0):
+    """
+    Generate a list of random spectra with a varying number of peaks.
+
+    :returns: Tuple of two lists with the sorted m/z values and the intensities of each spectrum
+    """
+    random_state = np.random.RandomState(seed)
+    mzs = []
+    intensities = []
+    for _ in xrange(num_spectra):
+        num_peaks = max(random_state.poisson(peaks_per_spectrum), 2)
+        mzs.append(np.sort(random_state.uniform(mz_min, mz_max, num_peaks)))
+        intensities.append((random_state.rand(num_peaks) * 1000).astype('float32'))
+    return mzs, intensities
+
+
+def time_function(function, num_spectra):
+    """
+    Time the given function and return the throughput in spectra per second.
+    """
+    start_time = time.time()
+    function()
+    return num_spectra / (time.time() - start_time)
+
+
+def main(argv=None):
+    """Then main function"""
+    if argv is None:
+        argv = sys.argv
+    num_spectra = int(argv[1]) if len(argv) > 1 else 5000
+    mz_axis_length = int(argv[2]) if len(argv) > 2 else 20000
+    peaks_per_spectrum = int(argv[3]) if len(argv) > 3 else 1000
+
+    mzs, intensities = generate_spectra(num_spectra, peaks_per_spectrum)
+    mz_axis = np.linspace(100., 1000., mz_axis_length)
+    results = np.zeros(shape=(num_spectra, mz_axis_length), dtype='float64')
+
+    def profile_interp1d():
+        for index in xrange(num_spectra):
+            interpolator = interpolate.interp1d(mzs[index], intensities[index], fill_value=0, bounds_error=False)
+            results[index, :] = interpolator(mz_axis)
+
+    def profile_interp():
+        for index in xrange(num_spectra):
+            results[index, :] = np.interp(mz_axis, mzs[index], intensities[index], 0, 0)
+
+    def centroid_histogram():
+        for index in xrange(num_spectra):
+            bin_edges = np.append(mz_axis, mz_axis[-1] + np.diff(mz_axis).mean())
+            results[index, :] = np.histogram(mzs[index], bins=bin_edges, weights=intensities[index])[0]
+
+    def batched(mode):
+        reprofiler = spectrum_reprofiler(mz_axis=mz_axis, mode=mode)
+        block_size = reprofiler.get_block_size()
+        for start in xrange(0, num_spectra, block_size):
+            stop = min(start + block_size, num_spectra)
+            reprofiler.reprofile(mzs=mzs[start:stop], intensities=intensities[start:stop], out=results[start:stop])
+
+    print "Spectra: " + str(num_spectra) + "  m/z axis length: " + str(mz_axis_length) + \
+        "  peaks per spectrum: " + str(peaks_per_spectrum)
+    print "profile  per-spectrum interp1d   [spectra/s]: " + str(time_function(profile_interp1d, num_spectra))
+    print "profile  per-spectrum np.interp  [spectra/s]: " + str(time_function(profile_interp, num_spectra))
+    print "profile  batched                 [spectra/s]: " + str(time_function(lambda: batched('profile'),
+                                                                              num_spectra))
+    print "centroid per-spectrum histogram  [spectra/s]: " + str(time_function(centroid_histogram, num_spectra))
+    print "centroid batched                 [spectra/s]: " + str(time_function(lambda: batched('centroid'),
+                                                                              num_spectra))
+
+
+if __name__ == "__main__":
+    main()
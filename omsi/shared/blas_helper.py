@@ -0,0 +1,52 @@
+"""
+Module with helper functions for controlling the number of threads used by the BLAS library
+numpy is linked against (e.g., OpenBLAS or MKL) for the duration of a computation.
+"""
+from contextlib import contextmanager
+from omsi.shared.log import log_helper
+
+
+@contextmanager
+def blas_threads(num_threads=None):
+    """
+    Context manager limiting the number of threads used by BLAS within the context, e.g.:
+
+    .. code-block:: python
+
+        with blas_threads(4):
+            product = np.dot(a, b)
+
+    The number of threads is set via threadpoolctl if available and via the mkl module otherwise.
+    If neither is available then a warning is logged and the BLAS settings remain unchanged (i.e.,
+    the number of threads is then controlled only via environment variables such as OMP_NUM_THREADS
+    that must be set before numpy is loaded).
+
+    :param num_threads: The number of BLAS threads. Default is None (or <1), in which case the
+        BLAS settings are not changed.
+    """
+    if num_threads is None or num_threads < 1:
+        yield
+        return
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        threadpool_limits = None
+    if threadpool_limits is not None:
+        with threadpool_limits(limits=int(num_threads), user_api='blas'):
+            yield
+        return
+    try:
+        import mkl
+    except ImportError:
+        mkl = None
+    if mkl is not None:
+        previous_num_threads = mkl.get_max_threads()
+        mkl.set_num_threads(int(num_threads))
+        try:
+            yield
+        finally:
+            mkl.set_num_threads(previous_num_threads)
+        return
+    log_helper.warning(__name__, "Setting the number of BLAS threads requires threadpoolctl or mkl. " +
+                       "Using the default BLAS settings.")
+    yield
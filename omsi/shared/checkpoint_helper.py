@@ -0,0 +1,152 @@
+"""
+Module with helper functions for checkpointing the results of data blocks processed in parallel
+(see omsi.shared.mpi_helper.parallel_over_axes and omsi.shared.process_helper.parallel_over_axes_processes),
+so that a restarted run can skip the blocks that have already been completed.
+"""
+import os
+import time
+import hashlib
+import tempfile
+import cPickle as pickle
+
+import omsi.shared.mpi_helper as mpi_helper
+from omsi.shared.log import log_helper
+
+
+class block_checkpoint(object):
+    """
+    Checkpoint of the results of data blocks. The result of each block is stored in a separate file in the
+    checkpoint directory. The files are written to a temporary file first and then renamed, i.e., a block
+    is either completely stored or not at all, even if the run is killed while writing.
+
+    NOTE: Blocks are identified by their selection only. The checkpoint directory must, therefore, be specific
+    to the task function and data being processed (e.g., the executors use one directory per analysis and
+    cache key). For static schedules, the blocks depend on the number of ranks or processes, i.e., blocks are
+    only reused if the run is restarted with the same number of ranks or processes.
+
+    :ivar checkpoint_directory: The directory where the results of the blocks are stored
+    :ivar comm: The MPI communicator used to share the list of completed blocks
+    :ivar root: The MPI root rank that lists the checkpoint directory
+    :ivar completed_blocks: Set with the keys of all completed blocks (see get_block_key)
+    :ivar num_restored: The number of blocks loaded from the checkpoint
+    :ivar num_stored: The number of blocks stored in the checkpoint
+
+    """
+    def __init__(self, checkpoint_directory, comm=None, root=0):
+        """
+        Initialize the checkpoint
+
+        :param checkpoint_directory: The directory where the results of the blocks are stored. The directory
+            is created if necessary.
+        :param comm: The MPI communicator used to share the list of completed blocks. Default value is None,
+            in which case MPI.COMM_WORLD is used.
+        :param root: The MPI root rank that lists the checkpoint directory
+        """
+        self.checkpoint_directory = checkpoint_directory
+        self.comm = comm
+        self.root = root
+        self.completed_blocks = set()
+        self.num_restored = 0
+        self.num_stored = 0
+        if not os.path.isdir(self.checkpoint_directory):
+            try:
+                os.makedirs(self.checkpoint_directory)
+            except OSError:
+                # The directory may have been created by another rank in the meantime
+                if not os.path.isdir(self.checkpoint_directory):
+                    raise
+
+    @staticmethod
+    def get_block_key(block_selection):
+        """
+        Get the key identifying the given block selection.
+
+        :param block_selection: Tuple of slices and/or integers (or a single slice or integer) with the selection
+
+        :return: String with the hex digest of the selection
+        """
+        if not isinstance(block_selection, (tuple, list)):
+            block_selection = (block_selection, )
+        normalized = tuple((selection.start, selection.stop, selection.step) if isinstance(selection, slice)
+                           else int(selection) for selection in block_selection)
+        return hashlib.sha1(repr(normalized)).hexdigest()
+
+    def get_block_filename(self, block_selection):
+        """
+        Get the name of the file with the result of the given block.
+
+        :param block_selection: The selection of the block
+
+        :return: String with the filename
+        """
+        return os.path.join(self.checkpoint_directory, 'block_' + self.get_block_key(block_selection) + '.pkl')
+
+    def load_index(self, comm=None, collective=True):
+        """
+        Determine which blocks have been completed. The root lists the checkpoint directory and broadcasts
+        the list of completed blocks to all ranks, so that we do not query the file system on each rank.
+
+        :param comm: The MPI communicator to be used. Default value is None, in which case self.comm is used.
+        :param collective: Boolean indicating whether the function is called by all ranks of the communicator.
+            If False, then the calling process lists the checkpoint directory itself.
+
+        :return: Set with the keys of all completed blocks
+        """
+        comm = comm if comm is not None else self.comm
+        completed_blocks = None
+        if not collective or mpi_helper.get_rank(comm=comm) == self.root:
+            completed_blocks = set(filename[len('block_'):-len('.pkl')]
+                                   for filename in os.listdir(self.checkpoint_directory)
+                                   if filename.startswith('block_') and filename.endswith('.pkl'))
+        if collective and mpi_helper.get_size(comm=comm) > 1:
+            completed_blocks = mpi_helper.broadcast(completed_blocks, comm=comm, root=self.root)
+        self.completed_blocks = completed_blocks
+        if len(self.completed_blocks) > 0:
+            log_helper.info(__name__, "Found " + str(len(self.completed_blocks)) + " completed blocks in " +
+                            self.checkpoint_directory)
+        return self.completed_blocks
+
+    def contains(self, block_selection):
+        """
+        Check whether the given block has been completed.
+
+        :param block_selection: The selection of the block
+
+        :return: Boolean
+        """
+        return self.get_block_key(block_selection) in self.completed_blocks
+
+    def load(self, block_selection):
+        """
+        Load the result of a completed block.
+
+        :param block_selection: The selection of the block
+
+        :return: Tuple with the result of the task function and the time in seconds used to process the block
+        """
+        with open(self.get_block_filename(block_selection), 'rb') as block_file:
+            result, block_time = pickle.load(block_file)
+        self.num_restored += 1
+        return result, block_time
+
+    def store(self, block_selection, result, block_time):
+        """
+        Store the result of a block.
+
+        :param block_selection: The selection of the block
+        :param result: The result of the task function for the block. Must be picklable.
+        :param block_time: The time in seconds used to process the block
+        """
+        start_time = time.time()
+        handle, temp_filename = tempfile.mkstemp(suffix='.tmp', dir=self.checkpoint_directory)
+        try:
+            with os.fdopen(handle, 'wb') as block_file:
+                pickle.dump((result, block_time), block_file, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_filename, self.get_block_filename(block_selection))
+        except:
+            os.remove(temp_filename)
+            raise
+        self.completed_blocks.add(self.get_block_key(block_selection))
+        self.num_stored += 1
+        log_helper.debug(__name__, "Stored block " + str(block_selection) + " in " +
+                         str(time.time() - start_time) + "s")
@@ -0,0 +1,446 @@
+"""
+Module with helper functions for processing n-dimensional datasets (e.g., h5py datasets,
+omsi_file_msidata objects, or numpy arrays) in blocks that are aligned with the chunking
+of the data, so that each chunk of the data is read only once per pass over the data.
+The module also provides a streaming reduction engine (see reduce_data) used to compute
+reductions (sum, mean, min, max, count_nonzero, percentile) of data that may not fit into memory.
+"""
+import itertools
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+
+def get_chunk_shape(data):
+    """
+    Get the chunking of the given dataset.
+
+    :param data: h5py.Dataset, omsi_file_msidata, or numpy array
+
+    :returns: Tuple with the chunk shape or None if the data is not chunked. For omsi_file_msidata
+        objects the chunking of the first (i.e., raw) copy of the data is returned if the data is
+        stored as a full cube.
+    """
+    chunks = getattr(data, 'chunks', None)
+    if chunks is None and hasattr(data, 'datasets') and len(data.datasets) > 0:
+        chunks = getattr(data.datasets[0], 'chunks', None)
+        # The datasets of the partial_cube and partial_spectra formats do not have the layout of the data
+        if chunks is not None and len(chunks) != len(data.shape):
+            chunks = None
+    return tuple(chunks) if chunks is not None else None
+
+
+def get_chunk_aligned_blocks(shape, chunks=None, itemsize=8, max_bytes=256*1024*1024, split_axes=None):
+    """
+    Split the given shape into blocks that are aligned with the chunking of the data.
+
+    Along the axes that are not split the blocks always cover the full extent of the data. The extent
+    of the blocks along the split axes is a multiple of the chunk size. The blocks are grown starting
+    from the innermost split axis, i.e., the blocks cover the full extent of an inner axis before they
+    are extended along an outer axis. A block always covers at least one chunk along the split axes,
+    even if this exceeds max_bytes.
+
+    :param shape: The shape of the data
+    :param chunks: The chunk shape of the data. If None, then chunks of size 1 along the split axes are assumed.
+    :param itemsize: Number of bytes per data value
+    :param max_bytes: The maximum number of bytes per block
+    :param split_axes: List of axes along which the data may be split. Default is None, in which case
+        all but the last axis are split (e.g., (0, 1) for 3D MSI data so that blocks contain complete spectra).
+
+    :returns: List of tuples of slices, one tuple per block
+    """
+    shape = tuple(int(dim) for dim in shape)
+    if split_axes is None:
+        split_axes = range(len(shape) - 1)
+    if chunks is None:
+        chunks = (1, ) * len(shape)
+    block_shape = [min(int(chunks[axis]), shape[axis]) if axis in split_axes else shape[axis]
+                   for axis in range(len(shape))]
+    block_shape = [max(extent, 1) for extent in block_shape]
+    for axis in reversed(sorted(split_axes)):
+        chunk_extent = block_shape[axis]
+        other_bytes = itemsize * int(np.prod([block_shape[other_axis] for other_axis in range(len(shape))
+                                              if other_axis != axis]))
+        if other_bytes * shape[axis] <= max_bytes:
+            block_shape[axis] = max(shape[axis], 1)
+        else:
+            num_chunks = max(int(max_bytes // max(other_bytes * chunk_extent, 1)), 1)
+            block_shape[axis] = min(num_chunks * chunk_extent, max(shape[axis], 1))
+        if block_shape[axis] < shape[axis]:
+            break
+    axis_slices = [[slice(start, min(start + block_shape[axis], shape[axis]))
+                    for start in xrange(0, shape[axis], block_shape[axis])]
+                   for axis in range(len(shape))]
+    return list(itertools.product(*axis_slices))
+
+
+def iterate_blocks(data, blocks, num_threads=1):
+    """
+    Iterate over the given blocks of the data.
+
+    :param data: The data to be read (e.g., h5py.Dataset, omsi_file_msidata, or numpy array)
+    :param blocks: List of block selections, e.g., computed via get_chunk_aligned_blocks
+    :param num_threads: Number of threads used to prefetch the next blocks while the current
+        block is being processed. Set to 0 to read the blocks synchronously.
+
+    :returns: Generator yielding for each block a tuple of the block selection and the numpy array with the data
+    """
+    if num_threads < 1 or len(blocks) < 2:
+        for block in blocks:
+            yield block, np.asarray(data[block])
+        return
+    thread_pool = ThreadPool(num_threads)
+    try:
+        pending = [thread_pool.apply_async(data.__getitem__, (block, ))
+                   for block in blocks[0:num_threads]]
+        for block_index, block in enumerate(blocks):
+            block_data = pending.pop(0).get()
+            next_index = block_index + num_threads
+            if next_index < len(blocks):
+                pending.append(thread_pool.apply_async(data.__getitem__, (blocks[next_index], )))
+            yield block, np.asarray(block_data)
+    finally:
+        thread_pool.terminate()
+
+
+REDUCTION_OPERATIONS = ('sum', 'mean', 'min', 'max', 'count_nonzero', 'percentile')
+"""The reduction operations supported by reduce_data"""
+
+
+def reduce_data(data,
+                op,
+                axis=None,
+                q=None,
+                last_axis_selection=None,
+                blocks=None,
+                max_bytes=256*1024*1024,
+                num_threads=1,
+                comm=None,
+                root=0,
+                num_bins=256):
+    """
+    Streaming reduction of n-dimensional data.
+
+    The data is processed one block at a time (by default using chunk-aligned blocks of complete spectra,
+    see get_chunk_aligned_blocks) and the partial results of the blocks are combined, i.e., the memory
+    used is bounded by the size of the blocks and the size of the result. Multiple reductions can be
+    computed in a single pass over the data by specifying a list of operations. Supported operations are:
+
+    * 'sum', 'min', 'max' : Same as np.sum, np.amin, np.amax
+    * 'mean' : Same as np.mean but always accumulated in float64
+    * 'count_nonzero' : Number of non-zero values (same as np.count_nonzero)
+    * 'percentile' : Percentile(s) q (same as np.percentile). If the reduction axes are not split \
+        across blocks (e.g., axis=-1 for the default blocks) then the percentiles are exact. Otherwise \
+        streaming approximate percentiles are computed from per-element histograms with num_bins bins \
+        between the min and max value (requires an additional pass over the data), i.e., the error is \
+        bounded by (max-min)/num_bins. NaN values are not supported for approximate percentiles.
+
+    If the data provides a get_scan_dataset() function (e.g., omsi_file_msidata), then the data object
+    returned by that function is used for the reduction, e.g., the copy of the data that is best suited
+    for reading the full data.
+
+    :param data: The data to be reduced (e.g., h5py.Dataset, omsi_file_msidata, or numpy array)
+    :param op: String with the reduction operation or list of strings to compute multiple reductions in one pass.
+    :param axis: Integer or tuple of integers with the axes to be reduced. Default is None, i.e., reduce all axes.
+    :param q: Percentile or sequence of percentiles in [0, 100]. Required for the 'percentile' operation.
+    :param last_axis_selection: Optional selection (slice, index list, or boolean mask) applied to the last
+        axis of each block before the reduction, e.g., to reduce only a set of m/z values.
+    :param blocks: List of block selections. Default is None, in which case chunk-aligned blocks of at
+        most max_bytes are used. The blocks must cover the full extent of the last axis.
+    :param max_bytes: The maximum number of bytes per block (used only if blocks is None).
+    :param num_threads: Number of threads used to read (and decompress) the next blocks while the current
+        block is reduced. Set to 0 to read the blocks synchronously.
+    :param comm: MPI communicator. If set (and there is more than one rank) then the blocks are distributed
+        across the ranks and the result is available on all ranks. Default is None, i.e., no MPI.
+    :param root: The MPI rank used to combine the partial results of all ranks.
+    :param num_bins: Number of histogram bins per element used for streaming approximate percentiles.
+
+    :returns: Numpy array (or numpy scalar if all axes are reduced) with the result of the reduction. If
+        a list of operations is given then a list with one result per operation is returned. For the
+        'percentile' operation the first axis of the result indexes the percentiles if q is a sequence.
+
+    :raises ValueError: If an unsupported operation is requested or q is missing.
+    """
+    # Use the data object best suited for a full pass over the data
+    if hasattr(data, 'get_scan_dataset'):
+        data = data.get_scan_dataset(max_bytes=max_bytes)
+
+    # Check the input parameters
+    ops = [op, ] if isinstance(op, basestring) else list(op)
+    for current_op in ops:
+        if current_op not in REDUCTION_OPERATIONS:
+            raise ValueError("Unsupported reduction operation: " + str(current_op) +
+                             " Supported operations are: " + str(REDUCTION_OPERATIONS))
+    if 'percentile' in ops and q is None:
+        raise ValueError("The percentile reduction requires q.")
+    q_values = np.atleast_1d(np.asarray(q, dtype='float64')) if q is not None else None
+
+    # Determine the shape of the data, the reduction axes, and the blocks
+    data_shape = tuple(int(dim) for dim in data.shape)
+    ndim = len(data_shape)
+    shape = data_shape
+    if last_axis_selection is not None:
+        shape = shape[:-1] + (np.arange(shape[-1])[last_axis_selection].size, )
+    if axis is None:
+        reduce_axes = tuple(range(ndim))
+    else:
+        reduce_axes = tuple(sorted(set([int(current_axis) % ndim for current_axis in np.atleast_1d(axis)])))
+    if blocks is None:
+        blocks = get_chunk_aligned_blocks(shape=data_shape,
+                                          chunks=get_chunk_shape(data),
+                                          itemsize=np.dtype(data.dtype).itemsize,
+                                          max_bytes=max_bytes)
+    block_regions = [get_reduction_region(block, reduce_axes, ndim) for block in blocks]
+    # Percentiles are exact if each block covers the full extent of all reduction axes
+    exact_percentile = True
+    for block in blocks:
+        for current_axis in reduce_axes:
+            if current_axis < len(block) and current_axis < ndim - 1:
+                axis_start, axis_stop, _ = block[current_axis].indices(shape[current_axis])
+                exact_percentile &= (axis_start == 0 and axis_stop >= shape[current_axis])
+    use_mpi = comm is not None
+    if use_mpi:
+        from omsi.shared import mpi_helper
+        use_mpi = mpi_helper.get_size(comm=comm) > 1
+    if use_mpi:
+        rank = mpi_helper.get_rank(comm=comm)
+        blocks = blocks[rank::mpi_helper.get_size(comm=comm)]
+        block_regions = block_regions[rank::mpi_helper.get_size(comm=comm)]
+
+    # Pass 1: Compute all reductions that can be computed directly from the blocks
+    pass_ops = [current_op for current_op in ops if current_op != 'percentile' or exact_percentile]
+    if 'percentile' in ops and not exact_percentile:
+        pass_ops += [current_op for current_op in ('min', 'max') if current_op not in pass_ops]
+    keep_shape = tuple(1 if current_axis in reduce_axes else shape[current_axis] for current_axis in range(ndim))
+    results = dict([(current_op, None) for current_op in pass_ops])
+    seen = np.zeros(keep_shape, dtype='bool')
+    for block_index, (block, block_data) in enumerate(iterate_blocks(data, blocks, num_threads=num_threads)):
+        if last_axis_selection is not None:
+            block_data = block_data[..., last_axis_selection]
+        region = block_regions[block_index]
+        for current_op in pass_ops:
+            partial = reduce_block(block_data, current_op, reduce_axes, q_values)
+            if current_op == 'percentile':
+                results[current_op] = combine_reduction(current_op, results[current_op], seen,
+                                                        partial, (slice(None), ) + region,
+                                                        (len(q_values), ) + keep_shape)
+            else:
+                results[current_op] = combine_reduction(current_op, results[current_op], seen,
+                                                        partial, region, keep_shape)
+        seen[region] = True
+    if use_mpi:
+        collected = mpi_helper.gather((results, seen), comm=comm, root=root)
+        if rank == root:
+            for rank_results, rank_seen in collected[1:]:
+                for current_op in pass_ops:
+                    if rank_results[current_op] is not None:
+                        results[current_op] = combine_reduction(current_op, results[current_op], seen,
+                                                                rank_results[current_op], Ellipsis,
+                                                                rank_results[current_op].shape,
+                                                                partial_seen=rank_seen)
+                seen |= rank_seen
+        results, seen = mpi_helper.broadcast((results, seen), comm=comm, root=root)
+    if not np.all(seen):
+        raise ValueError("The blocks do not cover all elements of the data.")
+
+    # Pass 2: Compute approximate percentiles from histograms
+    if 'percentile' in ops and not exact_percentile:
+        results['percentile'] = histogram_percentile(data=data,
+                                                     blocks=blocks,
+                                                     block_regions=block_regions,
+                                                     last_axis_selection=last_axis_selection,
+                                                     min_values=results['min'],
+                                                     max_values=results['max'],
+                                                     num_values=int(np.prod([shape[current_axis]
+                                                                             for current_axis in reduce_axes])),
+                                                     q_values=q_values,
+                                                     num_bins=num_bins,
+                                                     num_threads=num_threads,
+                                                     comm=comm if use_mpi else None,
+                                                     root=root)
+
+    # Compile the final results
+    out_shape = tuple(shape[current_axis] for current_axis in range(ndim) if current_axis not in reduce_axes)
+    outputs = []
+    for current_op in ops:
+        result = results[current_op]
+        if current_op == 'mean':
+            result = result / float(np.prod([shape[current_axis] for current_axis in reduce_axes]))
+        if current_op == 'percentile':
+            result = result.reshape((len(q_values), ) + out_shape)
+            if np.ndim(q) == 0:
+                result = result[0]
+        else:
+            result = result.reshape(out_shape)
+        outputs.append(result[()] if result.ndim == 0 else result)
+    return outputs[0] if isinstance(op, basestring) else outputs
+
+
+def get_reduction_region(block, reduce_axes, ndim):
+    """
+    Get the region of the (keepdims) reduction result a block contributes to.
+
+    :param block: Tuple of slices with the block selection
+    :param reduce_axes: Tuple with the axes to be reduced
+    :param ndim: The number of dimensions of the data
+
+    :returns: Tuple of slices
+    """
+    block = tuple(block) + (slice(None), ) * (ndim - len(block))
+    return tuple(slice(0, 1) if current_axis in reduce_axes else
+                 (block[current_axis] if current_axis < ndim - 1 else slice(None))
+                 for current_axis in range(ndim))
+
+
+def reduce_block(block_data, op, reduce_axes, q_values=None):
+    """
+    Compute the partial reduction of a single block (see reduce_data).
+
+    :param block_data: Numpy array with the data of the block
+    :param op: The reduction operation
+    :param reduce_axes: Tuple with the axes to be reduced
+    :param q_values: 1D array of percentiles (required for the 'percentile' operation only)
+
+    :returns: Numpy array with the partial result with the reduced axes kept as axes of length one. For
+        the 'percentile' operation an additional first axis indexes the percentiles.
+    """
+    if op == 'sum':
+        return np.sum(block_data, axis=reduce_axes, keepdims=True)
+    elif op == 'mean':
+        return np.sum(block_data, axis=reduce_axes, dtype='float64', keepdims=True)
+    elif op == 'min':
+        return np.amin(block_data, axis=reduce_axes, keepdims=True)
+    elif op == 'max':
+        return np.amax(block_data, axis=reduce_axes, keepdims=True)
+    elif op == 'count_nonzero':
+        return np.sum(block_data != 0, axis=reduce_axes, dtype='int64', keepdims=True)
+    elif op == 'percentile':
+        return np.percentile(block_data, q_values, axis=reduce_axes, keepdims=True)
+    raise ValueError("Unsupported reduction operation: " + str(op))
+
+
+def combine_reduction(op, result, seen, partial, region, result_shape, partial_seen=None):
+    """
+    Combine the partial result of a block (or of another MPI rank) with the current result.
+
+    :param op: The reduction operation
+    :param result: Numpy array with the current (keepdims) result or None if the result has not been allocated yet
+    :param seen: Boolean numpy array of the (keepdims) result shape indicating which elements of the result
+        have received data already
+    :param partial: Numpy array with the partial result
+    :param region: The region of the result the partial result belongs to (see get_reduction_region)
+    :param result_shape: The shape of the (keepdims) result
+    :param partial_seen: Boolean numpy array indicating which elements of the partial result are valid.
+        Default is None, i.e., all elements are valid.
+
+    :returns: Numpy array with the updated result
+    """
+    if result is None:
+        result = np.zeros(result_shape, dtype=partial.dtype)
+    if op in ('sum', 'mean', 'count_nonzero'):
+        result[region] += partial
+        return result
+    current = result[region]
+    current_seen = seen[region[1:] if op == 'percentile' and region is not Ellipsis else region]
+    valid = np.ones(partial.shape, dtype='bool') if partial_seen is None else np.broadcast_to(partial_seen,
+                                                                                              partial.shape)
+    if op == 'min':
+        combined = np.where(current_seen, np.minimum(current, partial), partial)
+    elif op == 'max':
+        combined = np.where(current_seen, np.maximum(current, partial), partial)
+    else:
+        # The partial results of the percentiles cover disjoint regions
+        combined = partial
+    result[region] = np.where(valid, combined, current)
+    return result
+
+
+def histogram_percentile(data,
+                         blocks,
+                         block_regions,
+                         last_axis_selection,
+                         min_values,
+                         max_values,
+                         num_values,
+                         q_values,
+                         num_bins=256,
+                         num_threads=1,
+                         comm=None,
+                         root=0):
+    """
+    Compute streaming approximate percentiles from per-element histograms (see reduce_data).
+
+    :param data: The data to be reduced
+    :param blocks: List of the blocks to be processed
+    :param block_regions: List with the region of the result of each block (see get_reduction_region)
+    :param last_axis_selection: Optional selection applied to the last axis of each block
+    :param min_values: Numpy array with the (keepdims) minimum values
+    :param max_values: Numpy array with the (keepdims) maximum values
+    :param num_values: The number of values reduced to each element of the result
+    :param q_values: 1D numpy array with the percentiles
+    :param num_bins: The number of histogram bins
+    :param num_threads: Number of threads used to prefetch blocks
+    :param comm: MPI communicator used to combine the histograms of all ranks or None
+    :param root: The MPI root rank
+
+    :returns: Numpy array with the percentiles. The first axis indexes the percentiles and the remaining
+        axes have the (keepdims) shape of min_values.
+    """
+    keep_shape = min_values.shape
+    num_out = int(np.prod(keep_shape))
+    min_values = min_values.astype('float64')
+    max_values = max_values.astype('float64')
+    bin_width = (max_values - min_values) / float(num_bins)
+    safe_width = np.where(bin_width > 0, bin_width, 1.0)
+    out_index = np.arange(num_out, dtype='int64').reshape(keep_shape)
+    counts = np.zeros(num_out * num_bins, dtype='int64')
+    for block_index, (block, block_data) in enumerate(iterate_blocks(data, blocks, num_threads=num_threads)):
+        if last_axis_selection is not None:
+            block_data = block_data[..., last_axis_selection]
+        region = block_regions[block_index]
+        bins = np.floor((block_data - min_values[region]) / safe_width[region])
+        bins = np.clip(bins, 0, num_bins - 1).astype('int64')
+        block_out_index = out_index[region]
+        offset = int(block_out_index.min())
+        flat_index = (np.broadcast_to(block_out_index - offset, bins.shape) * num_bins + bins).reshape(-1)
+        num_block_out = int(block_out_index.max()) - offset + 1
+        counts[offset * num_bins:(offset + num_block_out) * num_bins] += \
+            np.bincount(flat_index, minlength=num_block_out * num_bins)
+    if comm is not None:
+        from omsi.shared import mpi_helper
+        collected = mpi_helper.gather(counts, comm=comm, root=root)
+        if mpi_helper.get_rank(comm=comm) == root:
+            counts = np.sum(collected, axis=0)
+        counts = mpi_helper.broadcast(counts, comm=comm, root=root)
+
+    # Approximate the order statistics from the histograms by assuming that the values are evenly spaced
+    # within each bin and compute the percentiles by linear interpolation between the order statistics
+    # (as done by np.percentile)
+    counts = counts.reshape((num_out, num_bins))
+    cumulative_counts = np.cumsum(counts, axis=1)
+    rows = np.arange(num_out)
+    min_flat = min_values.reshape(-1)
+    max_flat = max_values.reshape(-1)
+    width_flat = bin_width.reshape(-1)
+
+    def order_statistic(order_index):
+        """Approximate the value with the given index in the sorted values of each element"""
+        bin_index = np.argmax(cumulative_counts > order_index, axis=1)
+        bin_count = counts[rows, bin_index]
+        fraction = (order_index - (cumulative_counts[rows, bin_index] - bin_count) + 0.5) / np.maximum(bin_count, 1)
+        values = min_flat + (bin_index + np.clip(fraction, 0, 1)) * width_flat
+        return np.clip(values, min_flat, max_flat)
+
+    result = np.zeros((len(q_values), num_out), dtype='float64')
+    for q_index, q_value in enumerate(q_values):
+        if q_value <= 0:
+            result[q_index] = min_flat
+        elif q_value >= 100:
+            result[q_index] = max_flat
+        else:
+            target_rank = q_value / 100. * (num_values - 1)
+            lower_rank = int(np.floor(target_rank))
+            upper_rank = min(lower_rank + 1, num_values - 1)
+            lower_value = order_statistic(lower_rank)
+            upper_value = order_statistic(upper_rank)
+            result[q_index] = lower_value + (target_rank - lower_rank) * (upper_value - lower_value)
+    return result.reshape((len(q_values), ) + keep_shape)
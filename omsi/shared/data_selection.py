@@ -246,6 +246,20 @@ reduction_allowed_functions = {'area_near_peak': area_near_peak,
 
 """
 
+reduction_streaming_functions = {'amax': 'max',
+                                 'amin': 'min',
+                                 'count_nonzero': 'count_nonzero',
+                                 'max': 'max',
+                                 'min': 'min',
+                                 'mean': 'mean',
+                                 'percentile': 'percentile',
+                                 'sum': 'sum'}
+"""Dict of the reduction operations that are computed using the streaming reduction engine
+   omsi.shared.data_blocks.reduce_data(...) if the data is not a numpy array (e.g., a h5py.Dataset
+   or omsi_file_msidata object), i.e., the data is reduced one block at a time rather than being
+   loaded into memory at once. The values are the names of the corresponding reduce_data operations.
+"""
+
 transformation_allowed_single_data = {'abs': np.abs,
                                       'arccos': np.arccos,
                                       'arccosh': np.arccosh,
@@ -785,7 +799,7 @@ def perform_reduction(data, reduction, secondary_data, min_dim=None, http_error=
 
     # 1.5) Determine whether we should apply the reduction or not
     if min_dim:
-        if x1.ndim < min_dim:
+        if len(x1.shape) < min_dim:
             return x1
 
     # 1.6) Check if we have a data selection reduction
@@ -802,7 +816,25 @@ def perform_reduction(data, reduction, secondary_data, min_dim=None, http_error=
             selection = slice(None)
         return data[selection]
 
-    # 1.7 ) Perform the data reduction operation. This can be a large range of
+    # 1.7) Perform supported reductions of out-of-core data (e.g., h5py datasets or omsi_file_msidata objects)
+    # using the streaming reduction engine rather than loading the full data into memory
+    if reduction in reduction_streaming_functions and not isinstance(x1, np.ndarray) and \
+            set(kwargs.keys()) <= set(['q']):
+        try:
+            from omsi.shared.data_blocks import reduce_data
+            return reduce_data(data=x1,
+                               op=reduction_streaming_functions[reduction],
+                               axis=axis if axis_specified else None,
+                               q=kwargs.get('q', None))
+        except:
+            if http_error:
+                return HttpResponseNotFound("Requested data reduction " + str(reduction) + " failed. " +
+                                            str(sys.exc_info()))
+            else:
+                raise ValueError("Requested data reduction " + str(reduction) + " failed. " +
+                                 str(sys.exc_info()))
+
+    # 1.8 ) Perform the data reduction operation. This can be a large range of
     # numpy operations defined in
     # omsi.shared.omsi_data_selection.reduction_allowed_functions
     try:
@@ -63,16 +63,28 @@ class parallel_over_axes(object):
         If self.__data_collected is set and we are the root rank then this is a list of all the blocks
         processed by each rank.
     :ivar block_times: List of times in seconds used to process the data block with the given index.
-        NOTE: The block times include also any required communications and other operations to initialize
-        and complete the task, and not just the execution of the task function itself.
+        NOTE: The block times include also any operations to initialize and complete the task (e.g.,
+        reading the data block), and not just the execution of the task function itself. For DYNAMIC
+        scheduling the block times do not include the time to receive the task since the next task
+        is requested while the current task is processed.
     :ivar run_time: Float time in seconds for executing the run function.
     :ivar comm: The MPI communicator used for the parallelization. Default value is MPI.COMM_WORLD
+    :ivar block_size: The task granularity used for DYNAMIC scheduling, i.e., the number of elements along
+        the split axes per task (int) or BLOCK_SIZES['CHUNK'] for one chunk footprint of the data per task.
+    :ivar root_computes: Should the root rank also process tasks when using DYNAMIC scheduling?
+    :ivar block_costs: Optional numpy array with the shape of main_data along the split_axes with the
+        estimated cost of processing each element used to balance the blocks of the STATIC_ND schedule.
+    :ivar checkpoint: Optional omsi.shared.checkpoint_helper.block_checkpoint object used to store the result
+        of each completed block and to reuse the results of blocks completed by a previous run.
 
     """
     SCHEDULES = {'STATIC_1D': 'STATIC_1D',
                  'STATIC': 'STATIC',
+                 'STATIC_ND': 'STATIC_ND',
                  'DYNAMIC': 'DYNAMIC'}
 
+    BLOCK_SIZES = {'CHUNK': 'CHUNK'}
+
     MPI_MESSAGE_TAGS = {'RANK_MSG': 11,
                         'BLOCK_MSG': 12,
                         'COLLECT_MSG': 13}
@@ -85,7 +97,11 @@ class parallel_over_axes(object):
                  main_data_param_name,
                  schedule=SCHEDULES['STATIC_1D'],
                  root=0,
-                 comm=None):
+                 comm=None,
+                 block_size=1,
+                 root_computes=True,
+                 block_costs=None,
+                 checkpoint=None):
         """
 
         :param task_function: The function we should run.
@@ -98,6 +114,21 @@ class parallel_over_axes(object):
         :param schedule: The task scheduling schema to be used (see parallel_over_axes.SCHEDULES
         :param comm: The MPI communicator used for the parallelization. Default value is None, in which case
             MPI.COMM_WORLD is used
+        :param block_size: The task granularity for DYNAMIC scheduling. Either the number of elements
+            (e.g., pixels) along the split axes per task or BLOCK_SIZES['CHUNK'] to use one chunk footprint of
+            main_data (if main_data is chunked) per task. Default is 1, in which case each task is a single
+            integer point selection along the split axes. Otherwise, tasks are selections of slices.
+        :param root_computes: Should the root rank also process tasks when using DYNAMIC scheduling. If True,
+            then the root processes tasks whenever no worker is waiting for a task. Default is True.
+        :param block_costs: Numpy array with the shape of main_data along the split_axes with the estimated
+            cost of processing each element (e.g., the number of non-empty spectra). Used by the STATIC_ND
+            schedule to balance the blocks. Default is None, in which case the cost is estimated from the
+            xy_index of partial_cube and partial_spectra data or assumed to be uniform otherwise
+            (see get_block_costs).
+        :param checkpoint: Optional omsi.shared.checkpoint_helper.block_checkpoint object. If given, then the
+            result of each block is stored in the checkpoint as soon as the block is completed and blocks
+            that are already stored in the checkpoint are loaded rather than processed again. The results
+            of the task function must be picklable. Default is None, i.e., no checkpointing.
 
         """
         if not is_mpi_available():
@@ -119,6 +150,10 @@ class parallel_over_axes(object):
         self.run_time = None
         self.__data_collected = False
         self.comm = get_comm_world() if comm is None else comm
+        self.block_size = block_size
+        self.root_computes = root_computes
+        self.block_costs = block_costs
+        self.checkpoint = checkpoint
 
     def run(self):
         """
@@ -131,18 +166,23 @@ class parallel_over_axes(object):
                execution, this is always a list of length 1.
             2) List of block_indexes. Each block_index is a tuple with the selection used to
                divide the data into sub-blocks. In the case of static decomposition we have
-               a range slice object along the axes used for decomposition whereas in the
-               case of dynamic scheduling we usually have single integer point selections
-               for each task.
+               a range slice object along the axes used for decomposition (for STATIC_ND the
+               lists are empty on ranks that did not receive a block) whereas in the
+               case of dynamic scheduling we have single integer point selections for each
+               task if block_size is 1 and range slice objects otherwise.
 
         """
         from omsi.shared.log import log_helper
         start_time = time.time()
         self.__data_collected = False
+        if self.checkpoint is not None:
+            self.checkpoint.load_index(comm=self.comm)
         if self.schedule == self.SCHEDULES['DYNAMIC']:
             result = self.__run_dynamic()
         elif self.schedule == self.SCHEDULES['STATIC_1D'] or self.schedule == self.SCHEDULES['STATIC']:
             result = self.__run_static_1D()
+        elif self.schedule == self.SCHEDULES['STATIC_ND']:
+            result = self.__run_static_nd()
         else:
             log_helper.error(__name__, "Invalid scheduling scheme given: " + str(self.schedule))
             raise ValueError("Invalid scheduling scheme given: " + str(self.schedule))
@@ -150,7 +190,7 @@ class parallel_over_axes(object):
         self.run_time = end_time - start_time
         return result
 
-    def collect_data(self, force_collect=False):
+    def collect_data(self, force_collect=False, collect_results=True):
         """
         Collect the results from the parallel execution to the self.root rank.
 
@@ -164,6 +204,10 @@ class parallel_over_axes(object):
             By default the collect_data is performed only once for each time the run(..) function
             is called and the results are reused to ensure consistent data structures. We can
             force that collect will be reexecuted anyways by setting force_collect.
+        :param collect_results: Collect the self.result from all ranks. If False, then only the self.blocks
+            and self.block_times are collected and the self.result remains the local result of each rank.
+            This is useful when the results are numpy arrays that are collected more efficiently via
+            gather_array or written in parallel via write_virtual_dataset. Default is True.
 
         :return: On worker ranks (i.e., MPI_RANK!=self.root) this is simply the
             self.result and self.blocks containing the result created by run function.
@@ -182,14 +226,17 @@ class parallel_over_axes(object):
         if rank == self.root:
             log_helper.info(__name__, "COLLECTING RESULTS")
         # Collect the data, blocks, and block_times from all ranks
-        collected_data = self.comm.gather(self.result, root=self.root)
+        collected_data = self.comm.gather(self.result, root=self.root) if collect_results else None
         collected_blocks = self.comm.gather(self.blocks, root=self.root)
+        collected_block_times = self.comm.gather(self.block_times, root=self.root)
         # Save the data to self.result, self.block, self.block_times if we are the root
         if rank == self.root:
             # Merge the results from all the processes into a single result and blocks list
             # rather than having a list of lists of results
-            self.result = list(itertools.chain.from_iterable(collected_data))
+            if collect_results:
+                self.result = list(itertools.chain.from_iterable(collected_data))
             self.blocks = list(itertools.chain.from_iterable(collected_blocks))
+            self.block_times = list(itertools.chain.from_iterable(collected_block_times))
 
         # Record the time we used to collect the data
         end_time = time.time()
@@ -235,8 +282,10 @@ class parallel_over_axes(object):
         split_axis = self.split_axes[axes_sort_index[0]]
         split_axis_size = axes_shapes[split_axis]
         if split_axis_size < size:
-            raise NotImplementedError("STATIC scheduling currently parallelizes only over one axis, " +
-                                      "and the largest axis is too small to fill all MPI tasks")
+            if rank == self.root:
+                log_helper.info(__name__, "The largest axis is too small to fill all MPI tasks. " +
+                                          "Using STATIC_ND scheduling instead.")
+            return self.__run_static_nd()
         # Determine the size of 1D block
         block_size = int(split_axis_size / float(size) + 0.5)
         if block_size * size > split_axis_size and block_size > 1:
@@ -254,26 +303,232 @@ class parallel_over_axes(object):
         log_helper.info(__name__, "Rank: " + str(rank) + " Block: " + str(self.blocks))
 
         # Execute the task_function on the given data block
-        task_params = self.task_function_params
-        task_params[self.main_data_param_name] = self.main_data[self.blocks]
-        self.result = self.task_function(**task_params)
-
-        end_time = time.time()
-        run_time = end_time - start_time
-        self.block_times = [run_time, ]
-        log_helper.info(__name__, "TIME FOR PROCESSING THE DATA BLOCK: " + str(run_time))
+        block_selection = self.blocks
+        self.result = []
+        self.blocks = []
+        self.block_times = []
+        self.__process_block(block_selection)
+        log_helper.info(__name__, "TIME FOR PROCESSING THE DATA BLOCK: " + str(time.time() - start_time))
 
         # Return the output
-        self.result = [self.result, ]
-        self.blocks = [self.blocks, ]
         return self.result, self.blocks
 
+    def get_block_costs(self):
+        """
+        Get the estimated cost of processing each element of main_data along the split axes.
+
+        If self.block_costs is set, then the given costs are used. Otherwise, if main_data is
+        stored in the partial_cube or partial_spectra format (i.e., main_data has an xy_index) and
+        the split axes are a subset of the x/y axes, then the cost of a pixel is estimated
+        from the xy_index as 1 for non-empty pixels (partial_cube) or as the number of stored
+        values of the spectrum (partial_spectra) and 0 for empty pixels. Otherwise, all
+        elements have a cost of 1.
+
+        :return: Float64 numpy array with the shape of main_data along the split axes.
+        """
+        data_shape = tuple(int(dim) for dim in self.main_data.shape)
+        split_shape = tuple(data_shape[axis_index] for axis_index in self.split_axes)
+        if self.block_costs is not None:
+            block_costs = np.asarray(self.block_costs, dtype='float64')
+            if block_costs.shape != split_shape:
+                raise ValueError("The block_costs must have the shape of main_data along the split axes.")
+            return block_costs
+        xy_index = getattr(self.main_data, 'xy_index', None)
+        if xy_index is not None and len(data_shape) == 3 and set(self.split_axes).issubset([0, 1]):
+            xy_index = np.asarray(xy_index[:], dtype='int64')
+            xy_index_end = getattr(self.main_data, 'xy_index_end', None)
+            if xy_index_end is not None:
+                pixel_costs = np.maximum(np.asarray(xy_index_end[:], dtype='int64') - xy_index, 0)
+                pixel_costs[xy_index < 0] = 0
+            else:
+                pixel_costs = xy_index >= 0
+            pixel_costs = np.asarray(pixel_costs, dtype='float64')
+            # Sum the cost over the x/y axis that is not split
+            for axis_index in [1, 0]:
+                if axis_index not in self.split_axes:
+                    pixel_costs = pixel_costs.sum(axis=axis_index)
+            if sorted(self.split_axes) != list(self.split_axes):
+                pixel_costs = pixel_costs.transpose()
+            return pixel_costs
+        return np.ones(split_shape, dtype='float64')
+
+    def get_static_nd_blocks(self, num_blocks):
+        """
+        Compute the blocks of the STATIC_ND schedule.
+
+        The data is divided via recursive bisection along all split axes, i.e., the number of
+        blocks is factored over the split axes. In each step the current block of n blocks is
+        split into two parts with floor(n/2) and ceil(n/2) blocks along the split axis for which
+        the cost of the parts (see get_block_costs) is best proportional to the number of
+        blocks of each part (using the longest axis if multiple axes are similarly balanced).
+        All block edges are aligned with the chunking of main_data (if main_data is chunked,
+        e.g., an h5py.Dataset or omsi_file_msidata) so that different blocks do not need to
+        read the same chunks.
+
+        :param num_blocks: The number of blocks (usually the number of MPI ranks)
+
+        :return: List of num_blocks blocks. Each block is a tuple of slices or None if the data
+            does not contain a sufficient number of chunks to create the block.
+        """
+        from omsi.shared import data_blocks
+        data_shape = tuple(int(dim) for dim in self.main_data.shape)
+        chunks = data_blocks.get_chunk_shape(self.main_data)
+        split_chunks = [max(int(chunks[axis_index]), 1) if chunks is not None else 1
+                        for axis_index in self.split_axes]
+        # Compute the cost of each chunk along the split axes
+        chunk_costs = self.get_block_costs()
+        for index, chunk_extent in enumerate(split_chunks):
+            chunk_costs = np.add.reduceat(chunk_costs, np.arange(0, chunk_costs.shape[index], chunk_extent),
+                                          axis=index)
+
+        def bisect(chunk_ranges, num_parts):
+            """Recursively split the given ranges of chunks (one (start, stop) tuple per split axis)"""
+            extents = [stop - start for start, stop in chunk_ranges]
+            if num_parts == 1 or max(extents) < 2:
+                # The block is complete or consists of a single chunk and cannot be split further
+                return [chunk_ranges] + [None] * (num_parts - 1)
+            num_low = num_parts // 2
+            block_costs = chunk_costs[tuple(slice(start, stop) for start, stop in chunk_ranges)]
+            # Determine the best split along each axis. We prefer the split with the best balance
+            # of the cost and the longest axis if multiple axes provide a similar balance.
+            candidates = []
+            for split_index in range(len(extents)):
+                if extents[split_index] < 2:
+                    continue
+                other_axes = tuple(index for index in range(len(extents)) if index != split_index)
+                profile = np.cumsum(block_costs.sum(axis=other_axes) if len(other_axes) > 0 else block_costs)
+                if profile[-1] > 0:
+                    target = profile[-1] * num_low / float(num_parts)
+                    split_offset = int(np.argmin(np.abs(profile[:-1] - target))) + 1
+                    imbalance = abs(profile[split_offset - 1] - target) / profile[-1]
+                else:
+                    split_offset = int(extents[split_index] * num_low / float(num_parts) + 0.5)
+                    split_offset = min(max(split_offset, 1), extents[split_index] - 1)
+                    imbalance = 0
+                candidates.append((round(imbalance, 2), -extents[split_index], split_index, split_offset))
+            _, _, split_index, split_offset = min(candidates)
+            # Adjust the number of blocks of each part to the number of chunks available
+            other_extent = int(np.prod([extents[index] for index in range(len(extents)) if index != split_index]))
+            low_capacity = split_offset * other_extent
+            high_capacity = (extents[split_index] - split_offset) * other_extent
+            num_low = min(max(num_low, num_parts - high_capacity), low_capacity)
+            split_start = chunk_ranges[split_index][0] + split_offset
+            low_ranges = list(chunk_ranges)
+            low_ranges[split_index] = (chunk_ranges[split_index][0], split_start)
+            high_ranges = list(chunk_ranges)
+            high_ranges[split_index] = (split_start, chunk_ranges[split_index][1])
+            return bisect(low_ranges, num_low) + bisect(high_ranges, num_parts - num_low)
+
+        chunk_blocks = bisect([(0, extent) for extent in chunk_costs.shape], int(num_blocks))
+        # Convert the ranges of chunks to selections of the data
+        blocks = []
+        for chunk_ranges in chunk_blocks:
+            if chunk_ranges is None:
+                blocks.append(None)
+                continue
+            block = [slice(None)] * len(data_shape)
+            for axis_index, chunk_extent, (start, stop) in zip(self.split_axes, split_chunks, chunk_ranges):
+                block[axis_index] = slice(start * chunk_extent, min(stop * chunk_extent, data_shape[axis_index]))
+            blocks.append(tuple(block))
+        return blocks
+
+    def __run_static_nd(self):
+        """
+        Run the task function using a static task decomposition along all split axes.
+
+        The data is divided into one block per rank (see get_static_nd_blocks). The blocks are
+        computed independently on all ranks, i.e., no communication is required.
+
+        :return: Tuple with the following elements:
+
+            1) List with the results from the local execution of the task_function. This is
+               a list of length 1 or an empty list if the rank did not receive a block.
+            2) List of block_indexes. Each block_index is a tuple with the selection used to
+               divide the data into sub-blocks.
+
+        """
+        from omsi.shared.log import log_helper
+        rank = get_rank(comm=self.comm)
+        size = get_size(comm=self.comm)
+        blocks = self.get_static_nd_blocks(size)
+        if blocks.count(None) > 0 and rank == self.root:
+            log_helper.info(__name__,
+                            "Insufficient number of blocks for number of MPI ranks. Some ranks will remain idle")
+        self.result = []
+        self.blocks = []
+        self.block_times = []
+        if blocks[rank] is not None:
+            log_helper.info(__name__, "Rank: " + str(rank) + " Block: " + str(blocks[rank]))
+            self.__process_block(blocks[rank])
+            log_helper.info(__name__, "TIME FOR PROCESSING THE DATA BLOCK: " + str(self.block_times[0]))
+        return self.result, self.blocks
+
+    def get_dynamic_blocks(self):
+        """
+        Compute the list of tasks for DYNAMIC scheduling based on self.block_size.
+
+        :return: List of block selections. For block_size 1, each selection is a tuple with an integer
+            index for each split axis and slice(None) for all other axes. Otherwise, each selection is a
+            tuple of slices, covering block_size elements (or one chunk footprint) along the split axes.
+        """
+        from omsi.shared import data_blocks
+        data_shape = tuple(int(dim) for dim in self.main_data.shape)
+        if self.block_size == 1:
+            # Single-element tasks
+            base_blocks = [[slice(None)]] * len(data_shape)
+            for axis_index in self.split_axes:
+                base_blocks[axis_index] = range(data_shape[axis_index])
+            return list(itertools.product(*base_blocks))
+        elif self.block_size == self.BLOCK_SIZES['CHUNK']:
+            # One chunk footprint per task
+            return data_blocks.get_chunk_aligned_blocks(shape=data_shape,
+                                                        chunks=data_blocks.get_chunk_shape(self.main_data),
+                                                        itemsize=1,
+                                                        max_bytes=1,
+                                                        split_axes=self.split_axes)
+        else:
+            # Blocks of block_size elements, grown starting from the innermost split axis
+            other_size = int(np.prod([data_shape[axis_index] for axis_index in range(len(data_shape))
+                                      if axis_index not in self.split_axes]))
+            return data_blocks.get_chunk_aligned_blocks(shape=data_shape,
+                                                        chunks=None,
+                                                        itemsize=1,
+                                                        max_bytes=int(self.block_size) * other_size,
+                                                        split_axes=self.split_axes)
+
+    def __process_block(self, block_selection):
+        """
+        Execute the task function on the given data block and record the result, block, and time.
+
+        If a checkpoint is used, then the result is loaded from the checkpoint if the block has been
+        completed before and is stored in the checkpoint otherwise.
+
+        :param block_selection: The selection of the data block
+        """
+        if self.checkpoint is not None and self.checkpoint.contains(block_selection):
+            result, block_time = self.checkpoint.load(block_selection)
+            self.result.append(result)
+            self.blocks.append(block_selection)
+            self.block_times.append(block_time)
+            return
+        start_time = time.time()
+        task_params = self.task_function_params
+        task_params[self.main_data_param_name] = self.main_data[block_selection]
+        self.result.append(self.task_function(**task_params))
+        self.blocks.append(block_selection)
+        self.block_times.append(time.time() - start_time)
+        if self.checkpoint is not None:
+            self.checkpoint.store(block_selection, self.result[-1], self.block_times[-1])
+
     def __run_dynamic(self):
         """
         Run the task function using dynamic task scheduling.
 
-        The root rank divides the data into sub-tasks and sends the tasks to available MPI
-        processes on request.
+        The root rank divides the data into sub-tasks (see get_dynamic_blocks) and sends the tasks
+        to available MPI processes on request. Each worker keeps the request for its next task in
+        flight (using non-blocking communication) while processing the current task. If
+        root_computes is set, then the root processes tasks itself whenever no worker is waiting
+        for a task.
 
         :return: Tuple with the following elements:
 
@@ -285,41 +540,42 @@ class parallel_over_axes(object):
 
         """
         from omsi.shared.log import log_helper
-        import time
         rank = get_rank(comm=self.comm)
         size = get_size(comm=self.comm)
 
-        if size < 2:
+        if size < 2 and not self.root_computes:
             warnings.warn('DYNAMIC task scheduling requires at least 2 MPI ranks. Using STATIC scheduling instead.')
             return self.__run_static_1D()
 
+        self.result = []
+        self.blocks = []
+        self.block_times = []
         # We are the controlling rank
         if rank == self.root:
-            self.result = []
-            self.blocks = []
-            self.block_times = []
-            # Get data shape parameters and compute the data blocks
-            axes_shapes = np.asarray(self.main_data.shape)[self.split_axes]
-            total_num_subblocks = np.prod(axes_shapes)
+            # Compute the list of all blocks
+            block_tuples = self.get_dynamic_blocks()
+            total_num_subblocks = len(block_tuples)
             if total_num_subblocks < size:
-                if rank == self.root:
-                    warnings.warn("Insufficient number of blocks for number of MPI ranks. Some ranks will remain idle")
-
-            # Compute the list of all possible blocks
-            base_blocks = [[slice(None)]] * len(self.main_data.shape)
-            for axis_index in self.split_axes:
-                base_blocks[axis_index] = range(self.main_data.shape[axis_index])
-            block_tuples = itertools.product(*base_blocks)
+                warnings.warn("Insufficient number of blocks for number of MPI ranks. Some ranks will remain idle")
 
             # Communicate blocks with task ranks
             log_helper.info(__name__, "PROCESSING DATA BLOCKS")
             start_time = time.time()
             block_index = 0
-            for block_selection in block_tuples:
-                request_rank = self.comm.recv(source=MPI.ANY_SOURCE, tag=self.MPI_MESSAGE_TAGS['RANK_MSG'])
-                self.comm.send((block_index, block_selection),
-                               dest=request_rank,
-                               tag=self.MPI_MESSAGE_TAGS['BLOCK_MSG'])
+            while block_index < total_num_subblocks:
+                # Serve waiting workers first and process a block on the root if no worker is waiting.
+                # Blocks completed by a previous run are loaded from the checkpoint by the root itself.
+                restored = self.checkpoint is not None and self.checkpoint.contains(block_tuples[block_index])
+                if not restored and size > 1 and \
+                        (not self.root_computes or
+                         self.comm.Iprobe(source=MPI.ANY_SOURCE, tag=self.MPI_MESSAGE_TAGS['RANK_MSG'])):
+                    request_rank = self.comm.recv(source=MPI.ANY_SOURCE, tag=self.MPI_MESSAGE_TAGS['RANK_MSG'])
+                    self.comm.send((block_index, block_tuples[block_index]),
+                                   dest=request_rank,
+                                   tag=self.MPI_MESSAGE_TAGS['BLOCK_MSG'])
+                else:
+                    request_rank = rank
+                    self.__process_block(block_tuples[block_index])
                 block_index += 1
                 if (block_index % 100) == 0:
                     log_helper.debug(__name__, str((block_index, total_num_subblocks, request_rank)))
@@ -328,11 +584,10 @@ class parallel_over_axes(object):
             log_helper.info(__name__, "TIME FOR SCHEDULING ALL TASKS: " + str(run_time))
             start_time = time.time()
             log_helper.info(__name__, "FINALIZING")
-            # Terminate all ranks and receive all data from the different ranks if requested
+            # Terminate all ranks. Each worker has exactly one outstanding request for a task.
             all_ranks_status = np.zeros(size, 'bool')
             all_ranks_status[self.root] = True
             while not np.all(all_ranks_status):
-
                 request_rank = self.comm.recv(source=MPI.ANY_SOURCE, tag=self.MPI_MESSAGE_TAGS['RANK_MSG'])
                 self.comm.send((None, None), dest=request_rank, tag=self.MPI_MESSAGE_TAGS['BLOCK_MSG'])
                 all_ranks_status[request_rank] = True
@@ -343,25 +598,18 @@ class parallel_over_axes(object):
 
         # We are a rank that has to run tasks
         else:
-            # Request a new data block
-            self.result = []
-            self.blocks = []
-            self.block_times = []
-            while True:
-                start_time = time.time()
-                self.comm.send(rank, dest=self.root, tag=self.MPI_MESSAGE_TAGS['RANK_MSG'])
-                block_index, block_selection = self.comm.recv(source=self.root, tag=self.MPI_MESSAGE_TAGS['BLOCK_MSG'])
-                if block_index is None:
-                    break
+            # Request the first data block
+            self.comm.send(rank, dest=self.root, tag=self.MPI_MESSAGE_TAGS['RANK_MSG'])
+            block_index, block_selection = self.comm.recv(source=self.root, tag=self.MPI_MESSAGE_TAGS['BLOCK_MSG'])
+            while block_index is not None:
+                # Request the next data block while we process the current block
+                send_request = self.comm.isend(rank, dest=self.root, tag=self.MPI_MESSAGE_TAGS['RANK_MSG'])
+                recv_request = self.comm.irecv(source=self.root, tag=self.MPI_MESSAGE_TAGS['BLOCK_MSG'])
                 # Execute the task_function on the given data block
-                task_params = self.task_function_params
-                task_params[self.main_data_param_name] = self.main_data[block_selection]
-                self.result.append(self.task_function(**task_params))
-                self.blocks.append(block_selection)
-                # Record the timings
-                end_time = time.time()
-                run_time = end_time - start_time
-                self.block_times.append(run_time)
+                self.__process_block(block_selection)
+                # Wait for the next data block
+                block_index, block_selection = recv_request.wait()
+                send_request.wait()
 
         # Return the result
         return self.result, self.blocks
@@ -419,6 +667,133 @@ def gather(data, comm=None, root=0):
         return [data, ]
 
 
+def _get_array_layout(metadata):
+    """
+    Internal helper function used to determine the layout of the concatenation of the arrays of all ranks.
+
+    :param metadata: List with the (shape, dtype.str) tuple of the array of each rank
+
+    :return: Tuple of i) the numpy dtype, ii) the shape beyond the first axis, and iii) a list with the
+        length of the array of each rank along the first axis. Empty arrays are ignored for the dtype and shape.
+
+    :raises ValueError: If the arrays differ in their shape beyond the first axis or in their dtype.
+    """
+    non_empty = [(shape, dtype_str) for shape, dtype_str in metadata if int(np.prod(shape)) > 0]
+    if len(non_empty) == 0:
+        non_empty = metadata[0:1]
+    dtype = np.dtype(non_empty[0][1])
+    item_shape = tuple(non_empty[0][0][1:])
+    for shape, dtype_str in non_empty:
+        if tuple(shape[1:]) != item_shape or np.dtype(dtype_str) != dtype:
+            raise ValueError("The arrays of all ranks must have the same dtype and shape beyond the first axis.")
+    lengths = [int(shape[0]) if len(shape) > 0 else 0 for shape, _ in metadata]
+    return dtype, item_shape, lengths
+
+
+def gather_array(data, comm=None, root=0):
+    """
+    Typed MPI gather of numpy arrays along the first axis.
+
+    In contrast to gather(...), the arrays are not pickled. The ranks first announce the shape and dtype
+    of their arrays, the root preallocates the output array, and the data is then moved via Gatherv
+    directly into the output array. Arrays with a dtype without a corresponding MPI type (see
+    mpi_type_from_dtype), e.g., strings, are transferred as bytes. Ranks without data must provide an
+    empty array with the same shape along all but the first axis.
+
+    NOTE: MPI limits the number of elements received from each rank to the range of a 32bit int.
+
+    :param data: Numpy array with the data of the rank. Scalars are treated as arrays of length 1.
+    :param comm: MPI communicator. If None, then MPI.COMM_WORLD will be used.
+    :param root: The rank where the data should be collected to. Default value is 0
+
+    :return: Tuple of i) the numpy array with the data from all ranks concatenated in the order of
+        the ranks and ii) list with the length of the array of each rank along the first axis.
+        On all ranks other than the root, this is (None, None).
+
+    :raises ValueError: If the arrays of the ranks differ in their shape beyond the first axis or in their dtype.
+    """
+    data = np.ascontiguousarray(data)
+    if not MPI_AVAILABLE:
+        return data, [data.shape[0], ]
+    my_comm = comm if comm is not None else MPI.COMM_WORLD
+    rank = my_comm.Get_rank()
+    # Announce the shape and dtype of the data. All ranks validate the metadata to fail consistently.
+    metadata = my_comm.allgather((data.shape, data.dtype.str))
+    dtype, item_shape, lengths = _get_array_layout(metadata)
+    # Determine the MPI type and the number of elements of that type sent by each rank
+    mpi_type = mpi_type_from_dtype(dtype)
+    item_count = int(np.prod(item_shape))
+    if mpi_type is None:
+        mpi_type = MPI.BYTE
+        item_count *= dtype.itemsize
+    counts = [length * item_count for length in lengths]
+    sendbuf = [data if counts[rank] > 0 else np.zeros(0, dtype=dtype), counts[rank], mpi_type]
+    if rank == root:
+        gathered = np.empty(shape=(sum(lengths), ) + item_shape, dtype=dtype)
+        displacements = np.concatenate(([0], np.cumsum(counts)[:-1])).astype('int').tolist()
+        my_comm.Gatherv(sendbuf, [gathered, (counts, displacements), mpi_type], root=root)
+        return gathered, lengths
+    else:
+        my_comm.Gatherv(sendbuf, None, root=root)
+        return None, None
+
+
+def write_virtual_dataset(data, filename, dataset_name, comm=None, root=0):
+    """
+    Write the numpy arrays of all ranks to one HDF5 dataset without collecting the data on the root.
+
+    Each rank writes its array to its own HDF5 shard file (named <filename>_rank<rank>.<ext>, located
+    next to filename) and the root creates a virtual dataset in filename that concatenates the arrays of
+    all ranks along the first axis. Only the shapes of the arrays are communicated. The shard files must
+    be kept together with filename. Virtual datasets require HDF5 >=1.10 and h5py >=2.9.
+
+    :param data: Numpy array with the data of the rank
+    :param filename: Name of the HDF5 file where the virtual dataset should be created
+    :param dataset_name: Name of the dataset in filename and in the shard files. Existing datasets
+        with the same name are replaced.
+    :param comm: MPI communicator. If None, then MPI.COMM_WORLD will be used.
+    :param root: The rank where the virtual dataset should be created. Default value is 0
+
+    :return: List with the length of the array of each rank along the first axis.
+
+    :raises ValueError: If the arrays of the ranks differ in their shape beyond the first axis or in their dtype.
+    """
+    import h5py
+    data = np.ascontiguousarray(data)
+    my_comm = comm if comm is not None else get_comm_world()
+    rank = get_rank(comm=my_comm)
+    file_base, file_ext = os.path.splitext(filename)
+    shard_filenames = [file_base + '_rank' + str(shard_rank) + file_ext for shard_rank in range(get_size(my_comm))]
+    # Write the local data to the shard of the rank
+    shard_file = h5py.File(shard_filenames[rank], 'a')
+    if dataset_name in shard_file:
+        del shard_file[dataset_name]
+    shard_file.create_dataset(name=dataset_name, data=data)
+    shard_file.close()
+    # Announce the shape and dtype of the data. All ranks validate the metadata to fail consistently.
+    metadata = my_comm.allgather((data.shape, data.dtype.str)) if my_comm is not None \
+        else [(data.shape, data.dtype.str)]
+    dtype, item_shape, lengths = _get_array_layout(metadata)
+    # Create the virtual dataset referencing the shards of all ranks
+    if rank == root:
+        layout = h5py.VirtualLayout(shape=(sum(lengths), ) + item_shape, dtype=dtype)
+        offset = 0
+        for shard_filename, (shape, _), length in zip(shard_filenames, metadata, lengths):
+            if length > 0:
+                # Shard paths are stored relative to the virtual dataset so that the files can be moved together
+                layout[offset:(offset+length)] = h5py.VirtualSource(os.path.basename(shard_filename),
+                                                                    dataset_name,
+                                                                    shape=tuple(shape))
+            offset += length
+        output_file = h5py.File(filename, 'a')
+        if dataset_name in output_file:
+            del output_file[dataset_name]
+        output_file.create_virtual_dataset(dataset_name, layout)
+        output_file.close()
+    barrier(comm=my_comm)
+    return lengths
+
+
 def barrier(comm=None):
     """
     MPI barrier operation or no-op when running without MPI
@@ -473,6 +848,27 @@ def get_comm_world():
         return None
 
 
+def get_node_comm(comm=None):
+    """
+    Split the given communicator into one communicator per compute node, i.e., a communicator
+    with all ranks that share memory with the current rank.
+
+    :param comm: MPI communicator. If None, then MPI.COMM_WORLD will be used.
+    :return: mpi communicator with the ranks on the current node or None if MPI is not available
+    """
+    if MPI_AVAILABLE:
+        my_comm = comm if comm is not None else MPI.COMM_WORLD
+        try:
+            return my_comm.Split_type(MPI.COMM_TYPE_SHARED, key=my_comm.Get_rank())
+        except (AttributeError, NotImplementedError):
+            # MPI-2 implementations do not support Split_type so we group the ranks by hostname
+            hostnames = my_comm.allgather(MPI.Get_processor_name())
+            color = sorted(set(hostnames)).index(hostnames[my_comm.Get_rank()])
+            return my_comm.Split(color=color, key=my_comm.Get_rank())
+    else:
+        return None
+
+
 def is_mpi_available():
     """
     Check if MPI is available. Same as MPI_AVAILABLE
@@ -489,14 +885,11 @@ def mpi_type_from_dtype(dtype):
     :return: The MPI type or None if not found
     """
     if MPI_AVAILABLE:
-        try:
-            return MPI.__TypeDict__[dtype.char]
-        except AttributeError:  # Older versions of mpi4py use _typedict
-            return MPI._typedict[dtype.char]
-        except KeyError:
-            return None
-        except:
-            return None
+        # Older versions of mpi4py use __TypeDict__ and newer versions use _typedict
+        type_dict = getattr(MPI, '__TypeDict__', None)
+        if type_dict is None:
+            type_dict = getattr(MPI, '_typedict', {})
+        return type_dict.get(dtype.char, None)
     else:
         return None
 
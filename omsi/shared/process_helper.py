@@ -0,0 +1,346 @@
+"""
+Module used to parallelize the execution of a function over the blocks of a dataset using a
+pool of processes on a single node, e.g., on workstations where MPI is not available.
+
+The process pool is created via fork, i.e., the task function and its parameters are inherited by
+the worker processes and do not need to be pickled. Workers open HDF5 data read-only themselves
+and return large numpy arrays of the results through shared-memory (tmpfs) buffers rather than
+through pickled messages.
+"""
+import os
+import time
+import shutil
+import tempfile
+from multiprocessing import Pool, cpu_count
+import numpy as np
+
+from omsi.shared import mpi_helper
+
+BACKENDS = {'MPI': 'mpi',
+            'PROCESSES': 'processes',
+            'SERIAL': 'serial'}
+"""The parallel execution backends that analyses may select from"""
+
+SHARED_ARRAY_MIN_BYTES = 64 * 1024
+"""Numpy arrays in the results with at least this number of bytes are returned via shared memory"""
+
+_PROCESS_STATE = {}
+"""State of the current parallel_over_axes_processes run inherited by the worker processes"""
+
+
+class shared_array(object):
+    """
+    Reference to a numpy array stored by a worker process in a shared memory file.
+
+    :ivar filename: The name of the .npy file with the array
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        """
+        Map the array into memory and remove the file. The memory of the array is released
+        once the array is no longer referenced.
+
+        :return: Writable (copy-on-write) numpy memmap with the array
+        """
+        data = np.load(self.filename, mmap_mode='c')
+        os.remove(self.filename)
+        return data
+
+
+def share_arrays(result, directory, min_bytes=SHARED_ARRAY_MIN_BYTES):
+    """
+    Replace the large numpy arrays in the given result with shared_array references.
+
+    :param result: The result of a task function, e.g., a numpy array or a tuple or list of numpy arrays
+    :param directory: The directory where the arrays should be stored (ideally on a tmpfs, e.g., /dev/shm)
+    :param min_bytes: Minimum size of arrays in bytes to be stored in shared memory
+
+    :return: The result with the arrays replaced by shared_array objects
+    """
+    if isinstance(result, np.ndarray) and not isinstance(result, np.memmap) and \
+            result.nbytes >= min_bytes and not result.dtype.hasobject:
+        handle, filename = tempfile.mkstemp(suffix='.npy', dir=directory)
+        with os.fdopen(handle, 'wb') as outfile:
+            np.save(outfile, result)
+        return shared_array(filename)
+    elif isinstance(result, tuple):
+        return tuple(share_arrays(value, directory, min_bytes) for value in result)
+    elif isinstance(result, list):
+        return [share_arrays(value, directory, min_bytes) for value in result]
+    return result
+
+
+def load_shared_arrays(result):
+    """
+    Replace all shared_array references in the result with the corresponding numpy arrays.
+
+    :param result: The result with shared_array references as returned by share_arrays
+
+    :return: The result with the numpy arrays
+    """
+    if isinstance(result, shared_array):
+        return result.load()
+    elif isinstance(result, tuple):
+        return tuple(load_shared_arrays(value) for value in result)
+    elif isinstance(result, list):
+        return [load_shared_arrays(value) for value in result]
+    return result
+
+
+def _open_data_source(data_source):
+    """
+    Open the data described by get_data_source read-only in the current process.
+
+    :param data_source: Tuple of (filename, object path, is_omsi_object)
+
+    :return: h5py.Dataset or omsi_file API object with the data
+    """
+    import h5py
+    filename, object_path, is_omsi_object = data_source
+    h5py_object = h5py.File(filename, 'r')[object_path]
+    if is_omsi_object:
+        from omsi.dataformat.omsi_file.common import omsi_file_common
+        return omsi_file_common.get_omsi_object(h5py_object)
+    return h5py_object
+
+
+def get_data_source(data):
+    """
+    Get the description of the file-based data that worker processes should open themselves.
+
+    :param data: The data (e.g., h5py.Dataset, omsi_file_msidata, or numpy array)
+
+    :return: Tuple of (filename, object path, is_omsi_object) or None if the data is not stored in HDF5.
+    """
+    import h5py
+    if isinstance(data, h5py.Dataset):
+        data.file.flush()
+        return data.file.filename, data.name, False
+    managed_group = getattr(data, 'managed_group', None)
+    if isinstance(managed_group, h5py.Group):
+        managed_group.file.flush()
+        return managed_group.file.filename, managed_group.name, True
+    return None
+
+
+def _initialize_process():
+    """
+    Initialize a worker process of the process pool by opening the data read-only.
+
+    The file is usually still open for writing in the calling process, which has flushed the
+    data before creating the pool. HDF5 file locking (HDF5 >=1.10) is therefore disabled in
+    the worker processes unless HDF5_USE_FILE_LOCKING is set explicitly.
+    """
+    data_source = _PROCESS_STATE.get('data_source', None)
+    if data_source is not None:
+        os.environ.setdefault('HDF5_USE_FILE_LOCKING', 'FALSE')
+        _PROCESS_STATE['main_data'] = _open_data_source(data_source)
+
+
+def _execute_block(block_selection):
+    """
+    Execute the task function on a data block in a worker process of the process pool.
+
+    :param block_selection: The selection of the data block
+
+    :return: Tuple of the block selection, the result (with large arrays in shared memory), and the
+        time in seconds to process the block
+    """
+    start_time = time.time()
+    task_params = dict(_PROCESS_STATE['task_function_params'])
+    task_params[_PROCESS_STATE['main_data_param_name']] = _PROCESS_STATE['main_data'][block_selection]
+    result = _PROCESS_STATE['task_function'](**task_params)
+    result = share_arrays(result, _PROCESS_STATE['shared_directory'])
+    return block_selection, result, time.time() - start_time
+
+
+class parallel_over_axes_processes(mpi_helper.parallel_over_axes):
+    """
+    Helper class used to parallelize the execution of a function using a pool of processes by splitting
+    the input data into sub-blocks along a given set of axes.
+
+    The class supports the same SCHEDULES and provides the same interface as mpi_helper.parallel_over_axes.
+    For the static schedules the data is divided into one block per process (see get_static_nd_blocks)
+    and for DYNAMIC scheduling the blocks (see get_dynamic_blocks) are assigned to processes as they
+    become available. All results are available in the calling process, i.e., the calling process acts
+    as the root rank and collect_data is a no-op.
+
+    NOTE: The task function and its parameters are inherited by the worker processes via fork. If main_data
+    is a h5py.Dataset or omsi_file_msidata object, then the workers open the file read-only themselves.
+
+    :ivar num_processes: The number of worker processes
+
+    See mpi_helper.parallel_over_axes for a description of the other instance variables.
+    """
+    def __init__(self,
+                 task_function,
+                 task_function_params,
+                 main_data,
+                 split_axes,
+                 main_data_param_name,
+                 schedule=mpi_helper.parallel_over_axes.SCHEDULES['STATIC_1D'],
+                 num_processes=None,
+                 block_size=1,
+                 block_costs=None,
+                 checkpoint=None):
+        """
+
+        :param task_function: The function we should run.
+        :param task_function_params: Dict with the input parameters for the function.
+            may be None or {} if no parameters are needed.
+        :param main_data: Dataset over which we should parallelize
+        :param split_axes: List of integer axis indicies over which we should parallelize
+        :param main_data_param_name: The name of data input parameter of the task function
+        :param schedule: The task scheduling schema to be used (see parallel_over_axes.SCHEDULES)
+        :param num_processes: The number of worker processes. Default is None (or <1), in which
+            case one process per CPU is used.
+        :param block_size: The task granularity for DYNAMIC scheduling
+            (see mpi_helper.parallel_over_axes.__init__)
+        :param block_costs: The estimated cost of processing each element used by the static schedules
+            (see mpi_helper.parallel_over_axes.__init__)
+        :param checkpoint: Optional omsi.shared.checkpoint_helper.block_checkpoint object used to store and
+            reuse the results of completed blocks (see mpi_helper.parallel_over_axes.__init__). The results
+            are stored by the calling process.
+
+        """
+        self.task_function = task_function
+        self.schedule = schedule
+        self.split_axes = split_axes
+        if isinstance(self.split_axes, int):  # Make sure that split-axis is a list not just a single index
+            self.split_axes = [self.split_axes, ]
+        self.main_data = main_data
+        self.main_data_param_name = main_data_param_name
+        self.task_function_params = task_function_params
+        if self.task_function_params is None:
+            self.task_function_params = {}
+        self.root = 0
+        self.result = None
+        self.blocks = None
+        self.block_times = None
+        self.run_time = None
+        self.comm = None
+        self.block_size = block_size
+        self.root_computes = True
+        self.block_costs = block_costs
+        self.checkpoint = checkpoint
+        self.num_processes = num_processes if num_processes is not None and num_processes > 0 else cpu_count()
+
+    def run(self):
+        """
+        Call this function to run the function in parallel.
+
+        :return: Tuple with the following elements:
+
+            1) List with the results from the execution of the task_function. Each
+               entry is the result from one return of the task_function.
+            2) List of block_indexes. Each block_index is a tuple with the selection used to
+               divide the data into sub-blocks.
+
+        """
+        from omsi.shared.log import log_helper
+        start_time = time.time()
+        if self.schedule == self.SCHEDULES['DYNAMIC']:
+            block_tuples = self.get_dynamic_blocks()
+        elif self.schedule in [self.SCHEDULES['STATIC_1D'], self.SCHEDULES['STATIC'], self.SCHEDULES['STATIC_ND']]:
+            block_tuples = [block for block in self.get_static_nd_blocks(self.num_processes) if block is not None]
+        else:
+            log_helper.error(__name__, "Invalid scheduling scheme given: " + str(self.schedule))
+            raise ValueError("Invalid scheduling scheme given: " + str(self.schedule))
+
+        self.result = []
+        self.blocks = []
+        self.block_times = []
+        # Load the results of the blocks completed by a previous run from the checkpoint
+        if self.checkpoint is not None:
+            self.checkpoint.load_index(collective=False)
+            restored_blocks = [block for block in block_tuples if self.checkpoint.contains(block)]
+            block_tuples = [block for block in block_tuples if not self.checkpoint.contains(block)]
+            for block_selection in restored_blocks:
+                result, block_time = self.checkpoint.load(block_selection)
+                self.result.append(result)
+                self.blocks.append(block_selection)
+                self.block_times.append(block_time)
+            if len(restored_blocks) > 0:
+                log_helper.info(__name__, "RESTORED " + str(len(restored_blocks)) + " DATA BLOCKS FROM CHECKPOINT")
+        shared_directory = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        _PROCESS_STATE.clear()
+        _PROCESS_STATE.update({'task_function': self.task_function,
+                               'task_function_params': self.task_function_params,
+                               'main_data': self.main_data,
+                               'main_data_param_name': self.main_data_param_name,
+                               'data_source': get_data_source(self.main_data),
+                               'shared_directory': shared_directory})
+        log_helper.info(__name__, "PROCESSING " + str(len(block_tuples)) + " DATA BLOCKS USING " +
+                        str(self.num_processes) + " PROCESSES")
+        process_pool = Pool(min(self.num_processes, max(len(block_tuples), 1)), initializer=_initialize_process)
+        try:
+            for block_selection, result, block_time in process_pool.imap_unordered(_execute_block,
+                                                                                   block_tuples,
+                                                                                   chunksize=1):
+                self.result.append(load_shared_arrays(result))
+                self.blocks.append(block_selection)
+                self.block_times.append(block_time)
+                if self.checkpoint is not None:
+                    self.checkpoint.store(block_selection, self.result[-1], block_time)
+            process_pool.close()
+        finally:
+            process_pool.terminate()
+            _PROCESS_STATE.clear()
+            shutil.rmtree(shared_directory, ignore_errors=True)
+        self.run_time = time.time() - start_time
+        log_helper.info(__name__, "TIME FOR PROCESSING ALL DATA BLOCKS: " + str(self.run_time))
+        return self.result, self.blocks
+
+    def collect_data(self, force_collect=False, collect_results=True):
+        """
+        All results are already available in the calling process.
+
+        :return: Tuple of self.result and self.blocks
+        """
+        return self.result, self.blocks
+
+
+def use_parallel_backend(backend, num_processes=None, comm=None):
+    """
+    Check whether the given parallel backend should be used to execute an analysis.
+
+    :param backend: The parallel backend (see BACKENDS)
+    :param num_processes: The number of processes of the PROCESSES backend. None or <1 means one per CPU.
+    :param comm: The MPI communicator of the MPI backend
+
+    :return: True if the backend parallelizes the execution, i.e., if we use MPI with more than one rank
+        or more than one process, and False if the analysis should be executed in serial.
+
+    :raises ValueError: If an invalid backend is given
+    """
+    if backend == BACKENDS['MPI']:
+        return mpi_helper.get_size(comm=comm) > 1
+    elif backend == BACKENDS['PROCESSES']:
+        return num_processes is None or num_processes < 1 or num_processes > 1
+    elif backend == BACKENDS['SERIAL']:
+        return False
+    raise ValueError("Invalid parallel backend given: " + str(backend))
+
+
+def create_scheduler(backend, num_processes=None, root=0, comm=None, **kwargs):
+    """
+    Create the scheduler for executing a task function in parallel using the given backend.
+
+    :param backend: The parallel backend (see BACKENDS). Must be MPI or PROCESSES.
+    :param num_processes: The number of processes of the PROCESSES backend. None or <1 means one per CPU.
+    :param root: The root rank of the MPI backend
+    :param comm: The MPI communicator of the MPI backend
+    :param kwargs: Additional keyword arguments of the scheduler, i.e., task_function, task_function_params,
+        main_data, split_axes, main_data_param_name, schedule, block_size, block_costs, and checkpoint.
+
+    :return: mpi_helper.parallel_over_axes or parallel_over_axes_processes object
+
+    :raises ValueError: If an invalid backend is given
+    """
+    if backend == BACKENDS['MPI']:
+        return mpi_helper.parallel_over_axes(root=root, comm=comm, **kwargs)
+    elif backend == BACKENDS['PROCESSES']:
+        return parallel_over_axes_processes(num_processes=num_processes, **kwargs)
+    raise ValueError("Invalid parallel backend given: " + str(backend))
@@ -0,0 +1,187 @@
+"""
+Module with a vectorized kernel for re-gridding (reprofiling) batches of spectra with
+different m/z values onto a common m/z axis. The kernel is shared by the file readers
+(e.g., mzml_file, xmassmzml_file, and imzml_file) to convert spectra to a data cube.
+"""
+import numpy as np
+
+
+class spectrum_reprofiler(object):
+    """
+    Reprofile batches of ragged spectra onto a common m/z axis.
+
+    Two modes are supported:
+
+    * ``profile`` : Linearly interpolate the intensities onto the m/z axis. Intensities \
+      outside of the m/z range of a spectrum are set to 0. This is equivalent to \
+      ``np.interp(mz_axis, mz, intensity, 0, 0)`` for each spectrum.
+    * ``centroid`` : Sum the intensities of all peaks that fall into the bin of each m/z \
+      value. By default, the bins start at the values of the m/z axis and the last bin \
+      is extended by the mean m/z spacing. This is equivalent to \
+      ``np.histogram(mz, bins=bin_edges, weights=intensity)[0]`` for each spectrum.
+
+    All per-axis data (i.e., the bin edges) is computed once when the object is created. In centroid
+    mode, a batch of spectra is then processed at once using flat, concatenated arrays of the m/z and
+    intensity values of all spectra, i.e., a single searchsorted and bincount per batch rather than
+    one histogram per spectrum. In profile mode, the spectra of a batch are interpolated directly into
+    the preallocated output (see spectrum_reprofiler.__interpolate).
+
+    Example use::
+
+        reprofiler = spectrum_reprofiler(mz_axis=np.linspace(100, 1000, 10000), mode='profile')
+        block_size = reprofiler.get_block_size()
+        spectra = reprofiler.reprofile(mzs=[mz1, mz2, mz3], intensities=[int1, int2, int3])
+
+    :ivar mz_axis: 1D float64 numpy array with the sorted target m/z axis
+    :ivar mode: The reprofiling mode, one of spectrum_reprofiler.available_modes
+    :ivar bin_edges: 1D float64 numpy array with the mz_axis.size+1 bin edges used in centroid mode
+    """
+    available_modes = {'profile': 'profile',
+                       'centroid': 'centroid'}
+
+    def __init__(self, mz_axis, mode='profile', bin_edges=None):
+        """
+        Initialize the reprofiler for a given m/z axis.
+
+        :param mz_axis: 1D numpy array with the sorted target m/z axis
+        :param mode: One of 'profile' or 'centroid'. Default is 'profile'.
+        :param bin_edges: Optional 1D numpy array with the mz_axis.size+1 bin edges for centroid mode.
+            By default, the bin edges are the values of the m/z axis with an additional edge one
+            mean m/z spacing after the last value.
+        """
+        if mode not in self.available_modes:
+            raise ValueError('Unknown reprofiling mode ' + str(mode))
+        self.mz_axis = np.asarray(mz_axis, dtype='float64').reshape(-1)
+        self.mode = mode
+        self.bin_edges = None
+        if self.mode == self.available_modes['centroid']:
+            if bin_edges is not None:
+                self.bin_edges = np.asarray(bin_edges, dtype='float64').reshape(-1)
+            elif self.mz_axis.size > 1:
+                self.bin_edges = np.append(self.mz_axis, self.mz_axis[-1] + np.diff(self.mz_axis).mean())
+            elif self.mz_axis.size == 1:
+                self.bin_edges = np.append(self.mz_axis, self.mz_axis[-1] + 1.0)
+            else:
+                self.bin_edges = np.zeros(1, dtype='float64')
+            if self.bin_edges.size != self.mz_axis.size + 1:
+                raise ValueError('The number of bin edges must be the length of the m/z axis + 1')
+
+    def get_block_size(self, max_bytes=64*1024*1024):
+        """
+        Get the number of spectra that can be reprofiled at once using about max_bytes of memory.
+
+        :param max_bytes: The maximum number of bytes to be used
+
+        :returns: Integer with the number of spectra (at least 1)
+        """
+        # Centroid mode uses ~2 temporary 8 byte arrays of the size of the output
+        bytes_per_spectrum = self.mz_axis.size * (8 if self.mode == self.available_modes['profile'] else 16)
+        return max(int(max_bytes // max(bytes_per_spectrum, 1)), 1)
+
+    def reprofile_spectrum(self, mz, intensity):
+        """
+        Reprofile a single spectrum.
+
+        :param mz: 1D numpy array with the sorted m/z values of the spectrum
+        :param intensity: 1D numpy array with the intensity values of the spectrum
+
+        :returns: 1D float64 numpy array with mz_axis.size values
+        """
+        return self.reprofile(mzs=[mz], intensities=[intensity])[0]
+
+    def reprofile(self, mzs, intensities, out=None):
+        """
+        Reprofile a batch of spectra.
+
+        :param mzs: List of 1D numpy arrays with the sorted m/z values of each spectrum
+        :param intensities: List of 1D numpy arrays with the intensity values of each spectrum
+        :param out: Optional 2D numpy array of shape (len(mzs), mz_axis.size) for the result
+
+        :returns: 2D numpy array of shape (len(mzs), mz_axis.size). Unless out is given the array is float64.
+        """
+        if out is None:
+            out = np.zeros(shape=(len(mzs), self.mz_axis.size), dtype='float64')
+        if self.mode == self.available_modes['profile']:
+            return self.__interpolate(mzs, intensities, out)
+        spectrum_lengths = np.asarray([np.size(mz) for mz in mzs], dtype='int64')
+        if len(mzs) > 0:
+            flat_mz = np.concatenate([np.asarray(mz, dtype='float64').reshape(-1) for mz in mzs])
+            flat_intensity = np.concatenate([np.asarray(intensity, dtype='float64').reshape(-1)
+                                             for intensity in intensities])
+        else:
+            flat_mz = np.zeros(0, dtype='float64')
+            flat_intensity = np.zeros(0, dtype='float64')
+        return self.reprofile_flat(flat_mz=flat_mz,
+                                   flat_intensity=flat_intensity,
+                                   spectrum_lengths=spectrum_lengths,
+                                   out=out)
+
+    def reprofile_flat(self, flat_mz, flat_intensity, spectrum_lengths, out=None):
+        """
+        Reprofile a batch of spectra given as flat, concatenated arrays.
+
+        :param flat_mz: 1D numpy array with the concatenated m/z values of all spectra.
+            The m/z values of each spectrum must be sorted.
+        :param flat_intensity: 1D numpy array with the concatenated intensity values of all spectra
+        :param spectrum_lengths: 1D integer numpy array with the number of values of each spectrum
+        :param out: Optional 2D numpy array of shape (len(spectrum_lengths), mz_axis.size) for the result
+
+        :returns: 2D numpy array of shape (len(spectrum_lengths), mz_axis.size)
+        """
+        flat_mz = np.asarray(flat_mz, dtype='float64').reshape(-1)
+        flat_intensity = np.asarray(flat_intensity, dtype='float64').reshape(-1)
+        spectrum_lengths = np.asarray(spectrum_lengths, dtype='int64').reshape(-1)
+        num_spectra = spectrum_lengths.size
+        num_mz = self.mz_axis.size
+        if flat_mz.size != flat_intensity.size or flat_mz.size != spectrum_lengths.sum():
+            raise ValueError('The number of m/z and intensity values must match the spectrum lengths')
+        if self.mode == self.available_modes['profile']:
+            spectrum_ends = np.cumsum(spectrum_lengths)
+            spectrum_starts = spectrum_ends - spectrum_lengths
+            if out is None:
+                out = np.zeros(shape=(num_spectra, num_mz), dtype='float64')
+            return self.__interpolate(mzs=[flat_mz[start:end] for start, end in zip(spectrum_starts, spectrum_ends)],
+                                      intensities=[flat_intensity[start:end]
+                                                   for start, end in zip(spectrum_starts, spectrum_ends)],
+                                      out=out)
+        result = self.__histogram_flat(flat_mz, flat_intensity, spectrum_lengths)
+        if out is None:
+            return result
+        out[:] = result
+        return out
+
+    def __histogram_flat(self, flat_mz, flat_intensity, spectrum_lengths):
+        """
+        Private helper function used to compute the histograms of all spectra using a single bincount.
+
+        :returns: 2D float64 numpy array of shape (len(spectrum_lengths), mz_axis.size)
+        """
+        num_spectra = spectrum_lengths.size
+        num_mz = self.mz_axis.size
+        spectrum_ids = np.repeat(np.arange(num_spectra, dtype='int64'), spectrum_lengths)
+        bins = np.searchsorted(self.bin_edges, flat_mz, side='right') - 1
+        # Consistent with np.histogram the last bin includes its right edge
+        bins[flat_mz == self.bin_edges[-1]] = num_mz - 1
+        valid = (bins >= 0) & (bins < num_mz)
+        return np.bincount(spectrum_ids[valid] * num_mz + bins[valid],
+                           weights=flat_intensity[valid],
+                           minlength=num_spectra * num_mz).reshape((num_spectra, num_mz))
+
+    def __interpolate(self, mzs, intensities, out):
+        """
+        Private helper function used to linearly interpolate a batch of spectra into the rows of out.
+
+        np.interp is linear in the number of m/z values and peaks of a spectrum so that a loop over
+        the spectra that writes directly to the preallocated output is faster than a flat, vectorized
+        formulation (which requires a binary search for every value of the output).
+
+        :param mzs: List of 1D numpy arrays with the sorted m/z values of each spectrum
+        :param intensities: List of 1D numpy arrays with the intensity values of each spectrum
+        :param out: 2D numpy array of shape (len(mzs), mz_axis.size) for the result
+        """
+        for index in xrange(len(mzs)):
+            if np.size(mzs[index]) > 0:
+                out[index, :] = np.interp(self.mz_axis, mzs[index], intensities[index], 0, 0)
+            else:
+                out[index, :] = 0
+        return out
@@ -20,6 +20,7 @@ import getpass
 from omsi.dataformat import *
 from omsi.dataformat import omsi_file
 from omsi.dataformat import file_reader_base
+from omsi.dataformat.omsi_file.buffered_writer import omsi_buffered_writer
 from omsi.analysis.multivariate_stats.omsi_nmf import omsi_nmf
 from omsi.analysis.findpeaks.omsi_findpeaks_global import omsi_findpeaks_global
 from omsi.analysis.findpeaks.omsi_findpeaks_local import omsi_findpeaks_local
@@ -35,6 +36,8 @@ import numpy as np
 import math
 import h5py
 import time
+import multiprocessing
+import Queue
 
 # Imports for thumbnail image rendering
 try:
@@ -400,6 +403,9 @@ class ConvertSettings(object):
     io_option = "spectrum_to_image"
     # When using the spectrum_to_image io option, what is the maximum block of images we should load in Byte
     io_block_size_limit = 1024 * 1024 * 500  # 500 MB limit
+    # Number of reader processes used to read and reprofile the spectra of a file in parallel. The
+    # blocks are streamed to the main process which is the only process writing to the HDF5 file.
+    num_workers = 1
     format_option = None  # Define which file format reader should be used. None=determine automatically
     region_option = "split+merge"  # Define the region option to be used
     auto_chunk = True  # Automatically decide which chunking should be used
@@ -642,6 +648,17 @@ class ConvertSettings(object):
                 except:
                     log_helper.warning(__name__, "An error accured while parsing the --io-block-limit command.")
                     input_error = True
+            elif current_arg == "--num-workers":
+                start_index += 2
+                try:
+                    ConvertSettings.num_workers = int(argv[i + 1])
+                    if ConvertSettings.num_workers < 1:
+                        raise ValueError("The number of workers must be at least 1")
+                    log_helper.info(__name__, "Set number of reader processes to: " +
+                                    str(ConvertSettings.num_workers))
+                except:
+                    log_helper.warning(__name__, "An error accured while parsing the --num-workers command.")
+                    input_error = True
             elif current_arg == "--thumbnail":
                 start_index += 1
                 ConvertSettings.generate_thumbnail = True
@@ -918,6 +935,10 @@ class ConvertSettings(object):
         print "             complete a set of images and then write the block of images at once."
         print "--io-block-limit <MB>: When using spectrum-to-image io (default when using auto-chunking),"
         print "             what should the maximum block in MB that we load into memory. (Default=2000MB)"
+        print "--num-workers <n>: Number of reader processes used to read and reprofile the spectra of each"
+        print "             input file in parallel. The reader processes stream chunk-aligned blocks through"
+        print "             a bounded queue to the main process which writes all data to the HDF5 file."
+        print "             All blocks in flight are limited by --io-block-limit. (Default=1, i.e, serial)"
         print ""
         print "===DATABSE OPTIONS=== "
         print ""
@@ -1111,11 +1132,22 @@ class ConvertFiles(object):
             data = omsi_file.omsi_file_msidata(data_group=data_group,
                                                preload_mz=False,
                                                preload_xy_index=False)
-            ConvertFiles.write_data(input_file=input_file,
-                                    data=data,
-                                    data_io_option='spectrum',  # ConvertSettings.io_option,
-                                    chunk_shape=ConvertSettings.chunks,
-                                    write_progress=(ConvertSettings.job_id is None))
+            written_in_parallel = False
+            if ConvertSettings.num_workers > 1:
+                written_in_parallel = ConvertFiles.write_data_parallel(
+                    input_file=input_file,
+                    input_dataset=curr_dataset,
+                    data=data,
+                    num_workers=ConvertSettings.num_workers,
+                    chunk_shape=ConvertSettings.chunks,
+                    block_size_limit=ConvertSettings.io_block_size_limit,
+                    write_progress=(ConvertSettings.job_id is None))
+            if not written_in_parallel:
+                ConvertFiles.write_data(input_file=input_file,
+                                        data=data,
+                                        data_io_option='spectrum',  # ConvertSettings.io_option,
+                                        chunk_shape=ConvertSettings.chunks,
+                                        write_progress=(ConvertSettings.job_id is None))
             ConvertSettings.omsi_output_file.flush()
 
             # Generate any additional data copies if requested
@@ -1728,14 +1760,16 @@ class ConvertFiles(object):
         return spectrum_chunk, slice_chunk, balanced_chunk
 
     @staticmethod
-    def write_data(input_file, data, data_io_option="spectrum", chunk_shape=None, write_progress=True):
+    def write_data(input_file, data, data_io_option="spectrum", chunk_shape=None, write_progress=True,
+                   block_size_limit=None):
         """Helper function used to implement different data write options.
 
             :param input_file: The input data file
             :param data: The output dataset (either an h5py dataset or omsi_file_msidata object.
             :param data_io_option: String indicating the data write method to be used. One of:
 
-                * ``spectrum``: Write the data one spectrum at a time
+                * ``spectrum``: Write the data one spectrum at a time. For file readers the spectra \
+                  are collected in chunk-aligned tiles (see omsi_buffered_writer) which are written at once.
                 * ``all`` : Write the complete dataset at once.
                 * ``chunk`` : Write the data one chunk at a time.
 
@@ -1743,17 +1777,23 @@ class ConvertFiles(object):
                                 be written when a chunk-aligned write is requested.
             :param write_progress: Write progress in % to standard out while data is being written.
             :type write_progress: bool
+            :param block_size_limit: Maximum number of bytes of the tiles kept in memory when writing the
+                spectra of a file reader. Default is ConvertSettings.io_block_size_limit.
 
         """
         if data_io_option == "spectrum" or (data_io_option == "chunk" and (chunk_shape is None)):
             num_spectra = float(input_file.shape[0] * input_file.shape[1])
             if isinstance(input_file, file_reader_base.file_reader_base):
+                if block_size_limit is None:
+                    block_size_limit = ConvertSettings.io_block_size_limit
+                writer = omsi_buffered_writer(data=data,
+                                              chunk_shape=chunk_shape,
+                                              max_bytes=block_size_limit)
                 spectrum_index = 0
                 for spectrum in input_file.spectrum_iter():
-                    xindex = spectrum[0][0]
-                    yindex = spectrum[0][1]
-                    vals = spectrum[1]
-                    data[xindex, yindex, :] = vals
+                    writer.write_spectrum(xindex=spectrum[0][0],
+                                          yindex=spectrum[0][1],
+                                          values=spectrum[1])
                     spectrum_index += 1
                     if write_progress:
                         try:
@@ -1761,6 +1801,7 @@ class ConvertFiles(object):
                             sys.stdout.flush()
                         except ValueError:
                             write_progress = False
+                writer.close()
             else:
                 for xindex in xrange(0, input_file.shape[0]):
                     if write_progress:
@@ -1835,6 +1876,147 @@ class ConvertFiles(object):
                             sys.stdout.write("[" + str(int(100. * float(itertest) / float(num_chunks))) + "%]" + "\r")
                             sys.stdout.flush()
 
+    @staticmethod
+    def plan_tiles(shape, chunk_shape, itemsize, max_tile_bytes):
+        """
+        Helper function used to split the x/y domain of a dataset into chunk-aligned tiles.
+
+        Each tile covers one x-row of chunks and as many complete y-chunks as fit into max_tile_bytes
+        (but at least one chunk), and always spans the full m/z axis.
+
+        :param shape: The 3D shape of the dataset
+        :param chunk_shape: The chunking of the output dataset. If None then tiles of single x-rows are used.
+        :param itemsize: Number of bytes per data value
+        :param max_tile_bytes: Maximum number of bytes per tile
+
+        :returns: List of (xstart, xend, ystart, yend) tuples
+        """
+        xdim, ydim, zdim = shape[0], shape[1], shape[2]
+        tile_x = min(chunk_shape[0], xdim) if chunk_shape is not None else 1
+        chunk_y = min(chunk_shape[1], ydim) if chunk_shape is not None else 1
+        bytes_per_y_chunk = max(tile_x * chunk_y * zdim * itemsize, 1)
+        num_y_chunks = max(int(max_tile_bytes // bytes_per_y_chunk), 1)
+        tile_y = min(num_y_chunks * chunk_y, ydim)
+        return [(xstart, min(xstart + tile_x, xdim), ystart, min(ystart + tile_y, ydim))
+                for xstart in xrange(0, xdim, tile_x)
+                for ystart in xrange(0, ydim, tile_y)]
+
+    @staticmethod
+    def read_tiles(input_dataset, tiles, tile_queue):
+        """
+        Reader process used by write_data_parallel to read a list of tiles and put them on the queue.
+
+        The process opens its own instance of the file reader, reads (and thereby reprofiles) the data
+        of the given tiles, and puts ('tile', xstart, xend, ystart, yend, data) messages on the queue.
+        When all tiles are read a ('done', ) message is sent. Errors are reported via ('error', message).
+
+        :param input_dataset: Dict describing the input dataset (see ConvertSettings.dataset_list)
+        :param tiles: List of (xstart, xend, ystart, yend) tuples of the tiles to be read
+        :param tile_queue: The multiprocessing.Queue for the tiles
+        """
+        try:
+            input_file = ConvertSettings.available_formats[input_dataset['format']](
+                basename=input_dataset['basename'],
+                requires_slicing=False)
+            if input_file.supports_regions():
+                input_file.set_region_selection(region_index=input_dataset.get('region', None))
+            if input_file.supports_multidata():
+                input_file.set_dataset_selection(dataset_index=input_dataset.get('dataset', None))
+            for xstart, xend, ystart, yend in tiles:
+                tile_queue.put(('tile', xstart, xend, ystart, yend,
+                                np.asarray(input_file[xstart:xend, ystart:yend, :], dtype=input_file.data_type)))
+            input_file.close_file()
+            tile_queue.put(('done', ))
+        except:
+            tile_queue.put(('error', unicode(sys.exc_info()[0]) + u": " + unicode(sys.exc_info()[1])))
+
+    @staticmethod
+    def write_data_parallel(input_file, input_dataset, data, num_workers, chunk_shape,
+                            block_size_limit=None, write_progress=True):
+        """
+        Pipelined version of write_data for file readers using multiple reader processes.
+
+        The x/y domain is split into chunk-aligned tiles (see plan_tiles) that are distributed round-robin
+        to num_workers reader processes. Each reader process opens its own instance of the file reader
+        and streams the tiles through a bounded queue to the calling process, which is the only process
+        writing to the HDF5 file. The queue size and tile size are chosen such that the tiles in flight
+        use at most about block_size_limit bytes of memory.
+
+        :param input_file: The open input file reader. Used to determine the shape and data type
+            of the data and to check whether the reader supports slicing.
+        :param input_dataset: Dict describing the input dataset (see ConvertSettings.dataset_list) with
+            the 'basename', 'format', 'region', and 'dataset' keys used by the reader processes to open the file.
+        :param data: The output dataset (either an h5py dataset or omsi_file_msidata object).
+        :param num_workers: Number of reader processes to be used.
+        :param chunk_shape: The chunking used by the data. Used to align the tiles with the chunks.
+        :param block_size_limit: Maximum number of bytes for all tiles in flight.
+            Default is ConvertSettings.io_block_size_limit.
+        :param write_progress: Write progress in % to standard out while data is being written.
+        :type write_progress: bool
+
+        :returns: Boolean indicating whether the data has been written. False in case that the file reader does
+            not support slicing without reading all data into memory, in which case nothing has been written.
+
+        :raises ValueError: If a reader process fails.
+        """
+        if input_dataset.get('format', None) is None:
+            return False
+        try:
+            input_file[0:1, 0:1, :]
+        except (NotImplementedError, ValueError):
+            log_helper.info(__name__, "The file reader does not support slicing. Using serial spectrum I/O.")
+            return False
+
+        if block_size_limit is None:
+            block_size_limit = ConvertSettings.io_block_size_limit
+        queue_size = 2 * num_workers
+        itemsize = np.dtype(input_file.data_type).itemsize
+        tiles = ConvertFiles.plan_tiles(shape=input_file.shape,
+                                        chunk_shape=chunk_shape,
+                                        itemsize=itemsize,
+                                        max_tile_bytes=block_size_limit / (queue_size + num_workers))
+        num_workers = max(min(num_workers, len(tiles)), 1)
+        log_helper.info(__name__, "Pipelined I/O using " + str(num_workers) + " reader processes and " +
+                        str(len(tiles)) + " tiles")
+
+        tile_queue = multiprocessing.Queue(maxsize=queue_size)
+        workers = [multiprocessing.Process(target=ConvertFiles.read_tiles,
+                                           args=(input_dataset, tiles[worker_index::num_workers], tile_queue))
+                   for worker_index in xrange(num_workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        num_done = 0
+        num_written = 0
+        try:
+            while num_done < num_workers:
+                try:
+                    message = tile_queue.get(timeout=1)
+                except Queue.Empty:
+                    if len([worker for worker in workers if worker.exitcode not in (None, 0)]) > 0:
+                        raise ValueError("A reader process terminated unexpectedly.")
+                    continue
+                if message[0] == 'tile':
+                    xstart, xend, ystart, yend, tile_data = message[1:]
+                    data[xstart:xend, ystart:yend, :] = tile_data
+                    num_written += 1
+                    if write_progress:
+                        try:
+                            sys.stdout.write("[" + str(int(100. * num_written / float(len(tiles)))) + "%]" + "\r")
+                            sys.stdout.flush()
+                        except ValueError:
+                            write_progress = False
+                elif message[0] == 'done':
+                    num_done += 1
+                else:
+                    raise ValueError("A reader process failed: " + message[1])
+        finally:
+            for worker in workers:
+                if worker.is_alive() and num_done < num_workers:
+                    worker.terminate()
+                worker.join()
+        return True
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,265 @@
+"""
+Module for checkpointing the execution of workflows.
+
+A workflow checkpoint is an OMSI file to which workflow executors save each analysis as soon as it has been
+completed, together with a workflow state record describing the state of all analyses of the workflow. When
+the workflow is executed again with the same checkpoint file, the analyses completed by the previous run are
+restored from the file and the execution resumes with the first incomplete analysis.
+
+Analyses are identified by the key of the content-addressed result cache (see omsi.analysis.result_cache), i.e.,
+an analysis is restored only if its class, code, and inputs are unchanged.
+
+In addition, analyses that parallelize their execution via mpi_helper.parallel_over_axes checkpoint their
+completed data blocks (see omsi.shared.checkpoint_helper) in a directory next to the checkpoint file, so that
+an analysis that was interrupted does not need to process the blocks it already completed again.
+"""
+import os
+import json
+import time
+import shutil
+
+import h5py
+
+import omsi.shared.mpi_helper as mpi_helper
+from omsi.shared.log import log_helper
+
+
+class workflow_checkpoint(object):
+    """
+    Checkpoint of the execution of a workflow stored in an OMSI file.
+
+    :ivar filename: The name of the OMSI file with the checkpoint
+    :ivar block_checkpoints: Boolean indicating whether the data blocks of analyses should be checkpointed
+    :ivar comm: The MPI communicator of the workflow executor
+    :ivar root: The MPI root rank of the workflow executor. Only the root writes to the checkpoint file.
+    :ivar omsi_object: The omsi_file opened for writing (only on the root)
+    :ivar experiment: The omsi_file_experiment where analyses are saved (only on the root)
+    :ivar keys: List with the cache key of each analysis of the workflow
+    :ivar state: Dict with the workflow state record with a list of dicts describing each analysis of the
+        workflow (i.e., 'analysis', 'analysis_type', 'cache_key', 'status', and 'group') and the time of the
+        last update
+    :ivar restored_nodes: List with the indices of the analyses restored from the checkpoint
+    :ivar analyses: The list of analyses of the workflow. Links from the analyses to the checkpoint file are
+        removed when the checkpoint is closed.
+
+    :cvar STATE_DATASET: Name of the dataset in the experiment group with the workflow state record
+    :cvar NODE_STATES: Possible states of analyses in the workflow state record
+    """
+    STATE_DATASET = 'workflow_state'
+    NODE_STATES = {'PENDING': 'pending',
+                   'COMPLETED': 'completed'}
+
+    def __init__(self, filename, block_checkpoints=True, comm=None, root=0):
+        """
+        Initialize the checkpoint
+
+        :param filename: The name of the OMSI file with the checkpoint. The file is created if necessary.
+        :param block_checkpoints: Boolean indicating whether the data blocks of analyses should be checkpointed
+        :param comm: The MPI communicator of the workflow executor
+        :param root: The MPI root rank of the workflow executor
+        """
+        self.filename = filename
+        self.block_checkpoints = block_checkpoints
+        self.comm = comm
+        self.root = root
+        self.omsi_object = None
+        self.experiment = None
+        self.keys = []
+        self.state = None
+        self.restored_nodes = []
+        self.analyses = []
+
+    def is_root(self):
+        """
+        Check whether we are the MPI root of the checkpoint.
+
+        :return: Boolean
+        """
+        return mpi_helper.get_rank(comm=self.comm) == self.root
+
+    def get_block_directory(self, key):
+        """
+        Get the directory used to checkpoint the data blocks of the analysis with the given key.
+
+        :param key: The cache key of the analysis
+
+        :return: String with the name of the directory
+        """
+        return os.path.join(os.path.abspath(self.filename) + '_blocks', key)
+
+    def read_state(self):
+        """
+        Read the workflow state record from the checkpoint file. The record is read on the root and
+        broadcast to all ranks.
+
+        :return: Dict with the workflow state record or None if the file or record does not exist
+        """
+        state = None
+        if self.is_root() and os.path.exists(self.filename):
+            with h5py.File(self.filename, 'r') as checkpoint_file:
+                for group in checkpoint_file.values():
+                    if isinstance(group, h5py.Group) and self.STATE_DATASET in group:
+                        state = json.loads(str(group[self.STATE_DATASET][()]))
+                        break
+        if mpi_helper.get_size(comm=self.comm) > 1:
+            state = mpi_helper.broadcast(state, comm=self.comm, root=self.root)
+        return state
+
+    def write_state(self):
+        """
+        Write the workflow state record to the checkpoint file (only on the root).
+        """
+        if not self.is_root():
+            return
+        self.state['updated'] = time.ctime()
+        experiment_group = self.experiment.managed_group
+        if self.STATE_DATASET in experiment_group:
+            del experiment_group[self.STATE_DATASET]
+        experiment_group[self.STATE_DATASET] = json.dumps(self.state)
+        experiment_group.file.flush()
+
+    def open(self, analyses):
+        """
+        Open the checkpoint for the given workflow and restore all analyses completed by a previous run.
+        Must be called by all ranks of the communicator.
+
+        :param analyses: The list of analyses of the workflow (e.g., workflow_executor_base.get_analyses())
+
+        :return: List with the indices of the analyses restored from the checkpoint
+        """
+        from omsi.analysis.result_cache import analysis_result_cache
+        from omsi.dataformat.omsi_file.main_file import omsi_file
+        from omsi.dataformat.omsi_file.analysis import omsi_file_analysis
+        self.analyses = list(analyses)
+        # Compute the keys of all analyses on the root
+        keys = None
+        if self.is_root():
+            result_cache = analysis_result_cache()
+            keys = [result_cache.get_key(analysis) for analysis in analyses]
+        if mpi_helper.get_size(comm=self.comm) > 1:
+            keys = mpi_helper.broadcast(keys, comm=self.comm, root=self.root)
+        self.keys = keys
+
+        # Restore all analyses completed by a previous run
+        prior_state = self.read_state()
+        completed = {}
+        if prior_state is not None:
+            completed = dict((node['cache_key'], node['group']) for node in prior_state['nodes']
+                             if node['status'] == self.NODE_STATES['COMPLETED'])
+        self.restored_nodes = []
+        checkpointed_nodes = [node_index for node_index in range(len(analyses)) if self.keys[node_index] in completed]
+        for node_index in checkpointed_nodes:
+            analysis = analyses[node_index]
+            if analysis.update_analysis:
+                analysis_result_cache.load_outputs(analysis, self.filename, completed[self.keys[node_index]])
+                analysis.update_analysis = False
+                if analysis.run_info is not None:
+                    analysis.run_info.clear()
+                    analysis.run_info[analysis_result_cache.CACHE_KEY] = unicode(self.keys[node_index])
+                    analysis.run_info['checkpoint_source'] = unicode(self.filename + ':' +
+                                                                     completed[self.keys[node_index]])
+                self.restored_nodes.append(node_index)
+        incomplete_nodes = [node_index for node_index, analysis in enumerate(analyses) if analysis.update_analysis]
+        if prior_state is not None:
+            log_helper.info(__name__, "Restored " + str(len(self.restored_nodes)) + " analyses from " +
+                            self.filename + ". Resuming the workflow at " +
+                            (str(analyses[incomplete_nodes[0]]) if len(incomplete_nodes) > 0 else "the end"),
+                            root=self.root, comm=self.comm)
+
+        # Open the checkpoint file for writing and record the state of the workflow
+        if self.is_root():
+            self.omsi_object = omsi_file(self.filename, 'a')
+            self.experiment = None
+            for exp_index in range(self.omsi_object.get_num_experiments()):
+                experiment = self.omsi_object.get_experiment(exp_index)
+                if self.STATE_DATASET in experiment.managed_group:
+                    self.experiment = experiment
+                    break
+            if self.experiment is None:
+                self.experiment = self.omsi_object.create_experiment(exp_identifier='workflow_checkpoint')
+            # Link the restored analyses to the checkpoint file so that they are not saved again
+            for node_index in self.restored_nodes:
+                group_path = completed[self.keys[node_index]]
+                analyses[node_index].omsi_analysis_storage.append(
+                    omsi_file_analysis(self.omsi_object.managed_group[group_path]))
+        self.state = {'nodes': [{'analysis': unicode(analysis),
+                                 'analysis_type': unicode(analysis.get_analysis_type()),
+                                 'cache_key': self.keys[node_index],
+                                 'status': self.NODE_STATES['COMPLETED'] if node_index in checkpointed_nodes
+                                 else self.NODE_STATES['PENDING'],
+                                 'group': completed[self.keys[node_index]] if node_index in checkpointed_nodes
+                                 else None}
+                                for node_index, analysis in enumerate(analyses)]}
+        self.write_state()
+        # Save analyses that have been completed before but that are not part of the checkpoint yet
+        for node_index, analysis in enumerate(analyses):
+            if not analysis.update_analysis and node_index not in checkpointed_nodes:
+                self.store(node_index, analysis)
+
+        # Checkpoint the data blocks of all incomplete analyses
+        if self.block_checkpoints:
+            for node_index in incomplete_nodes:
+                analyses[node_index].block_checkpoint_directory = self.get_block_directory(self.keys[node_index])
+        return self.restored_nodes
+
+    def store(self, node_index, analysis):
+        """
+        Save the completed analysis to the checkpoint file and update the workflow state record.
+        Must be called by all ranks of the communicator.
+
+        :param node_index: The index of the analysis in the workflow
+        :param analysis: The completed analysis
+        """
+        from omsi.analysis.result_cache import analysis_result_cache
+        from omsi.dataformat.omsi_file.analysis import omsi_analysis_manager
+        if self.state['nodes'][node_index]['status'] == self.NODE_STATES['COMPLETED']:
+            return
+        start_time = time.time()
+        if analysis.run_info is not None:
+            analysis.run_info[analysis_result_cache.CACHE_KEY] = unicode(self.keys[node_index])
+        saved_analysis = omsi_analysis_manager.create_analysis_static(
+            analysis_parent=self.experiment.managed_group if self.is_root() else None,
+            analysis=analysis,
+            flush_io=True,
+            force_save=False,
+            save_unsaved_dependencies=True,
+            mpi_root=self.root,
+            mpi_comm=self.comm)
+        self.state['nodes'][node_index]['status'] = self.NODE_STATES['COMPLETED']
+        if self.is_root():
+            self.state['nodes'][node_index]['group'] = saved_analysis[0].managed_group.name
+            self.write_state()
+            # The data blocks are no longer needed once the analysis has been saved
+            if analysis.block_checkpoint_directory is not None:
+                shutil.rmtree(analysis.block_checkpoint_directory, ignore_errors=True)
+        analysis.block_checkpoint_directory = None
+        log_helper.debug(__name__, "Saved " + str(analysis) + " to the checkpoint in " +
+                         str(time.time() - start_time) + "s", root=self.root, comm=self.comm)
+
+    def is_checkpoint_storage(self, analysis_storage):
+        """
+        Check whether the given analysis storage is located in the checkpoint file.
+
+        :param analysis_storage: The omsi_file_analysis object from the omsi_analysis_storage of an analysis
+
+        :return: Boolean
+        """
+        try:
+            return os.path.abspath(analysis_storage.managed_group.file.filename) == os.path.abspath(self.filename)
+        except (ValueError, RuntimeError):
+            # The file of the storage has been closed
+            return False
+
+    def close(self):
+        """
+        Close the checkpoint file. The links from the analyses to the checkpoint file (i.e., their
+        omsi_analysis_storage entries in the file) are removed as they become invalid when the file is closed.
+        """
+        for analysis in self.analyses:
+            analysis.omsi_analysis_storage = [analysis_storage for analysis_storage in analysis.omsi_analysis_storage
+                                              if not self.is_checkpoint_storage(analysis_storage)]
+        self.analyses = []
+        if self.omsi_object is not None:
+            self.omsi_object.close_file()
+        self.omsi_object = None
+        self.experiment = None
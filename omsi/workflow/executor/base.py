@@ -22,6 +22,10 @@ class workflow_executor_base(parameter_manager):
 
     :ivar analysis_objects: Private set of analysis objects to be executed
     :type analysis_objects: analysis_task_list
+    :ivar dependency_graph: List with the sorted list of indices of the predecessors of each analysis
+        (see build_dependency_graph)
+    :ivar checkpoint: The omsi.workflow.checkpoint.workflow_checkpoint used to save completed analyses if the
+        checkpoint_file parameter is set (see open_checkpoint)
 
     :cvar DEFAULT_EXECUTOR_CLASS: Define the derived workflow_executor_base class to be used as default executor
         The default value is None, in which case the greedy_workflow_executor is used. This variable is used
@@ -123,6 +127,8 @@ class workflow_executor_base(parameter_manager):
         self.mpi_comm = mpi_helper.get_comm_world()
         self.mpi_root = 0
         self.workflow_identifier = "we"
+        self.dependency_graph = []
+        self.checkpoint = None
         # self.parameters = []  # Inherited from parameter_manager and set in parent class
 
         dtypes = data_dtypes.get_dtypes()
@@ -136,6 +142,19 @@ class workflow_executor_base(parameter_manager):
                            required=False,
                            default=False,
                            dtype=dtypes['bool'])
+        self.add_parameter(name='checkpoint_file',
+                           help='OMSI file used to checkpoint the workflow. Completed analyses are saved to the ' +
+                                'file and restored from the file when the workflow is executed again.',
+                           required=False,
+                           default=None,
+                           dtype=dtypes['unicode'])
+        self.add_parameter(name='checkpoint_blocks',
+                           help='Checkpoint the completed data blocks of analyses that are executed in parallel ' +
+                                'so that interrupted analyses do not process them again. Used only if a ' +
+                                'checkpoint_file is given.',
+                           required=False,
+                           default=True,
+                           dtype=dtypes['bool'])
 
     def __call__(self):
         """
@@ -191,7 +210,16 @@ class workflow_executor_base(parameter_manager):
         Execute the workflow. This uses the main() function to run the actual workflow.
         """
         log_helper.debug(__name__, "Execute", root=self.mpi_root, comm=self.mpi_comm)
-        result = self.run_info(self.main)()
+        try:
+            result = self.run_info(self.main)()
+        finally:
+            self.close_checkpoint()
+        # Record how many analyses reused outputs from the result cache
+        cache_hits = [analysis.run_info['cache_hit'] for analysis in self.get_analyses()
+                      if analysis.run_info is not None and 'cache_hit' in analysis.run_info]
+        if len(cache_hits) > 0:
+            self.run_info['cache_hits'] = sum(cache_hits)
+            self.run_info['cache_misses'] = len(cache_hits) - sum(cache_hits)
         try:
             log_helper.debug(__name__, 'Execution time: ' + str(self.run_info['execution_time']) + "s",
                              root=self.mpi_root, comm=self.mpi_comm)
@@ -254,6 +282,90 @@ class workflow_executor_base(parameter_manager):
         """
         return self.analysis_tasks.add_analysis_dependencies()
 
+    def build_dependency_graph(self):
+        """
+        Compute the dependency graph of all analyses of the workflow from the dependency_dict links
+        of the analyses. Dependencies on file-based data are ignored.
+
+        :return: List with the sorted list of indices of the predecessors of each analysis. The list is
+            also stored in self.dependency_graph
+        """
+        all_analyses = self.get_analyses()
+        node_indices = dict((id(analysis), node_index) for node_index, analysis in enumerate(all_analyses))
+        self.dependency_graph = []
+        for analysis in all_analyses:
+            predecessors = set()
+            for dependency_param in analysis.get_all_dependency_data():
+                dependency_object = dependency_param['data']['omsi_object']
+                if id(dependency_object) in node_indices:
+                    predecessors.add(node_indices[id(dependency_object)])
+            self.dependency_graph.append(sorted(predecessors))
+        return self.dependency_graph
+
+    def release_intermediate_outputs(self, released):
+        """
+        Push the outputs of completed analyses to file (see analysis_base.clear_and_restore) once all analyses
+        that depend on them have completed. The outputs of analyses that no other analysis of the workflow
+        depends on are kept in memory. Requires that the dependency graph has been computed.
+
+        :param released: Set of indices of analyses whose outputs have been released. Updated in place.
+
+        :return: List of indices of the analyses whose outputs have been released by this call
+        """
+        all_analyses = self.get_analyses()
+        consumers = [[] for _ in self.dependency_graph]
+        for node_index, predecessors in enumerate(self.dependency_graph):
+            for pred in predecessors:
+                consumers[pred].append(node_index)
+        released_now = []
+        for node_index, analysis in enumerate(all_analyses):
+            if node_index in released or analysis.update_analysis or len(consumers[node_index]) == 0:
+                continue
+            if not any(all_analyses[consumer].update_analysis for consumer in consumers[node_index]):
+                log_helper.debug(__name__, "Releasing outputs of " + str(analysis),
+                                 root=self.mpi_root, comm=self.mpi_comm)
+                analysis.clear_and_restore()
+                released.add(node_index)
+                released_now.append(node_index)
+        return released_now
+
+    def open_checkpoint(self):
+        """
+        Open the checkpoint of the workflow if the checkpoint_file parameter is set and restore all
+        analyses completed by a previous run. Executors call this function after all dependencies
+        have been added to the workflow and before any analyses are executed.
+
+        :return: List with the indices of the analyses restored from the checkpoint
+        """
+        self.close_checkpoint()
+        if self['checkpoint_file'] is None:
+            return []
+        from omsi.workflow.checkpoint import workflow_checkpoint
+        self.checkpoint = workflow_checkpoint(filename=self['checkpoint_file'],
+                                              block_checkpoints=self['checkpoint_blocks'],
+                                              comm=self.mpi_comm,
+                                              root=self.mpi_root)
+        restored_nodes = self.checkpoint.open(self.get_analyses())
+        self.run_info['checkpoint_restored'] = len(restored_nodes)
+        return restored_nodes
+
+    def checkpoint_analysis(self, node_index):
+        """
+        Save the completed analysis with the given index to the checkpoint (if a checkpoint is used).
+
+        :param node_index: Index of the analysis in the workflow
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.store(node_index, self.get_analyses()[node_index])
+
+    def close_checkpoint(self):
+        """
+        Close the checkpoint of the workflow (if a checkpoint is used).
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+        self.checkpoint = None
+
     def get_analyses(self):
         """
         Get the list of analyses to be run.
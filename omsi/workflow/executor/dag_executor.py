@@ -0,0 +1,450 @@
+"""
+Module used to execute analysis workflows based on their dependency graph.
+
+The dependency graph (a directed acyclic graph (DAG) of the analyses) is computed once from the dependency_dict
+links of the analyses, and each analysis is executed as soon as all of its predecessors in the graph are
+complete. Analyses that are ready at the same time are executed concurrently, either in a pool of forked
+processes on a single node or on disjoint MPI sub-communicators.
+"""
+import os
+import time
+import shutil
+import tempfile
+import traceback
+import cPickle as pickle
+from Queue import Empty
+from multiprocessing import Process, Queue, cpu_count
+
+from omsi.workflow.executor.base import workflow_executor_base
+from omsi.shared.log import log_helper
+from omsi.datastructures.analysis_data import data_dtypes
+import omsi.shared.mpi_helper as mpi_helper
+import omsi.shared.process_helper as process_helper
+from omsi.workflow.memory_model import analysis_memory_model, get_input_size
+
+
+def _execute_node_process(node_index, analysis, result_queue, shared_directory):
+    """
+    Execute an analysis in a forked worker process and send the outputs to the calling process.
+
+    The worker inherits the analysis and the in-memory outputs of all completed analyses from the calling
+    process, i.e., inputs do not need to be pickled or stored to file. Large numpy arrays of the
+    outputs are returned via shared memory files (see omsi.shared.process_helper.share_arrays).
+
+    :param node_index: Index of the analysis in the workflow
+    :param analysis: The analysis object to be executed
+    :param result_queue: multiprocessing.Queue used to send the result
+    :param shared_directory: The directory for storing large output arrays
+
+    :return: Puts a tuple of (node_index, status, message, node_time) on the result_queue. The status is
+        either 'completed' (message is the pickled tuple of data_names, outputs, and run_info),
+        'unpicklable' (the outputs cannot be sent to the calling process), or 'failed' (message
+        is the traceback of the error).
+    """
+    start_time = time.time()
+    try:
+        analysis.execute()
+    except Exception:
+        result_queue.put((node_index, 'failed', traceback.format_exc(), time.time() - start_time))
+        return
+    node_time = time.time() - start_time
+    try:
+        outputs = [(ana_data['name'], ana_data['data']) for ana_data in analysis.get_all_analysis_data()]
+        message = pickle.dumps((list(analysis.data_names),
+                                process_helper.share_arrays(outputs, shared_directory),
+                                dict(analysis.run_info)),
+                               pickle.HIGHEST_PROTOCOL)
+        result_queue.put((node_index, 'completed', message, node_time))
+    except Exception:
+        result_queue.put((node_index, 'unpicklable', traceback.format_exc(), node_time))
+
+
+class dag_executor(workflow_executor_base):
+    """
+    Execute a set of analysis objects and their dependencies based on the dependency graph of the analyses
+
+    :ivar run_info: The runtime information dictionary for the overall workflow. In addition to the standard
+        data, the executor records the names of the analyses ('dag_nodes'), the wall time of each analysis
+        in seconds ('dag_node_times'), the indices of the analyses on the critical path ('dag_critical_path'),
+        and the total time of the critical path ('dag_critical_path_time').
+    :ivar mpi_comm: The MPI communicator to be used when running in parallel
+    :ivar mpi_root: The MPI root rank when running in parallel
+    :ivar dependency_graph: List with the sorted list of indices of the predecessors of each analysis
+    :ivar node_times: List with the wall time in seconds of each analysis (None if it was not executed)
+    :ivar input_sizes: List with the size in bytes of the inputs of each analysis (None if it was not executed)
+    :ivar released_nodes: Set with the indices of the analyses whose outputs have been pushed to file
+    :ivar memory_model: The omsi.workflow.memory_model.analysis_memory_model used to predict the peak memory
+        usage of analyses. The model learns from all analyses executed by the executor. Use
+        memory_model.add_history(...) to add the runtime information of analyses stored in OMSI files.
+
+    Additional parameters:
+
+    :param reduce_memory_usage: Boolean indicating whether we should reduce memory usage by pushing analysis
+        data to file once all analyses that depend on it have been completed. This reduces the amount of data
+        we keep in memory but results in additional overhead for I/O and temporary disk storage.
+    :param backend: The parallel backend used to execute independent analyses concurrently:
+        'mpi' executes the analyses that are ready on disjoint sub-communicators of mpi_comm,
+        'processes' executes the analyses in forked processes, and 'serial' executes one analysis at a time.
+    :param num_processes: The maximum number of analyses executed concurrently by the processes backend.
+    :param memory_budget: The memory in GB available to the analyses executed concurrently by the processes
+        backend. An analysis is started only if the sum of the predicted peak memory usage of all running
+        analyses stays within the budget. Analyses without a prediction only run if no other analysis is running.
+
+    """
+    def __init__(self, analysis_objects=None):
+        """
+        Initalize the workflow driver
+
+        :param analysis_objects: A list of analysis objects to be executed
+        """
+        super(dag_executor, self).__init__(analysis_objects)
+        self.mpi_comm = mpi_helper.get_comm_world()
+        self.mpi_root = 0
+        self.node_times = []
+        self.input_sizes = []
+        self.released_nodes = set()
+        self.memory_model = analysis_memory_model()
+        dtypes = data_dtypes.get_dtypes()
+        self.add_parameter(name='reduce_memory_usage',
+                           help='Reduce memory usage by pushing analyses to file once all analyses ' +
+                                'that depend on them complete, processing dependencies out-of-core.',
+                           dtype=dtypes['bool'],
+                           required=False,
+                           default=False)
+        self.add_parameter(name='synchronize',
+                           help='Place an MPI-barrier at the beginning of the exection of the workflow. ' +
+                                'This can be useful when we require that all MPI ranks are fully initalized.',
+                           dtype=dtypes['bool'],
+                           required=False,
+                           default=False)
+        self.add_parameter(name='backend',
+                           help='The parallel backend used to execute independent analyses concurrently, ' +
+                                'i.e., MPI sub-communicators, forked processes, or serial.',
+                           dtype=str,
+                           required=False,
+                           default=process_helper.BACKENDS['MPI'],
+                           choices=process_helper.BACKENDS.values())
+        self.add_parameter(name='num_processes',
+                           help='Maximum number of analyses executed concurrently by the processes backend. ' +
+                                'Set to 0 to use one process per CPU.',
+                           dtype=int,
+                           required=False,
+                           default=0)
+        self.add_parameter(name='memory_budget',
+                           help='Memory in GB available to analyses executed concurrently by the processes ' +
+                                'backend. Set to 0 for no limit.',
+                           dtype=float,
+                           required=False,
+                           default=0.0)
+
+    def get_ready_nodes(self, exclude=None):
+        """
+        Get the analyses that have not been executed yet and for which all predecessors are complete.
+
+        :param exclude: Optional collection of indices of analyses to be ignored, e.g., analyses that are running
+
+        :return: Sorted list of indices of the analyses that are ready to be executed
+        """
+        all_analyses = self.get_analyses()
+        ready_nodes = []
+        for node_index, analysis in enumerate(all_analyses):
+            if not analysis.update_analysis or (exclude is not None and node_index in exclude):
+                continue
+            if any(all_analyses[pred].update_analysis for pred in self.dependency_graph[node_index]):
+                continue
+            if len(analysis.check_ready_to_execute()) == 0:
+                ready_nodes.append(node_index)
+        return ready_nodes
+
+    def get_critical_path(self):
+        """
+        Compute the critical path of the workflow, i.e., the path through the dependency graph with the
+        largest total wall time of the analyses. Analyses that were not executed contribute no time.
+
+        :return: Tuple of the list of indices of the analyses on the critical path and the total time of the path
+        """
+        num_nodes = len(self.dependency_graph)
+        path_times = [None] * num_nodes
+        path_preds = [None] * num_nodes
+        # Process the nodes in topological order
+        num_pending = [len(preds) for preds in self.dependency_graph]
+        successors = [[] for _ in range(num_nodes)]
+        for node_index, preds in enumerate(self.dependency_graph):
+            for pred in preds:
+                successors[pred].append(node_index)
+        node_stack = [node_index for node_index in range(num_nodes) if num_pending[node_index] == 0]
+        while len(node_stack) > 0:
+            node_index = node_stack.pop()
+            for pred in self.dependency_graph[node_index]:
+                if path_preds[node_index] is None or path_times[pred] > path_times[path_preds[node_index]]:
+                    path_preds[node_index] = pred
+            start_time = path_times[path_preds[node_index]] if path_preds[node_index] is not None else 0.0
+            path_times[node_index] = start_time + (self.node_times[node_index] or 0.0)
+            for succ in successors[node_index]:
+                num_pending[succ] -= 1
+                if num_pending[succ] == 0:
+                    node_stack.append(succ)
+        if num_nodes == 0:
+            return [], 0.0
+        # Trace the critical path back from its last analysis, which has no successors
+        critical_path = []
+        node_index = max([index for index in range(num_nodes) if len(successors[index]) == 0],
+                         key=lambda index: path_times[index])
+        path_time = path_times[node_index]
+        while node_index is not None:
+            critical_path.insert(0, node_index)
+            node_index = path_preds[node_index]
+        return critical_path, path_time
+
+    def execute_node(self, node_index):
+        """
+        Execute the given analysis in the current process
+
+        :param node_index: Index of the analysis in the workflow
+        """
+        analysis = self.get_analyses()[node_index]
+        log_helper.debug(__name__, "Execute analysis: " + str(analysis), root=self.mpi_root, comm=self.mpi_comm)
+        self.input_sizes[node_index] = get_input_size(analysis)
+        start_time = time.time()
+        analysis.execute()
+        self.node_times[node_index] = time.time() - start_time
+        self.complete_node(node_index)
+
+    def record_node(self, node_index, data_names, outputs, node_time, run_info=None):
+        """
+        Record the outputs of an analysis that has been executed in a different process.
+
+        :param node_index: Index of the analysis in the workflow
+        :param data_names: The list of names of the outputs of the analysis
+        :param outputs: List of tuples of (name, data) of the outputs of the analysis
+        :param node_time: The wall time in seconds of the analysis
+        :param run_info: Optional dict with the runtime information of the analysis
+        """
+        analysis = self.get_analyses()[node_index]
+        analysis.omsi_analysis_storage = []
+        analysis.define_missing_parameters()
+        analysis.data_names = list(data_names)
+        for data_name, data in outputs:
+            analysis[data_name] = data
+        analysis.run_info.clear()
+        if run_info is not None:
+            analysis.run_info.update(run_info)
+        analysis.update_analysis = False
+        self.node_times[node_index] = node_time
+
+    def complete_node(self, node_index):
+        """
+        Save the given completed analysis to the checkpoint (if used), update the memory model with the memory
+        usage of the analysis, and release the outputs of analyses that are no longer needed if
+        reduce_memory_usage is set.
+
+        :param node_index: Index of the analysis in the workflow
+        """
+        analysis = self.get_analyses()[node_index]
+        self.checkpoint_analysis(node_index)
+        if analysis.run_info is not None and self.input_sizes[node_index] is not None:
+            analysis.run_info['input_size'] = self.input_sizes[node_index]
+            self.memory_model.add_analysis(analysis)
+        if self['reduce_memory_usage']:
+            self.release_intermediate_outputs(self.released_nodes)
+
+    def admit_node(self, node_index, running_memory):
+        """
+        Check whether the given analysis can be started without exceeding the memory budget.
+
+        :param node_index: Index of the analysis in the workflow
+        :param running_memory: List with the predicted memory usage in bytes of the running analyses
+
+        :return: Tuple of a boolean indicating whether the analysis may be started and the predicted memory
+            usage of the analysis in bytes (None if unknown)
+        """
+        self.input_sizes[node_index] = get_input_size(self.get_analyses()[node_index])
+        node_memory = self.memory_model.predict_analysis(self.get_analyses()[node_index],
+                                                         self.input_sizes[node_index])
+        if self['memory_budget'] <= 0 or len(running_memory) == 0:
+            return True, node_memory
+        if node_memory is None or None in running_memory:
+            return False, node_memory
+        return sum(running_memory) + node_memory <= self['memory_budget'] * 1024 ** 3, node_memory
+
+    def run_serial(self):
+        """
+        Execute all analyses that are ready one at a time in the current process.
+        """
+        ready_nodes = self.get_ready_nodes()
+        while len(ready_nodes) > 0:
+            for node_index in ready_nodes:
+                self.execute_node(node_index)
+            ready_nodes = self.get_ready_nodes()
+
+    def run_processes(self, num_processes):
+        """
+        Execute the analyses in forked processes. Each process executes a single analysis and is started
+        once all predecessors of the analysis are complete, i.e., the process inherits all its inputs.
+        Analyses with outputs that cannot be pickled are re-executed in the current process.
+
+        :param num_processes: The maximum number of analyses executed concurrently
+
+        :raises RuntimeError: If the execution of an analysis failed
+        """
+        all_analyses = self.get_analyses()
+        result_queue = Queue()
+        shared_directory = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        running = {}
+        running_memory = {}
+        try:
+            while True:
+                # Start all analyses that are ready and that fit into the memory budget
+                for node_index in self.get_ready_nodes(exclude=running):
+                    if len(running) >= num_processes:
+                        break
+                    admit, node_memory = self.admit_node(node_index, running_memory.values())
+                    if not admit:
+                        continue
+                    running_memory[node_index] = node_memory
+                    log_helper.debug(__name__, "Start analysis: " + str(all_analyses[node_index]) +
+                                     " (predicted memory " + str(node_memory) + " bytes)")
+                    running[node_index] = Process(target=_execute_node_process,
+                                                  args=(node_index, all_analyses[node_index],
+                                                        result_queue, shared_directory))
+                    running[node_index].start()
+                if len(running) == 0:
+                    break
+                # Wait for any analysis to complete
+                try:
+                    node_index, status, message, node_time = result_queue.get(timeout=1)
+                except Empty:
+                    for node_index, process in running.items():
+                        if not process.is_alive() and process.exitcode != 0:
+                            raise RuntimeError("Process executing " + str(all_analyses[node_index]) +
+                                               " terminated with exit code " + str(process.exitcode))
+                    continue
+                running.pop(node_index).join()
+                running_memory.pop(node_index)
+                if status == 'completed':
+                    data_names, outputs, run_info = pickle.loads(message)
+                    self.record_node(node_index, data_names, process_helper.load_shared_arrays(outputs),
+                                     node_time, run_info)
+                    self.complete_node(node_index)
+                elif status == 'unpicklable':
+                    log_helper.warning(__name__, "Outputs of " + str(all_analyses[node_index]) + " cannot be " +
+                                       "transferred between processes. Executing the analysis in the main process.")
+                    self.execute_node(node_index)
+                else:
+                    raise RuntimeError("Execution of " + str(all_analyses[node_index]) + " failed:\n" + message)
+        finally:
+            for process in running.values():
+                process.terminate()
+            shutil.rmtree(shared_directory, ignore_errors=True)
+
+    def run_mpi(self):
+        """
+        Execute the analyses that are ready concurrently on disjoint sub-communicators of self.mpi_comm.
+
+        The ready analyses are executed in waves. In each wave, the ranks are split into one group per ready
+        analysis (or one group per rank if more analyses are ready than there are ranks). After the wave, the
+        root of each group broadcasts the outputs of its analysis to all ranks.
+        """
+        all_analyses = self.get_analyses()
+        rank = mpi_helper.get_rank(comm=self.mpi_comm)
+        ready_nodes = self.get_ready_nodes()
+        while len(ready_nodes) > 0:
+            num_groups = min(len(ready_nodes), mpi_helper.get_size(comm=self.mpi_comm))
+            group_index = rank % num_groups
+            group_comm = self.mpi_comm.Split(group_index, rank)
+            analysis = all_analyses[ready_nodes[group_index]]
+            for node_index in ready_nodes[:num_groups]:
+                self.input_sizes[node_index] = get_input_size(all_analyses[node_index])
+            analysis_comm, analysis_root = analysis.mpi_comm, analysis.mpi_root
+            analysis.mpi_comm, analysis.mpi_root = group_comm, 0
+            log_helper.debug(__name__, "Execute analysis: " + str(analysis) + " on " +
+                             str(group_comm.Get_size()) + " ranks", root=0, comm=group_comm)
+            start_time = time.time()
+            try:
+                analysis.execute()
+            finally:
+                analysis.mpi_comm, analysis.mpi_root = analysis_comm, analysis_root
+                group_comm.Free()
+            node_time = time.time() - start_time
+            # The root of each group is the rank with the same index as the group
+            for group_root in range(num_groups):
+                message = None
+                if rank == group_root:
+                    message = (list(analysis.data_names),
+                               [(ana_data['name'], ana_data['data']) for ana_data in analysis.get_all_analysis_data()],
+                               node_time)
+                message = self.mpi_comm.bcast(message, root=group_root)
+                if rank != group_root:
+                    self.record_node(ready_nodes[group_root], *message)
+                else:
+                    self.node_times[ready_nodes[group_root]] = node_time
+            # Push outputs to file collectively, i.e., one analysis at a time on all ranks
+            for node_index in ready_nodes[:num_groups]:
+                self.complete_node(node_index)
+            ready_nodes = self.get_ready_nodes()
+
+    def main(self):
+        """
+        Execute the analysis workflow
+        """
+        # Do the optional MPI barrier
+        if self['synchronize']:
+            mpi_helper.barrier(comm=self.mpi_comm)
+
+        # Check if we have anything to do at all
+        if len(self.get_analyses()) == 0:
+            log_helper.info(__name__, "The workflow is empty", root=self.mpi_root, comm=self.mpi_comm)
+            return
+
+        # Add all dependencies to the workflow and compute the dependency graph
+        log_helper.debug(__name__, "Executing the workflow", root=self.mpi_root, comm=self.mpi_comm)
+        log_helper.debug(__name__, "Adding all dependencies", root=self.mpi_root, comm=self.mpi_comm)
+        self.add_analysis_dependencies()
+        self.build_dependency_graph()
+        all_analyses = self.get_analyses()
+        self.node_times = [None] * len(all_analyses)
+        self.input_sizes = [None] * len(all_analyses)
+        self.released_nodes = set()
+        self.open_checkpoint()
+
+        # Execute the analyses as soon as their predecessors are complete
+        log_helper.debug(__name__, "Running the analysis workflow", root=self.mpi_root, comm=self.mpi_comm)
+        num_processes = self['num_processes'] if self['num_processes'] > 0 else cpu_count()
+        if self['backend'] == process_helper.BACKENDS['PROCESSES'] and num_processes > 1:
+            self.run_processes(num_processes)
+        elif self['backend'] == process_helper.BACKENDS['MPI'] and mpi_helper.get_size(comm=self.mpi_comm) > 1:
+            self.run_mpi()
+        else:
+            self.run_serial()
+
+        # Record the wall time of all analyses and the critical path
+        critical_path, critical_path_time = self.get_critical_path()
+        self.run_info['dag_nodes'] = [unicode(analysis) for analysis in all_analyses]
+        self.run_info['dag_node_times'] = [node_time if node_time is not None else -1.0
+                                           for node_time in self.node_times]
+        self.run_info['dag_critical_path'] = critical_path
+        self.run_info['dag_critical_path_time'] = float(critical_path_time)
+        log_helper.info(__name__, "Critical path of the workflow: " +
+                        str([unicode(all_analyses[node_index]) for node_index in critical_path]) +
+                        " (" + str(critical_path_time) + "s)", root=self.mpi_root, comm=self.mpi_comm)
+
+        # Check if there is any other tasks that we need to execute now
+        num_tasks_completed, num_tasks_waiting, num_tasks_ready, num_tasks_blocked = \
+            all_analyses.task_status_stats()
+        if num_tasks_waiting == 0:
+            log_helper.info(__name__, "Completed executing the workflow.", root=self.mpi_root, comm=self.mpi_comm)
+        elif num_tasks_ready == 0:
+            blocking_tasks = all_analyses.get_blocking_tasks()
+            log_helper.warning(__name__, "Workflow could not be fully executed. " + str(num_tasks_waiting) +
+                               " remain in the queue but cannot be completed due to unresolved dependencies." +
+                               " The workflow will be restarted once the outputs of the blocking tasks are ready." +
+                               " Blocking tasks are: " + str(blocking_tasks),
+                               root=self.mpi_root, comm=self.mpi_comm)
+            # Tell all blocking tasks that they should continue the workflow once they are ready
+            # This happens in omsi.analysis.analysis_base.outputs_ready(...) function
+            for block_task in blocking_tasks:
+                block_task.continue_workflow_when_ready(self)
+        # All analyses are done, so we no longer need to coninue any analyses when we are done
+        if num_tasks_blocked == 0:
+            for analysis in all_analyses:
+                analysis.continue_analysis_when_ready = False
@@ -19,8 +19,8 @@ class greedy_executor(workflow_executor_base):
     Additional parameters:
 
     :param reduce_memory_usage: Boolean indicating whether we should reduce memory usage by pushing analysis
-        data to file after an analysis has been completed. This reduces the amount of data we keep in memory
-        but results in additional overhead for I/O and temporary disk storage.
+        data to file once all analyses that depend on it have been completed. This reduces the amount of data
+        we keep in memory but results in additional overhead for I/O and temporary disk storage.
 
     """
     def __init__(self, analysis_objects=None):
@@ -33,8 +33,8 @@ class greedy_executor(workflow_executor_base):
         self.mpi_comm = mpi_helper.get_comm_world()
         self.mpi_root = 0
         self.add_parameter(name='reduce_memory_usage',
-                           help='Reduce memory usage by pushing analyses to file each time they ' +
-                                'complete, processing dependencies out-of-core.',
+                           help='Reduce memory usage by pushing analyses to file once all analyses ' +
+                                'that depend on them complete, processing dependencies out-of-core.',
                            dtype=data_dtypes.bool_type,
                            required=False,
                            default=False)
@@ -62,6 +62,9 @@ class greedy_executor(workflow_executor_base):
         log_helper.debug(__name__, "Executing the workflow", root=self.mpi_root, comm=self.mpi_comm)
         log_helper.debug(__name__, "Adding all dependencies", root=self.mpi_root, comm=self.mpi_comm)
         self.add_analysis_dependencies()
+        self.build_dependency_graph()
+        self.open_checkpoint()
+        released = set()
 
         # Execute the workflow in a greedy fashion (i.e., execute whichever analysis is ready and has not be run yet)
         log_helper.debug(__name__, "Running the analysis workflow", root=self.mpi_root, comm=self.mpi_comm)
@@ -70,13 +73,14 @@ class greedy_executor(workflow_executor_base):
         continue_running = True
         while continue_running:
             # Run all analyses that are ready
-            for analysis in all_analyses:
+            for node_index, analysis in enumerate(all_analyses):
                 if analysis.update_analysis and len(analysis.check_ready_to_execute()) == 0:
                     log_helper.debug(__name__, "Execute analysis: " + str(analysis),
                                      root=self.mpi_root, comm=self.mpi_comm)
                     analysis.execute()
+                    self.checkpoint_analysis(node_index)
                     if self['reduce_memory_usage']:
-                        analysis.clear_and_restore()
+                        self.release_intermediate_outputs(released)
             # Check if there is any other tasks that we need to execute now
             num_tasks_completed, num_tasks_waiting, num_tasks_ready, num_tasks_blocked = \
                 all_analyses.task_status_stats()
@@ -0,0 +1,205 @@
+"""
+Module with a simple model of the peak memory usage of analyses. Workflow executors use the model to
+decide which analyses can be executed concurrently without exceeding the memory budget of a node.
+
+The model is learned from the runtime information of previous executions of analyses, i.e., the
+'max_memory' and 'start_memory' recorded by omsi.datastructures.run_info_data.run_info_dict, and the
+'input_size' recorded by the workflow executors.
+"""
+import numpy as np
+
+from omsi.shared.log import log_helper
+
+
+def get_data_size(data):
+    """
+    Get the size in bytes of the given data object.
+
+    :param data: The data, e.g., a numpy array, h5py.Dataset, omsi_file_msidata, or a list of such objects
+
+    :return: Integer with the number of bytes. Objects without a shape and dtype have a size of 0.
+    """
+    if hasattr(data, 'shape') and hasattr(data, 'dtype'):
+        try:
+            return int(np.prod(data.shape)) * np.dtype(data.dtype).itemsize
+        except TypeError:
+            return 0
+    elif isinstance(data, (list, tuple)):
+        return sum(get_data_size(value) for value in data)
+    return 0
+
+
+def get_input_size(analysis):
+    """
+    Get the total size in bytes of the input data of the given analysis.
+
+    :param analysis: The analysis object (omsi.analysis.base.analysis_base)
+
+    :return: Integer with the number of bytes of all parameters. Dependencies that are not ready are ignored.
+    """
+    from omsi.datastructures.dependency_data import dependency_dict
+    input_size = 0
+    for param in analysis.parameters:
+        data = param['data'] if param['data'] is not None else param['default']
+        if isinstance(data, dependency_dict):
+            data = data.get_data()
+            if isinstance(data, dependency_dict):
+                continue
+        input_size += get_data_size(data)
+    return input_size
+
+
+def get_run_info_value(run_info, key):
+    """
+    Get a numeric value from the runtime information of an analysis.
+
+    :param run_info: Dict with the runtime information. The values may be numbers, strings, numpy arrays,
+        h5py.Datasets (e.g., for analyses stored in a file), or lists with one value per MPI rank.
+    :param key: The key of the value
+
+    :return: Float with the value (the maximum over all MPI ranks) or None if the value is not available
+    """
+    value = run_info.get(key, None)
+    if value is None:
+        return None
+    try:
+        values = np.asarray(value[()] if hasattr(value, 'dtype') and not isinstance(value, np.ndarray) else value)
+        values = values.astype('float64')
+    except (TypeError, ValueError):
+        return None
+    if values.size == 0:
+        return None
+    return float(values.max())
+
+
+class analysis_memory_model(object):
+    """
+    Model of the peak memory usage of analyses as a function of the analysis type and the size of the inputs.
+
+    For each analysis type, the model fits a line to the observed pairs of input size and memory usage and
+    shifts it so that it covers all observations. If all observations have the same input size, then the memory
+    usage is assumed to be proportional to the input size.
+
+    :ivar records: Dict with a list of (input_size, memory_usage) tuples in bytes for each analysis type
+    :ivar safety_factor: Factor by which the predicted memory usage is increased
+    :ivar default_memory: Memory usage in bytes assumed for analysis types without any records. None if unknown.
+    """
+    def __init__(self, safety_factor=1.2, default_memory=None):
+        """
+        Initialize an empty memory model
+
+        :param safety_factor: Factor by which the predicted memory usage is increased
+        :param default_memory: Memory usage in bytes assumed for analysis types without any records
+        """
+        self.records = {}
+        self.safety_factor = safety_factor
+        self.default_memory = default_memory
+
+    def add_record(self, analysis_type, input_size, memory_usage):
+        """
+        Add an observation of the memory usage of an analysis.
+
+        :param analysis_type: String with the analysis type
+        :param input_size: The size of the inputs in bytes
+        :param memory_usage: The peak memory used by the analysis in bytes
+        """
+        self.records.setdefault(unicode(analysis_type), []).append((float(input_size), float(memory_usage)))
+
+    def add_run_info(self, analysis_type, run_info, input_size=None):
+        """
+        Add an observation from the runtime information of an analysis. The memory usage is the
+        difference of 'max_memory' and 'start_memory'. Executions that reused cached outputs are ignored.
+
+        :param analysis_type: String with the analysis type
+        :param run_info: Dict with the runtime information of the analysis
+        :param input_size: The size of the inputs in bytes. If None, then 'input_size' of the run_info is used.
+
+        :return: Boolean indicating whether an observation has been added
+        """
+        max_memory = get_run_info_value(run_info, 'max_memory')
+        if max_memory is None or get_run_info_value(run_info, 'cache_hit'):
+            return False
+        start_memory = get_run_info_value(run_info, 'start_memory')
+        if input_size is None:
+            input_size = get_run_info_value(run_info, 'input_size')
+        self.add_record(analysis_type,
+                        input_size if input_size is not None else 0,
+                        max(max_memory - (start_memory if start_memory is not None else 0), 0))
+        return True
+
+    def add_analysis(self, analysis):
+        """
+        Add an observation from a completed analysis.
+
+        :param analysis: The analysis object (omsi.analysis.base.analysis_base)
+
+        :return: Boolean indicating whether an observation has been added
+        """
+        if analysis.run_info is None:
+            return False
+        return self.add_run_info(analysis.get_analysis_type(), analysis.run_info)
+
+    def add_history(self, omsi_object):
+        """
+        Add observations from all analyses stored in an OMSI file.
+
+        :param omsi_object: The omsi_file, omsi_file_experiment, or omsi_file_analysis object
+
+        :return: Integer with the number of observations added
+        """
+        if hasattr(omsi_object, 'get_num_experiments'):
+            experiments = [omsi_object.get_experiment(exp_index)
+                           for exp_index in range(omsi_object.get_num_experiments())]
+        else:
+            experiments = [omsi_object]
+        num_records = 0
+        for experiment in experiments:
+            if hasattr(experiment, 'get_num_analysis'):
+                stored_analyses = [experiment.get_analysis(ana_index)
+                                   for ana_index in range(experiment.get_num_analysis())]
+            else:
+                stored_analyses = [experiment]
+            for stored_analysis in stored_analyses:
+                if self.add_run_info(unicode(stored_analysis.get_analysis_type()[0]),
+                                     stored_analysis.get_all_runinfo_data(load_data=False)):
+                    num_records += 1
+        log_helper.debug(__name__, "Added " + str(num_records) + " memory usage records")
+        return num_records
+
+    def predict(self, analysis_type, input_size):
+        """
+        Predict the peak memory usage of an analysis.
+
+        :param analysis_type: String with the analysis type
+        :param input_size: The size of the inputs in bytes
+
+        :return: The predicted memory usage in bytes or default_memory if no records are available
+        """
+        records = self.records.get(unicode(analysis_type), [])
+        if len(records) == 0:
+            return self.default_memory
+        input_sizes = np.asarray([record[0] for record in records])
+        memory_usages = np.asarray([record[1] for record in records])
+        if np.unique(input_sizes).size > 1:
+            slope = max(np.polyfit(input_sizes, memory_usages, 1)[0], 0.0)
+            intercept = np.max(memory_usages - slope * input_sizes)
+        elif input_sizes[0] > 0:
+            slope = np.max(memory_usages) / input_sizes[0]
+            intercept = 0.0
+        else:
+            slope = 0.0
+            intercept = np.max(memory_usages)
+        return int(self.safety_factor * (intercept + slope * input_size))
+
+    def predict_analysis(self, analysis, input_size=None):
+        """
+        Predict the peak memory usage of the given analysis.
+
+        :param analysis: The analysis object (omsi.analysis.base.analysis_base)
+        :param input_size: The size of the inputs in bytes. If None, then get_input_size is used.
+
+        :return: The predicted memory usage in bytes or default_memory if no records are available
+        """
+        if input_size is None:
+            input_size = get_input_size(analysis)
+        return self.predict(analysis.get_analysis_type(), input_size)
@@ -0,0 +1,116 @@
+"""
+Testing for the node-local cache of Pactolus fragmentation trees. The tests run on a single rank.
+"""
+import unittest
+import tempfile
+import shutil
+import os
+import numpy as np
+from omsi.analysis.compound_stats.pactolus_tree_cache import pactolus_tree_cache
+
+
+class test_pactolus_tree_cache(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        self.tree_directory = tempfile.mkdtemp()
+        self.cache_directory = tempfile.mkdtemp()
+        # Create fake tree files and the file lookup table
+        self.ms1_mass = np.asarray([100.0, 150.0, 200.0, 251.0])
+        self.file_lookup_table = np.zeros((4,), dtype=[('filename', 'S100'), ('ms1_mass', 'f8')])
+        for tree_index, ms1_mass in enumerate(self.ms1_mass):
+            filename = os.path.join(self.tree_directory, 'tree_' + str(tree_index) + '.h5')
+            with open(filename, 'w') as tree_file:
+                tree_file.write('tree ' + str(tree_index))
+            self.file_lookup_table[tree_index] = (filename, ms1_mass)
+        self.table_file = os.path.join(self.tree_directory, 'trees.npy')
+        np.save(self.table_file, self.file_lookup_table)
+
+    def tearDown(self):
+        shutil.rmtree(self.tree_directory, ignore_errors=True)
+        shutil.rmtree(self.cache_directory, ignore_errors=True)
+
+    def test_get_file_lookup_table(self):
+        tree_cache = pactolus_tree_cache(cache_directory=self.cache_directory)
+        file_lookup_table = tree_cache.get_file_lookup_table(self.table_file)
+        self.assertTrue(np.all(file_lookup_table == self.file_lookup_table))
+        self.assertGreaterEqual(tree_cache.tree_load_time, 0)
+
+    def test_select_trees(self):
+        selected = pactolus_tree_cache.select_trees(self.file_lookup_table,
+                                                    precursor_mz=[149.0],
+                                                    ms1_mass_tol=0.01,
+                                                    neutralizations=[0, 1])
+        self.assertListEqual(selected.tolist(), [1])
+        selected = pactolus_tree_cache.select_trees(self.file_lookup_table,
+                                                    precursor_mz=np.asarray([100.0, 250.0]),
+                                                    ms1_mass_tol=[0.01],
+                                                    neutralizations=[1])
+        self.assertListEqual(selected.tolist(), [0, 3])
+        selected = pactolus_tree_cache.select_trees(self.file_lookup_table)
+        self.assertListEqual(selected.tolist(), [0, 1, 2, 3])
+
+    def test_stage_and_cleanup(self):
+        tree_cache = pactolus_tree_cache(cache_directory=self.cache_directory)
+        scoring_lookup_table = tree_cache.stage(self.file_lookup_table,
+                                                precursor_mz=[150.0, 200.0],
+                                                ms1_mass_tol=0.01,
+                                                neutralizations=[0])
+        self.assertEquals(tree_cache.num_trees, 2)
+        self.assertTrue(tree_cache.store_directory.startswith(self.cache_directory))
+        self.assertTrue(np.all(scoring_lookup_table['ms1_mass'] == self.file_lookup_table['ms1_mass']))
+        # Trees that are not needed keep their original filename
+        for tree_index in [0, 3]:
+            self.assertEquals(scoring_lookup_table['filename'][tree_index],
+                              self.file_lookup_table['filename'][tree_index])
+        # The needed trees are read from the node-local store
+        for tree_index in [1, 2]:
+            filename = scoring_lookup_table['filename'][tree_index]
+            self.assertTrue(filename.startswith(tree_cache.store_directory))
+            with open(filename, 'r') as tree_file:
+                self.assertEquals(tree_file.read(), 'tree ' + str(tree_index))
+        store_directory = tree_cache.store_directory
+        tree_cache.cleanup()
+        self.assertFalse(os.path.exists(store_directory))
+        self.assertIsNone(tree_cache.store_directory)
+
+    def test_stage_max_bytes(self):
+        # Each tree file has 6 bytes, i.e., only the first of the selected trees fits
+        tree_cache = pactolus_tree_cache(cache_directory=self.cache_directory, max_bytes=10)
+        scoring_lookup_table = tree_cache.stage(self.file_lookup_table,
+                                                precursor_mz=[150.0, 200.0],
+                                                ms1_mass_tol=0.01,
+                                                neutralizations=[0])
+        self.assertEquals(tree_cache.num_trees, 1)
+        self.assertTrue(scoring_lookup_table['filename'][1].startswith(tree_cache.store_directory))
+        self.assertEquals(scoring_lookup_table['filename'][2], self.file_lookup_table['filename'][2])
+        tree_cache.cleanup()
+
+    def test_stage_failed_copy(self):
+        # A copy that fails midway (e.g., because the store is full) must not leave a truncated tree
+        def failing_copyfile(source, destination):
+            with open(destination, 'w') as destination_file:
+                destination_file.write('tr')
+            raise IOError(28, 'No space left on device')
+        copyfile = shutil.copyfile
+        shutil.copyfile = failing_copyfile
+        try:
+            tree_cache = pactolus_tree_cache(cache_directory=self.cache_directory)
+            scoring_lookup_table = tree_cache.stage(self.file_lookup_table, precursor_mz=[150.0])
+        finally:
+            shutil.copyfile = copyfile
+        self.assertEquals(tree_cache.num_trees, 0)
+        self.assertListEqual(os.listdir(tree_cache.store_directory), [])
+        self.assertEquals(scoring_lookup_table['filename'][1], self.file_lookup_table['filename'][1])
+        tree_cache.cleanup()
+
+    def test_stage_without_filenames(self):
+        tree_cache = pactolus_tree_cache(cache_directory=self.cache_directory)
+        file_lookup_table = np.zeros((4, 2))
+        self.assertIs(tree_cache.stage(file_lookup_table, precursor_mz=[150.0]), file_lookup_table)
+        self.assertIsNone(tree_cache.store_directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
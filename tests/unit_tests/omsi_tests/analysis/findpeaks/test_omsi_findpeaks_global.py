@@ -0,0 +1,84 @@
+"""
+Regression testing for the streaming global peak finding.
+"""
+import unittest
+import tempfile
+import numpy as np
+import h5py
+from omsi.analysis.findpeaks.omsi_findpeaks_global import omsi_findpeaks_global
+from omsi.analysis.findpeaks.third_party.findpeaks import findpeaks
+from omsi.analysis.findpeaks import findpeaks_batch
+
+
+def findpeaks_global_in_memory(data, mzdata, integration_width, smoothwidth, slwindow, peakheight):
+    """Reference implementation loading the full data and computing the peak cube one peak at a time"""
+    shape_x, shape_y, shape_z = data.shape
+    mean_spectrum = np.mean(data.reshape(shape_x*shape_y, shape_z), axis=0)
+    y = findpeaks(mzdata, mean_spectrum, smoothwidth, slwindow, peakheight).smoothListGaussian()
+    y = y - [x for x in findpeaks(mzdata, y, smoothwidth, slwindow, peakheight).sliding_window_minimum()]
+    pkmax = findpeaks(mzdata, y, smoothwidth, slwindow, peakheight).peakdet()[0]
+    mz_peaks = mzdata[np.asarray(pkmax)[:, 0].astype(int)]
+    flat_data = data.reshape(shape_x*shape_y, shape_z)
+    peak_cube = np.zeros((shape_x*shape_y, mz_peaks.shape[0]))
+    for i in range(len(mz_peaks)):
+        xx = np.where(np.abs(mzdata - mz_peaks[i]) < integration_width)
+        peak_cube[:, i] = np.amax(flat_data[:, xx[0]], 1)
+    return peak_cube.reshape(shape_x, shape_y, len(mz_peaks)), mz_peaks
+
+
+class test_omsi_findpeaks_global(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        self.named_temporary_file = tempfile.NamedTemporaryFile()
+        self.h5py_file = h5py.File(self.named_temporary_file.name, 'w')
+        random_state = np.random.RandomState(0)
+        self.mzdata = np.linspace(100, 1000, 2000)
+        self.temp_data = random_state.randint(0, 5, size=(7, 5, 2000)).astype('uint16')
+        for center in random_state.randint(0, 2000, 30):
+            peak = random_state.randint(0, 200, size=(7, 5, 1)).astype('uint16')
+            self.temp_data[:, :, max(center - 4, 0):center + 4] += peak
+        self.temp_data[:, :, -3:] += 300
+        self.dataset = self.h5py_file.create_dataset('data', data=self.temp_data, chunks=(2, 2, 256))
+
+    def tearDown(self):
+        # Clean up the test suite
+        self.h5py_file.close()
+        del self.h5py_file
+        del self.named_temporary_file
+
+    def test_findpeaks_global(self):
+        ref_cube, ref_mz = findpeaks_global_in_memory(self.temp_data, self.mzdata, 1.5, 3, 100, 10)
+        self.assertGreater(ref_mz.size, 0)
+        # Process the data as a single block and as many small blocks
+        for max_block_bytes, num_io_threads in [(256 * 1024 * 1024, 1), (10000, 2), (10000, 0)]:
+            fpg = omsi_findpeaks_global()
+            fpg.execute(msidata=self.dataset,
+                        mzdata=self.mzdata,
+                        integration_width=1.5,
+                        smoothwidth=3,
+                        slwindow=100,
+                        peakheight=10,
+                        max_block_bytes=max_block_bytes,
+                        num_io_threads=num_io_threads)
+            self.assertTrue(np.array_equal(fpg['peak_mz'], ref_mz))
+            self.assertTrue(np.array_equal(fpg['peak_cube'], ref_cube))
+
+    def test_peak_windows(self):
+        mzdata = np.linspace(100, 200, 1001)
+        mz_peaks = np.concatenate([mzdata[[0, 1, 500, 999, 1000]], [150.05]])
+        for integration_width in [0.1, 0.3, 0.051, 500]:
+            start, stop = findpeaks_batch.get_peak_windows(mzdata, mz_peaks, integration_width)
+            spectra = np.random.rand(4, mzdata.size)
+            maxima = findpeaks_batch.window_maximum(spectra, start, stop)
+            for index, mz_peak in enumerate(mz_peaks):
+                window = np.where(np.abs(mzdata - mz_peak) < integration_width)[0]
+                self.assertEquals((start[index], stop[index]), (window[0], window[-1] + 1))
+                self.assertTrue(np.array_equal(maxima[:, index], np.amax(spectra[:, window], 1)))
+        self.assertRaises(ValueError, findpeaks_batch.get_peak_windows, mzdata[::-1], mz_peaks, 0.1)
+        self.assertRaises(ValueError, findpeaks_batch.get_peak_windows, mzdata, mz_peaks, 1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
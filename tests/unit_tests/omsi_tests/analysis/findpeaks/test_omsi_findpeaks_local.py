@@ -0,0 +1,93 @@
+"""
+Regression testing for the batched local peak finding.
+"""
+import unittest
+import tempfile
+import numpy as np
+import h5py
+from omsi.analysis.findpeaks.omsi_findpeaks_local import omsi_findpeaks_local
+from omsi.analysis.findpeaks.third_party.findpeaks import findpeaks
+from omsi.analysis.findpeaks import findpeaks_batch
+
+
+def findpeaks_local_per_pixel(msidata, mzdata, smoothwidth, slwindow, peakheight):
+    """Reference implementation processing one pixel at a time using the third-party findpeaks"""
+    peak_mz = []
+    peak_values = []
+    peak_arrayindex = np.zeros(shape=(msidata.shape[0]*msidata.shape[1], 3), dtype='int64')
+    current_index = 0
+    pixel_index = 0
+    for xi in xrange(0, msidata.shape[0]):
+        for yi in xrange(0, msidata.shape[1]):
+            y = findpeaks(mzdata, msidata[xi, yi, :], smoothwidth, slwindow, peakheight).smoothListGaussian()
+            y = y - [x for x in findpeaks(mzdata, y, smoothwidth, slwindow, peakheight).sliding_window_minimum()]
+            pkmax = findpeaks(mzdata, y, smoothwidth, slwindow, peakheight).peakdet()[0]
+            peak_mz = peak_mz + [x[0] for x in pkmax]
+            peak_values = peak_values + [x[1] for x in pkmax]
+            peak_arrayindex[pixel_index, :] = (xi, yi, current_index)
+            pixel_index += 1
+            current_index += len(pkmax)
+    return np.asarray(peak_mz), np.asarray(peak_values), peak_arrayindex
+
+
+class test_omsi_findpeaks_local(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        self.named_temporary_file = tempfile.NamedTemporaryFile()
+        self.h5py_file = h5py.File(self.named_temporary_file.name, 'w')
+        random_state = np.random.RandomState(0)
+        self.mzdata = np.linspace(100, 1000, 3000)
+        self.temp_data = (random_state.rand(6, 5, 3000) * 5).astype('float32')
+        for xi in range(6):
+            for yi in range(5):
+                for center in random_state.randint(0, 3000, 40):
+                    self.temp_data[xi, yi, max(center - 5, 0):center + 5] += random_state.rand() * 100
+        self.temp_data[2, 2, :] = 0
+        self.dataset = self.h5py_file.create_dataset('data', data=self.temp_data, chunks=(2, 2, 512))
+
+    def tearDown(self):
+        # Clean up the test suite
+        self.h5py_file.close()
+        del self.h5py_file
+        del self.named_temporary_file
+
+    def test_findpeaks_local(self):
+        ref_mz, ref_values, ref_arrayindex = findpeaks_local_per_pixel(self.temp_data, self.mzdata, 3, 100, 10)
+        self.assertGreater(ref_mz.size, 0)
+        # Process the data as a single block and as many small blocks
+        for max_block_bytes in [256 * 1024 * 1024, 1000]:
+            fpl = omsi_findpeaks_local()
+            fpl.execute(msidata=self.dataset,
+                        mzdata=self.mzdata,
+                        smoothwidth=3,
+                        slwindow=100,
+                        peakheight=10,
+                        max_block_bytes=max_block_bytes)
+            self.assertEquals(fpl['peak_mz'].dtype, ref_mz.dtype)
+            self.assertTrue(np.array_equal(fpl['peak_mz'], ref_mz))
+            self.assertTrue(np.array_equal(fpl['peak_value'], ref_values))
+            self.assertTrue(np.array_equal(fpl['peak_arrayindex'], ref_arrayindex))
+
+    def test_peakdet(self):
+        random_state = np.random.RandomState(1)
+        spectra = random_state.rand(20, 500) * 30
+        for num_spectra in [20, 3]:
+            spectrum_index, mz_index, values = findpeaks_batch.peakdet(spectra[0:num_spectra], 10)
+            for index in range(num_spectra):
+                maxtab = findpeaks(None, spectra[index], None, None, 10).peakdet()[0]
+                self.assertEquals(list(mz_index[spectrum_index == index]), [peak[0] for peak in maxtab])
+                self.assertEquals(list(values[spectrum_index == index]), [peak[1] for peak in maxtab])
+
+    def test_sliding_window_minimum(self):
+        spectra = np.random.rand(3, 200)
+        for slwindow in [1, 7, 100, 300]:
+            result = findpeaks_batch.sliding_window_minimum(spectra, slwindow)
+            for index in range(3):
+                reference = [x for x in findpeaks(None, spectra[index], None, slwindow, None).sliding_window_minimum()]
+                self.assertTrue(np.array_equal(result[index], reference))
+
+
+if __name__ == '__main__':
+    unittest.main()
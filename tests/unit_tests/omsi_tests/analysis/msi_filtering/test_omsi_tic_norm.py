@@ -0,0 +1,66 @@
+"""
+Basic testing for the TIC normalization analysis.
+"""
+import unittest
+import tempfile
+import numpy as np
+import h5py
+from omsi.analysis.msi_filtering.omsi_tic_norm import omsi_tic_norm
+
+
+class test_omsi_tic_norm(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        self.named_temporary_file = tempfile.NamedTemporaryFile()
+        self.h5py_file = h5py.File(self.named_temporary_file.name, 'w')
+        random_state = np.random.RandomState(0)
+        self.temp_data = (random_state.rand(9, 7, 50) * 100).astype('float32')
+        self.temp_data[2, 3, :] = 0
+        self.mzdata = np.linspace(100, 200, 50)
+        self.dataset = self.h5py_file.create_dataset('data', data=self.temp_data, chunks=(4, 2, 16))
+
+    def tearDown(self):
+        # Clean up the test suite
+        self.h5py_file.close()
+        del self.h5py_file
+        del self.named_temporary_file
+
+    def reference_tic_norm(self, idx_mz, max_count):
+        """Compute the normalized data for the full in-memory data"""
+        selected_data = self.temp_data[:, :, idx_mz].astype('float')
+        tic = selected_data.sum(axis=2)
+        maxs = selected_data.max(axis=2)
+        factors = np.zeros(tic.shape)
+        factors[tic > 0] = tic[tic > 0].mean() / tic[tic > 0]
+        valid = (maxs >= max_count) & (tic > 0)
+        result = np.zeros(self.temp_data.shape)
+        result[valid, :] = np.around(self.temp_data[valid, :] * factors[valid][:, np.newaxis])
+        return result
+
+    def test_tic_norm(self):
+        for max_block_bytes, num_io_threads in [(256 * 1024 * 1024, 1), (1000, 0), (1000, 2)]:
+            tic_norm = omsi_tic_norm()
+            tic_norm.execute(msidata=self.dataset,
+                             mzdata=self.mzdata,
+                             maxCount=30,
+                             max_block_bytes=max_block_bytes,
+                             num_io_threads=num_io_threads)
+            self.assertTrue(np.all(tic_norm['norm_msidata'][:] == self.reference_tic_norm(slice(None), 30)))
+            self.assertEquals(tic_norm['norm_msidata'].dtype, np.dtype('uint16'))
+
+    def test_tic_norm_informative_ions(self):
+        tic_norm = omsi_tic_norm()
+        tic_norm.execute(msidata=self.dataset,
+                         mzdata=self.mzdata,
+                         maxCount=0,
+                         infIons=np.asarray([120.0, 150.0]),
+                         mzTol=5.0,
+                         max_block_bytes=1000)
+        idx_mz = np.where((np.abs(self.mzdata - 120.0) <= 5.0) | (np.abs(self.mzdata - 150.0) <= 5.0))[0]
+        self.assertTrue(np.all(tic_norm['norm_msidata'][:] == self.reference_tic_norm(idx_mz, 0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
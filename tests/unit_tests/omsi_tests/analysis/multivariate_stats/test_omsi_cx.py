@@ -0,0 +1,71 @@
+"""
+Basic testing for the CX analysis and the randomized leverage scores.
+"""
+import unittest
+import tempfile
+import numpy as np
+import h5py
+from omsi.analysis.multivariate_stats.omsi_cx import omsi_cx
+from omsi.analysis.multivariate_stats import cx_randomized
+
+
+class test_omsi_cx(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        self.named_temporary_file = tempfile.NamedTemporaryFile()
+        self.h5py_file = h5py.File(self.named_temporary_file.name, 'w')
+        random_state = np.random.RandomState(0)
+        # Rank-4 data, i.e., the randomized leverage scores of rank 4 are exact
+        self.temp_data = np.dot(random_state.rand(12, 10, 4), random_state.rand(4, 50))
+        self.dataset = self.h5py_file.create_dataset('data', data=self.temp_data, chunks=(4, 5, 50))
+        self.mask = np.ones((12, 10), dtype='bool')
+        self.mask[0:4, :] = False
+
+    def tearDown(self):
+        # Clean up the test suite
+        self.h5py_file.close()
+        del self.h5py_file
+        del self.named_temporary_file
+
+    def test_randomized_leverage_scores(self):
+        matrix = self.temp_data.reshape((-1, 50)).transpose()
+        exact_rows = omsi_cx.comp_lev_exact(matrix, 4, 0)
+        exact_columns = omsi_cx.comp_lev_exact(matrix, 4, 1).reshape((12, 10))
+        for max_block_bytes, num_power_iterations in [(256 * 1024 * 1024, 0), (2000, 1), (2000, 2)]:
+            rows, columns, info = cx_randomized.randomized_leverage_scores(data=self.dataset,
+                                                                           rank=4,
+                                                                           num_power_iterations=num_power_iterations,
+                                                                           random_state=np.random.RandomState(0),
+                                                                           max_bytes=max_block_bytes)
+            self.assertTrue(np.allclose(rows, exact_rows))
+            self.assertTrue(np.allclose(columns, exact_columns))
+            self.assertEquals(info['num_passes'], num_power_iterations + 2)
+
+    def test_randomized_leverage_scores_mask(self):
+        matrix = self.temp_data[self.mask].transpose()
+        exact_columns = omsi_cx.comp_lev_exact(matrix, 4, 1)
+        rows, columns, info = cx_randomized.randomized_leverage_scores(data=self.dataset,
+                                                                       rank=4,
+                                                                       mask=self.mask,
+                                                                       random_state=np.random.RandomState(0),
+                                                                       max_bytes=2000)
+        self.assertTrue(np.allclose(columns[self.mask], exact_columns))
+        self.assertTrue(np.all(columns[~self.mask] == -1))
+
+    def test_omsi_cx_randomized(self):
+        for objective_dim in [0, 1]:
+            exact = omsi_cx()
+            exact.execute(msidata=self.dataset, rank=4, objectiveDim=objective_dim)
+            randomized = omsi_cx()
+            randomized.execute(msidata=self.dataset, rank=4, objectiveDim=objective_dim,
+                               method='randomized', sketchSize=8, powerIterations=1)
+            self.assertEquals(exact['levScores'].shape, randomized['levScores'].shape)
+            self.assertTrue(np.allclose(exact['levScores'][:], randomized['levScores'][:]))
+            self.assertEquals(exact['infIndices'].shape, randomized['infIndices'].shape)
+            self.assertTrue('cx_sketch_time' in randomized.run_info)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+Basic testing for the k-means analysis and the mini-batch k-means engine.
+"""
+import unittest
+import tempfile
+import numpy as np
+import h5py
+from omsi.analysis.multivariate_stats.omsi_kmeans import omsi_kmeans
+from omsi.analysis.multivariate_stats import kmeans_streaming
+
+
+class test_omsi_kmeans(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        self.named_temporary_file = tempfile.NamedTemporaryFile()
+        self.h5py_file = h5py.File(self.named_temporary_file.name, 'w')
+        random_state = np.random.RandomState(0)
+        # Three well separated clusters of spectra arranged in horizontal stripes
+        centers = np.zeros((3, 30))
+        centers[0, 0:10] = 100
+        centers[1, 10:20] = 100
+        centers[2, 20:30] = 100
+        self.labels = np.repeat(np.arange(3), 4)[:, np.newaxis] * np.ones((12, 10), dtype='int')
+        self.temp_data = centers[self.labels] + random_state.rand(12, 10, 30)
+        self.dataset = self.h5py_file.create_dataset('data', data=self.temp_data, chunks=(2, 5, 30))
+        self.mask = np.ones((12, 10), dtype='bool')
+        self.mask[:, 0:5] = False
+
+    def tearDown(self):
+        # Clean up the test suite
+        self.h5py_file.close()
+        del self.h5py_file
+        del self.named_temporary_file
+
+    def assert_same_clustering(self, labels, reference):
+        """Check that the labels define the same partition as the reference labels"""
+        self.assertEquals(len(np.unique(labels)), len(np.unique(reference)))
+        for label in np.unique(reference):
+            self.assertEquals(len(np.unique(labels[reference == label])), 1)
+
+    def test_assign_clusters(self):
+        spectra = self.temp_data.reshape((-1, 30))
+        centers = spectra[[0, 50, 100]]
+        labels, squared_distances = kmeans_streaming.assign_clusters(spectra, centers)
+        distances = ((spectra[:, np.newaxis, :] - centers[np.newaxis, :, :]) ** 2).sum(axis=-1)
+        self.assertTrue(np.all(labels == np.argmin(distances, axis=1)))
+        self.assertTrue(np.allclose(squared_distances, distances.min(axis=1)))
+
+    def test_streaming_kmeans(self):
+        for max_block_bytes, num_io_threads, num_processes in [(256 * 1024 * 1024, 1, 1), (1000, 0, 1), (1000, 2, 1)]:
+            centers, labels, info = kmeans_streaming.streaming_kmeans(data=self.dataset,
+                                                                      num_clusters=3,
+                                                                      batch_size=20,
+                                                                      num_restarts=3,
+                                                                      random_state=np.random.RandomState(0),
+                                                                      max_bytes=max_block_bytes,
+                                                                      num_threads=num_io_threads,
+                                                                      num_processes=num_processes)
+            self.assertEquals(centers.shape, (3, 30))
+            self.assertEquals(labels.shape, (12, 10))
+            self.assert_same_clustering(labels, self.labels)
+            self.assertEquals(len(info['restart_inertia']), 3)
+
+    def test_streaming_kmeans_process_pool(self):
+        centers, labels, info = kmeans_streaming.streaming_kmeans(data=self.temp_data,
+                                                                  num_clusters=3,
+                                                                  batch_size=20,
+                                                                  num_restarts=2,
+                                                                  random_state=np.random.RandomState(0),
+                                                                  num_processes=2)
+        self.assert_same_clustering(labels, self.labels)
+
+    def test_streaming_kmeans_process_pool_h5py(self):
+        # The processes open the file read-only while it is still open for writing in this process
+        centers, labels, info = kmeans_streaming.streaming_kmeans(data=self.dataset,
+                                                                  num_clusters=3,
+                                                                  batch_size=20,
+                                                                  num_restarts=2,
+                                                                  random_state=np.random.RandomState(0),
+                                                                  num_processes=2)
+        self.assert_same_clustering(labels, self.labels)
+        self.assertEquals(len(info['restart_inertia']), 2)
+
+    def test_streaming_kmeans_mask(self):
+        centers, labels, info = kmeans_streaming.streaming_kmeans(data=self.dataset,
+                                                                  num_clusters=3,
+                                                                  mask=self.mask,
+                                                                  batch_size=20,
+                                                                  random_state=np.random.RandomState(0),
+                                                                  max_bytes=1000)
+        self.assertTrue(np.all(labels[~self.mask] == -1))
+        self.assert_same_clustering(labels[self.mask], self.labels[self.mask])
+
+    def test_omsi_kmeans_minibatch(self):
+        kmeans = omsi_kmeans()
+        kmeans.execute(msidata=self.dataset,
+                       numClusters=3,
+                       numRepeat=2,
+                       batchSize=20,
+                       method='minibatch')
+        self.assertEquals(kmeans['clusters'].shape, (12, 10))
+        self.assertEquals(kmeans['centers'].shape, (3, 30))
+        self.assert_same_clustering(kmeans['clusters'][:], self.labels)
+        self.assertTrue('kmeans_inertia' in kmeans.run_info)
+
+
+if __name__ == '__main__':
+    unittest.main()
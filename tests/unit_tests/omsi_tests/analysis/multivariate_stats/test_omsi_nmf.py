@@ -0,0 +1,125 @@
+"""
+Basic testing for the NMF analysis and the streaming NMF engine.
+"""
+import unittest
+import tempfile
+import numpy as np
+import h5py
+from omsi.analysis.multivariate_stats.omsi_nmf import omsi_nmf
+from omsi.analysis.multivariate_stats import nmf_streaming
+
+
+class test_omsi_nmf(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        self.named_temporary_file = tempfile.NamedTemporaryFile()
+        self.h5py_file = h5py.File(self.named_temporary_file.name, 'w')
+        random_state = np.random.RandomState(0)
+        # Exactly low-rank nonnegative data
+        self.temp_data = np.dot(random_state.rand(12, 10, 3), random_state.rand(3, 40) * 100)
+        self.dataset = self.h5py_file.create_dataset('data', data=self.temp_data, chunks=(4, 5, 40))
+        self.mask = np.ones((12, 10), dtype='bool')
+        self.mask[0:4, :] = False
+
+    def tearDown(self):
+        # Clean up the test suite
+        self.h5py_file.close()
+        del self.h5py_file
+        del self.named_temporary_file
+
+    def test_nndsvd(self):
+        data = self.temp_data.reshape((-1, 40)).T
+        for init in nmf_streaming.INIT_METHODS:
+            w_matrix, h_matrix = nmf_streaming.initialize_nmf(data, 5, init=init,
+                                                              random_state=np.random.RandomState(0))
+            self.assertEquals(w_matrix.shape, (40, 5))
+            self.assertEquals(h_matrix.shape, (5, 120))
+            self.assertTrue(np.all(w_matrix >= 0))
+            self.assertTrue(np.all(h_matrix >= 0))
+        # NNDSVD is deterministic and exact for rank-1 data
+        rank_one = np.outer(np.arange(1, 41), np.arange(1, 121)).astype('float')
+        w_matrix, h_matrix = nmf_streaming.nndsvd(rank_one, 1)
+        self.assertTrue(np.allclose(np.dot(w_matrix, h_matrix), rank_one))
+        # The initialization can be computed from a sample of the spectra
+        for init in ['nndsvd', 'nndsvda']:
+            w_matrix, h_matrix = nmf_streaming.initialize_nmf(data, 3, init=init,
+                                                              random_state=np.random.RandomState(0),
+                                                              sample_size=30)
+            self.assertEquals(w_matrix.shape, (40, 3))
+            self.assertEquals(h_matrix.shape, (3, 120))
+            self.assertTrue(np.all(w_matrix >= 0))
+            self.assertTrue(np.all(h_matrix >= 0))
+
+    def test_truncated_svd(self):
+        data = self.temp_data.reshape((-1, 40)).T
+        s_values = np.linalg.svd(data, compute_uv=False)
+        for matrix in [data, data.T]:
+            u_matrix, t_values, v_matrix = nmf_streaming.truncated_svd(matrix, 5)
+            # The data has rank 3 so only 3 singular values are returned
+            self.assertEquals(t_values.shape, (3, ))
+            self.assertTrue(np.allclose(t_values, s_values[0:3]))
+            self.assertTrue(np.allclose(np.dot(u_matrix * t_values, v_matrix), matrix))
+
+    def test_streaming_nmf(self):
+        for max_block_bytes, num_io_threads in [(256 * 1024 * 1024, 1), (2000, 0), (2000, 2)]:
+            w_matrix, h_matrix, info = nmf_streaming.streaming_nmf(data=self.dataset,
+                                                                   num_components=3,
+                                                                   random_state=np.random.RandomState(0),
+                                                                   max_epochs=50,
+                                                                   max_bytes=max_block_bytes,
+                                                                   num_threads=num_io_threads)
+            self.assertEquals(w_matrix.shape, (40, 3))
+            self.assertEquals(h_matrix.shape, (12, 10, 3))
+            self.assertTrue(np.all(w_matrix >= 0) and np.all(h_matrix >= 0))
+            reconstruction = np.dot(h_matrix, w_matrix.T)
+            self.assertLess(np.linalg.norm(reconstruction - self.temp_data) / np.linalg.norm(self.temp_data), 0.05)
+            self.assertAlmostEqual(info['relative_error'],
+                                   np.linalg.norm(reconstruction - self.temp_data) / np.linalg.norm(self.temp_data),
+                                   places=5)
+            self.assertEquals(len(info['epoch_errors']), info['num_epochs'])
+
+    def test_streaming_nmf_mask(self):
+        w_matrix, h_matrix, info = nmf_streaming.streaming_nmf(data=self.dataset,
+                                                               num_components=3,
+                                                               out=np.ones((12, 10, 3)),
+                                                               mask=self.mask,
+                                                               random_state=np.random.RandomState(0),
+                                                               max_bytes=2000)
+        self.assertTrue(np.all(h_matrix[0:4] == 0))
+        self.assertTrue(np.all(h_matrix[4:].sum(axis=-1) > 0))
+
+    def test_omsi_nmf_streaming(self):
+        nmf = omsi_nmf()
+        nmf.execute(msidata=self.dataset,
+                    numComponents=3,
+                    method='streaming',
+                    max_block_bytes=2000,
+                    seed=1)
+        self.assertEquals(nmf['wo'].shape, (40, 3))
+        self.assertEquals(nmf['ho'].shape, (12, 10, 3))
+        self.assertTrue(nmf.run_info['nmf_relative_error'] < 0.05)
+        self.assertTrue('nmf_epoch_errors' in nmf.run_info)
+        # The same seed gives the same result
+        nmf_repeat = omsi_nmf()
+        nmf_repeat.execute(msidata=self.dataset,
+                           numComponents=3,
+                           method='streaming',
+                           max_block_bytes=2000,
+                           seed=1)
+        self.assertTrue(np.allclose(nmf['wo'][:], nmf_repeat['wo'][:]))
+
+    def test_omsi_nmf_in_memory(self):
+        nmf = omsi_nmf()
+        nmf.execute(msidata=self.dataset,
+                    numComponents=3,
+                    mask=self.mask,
+                    numIter=200)
+        self.assertEquals(nmf['ho'].shape, (12, 10, 3))
+        self.assertTrue(np.all(nmf['ho'][0:4] == 0))
+        self.assertTrue('nmf_relative_error' in nmf.run_info)
+
+
+if __name__ == '__main__':
+    unittest.main()
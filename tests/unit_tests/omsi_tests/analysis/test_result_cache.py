@@ -0,0 +1,126 @@
+"""
+Testing for the content-addressed result cache of analyses.
+"""
+import unittest
+import tempfile
+import shutil
+import os
+import numpy as np
+from omsi.analysis.generic import analysis_generic
+from omsi.analysis.result_cache import analysis_result_cache
+from omsi.dataformat.omsi_file.main_file import omsi_file
+
+EXECUTION_COUNT = [0]
+
+
+def scale_data(data, scale=1):
+    """Analysis function used for testing"""
+    EXECUTION_COUNT[0] += 1
+    return data * scale
+
+
+class test_result_cache(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        self.cache_directory = tempfile.mkdtemp()
+        self.named_temporary_file = tempfile.NamedTemporaryFile(suffix='.h5')
+        self.data = np.arange(100)
+        EXECUTION_COUNT[0] = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_directory, ignore_errors=True)
+        del self.named_temporary_file
+
+    def create_analysis(self, result_cache, scale=2):
+        analysis = analysis_generic.from_function(scale_data)
+        analysis.result_cache = result_cache
+        analysis['data'] = self.data
+        analysis['scale'] = scale
+        return analysis
+
+    def test_get_key(self):
+        result_cache = analysis_result_cache()
+        key = result_cache.get_key(self.create_analysis(result_cache))
+        self.assertEquals(key, result_cache.get_key(self.create_analysis(result_cache)))
+        self.assertNotEquals(key, result_cache.get_key(self.create_analysis(result_cache, scale=3)))
+        with self.assertRaises(ValueError):
+            analysis_result_cache(input_identity='mtime')
+
+    def test_get_code_version(self):
+        # Create a package with an analysis module that imports a helper module inside of a function
+        package_root = tempfile.mkdtemp(dir=self.cache_directory)
+        os.mkdir(os.path.join(package_root, 'cachetestpkg'))
+        sources = {'__init__.py': '',
+                   'helper.py': 'def compute(data):\n    return data * 2\n',
+                   'analysis.py': 'import os\n\n\ndef execute(data):\n' +
+                                  '    from cachetestpkg import helper\n    return helper.compute(data)\n'}
+        for name, source in sources.items():
+            with open(os.path.join(package_root, 'cachetestpkg', name), 'w') as source_file:
+                source_file.write(source)
+        analysis_file = os.path.join(package_root, 'cachetestpkg', 'analysis.py')
+        helper_file = os.path.join(package_root, 'cachetestpkg', 'helper.py')
+        source_files = analysis_result_cache.get_source_files(analysis_file,
+                                                              package_name='cachetestpkg',
+                                                              package_root=package_root)
+        self.assertListEqual(source_files, sorted([os.path.abspath(analysis_file), os.path.abspath(helper_file)]))
+        code_version = analysis_result_cache.get_source_digest(source_files)
+        # Editing the helper module changes the code version
+        with open(helper_file, 'w') as source_file:
+            source_file.write('def compute(data):\n    return data * 3\n')
+        self.assertNotEquals(code_version, analysis_result_cache.get_source_digest(source_files))
+        # The helper modules of the analyses of the omsi package are included
+        from omsi.analysis.multivariate_stats import omsi_nmf, nmf_streaming
+        source_files = analysis_result_cache.get_source_files(omsi_nmf.__file__.replace('.pyc', '.py'))
+        self.assertIn(os.path.abspath(nmf_streaming.__file__.replace('.pyc', '.py')), source_files)
+
+    def test_get_key_dependencies(self):
+        result_cache = analysis_result_cache()
+        keys = []
+        for scale in [2, 3]:
+            upstream = self.create_analysis(result_cache, scale=scale)
+            downstream = self.create_analysis(result_cache)
+            downstream['data'] = upstream['output_0']
+            keys.append(result_cache.get_key(downstream))
+        self.assertNotEquals(keys[0], keys[1])
+
+    def test_cache_directory(self):
+        result_cache = analysis_result_cache(cache_directory=self.cache_directory)
+        analysis = self.create_analysis(result_cache)
+        analysis.execute()
+        self.assertFalse(analysis.run_info['cache_hit'])
+        self.assertEquals(result_cache.stores, 1)
+        # Executing the same analysis again reuses the stored outputs
+        analysis = self.create_analysis(result_cache)
+        output = analysis.execute()
+        self.assertTrue(analysis.run_info['cache_hit'])
+        self.assertEquals(analysis.run_info['cache_hits'], 1)
+        self.assertEquals(EXECUTION_COUNT[0], 1)
+        self.assertTrue(np.all(output == self.data * 2))
+        self.assertTrue(np.all(analysis['output_0'] == self.data * 2))
+        self.assertFalse(analysis.update_analysis)
+        # Changing the parameters results in a new execution
+        self.create_analysis(result_cache, scale=3).execute()
+        self.assertEquals(EXECUTION_COUNT[0], 2)
+        self.assertEquals(result_cache.misses, 2)
+
+    def test_omsi_file(self):
+        analysis = self.create_analysis(analysis_result_cache())
+        analysis.execute()
+        output_file = omsi_file(self.named_temporary_file.name, 'a')
+        experiment = output_file.create_experiment()
+        experiment.create_analysis(analysis)
+        output_file.flush()
+        # Reuse the outputs of the analysis stored in the file
+        result_cache = analysis_result_cache(omsi_files=output_file)
+        analysis = self.create_analysis(result_cache)
+        analysis.execute()
+        self.assertTrue(analysis.run_info['cache_hit'])
+        self.assertEquals(EXECUTION_COUNT[0], 1)
+        self.assertTrue(np.all(analysis['output_0'] == self.data * 2))
+        output_file.close_file()
+
+
+if __name__ == '__main__':
+    unittest.main()
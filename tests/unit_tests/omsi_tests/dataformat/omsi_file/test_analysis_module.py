@@ -4,6 +4,7 @@ This includes functionality across many of the modules.
 """
 import unittest
 import tempfile
+import h5py
 
 from omsi.dataformat.omsi_file.main_file import omsi_file
 from omsi.analysis.generic import analysis_generic
@@ -11,6 +12,13 @@ from omsi.datastructures.analysis_data import analysis_data
 from omsi.dataformat.omsi_file.analysis import omsi_file_analysis
 import numpy as np
 
+OUTPUT_DATASETS = {}
+
+
+def get_output_dataset(name):
+    """Analysis function used for testing"""
+    return OUTPUT_DATASETS[name]
+
 
 class test_omsi_file_analysis(unittest.TestCase):
 
@@ -45,6 +53,26 @@ class test_omsi_file_analysis(unittest.TestCase):
         self.assertEquals(tempanatype, testana.get_analysis_type())
         self.assertIsInstance(self.exp.get_analysis_by_identifier(testanaidname), omsi_file_analysis)
 
+    def test_create_analysis_h5py_output(self):
+        # Outputs stored in a h5py.Dataset of another file are copied blockwise and stay out-of-core
+        output_temporary_file = tempfile.NamedTemporaryFile()
+        output_file = h5py.File(output_temporary_file.name, 'w')
+        output_dataset = output_file.create_dataset('output', data=np.arange(3000).reshape((1000, 3)))
+        OUTPUT_DATASETS['output'] = output_dataset
+        testana = analysis_generic.from_function(get_output_dataset, name_key='h5py output')
+        testana.execute(name='output')
+        self.assertIsInstance(testana['output_0'], h5py.Dataset)
+        copy_block_bytes = omsi_file_analysis.copy_block_bytes
+        omsi_file_analysis.copy_block_bytes = 1000
+        try:
+            analysis, _ = self.exp.create_analysis(testana)
+        finally:
+            omsi_file_analysis.copy_block_bytes = copy_block_bytes
+        self.assertTrue(np.all(analysis['output_0'][:] == output_dataset[:]))
+        del OUTPUT_DATASETS['output']
+        output_file.close()
+        del output_temporary_file
+
 
     """
     print "Creating derived analysis"
@@ -0,0 +1,69 @@
+"""
+Basic testing for the in-memory block cache of the omsi_file package.
+"""
+import unittest
+import tempfile
+import numpy as np
+from omsi.dataformat.omsi_file.main_file import omsi_file
+from omsi.dataformat.omsi_file.msidata import omsi_file_msidata
+from omsi.dataformat.omsi_file.block_cache import omsi_block_cache
+
+
+class test_omsi_block_cache(unittest.TestCase):
+
+    def setUp(self):
+        self.named_temporary_file = tempfile.NamedTemporaryFile()
+        self.test_filename = self.named_temporary_file.name
+        self.testfile = omsi_file(self.test_filename)
+        self.exp = self.testfile.create_experiment()
+        self.temp_data = np.random.rand(9, 11, 300).astype('float32')
+        data_dataset, _, self.datagroup = self.exp.create_msidata_full_cube(data_shape=self.temp_data.shape,
+                                                                            chunks=(2, 3, 64))
+        data_dataset[:] = self.temp_data
+
+    def tearDown(self):
+        # Clean up the test suite
+        del self.testfile
+        del self.test_filename
+        del self.named_temporary_file
+
+    def test_cached_selections(self):
+        cache = omsi_block_cache(max_bytes=100000)
+        test_omsi_file_msidata_object = omsi_file_msidata(self.datagroup, block_cache=cache)
+        selections = [(slice(None), slice(None), 5),
+                      (1, 2, slice(None)),
+                      (slice(1, 8, 3), [0, 4, 10], slice(10, 200, 7)),
+                      (-1, -2, -3)]
+        for selection in selections:
+            for _ in range(2):
+                self.assertTrue(np.all(test_omsi_file_msidata_object[selection] == self.temp_data[selection]),
+                                msg='Cached selection ' + str(selection) + ' failed.')
+        statistics = cache.get_statistics()
+        self.assertGreater(statistics['hits'], 0)
+        self.assertGreater(statistics['misses'], 0)
+        self.assertLessEqual(statistics['current_bytes'], cache.max_bytes)
+
+    def test_eviction_and_invalidation(self):
+        cache = omsi_block_cache(max_bytes=2 * 3 * 64 * 4 * 3)
+        test_omsi_file_msidata_object = omsi_file_msidata(self.datagroup, block_cache=cache)
+        self.assertTrue(np.all(test_omsi_file_msidata_object[0, :, :] == self.temp_data[0, :, :]))
+        self.assertLessEqual(cache.current_bytes, cache.max_bytes)
+        self.assertGreater(cache.evictions, 0)
+        # Writing data must invalidate the cached blocks
+        test_omsi_file_msidata_object[0, 0, :] = np.zeros(300, dtype='float32')
+        self.temp_data[0, 0, :] = 0
+        self.assertTrue(np.all(test_omsi_file_msidata_object[0, :, :] == self.temp_data[0, :, :]))
+
+    def test_tune_chunk_cache(self):
+        test_omsi_file_msidata_object = omsi_file_msidata(self.datagroup)
+        test_omsi_file_msidata_object.create_optimized_chunking(chunks=(9, 11, 1))
+        settings = test_omsi_file_msidata_object.tune_chunk_cache(max_nbytes=4 * 1024 * 1024)
+        self.assertEquals(len(settings), 2)
+        for rdcc_nslots, rdcc_nbytes in settings:
+            self.assertGreater(rdcc_nslots, 0)
+            self.assertLessEqual(rdcc_nbytes, 4 * 1024 * 1024)
+        self.assertTrue(np.all(test_omsi_file_msidata_object[:, :, 7] == self.temp_data[:, :, 7]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Basic testing for the chunk-aligned buffered writer of the omsi_file package.
+"""
+import unittest
+import tempfile
+import numpy as np
+import h5py
+from omsi.dataformat.omsi_file.buffered_writer import omsi_buffered_writer
+
+
+class test_omsi_buffered_writer(unittest.TestCase):
+
+    def setUp(self):
+        self.named_temporary_file = tempfile.NamedTemporaryFile()
+        self.h5py_file = h5py.File(self.named_temporary_file.name, 'w')
+        self.temp_data = np.random.rand(10, 7, 50).astype('float32')
+        self.chunks = (4, 4, 16)
+
+    def tearDown(self):
+        # Clean up the test suite
+        self.h5py_file.close()
+        del self.h5py_file
+        del self.named_temporary_file
+
+    def get_spectra(self, missing=(), shuffle=True):
+        """Get a list of ((x, y), spectrum) tuples of the test data"""
+        spectra = [((x, y), self.temp_data[x, y, :])
+                   for x in range(self.temp_data.shape[0])
+                   for y in range(self.temp_data.shape[1])
+                   if (x, y) not in missing]
+        if shuffle:
+            np.random.RandomState(0).shuffle(spectra)
+        return spectra
+
+    def test_write_spectra(self):
+        # The different memory limits correspond to: all tiles in memory, spilling, and tiles larger than the limit
+        for max_bytes in [1024 * 1024, 4 * 7 * 50 * 4 + 1, 100]:
+            dataset = self.h5py_file.create_dataset('data_' + str(max_bytes),
+                                                    shape=self.temp_data.shape,
+                                                    dtype='float32',
+                                                    chunks=self.chunks)
+            writer = omsi_buffered_writer(data=dataset, max_bytes=max_bytes)
+            self.assertEquals(writer.tile_x, 4)
+            self.assertEquals(writer.write_spectra(self.get_spectra()), 70)
+            writer.close()
+            self.assertTrue(np.all(dataset[:] == self.temp_data), msg='Write failed for max_bytes=' + str(max_bytes))
+            self.assertEquals(writer.num_tiles_written, 3)
+            if max_bytes < 1024 * 1024:
+                self.assertGreater(writer.num_tiles_spilled, 0)
+
+    def test_missing_and_duplicate_spectra(self):
+        dataset = self.h5py_file.create_dataset('data', shape=self.temp_data.shape, dtype='float32', chunks=self.chunks)
+        writer = omsi_buffered_writer(data=dataset)
+        writer.write_spectra(self.get_spectra(missing=[(9, 6)], shuffle=False))
+        # All tiles but the last one (which is missing a spectrum) are written once they are complete
+        self.assertEquals(writer.num_tiles_written, 2)
+        # Duplicate spectra of tiles that have already been written are written directly
+        writer.write_spectrum(0, 0, np.ones(50, dtype='float32'))
+        writer.close()
+        self.temp_data[9, 6, :] = 0
+        self.temp_data[0, 0, :] = 1
+        self.assertTrue(np.all(dataset[:] == self.temp_data))
+
+
+if __name__ == '__main__':
+    unittest.main()
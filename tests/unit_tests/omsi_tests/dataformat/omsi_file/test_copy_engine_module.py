@@ -0,0 +1,72 @@
+"""
+Basic testing for the chunk-aligned copy engine of the omsi_file package.
+"""
+import unittest
+import tempfile
+import h5py
+import numpy as np
+from omsi.dataformat.omsi_file.copy_engine import omsi_copy_engine
+
+
+class test_omsi_copy_engine(unittest.TestCase):
+
+    def setUp(self):
+        self.named_temporary_file = tempfile.NamedTemporaryFile()
+        self.test_filename = self.named_temporary_file.name
+        self.testfile = h5py.File(self.test_filename, 'w')
+        self.temp_data = np.random.rand(17, 13, 501).astype('float32')
+
+    def tearDown(self):
+        # Clean up the test suite
+        self.testfile.close()
+        del self.testfile
+        del self.test_filename
+        del self.named_temporary_file
+
+    def test_copy(self):
+        layouts = [((4, 4, 256), 'gzip', (10, 10, 1), 'gzip'),
+                   ((4, 4, 256), None, (10, 10, 7), None),
+                   ((3, 5, 100), 'gzip', (7, 2, 1), 'lzf'),
+                   (None, None, (4, 4, 100), 'gzip')]
+        for index, (source_chunks, source_compression, dest_chunks, dest_compression) in enumerate(layouts):
+            source = self.testfile.create_dataset('source_%i' % index,
+                                                  data=self.temp_data,
+                                                  chunks=source_chunks,
+                                                  compression=source_compression)
+            for max_buffer_bytes in [256 * 1024 * 1024, 100000]:
+                destination = self.testfile.create_dataset('dest_%i_%i' % (index, max_buffer_bytes),
+                                                           shape=self.temp_data.shape,
+                                                           dtype=self.temp_data.dtype,
+                                                           chunks=dest_chunks,
+                                                           compression=dest_compression)
+                copy_engine = omsi_copy_engine(source=source,
+                                               destination=destination,
+                                               num_workers=2,
+                                               max_buffer_bytes=max_buffer_bytes)
+                statistics = copy_engine.copy()
+                self.assertTrue(np.array_equal(destination[:], self.temp_data),
+                                msg='Copy failed for layout ' + str(layouts[index]))
+                self.assertGreater(statistics['throughput_mb_s'], 0)
+
+    def test_copy_incompressible_chunks(self):
+        # HDF5 stores chunks that deflate cannot compress unfiltered and marks them in the filter mask
+        data = np.zeros((8, 4, 256), dtype='uint8')
+        data[4:] = np.random.randint(0, 256, size=(4, 4, 256))
+        source = self.testfile.create_dataset('source', data=data, chunks=(4, 4, 256), compression='gzip')
+        destination = self.testfile.create_dataset('dest', shape=data.shape, dtype=data.dtype,
+                                                   chunks=(2, 2, 256), compression='gzip')
+        statistics = omsi_copy_engine(source=source, destination=destination, num_workers=2).copy()
+        self.assertTrue(statistics['raw_read'])
+        self.assertTrue(np.array_equal(destination[:], data))
+
+    def test_plan_tiles(self):
+        source = self.testfile.create_dataset('source', shape=(20, 20, 1000), dtype='float32', chunks=(4, 4, 200))
+        destination = self.testfile.create_dataset('dest', shape=(20, 20, 1000), dtype='float32', chunks=(10, 10, 1))
+        tile_shape, tiles = omsi_copy_engine(source, destination).plan_tiles()
+        # The tiles must be aligned with both the source and destination chunking
+        self.assertEquals(tile_shape, (20, 20, 200))
+        self.assertEquals(len(tiles), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
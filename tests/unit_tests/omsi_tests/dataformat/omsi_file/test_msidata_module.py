@@ -82,6 +82,120 @@ class test_omsi_file_msidata(unittest.TestCase):
         # Test that the number of msi datasets is 1
         self.assertEquals(self.exp.get_num_msidata(), 1)
 
+    def test_create_msidata_partial_spectra(self):
+        # Test the creation and interaction with a partial spectra dataset
+        tempshape = tuple([6, 7, 50])
+        random_state = np.random.RandomState(0)
+        temp_cube = np.zeros(tempshape, dtype='f')
+        for x_index in range(tempshape[0]):
+            for y_index in range(tempshape[1]):
+                if random_state.rand() < 0.8:
+                    peaks = random_state.choice(tempshape[2], random_state.randint(1, 10), replace=False)
+                    temp_cube[x_index, y_index, peaks] = random_state.rand(peaks.size) + 1
+        spectra_length = (temp_cube > 0).sum(axis=2)
+        mask = spectra_length > 0
+        data_dataset, mz_index_dataset, mz_dataset, xy_index_dataset, xy_index_end_dataset, datagroup = \
+            self.exp.create_msidata_partial_spectra(spectra_length=spectra_length,
+                                                    len_global_mz=tempshape[2])
+        self.assertIsInstance(data_dataset, h5py.Dataset, msg='Check type of partial msi dataset')
+        self.assertIsInstance(mz_index_dataset, h5py.Dataset, msg='Check type of mz index dataset')
+        self.assertIsInstance(datagroup, h5py.Group, msg='Check type of data group')
+        data_dataset[:] = temp_cube[mask][temp_cube[mask] > 0]
+        mz_index_dataset[:] = np.nonzero(temp_cube[mask])[1]
+
+        # Test slicing against the data
+        test_omsi_file_msidata_object = omsi_file_msidata(datagroup)
+        self.assertTrue(np.all(test_omsi_file_msidata_object.shape == tempshape))
+        selections = [(slice(None), slice(None), slice(None)),
+                      (1, 2, slice(None)),
+                      (slice(None), slice(None), 5),
+                      (slice(1, 4), slice(2, 6), slice(3, 40, 2)),
+                      ([0, 3, 5], slice(None), slice(None)),
+                      (slice(None), 2, [7, 3, 3, 10]),
+                      (slice(0, 6, 5), slice(None), slice(None))]
+        for selection in selections:
+            self.assertTrue(np.all(test_omsi_file_msidata_object[selection] == temp_cube[selection]),
+                            msg='Slicing with ' + str(selection) + ' failed.')
+
+        # Test retrieving the peaks without filling the spectra
+        test_omsi_file_msidata_object.set_fill_spectra(False)
+        x_index, y_index = np.argwhere(mask)[0]
+        values, mz_indices = test_omsi_file_msidata_object[int(x_index), int(y_index), :]
+        self.assertTrue(np.all(values[0] == temp_cube[x_index, y_index, mz_indices[0]]))
+        self.assertEquals(values[0].size, spectra_length[x_index, y_index])
+
+    def test_best_dataset(self):
+        # Test that the dataset with the fewest chunks touched is selected
+        tempshape = tuple([20, 20, 500])
+        data_dataset, _, datagroup = self.exp.create_msidata_full_cube(data_shape=tempshape,
+                                                                       chunks=(1, 1, 500))
+        data_dataset[:] = np.random.rand(*tempshape)
+        test_omsi_file_msidata_object = omsi_file_msidata(datagroup)
+        test_omsi_file_msidata_object.create_optimized_chunking(chunks=(20, 20, 1))
+        spectrum_chunking = test_omsi_file_msidata_object.datasets[0].chunks
+        slice_chunking = test_omsi_file_msidata_object.datasets[1].chunks
+        self.assertEquals(test_omsi_file_msidata_object.__best_dataset__((slice(None), slice(None), 5)).chunks,
+                          slice_chunking)
+        self.assertEquals(test_omsi_file_msidata_object.__best_dataset__((1, 2, slice(None))).chunks,
+                          spectrum_chunking)
+        # A strided selection touches only few spectra but all m/z values
+        self.assertEquals(test_omsi_file_msidata_object.__best_dataset__((slice(0, 20, 10),
+                                                                          slice(0, 20, 10),
+                                                                          slice(None))).chunks,
+                          spectrum_chunking)
+        # Repeated decisions are served from the cache
+        self.assertEquals(test_omsi_file_msidata_object.__best_dataset__((slice(None), slice(None), 5)).chunks,
+                          slice_chunking)
+        # Selections of the same shape at different positions are served from the cache as well
+        self.assertEquals(test_omsi_file_msidata_object.__selection_pattern__((slice(None), slice(None), 5)),
+                          test_omsi_file_msidata_object.__selection_pattern__((slice(None), slice(None), 7)))
+        self.assertNotEquals(test_omsi_file_msidata_object.__selection_pattern__((slice(None), slice(None), 5)),
+                             test_omsi_file_msidata_object.__selection_pattern__((slice(0, 2), slice(None), 5)))
+
+        def fail_selection_cost(keys):
+            self.fail('The cost of the selection ' + str(keys) + ' should not be recomputed')
+        test_omsi_file_msidata_object.__selection_cost__ = fail_selection_cost
+        self.assertEquals(test_omsi_file_msidata_object.__best_dataset__((slice(None), slice(None), 7)).chunks,
+                          slice_chunking)
+        self.assertEquals(test_omsi_file_msidata_object.__best_dataset__((3, 4, slice(None))).chunks,
+                          spectrum_chunking)
+
+    def test_reduce(self):
+        # Test streaming reductions of a full cube with multiple copies of the data
+        tempshape = tuple([20, 20, 500])
+        temp_data = np.random.rand(*tempshape)
+        data_dataset, _, datagroup = self.exp.create_msidata_full_cube(data_shape=tempshape,
+                                                                       chunks=(1, 1, 500))
+        data_dataset[:] = temp_data
+        temp_data = data_dataset[:]
+        test_omsi_file_msidata_object = omsi_file_msidata(datagroup)
+        test_omsi_file_msidata_object.create_optimized_chunking(chunks=(20, 20, 1))
+        # A block of complete spectra of the image-chunked copy does not fit into max_bytes
+        self.assertEquals(test_omsi_file_msidata_object.get_scan_dataset(max_bytes=1024*1024).chunks,
+                          test_omsi_file_msidata_object.datasets[0].chunks)
+        mean_spectrum, max_image = test_omsi_file_msidata_object.reduce(['mean', 'max'], axis=(0, 1))
+        self.assertTrue(np.allclose(mean_spectrum, temp_data.mean(axis=(0, 1))))
+        self.assertTrue(np.all(max_image == temp_data.max(axis=(0, 1))))
+        self.assertTrue(np.allclose(test_omsi_file_msidata_object.reduce('sum', axis=2, max_bytes=10000),
+                                    temp_data.sum(axis=2)))
+        self.assertTrue(np.all(test_omsi_file_msidata_object.reduce('percentile', axis=2, q=50) ==
+                               np.percentile(temp_data, 50, axis=2)))
+
+        # Test streaming reductions of a partial cube
+        mask = np.zeros((10, 10), dtype='bool')
+        mask[1:8, 5:10] = True
+        _, _, _, _, datagroup = self.exp.create_msidata_partial_cube(data_shape=(10, 10, 100),
+                                                                     mask=mask,
+                                                                     chunks=(1, 1, 100))
+        partial_msidata = omsi_file_msidata(datagroup)
+        temp_data = np.zeros((10, 10, 100))
+        temp_data[1:8, 5:10, :] = np.random.rand(7, 5, 100)
+        partial_msidata[1:8, 5:10, :] = temp_data[1:8, 5:10, :]
+        temp_data = partial_msidata[:]
+        self.assertTrue(partial_msidata.get_scan_dataset() is partial_msidata)
+        self.assertTrue(np.allclose(partial_msidata.reduce('sum', axis=2), temp_data.sum(axis=2)))
+        self.assertEquals(partial_msidata.reduce('count_nonzero'), 7 * 5 * 100)
+
 
 if __name__ == '__main__':
     unittest.main()
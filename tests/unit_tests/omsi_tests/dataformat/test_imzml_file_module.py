@@ -0,0 +1,87 @@
+"""
+Basic testing for the imzml file reader and its out-of-core read path.
+"""
+import unittest
+import tempfile
+import shutil
+import os
+import numpy as np
+from omsi.dataformat import imzml_available
+
+
+@unittest.skipUnless(imzml_available(), "pyimzml is not available")
+class test_imzml_file(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_test_file(self, mode, xdim=3, ydim=4):
+        """
+        Write a small imzML/ibd file pair. The last pixel of the image has no spectrum.
+
+        :returns: Tuple of the name of the imzML file and a dict mapping (x index, y index) to the
+            (mz, intensity) arrays of the spectrum
+        """
+        from pyimzml.ImzMLWriter import ImzMLWriter
+        filename = os.path.join(self.temp_dir, 'test_' + mode + '.imzML')
+        random_state = np.random.RandomState(0)
+        spectra = {}
+        with ImzMLWriter(filename, mode=mode) as writer:
+            for x_index in range(xdim):
+                for y_index in range(ydim):
+                    if x_index == xdim - 1 and y_index == ydim - 1:
+                        continue
+                    if mode == 'continuous':
+                        mz = np.linspace(100., 200., 40)
+                    else:
+                        mz = np.sort(random_state.uniform(100., 200., 40))
+                    intensity = (random_state.rand(40) * 1000).astype('float32')
+                    spectra[(x_index, y_index)] = (mz, intensity)
+                    writer.addSpectrum(mz, intensity, (x_index + 1, y_index + 1, 1))
+        return filename, spectra
+
+    def check_lazy_reads(self, filename):
+        """Compare the out-of-core read path against the data read into memory"""
+        from omsi.dataformat.imzml_file import imzml_file
+        in_memory_imzml_file = imzml_file(filename, requires_slicing=True)
+        lazy_imzml_file = imzml_file(filename, requires_slicing=False, block_size=2)
+        self.assertIsNone(lazy_imzml_file.data)
+        self.assertEquals(lazy_imzml_file.shape, in_memory_imzml_file.shape)
+        selections = [(1, 2, slice(None)),
+                      (slice(None), slice(None), 5),
+                      (slice(None), slice(None), slice(None)),
+                      (slice(1, 3), [0, 3], slice(3, 30, 4))]
+        for selection in selections:
+            self.assertTrue(np.array_equal(lazy_imzml_file[selection], in_memory_imzml_file[selection]),
+                            msg='Selection ' + str(selection) + ' failed.')
+        num_spectra = 0
+        for (x_index, y_index), spectrum in lazy_imzml_file.spectrum_iter():
+            self.assertTrue(np.array_equal(spectrum, in_memory_imzml_file[x_index, y_index, :]))
+            num_spectra += 1
+        self.assertEquals(num_spectra, lazy_imzml_file.num_scans)
+        lazy_imzml_file.close_file()
+        return in_memory_imzml_file
+
+    def test_continuous(self):
+        filename, spectra = self.write_test_file(mode='continuous')
+        test_imzml_file = self.check_lazy_reads(filename)
+        self.assertEquals(test_imzml_file.imzml_type, test_imzml_file.available_imzml_types['continuous'])
+        self.assertEquals(test_imzml_file.shape, (3, 4, 40))
+        for (x_index, y_index), (mz, intensity) in spectra.items():
+            self.assertTrue(np.allclose(test_imzml_file[x_index, y_index, :], intensity))
+        self.assertTrue(np.all(test_imzml_file[2, 3, :] == 0))
+
+    def test_processed(self):
+        filename, spectra = self.write_test_file(mode='processed')
+        test_imzml_file = self.check_lazy_reads(filename)
+        self.assertEquals(test_imzml_file.imzml_type, test_imzml_file.available_imzml_types['processed'])
+        self.assertTrue(np.all(test_imzml_file[2, 3, :] == 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+"""
+Basic testing for the indexed mzml file reader.
+"""
+import unittest
+import tempfile
+import shutil
+import os
+import base64
+import struct
+import zlib
+import numpy as np
+from omsi.dataformat.mzml_file import mzml_file
+
+
+class test_mzml_file(unittest.TestCase):
+
+    scan_types = [('FTMS + p MALDI Full ms [100.00-200.00]', 100., 200.),
+                  ('ITMS + p MALDI Z ms2 150.00@cid60.00 [50.00-150.00]', 50., 150.)]
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.test_filename = os.path.join(self.temp_dir, 'test.mzML')
+        self.spectra = self.write_test_file(self.test_filename, xdim=4, ydim=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    @classmethod
+    def write_test_file(cls, filename, xdim, ydim):
+        """
+        Write a small thermo-style mzML file with two scan types.
+
+        :returns: Dict mapping (scan type, x index, y index) to the (mz, intensity) arrays of the spectrum
+        """
+        def encode(values, dtype, compress):
+            data = np.asarray(values, dtype=dtype).tostring()
+            return base64.b64encode(zlib.compress(data) if compress else data)
+
+        random_state = np.random.RandomState(0)
+        spectra = {}
+        lines = ['<?xml version="1.0" encoding="utf-8"?>',
+                 '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">',
+                 '<referenceableParamGroupList count="1">',
+                 '<referenceableParamGroup id="mz_encoding">',
+                 '<cvParam accession="MS:1000523" name="64-bit float" value=""/>',
+                 '<cvParam accession="MS:1000574" name="zlib compression" value=""/>',
+                 '</referenceableParamGroup>',
+                 '</referenceableParamGroupList>',
+                 '<run id="test"><spectrumList count="%i">' % (xdim * ydim * len(cls.scan_types))]
+        for x_index in range(xdim):
+            for y_index in range(ydim):
+                for scan_index, (scan_filter, mz_min, mz_max) in enumerate(cls.scan_types):
+                    num_peaks = 50 + random_state.randint(0, 10)
+                    mz = np.sort(random_state.uniform(mz_min, mz_max, num_peaks))
+                    intensity = (random_state.rand(num_peaks) * 1000).astype('float32')
+                    spectra[(scan_index, x_index, y_index)] = (mz, intensity)
+                    lines += ['<spectrum index="%i" id="scan=%i" spotID="0,%ix%i" defaultArrayLength="%i">' %
+                              (len(spectra) - 1, len(spectra), x_index + 10, y_index + 20, num_peaks),
+                              '<cvParam accession="MS:1000128" name="profile spectrum" value=""/>',
+                              '<scanList count="1"><scan>',
+                              '<cvParam accession="MS:1000512" name="filter string" value="%s"/>' % scan_filter,
+                              '<scanWindowList count="1"><scanWindow>',
+                              '<cvParam accession="MS:1000501" name="scan window lower limit" value="%f"/>' % mz_min,
+                              '<cvParam accession="MS:1000500" name="scan window upper limit" value="%f"/>' % mz_max,
+                              '</scanWindow></scanWindowList></scan></scanList>',
+                              '<binaryDataArrayList count="2">',
+                              '<binaryDataArray><referenceableParamGroupRef ref="mz_encoding"/>',
+                              '<cvParam accession="MS:1000514" name="m/z array" value=""/>',
+                              '<binary>%s</binary></binaryDataArray>' % encode(mz, '<f8', True),
+                              '<binaryDataArray><cvParam accession="MS:1000521" name="32-bit float" value=""/>',
+                              '<cvParam accession="MS:1000576" name="no compression" value=""/>',
+                              '<cvParam accession="MS:1000515" name="intensity array" value=""/>',
+                              '<binary>%s</binary></binaryDataArray>' % encode(intensity, '<f4', False),
+                              '</binaryDataArrayList></spectrum>']
+        lines += ['</spectrumList></run></mzML>']
+        with open(filename, 'w') as outfile:
+            outfile.write('\n'.join(lines))
+        return spectra
+
+    def test_spectrum_index(self):
+        test_mzml_file = mzml_file(self.test_filename, requires_slicing=False)
+        self.assertTrue(os.path.isfile(self.test_filename + mzml_file.index_file_extension))
+        self.assertEquals(test_mzml_file.num_scans, len(self.spectra))
+        self.assertEquals(test_mzml_file.mzml_type, mzml_file.available_mzml_types['thermo'])
+        self.assertEquals(test_mzml_file.scan_types, [scan_type[0] for scan_type in self.scan_types])
+        self.assertEquals(test_mzml_file.x_pos.tolist(), [10, 11, 12, 13])
+        self.assertEquals(test_mzml_file.y_pos.tolist(), [20, 21, 22])
+        # Reopening the file must use the saved index and give the same result
+        reopened_mzml_file = mzml_file(self.test_filename, requires_slicing=False)
+        for key in ['offsets', 'lengths', 'scan_indices', 'coordinates', 'mz_count']:
+            self.assertTrue(np.array_equal(test_mzml_file.spectrum_index[key], reopened_mzml_file.spectrum_index[key]))
+        self.assertEquals(test_mzml_file.scan_types, reopened_mzml_file.scan_types)
+
+    def test_spectrum_iter_and_slicing(self):
+        test_mzml_file = mzml_file(self.test_filename, requires_slicing=False)
+        in_memory_mzml_file = mzml_file(self.test_filename, requires_slicing=True)
+        for dataset_index in range(len(self.scan_types)):
+            test_mzml_file.set_dataset_selection(dataset_index)
+            in_memory_mzml_file.set_dataset_selection(dataset_index)
+            num_spectra = 0
+            for (x_index, y_index), spectrum in test_mzml_file.spectrum_iter():
+                mz, intensity = self.spectra[(dataset_index, x_index, y_index)]
+                self.assertTrue(np.allclose(spectrum, np.interp(test_mzml_file.mz, mz, intensity, 0, 0)))
+                num_spectra += 1
+            self.assertEquals(num_spectra, 12)
+            selections = [(1, 2, slice(None)),
+                          (slice(None), slice(None), 5),
+                          (slice(1, 3), [0, 2], slice(3, 30, 4))]
+            for selection in selections:
+                self.assertTrue(np.array_equal(test_mzml_file[selection], in_memory_mzml_file[selection]),
+                                msg='Selection ' + str(selection) + ' failed.')
+
+    def test_decode_numpress(self):
+        # Values [0, 1, 300] encoded with the half-byte encoding followed by a zero padding half-byte
+        self.assertListEqual(mzml_file.decode_numpress(b'\x87\x15\xc2\x10',
+                                                       'MS-Numpress positive integer compression').tolist(),
+                             [0., 1., 300.])
+        # Fixed point 100, the first two values, and the differences +50 and -100 to the linear extrapolation
+        linear_data = struct.pack('<dII', 100.0, 10000, 10100) + b'\x62\x3e\xc9'
+        self.assertTrue(np.allclose(mzml_file.decode_numpress(linear_data,
+                                                              'MS-Numpress linear prediction compression'),
+                                    [100., 101., 102.5, 103.]))
+        slof_data = struct.pack('<dHH', 1000.0, 0, 1000)
+        self.assertTrue(np.allclose(mzml_file.decode_numpress(slof_data,
+                                                              'MS-Numpress short logged float compression'),
+                                    [0., np.e - 1]))
+
+    def test_is_valid_dataset(self):
+        self.assertTrue(mzml_file.is_valid_dataset(self.test_filename))
+        invalid_filename = os.path.join(self.temp_dir, 'invalid.txt')
+        with open(invalid_filename, 'w') as outfile:
+            outfile.write('not an mzML file')
+        self.assertFalse(mzml_file.is_valid_dataset(invalid_filename))
+
+
+if __name__ == '__main__':
+    unittest.main()
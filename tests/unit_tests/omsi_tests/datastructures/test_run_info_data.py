@@ -0,0 +1,99 @@
+"""
+Test the recording of the peak memory usage by the omsi.datastructures.run_info_data module
+"""
+import unittest
+
+from omsi.datastructures.run_info_data import run_info_dict
+
+
+class test_run_info_dict(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        # Simulate the memory usage of the process and count the resets of the peak memory usage
+        self.num_resets = []
+        self.memory = {'current': 0, 'peak': 0}
+        self.reset_peak_memory_usage = run_info_dict.reset_peak_memory_usage
+        self.get_peak_memory_usage = run_info_dict.get_peak_memory_usage
+        self.get_memory_usage = run_info_dict.get_memory_usage
+        run_info_dict.reset_peak_memory_usage = staticmethod(self.reset_peak)
+        run_info_dict.get_peak_memory_usage = staticmethod(lambda: self.memory['peak'])
+        run_info_dict.get_memory_usage = staticmethod(lambda: self.memory['current'])
+
+    def tearDown(self):
+        run_info_dict.reset_peak_memory_usage = staticmethod(self.reset_peak_memory_usage)
+        run_info_dict.get_peak_memory_usage = staticmethod(self.get_peak_memory_usage)
+        run_info_dict.get_memory_usage = staticmethod(self.get_memory_usage)
+
+    def reset_peak(self):
+        self.num_resets.append(1)
+        self.memory['peak'] = self.memory['current']
+        return True
+
+    def allocate(self, num_bytes):
+        self.memory['current'] += num_bytes
+        self.memory['peak'] = max(self.memory['peak'], self.memory['current'])
+
+    def test_nested_recordings(self):
+        outer_run_info = run_info_dict()
+        inner_run_info = run_info_dict()
+        outer_run_info.gather_data = False
+        inner_run_info.gather_data = False
+
+        def inner():
+            self.assertEquals(run_info_dict.get_num_active_recordings(), 2)
+            return 1
+
+        def outer():
+            return inner_run_info(inner)() + inner_run_info(inner)()
+
+        self.assertEquals(outer_run_info(outer)(), 2)
+        # Each recording resets the peak memory usage
+        self.assertEquals(len(self.num_resets), 3)
+        self.assertEquals(run_info_dict.get_num_active_recordings(), 0)
+        self.assertIn('max_memory', outer_run_info)
+
+    def test_nested_peak_memory(self):
+        workflow_run_info = run_info_dict()
+        large_run_info = run_info_dict()
+        small_run_info = run_info_dict()
+        for run_info in (workflow_run_info, large_run_info, small_run_info):
+            run_info.gather_data = False
+
+        def analysis(num_bytes):
+            self.allocate(num_bytes)
+            self.allocate(-num_bytes)
+
+        def workflow():
+            self.allocate(50)
+            large_run_info(analysis)(1000)
+            small_run_info(analysis)(100)
+            self.allocate(-50)
+
+        self.allocate(10)
+        workflow_run_info(workflow)()
+        # Each analysis records its own peak, independent of the analyses executed before it
+        self.assertEquals(large_run_info['max_memory'] - large_run_info['start_memory'], 1000)
+        self.assertEquals(small_run_info['max_memory'] - small_run_info['start_memory'], 100)
+        # The enclosing recording records the peak of all nested recordings
+        self.assertEquals(workflow_run_info['start_memory'], 10)
+        self.assertEquals(workflow_run_info['max_memory'], 1060)
+        self.assertEquals(run_info_dict.get_num_active_recordings(), 0)
+
+    def test_failed_recording(self):
+        run_info = run_info_dict()
+        run_info.gather_data = False
+
+        def fail():
+            raise RuntimeError('Simulated failure')
+
+        with self.assertRaises(RuntimeError):
+            run_info(fail)()
+        self.assertEquals(run_info_dict.get_num_active_recordings(), 0)
+        run_info(lambda: None)()
+        self.assertEquals(len(self.num_resets), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
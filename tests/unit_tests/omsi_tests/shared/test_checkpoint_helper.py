@@ -0,0 +1,78 @@
+"""
+Testing for the checkpointing of data blocks processed in parallel.
+"""
+import os
+import unittest
+import tempfile
+import shutil
+import numpy as np
+from omsi.shared import process_helper
+from omsi.shared.checkpoint_helper import block_checkpoint
+from omsi.shared.mpi_helper import parallel_over_axes
+
+
+def block_sum(data):
+    """Task function used for testing"""
+    return np.sum(data)
+
+
+class test_checkpoint_helper(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        self.checkpoint_directory = tempfile.mkdtemp()
+        self.data = np.arange(8 * 6 * 50).reshape((8, 6, 50))
+
+    def tearDown(self):
+        shutil.rmtree(self.checkpoint_directory, ignore_errors=True)
+
+    def run_scheduler(self, checkpoint):
+        scheduler = process_helper.parallel_over_axes_processes(task_function=block_sum,
+                                                                task_function_params={},
+                                                                main_data=self.data,
+                                                                split_axes=[0, 1],
+                                                                main_data_param_name='data',
+                                                                schedule=parallel_over_axes.SCHEDULES['DYNAMIC'],
+                                                                num_processes=2,
+                                                                block_size=6,
+                                                                checkpoint=checkpoint)
+        result, blocks = scheduler.run()
+        return result, blocks
+
+    def test_get_block_key(self):
+        key = block_checkpoint.get_block_key((slice(0, 2), slice(None)))
+        self.assertEquals(key, block_checkpoint.get_block_key((slice(0, 2), slice(None))))
+        self.assertNotEquals(key, block_checkpoint.get_block_key((slice(0, 3), slice(None))))
+        self.assertNotEquals(block_checkpoint.get_block_key((1, 2)), block_checkpoint.get_block_key((2, 1)))
+
+    def test_store_and_load(self):
+        checkpoint = block_checkpoint(self.checkpoint_directory)
+        block = (slice(0, 2), 3)
+        self.assertFalse(checkpoint.contains(block))
+        checkpoint.store(block, np.arange(5), 1.5)
+        self.assertTrue(checkpoint.contains(block))
+        # A new checkpoint object finds the stored block
+        checkpoint = block_checkpoint(self.checkpoint_directory)
+        self.assertEquals(len(checkpoint.load_index()), 1)
+        result, block_time = checkpoint.load(block)
+        self.assertTrue(np.all(result == np.arange(5)))
+        self.assertEquals(block_time, 1.5)
+
+    def test_run_with_checkpoint(self):
+        checkpoint = block_checkpoint(self.checkpoint_directory)
+        result, blocks = self.run_scheduler(checkpoint)
+        self.assertEquals(checkpoint.num_stored, len(blocks))
+        self.assertEquals(sum(result), np.sum(self.data))
+        # Simulate an interrupted run by removing the result of one block
+        os.remove(checkpoint.get_block_filename(blocks[0]))
+        # Only the missing block is processed again
+        checkpoint = block_checkpoint(self.checkpoint_directory)
+        result, blocks = self.run_scheduler(checkpoint)
+        self.assertEquals(checkpoint.num_restored, len(blocks) - 1)
+        self.assertEquals(checkpoint.num_stored, 1)
+        self.assertEquals(sum(result), np.sum(self.data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""
+Basic testing for the chunk-aligned block helper functions of omsi.shared.data_blocks
+"""
+import unittest
+import tempfile
+import numpy as np
+import h5py
+from omsi.shared.data_blocks import get_chunk_shape, get_chunk_aligned_blocks, iterate_blocks, reduce_data
+
+
+class test_data_blocks(unittest.TestCase):
+
+    def setUp(self):
+        self.named_temporary_file = tempfile.NamedTemporaryFile()
+        self.h5py_file = h5py.File(self.named_temporary_file.name, 'w')
+        self.temp_data = np.random.rand(10, 9, 40)
+        self.dataset = self.h5py_file.create_dataset('data', data=self.temp_data, chunks=(4, 2, 8))
+
+    def tearDown(self):
+        # Clean up the test suite
+        self.h5py_file.close()
+        del self.h5py_file
+        del self.named_temporary_file
+
+    def test_get_chunk_aligned_blocks(self):
+        self.assertEquals(get_chunk_shape(self.dataset), (4, 2, 8))
+        self.assertIsNone(get_chunk_shape(self.temp_data))
+        # Blocks of 4x4 spectra, 4x9 spectra, and 8x9 spectra
+        for max_bytes, num_blocks in [(4 * 4 * 40 * 8, 9), (4 * 9 * 40 * 8, 3), (8 * 9 * 40 * 8, 2), (1, 15)]:
+            blocks = get_chunk_aligned_blocks(shape=self.dataset.shape,
+                                              chunks=self.dataset.chunks,
+                                              itemsize=8,
+                                              max_bytes=max_bytes)
+            self.assertEquals(len(blocks), num_blocks)
+            covered = np.zeros(self.dataset.shape, dtype='int')
+            for block in blocks:
+                self.assertEquals(block[0].start % 4, 0)
+                self.assertEquals(block[1].start % 2, 0)
+                self.assertEquals(block[2], slice(0, 40))
+                covered[block] += 1
+            self.assertTrue(np.all(covered == 1))
+
+    def test_iterate_blocks(self):
+        blocks = get_chunk_aligned_blocks(shape=self.dataset.shape, chunks=self.dataset.chunks, max_bytes=1000)
+        for num_threads in [0, 1, 3]:
+            num_blocks = 0
+            for block, block_data in iterate_blocks(self.dataset, blocks, num_threads=num_threads):
+                self.assertTrue(np.all(block_data == self.temp_data[block]))
+                num_blocks += 1
+            self.assertEquals(num_blocks, len(blocks))
+
+    def test_reduce_data(self):
+        self.temp_data[self.temp_data < 0.2] = 0
+        self.dataset[:] = self.temp_data
+        reference = {'sum': np.sum,
+                     'mean': np.mean,
+                     'min': np.amin,
+                     'max': np.amax,
+                     'count_nonzero': lambda data, axis: np.sum(data != 0, axis=axis)}
+        for axis in [None, 0, 2, (0, 1), (1, 2)]:
+            for max_bytes in [1000, 1024 * 1024]:
+                results = reduce_data(self.dataset, list(reference.keys()), axis=axis, max_bytes=max_bytes)
+                for op, result in zip(reference.keys(), results):
+                    expected = reference[op](self.temp_data, axis=axis)
+                    self.assertEquals(np.shape(result), np.shape(expected))
+                    self.assertTrue(np.allclose(result, expected), msg=str((op, axis, max_bytes)))
+                # Percentiles are approximate if the reduction axes are split across blocks
+                result = reduce_data(self.dataset, 'percentile', axis=axis, q=[0, 25, 50, 100],
+                                     max_bytes=max_bytes, num_bins=100)
+                expected = np.percentile(self.temp_data, [0, 25, 50, 100], axis=axis)
+                self.assertEquals(result.shape, expected.shape)
+                self.assertTrue(np.all(np.abs(result - expected) <= 0.01 + 1e-12))
+        # Percentiles along the spectra are exact
+        self.assertTrue(np.all(reduce_data(self.dataset, 'percentile', axis=2, q=30, max_bytes=1000) ==
+                               np.percentile(self.temp_data, 30, axis=2)))
+        # Reduction of a selection of the last axis
+        result = reduce_data(self.dataset, 'sum', axis=2, last_axis_selection=[3, 7, 20])
+        self.assertTrue(np.allclose(result, self.temp_data[:, :, [3, 7, 20]].sum(axis=2)))
+        self.assertRaises(ValueError, reduce_data, self.dataset, 'median')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+"""
+Testing for the mpi_helper.parallel_over_axes task scheduler. The tests run on a single rank.
+"""
+import unittest
+import tempfile
+import numpy as np
+import h5py
+from omsi.shared import mpi_helper
+
+
+def block_sum(data):
+    """Task function used for testing"""
+    return np.sum(data)
+
+
+@unittest.skipUnless(mpi_helper.is_mpi_available(), "MPI is not available")
+class test_parallel_over_axes(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        self.data = np.arange(7 * 5 * 4).reshape((7, 5, 4))
+
+    def get_scheduler(self, block_size=1, main_data=None, schedule='DYNAMIC', block_costs=None):
+        return mpi_helper.parallel_over_axes(task_function=block_sum,
+                                             task_function_params={},
+                                             main_data=main_data if main_data is not None else self.data,
+                                             split_axes=[0, 1],
+                                             main_data_param_name='data',
+                                             schedule=mpi_helper.parallel_over_axes.SCHEDULES[schedule],
+                                             block_size=block_size,
+                                             block_costs=block_costs)
+
+    def check_static_nd_blocks(self, blocks, num_blocks):
+        """Check that the non-empty blocks cover each element exactly once"""
+        self.assertEquals(len(blocks), num_blocks)
+        covered = np.zeros(self.data.shape[:-1], dtype='int')
+        for block in blocks:
+            if block is not None:
+                covered[block[:-1]] += 1
+        self.assertTrue(np.all(covered == 1))
+
+    def test_dynamic_blocks_single_element(self):
+        blocks = self.get_scheduler(1).get_dynamic_blocks()
+        self.assertEquals(len(blocks), 35)
+        self.assertEquals(blocks[0], (0, 0, slice(None)))
+        self.assertEquals(blocks[-1], (6, 4, slice(None)))
+
+    def test_dynamic_blocks_multiple_elements(self):
+        for block_size in [3, 5, 12]:
+            blocks = self.get_scheduler(block_size).get_dynamic_blocks()
+            covered = np.zeros(self.data.shape[:-1], dtype='int')
+            for block in blocks:
+                self.assertLessEqual(self.data[block].size, max(block_size, 5) * 4)
+                covered[block[:-1]] += 1
+            self.assertTrue(np.all(covered == 1))
+
+    def test_dynamic_blocks_chunk(self):
+        scheduler = self.get_scheduler(mpi_helper.parallel_over_axes.BLOCK_SIZES['CHUNK'])
+        # A numpy array is not chunked, i.e., each task is a single element
+        self.assertEquals(len(scheduler.get_dynamic_blocks()), 35)
+
+    def test_static_nd_blocks(self):
+        scheduler = self.get_scheduler(schedule='STATIC_ND')
+        for num_blocks in [1, 2, 3, 6, 7, 12, 35]:
+            blocks = scheduler.get_static_nd_blocks(num_blocks)
+            self.check_static_nd_blocks(blocks, num_blocks)
+            self.assertEquals(blocks.count(None), 0)
+        # More blocks than elements leaves some blocks empty
+        blocks = scheduler.get_static_nd_blocks(40)
+        self.check_static_nd_blocks(blocks, 40)
+        self.assertEquals(blocks.count(None), 5)
+
+    def test_static_nd_blocks_chunk_aligned(self):
+        named_temporary_file = tempfile.NamedTemporaryFile()
+        h5py_file = h5py.File(named_temporary_file.name, 'w')
+        dataset = h5py_file.create_dataset('data', data=self.data, chunks=(2, 3, 4))
+        scheduler = self.get_scheduler(main_data=dataset, schedule='STATIC_ND')
+        blocks = scheduler.get_static_nd_blocks(4)
+        self.check_static_nd_blocks(blocks, 4)
+        for block in blocks:
+            self.assertEquals(block[0].start % 2, 0)
+            self.assertEquals(block[1].start % 3, 0)
+        h5py_file.close()
+
+    def test_static_nd_blocks_costs(self):
+        # All the cost is in the first row, i.e., the row should be split across the blocks
+        block_costs = np.zeros(self.data.shape[:-1])
+        block_costs[0, :] = 1
+        scheduler = self.get_scheduler(schedule='STATIC_ND', block_costs=block_costs)
+        blocks = scheduler.get_static_nd_blocks(2)
+        self.check_static_nd_blocks(blocks, 2)
+        self.assertEquals([block_costs[block[:-1]].sum() for block in blocks], [2, 3])
+        with self.assertRaises(ValueError):
+            self.get_scheduler(schedule='STATIC_ND', block_costs=np.ones(3)).get_block_costs()
+
+    def test_run_static_nd(self):
+        if mpi_helper.get_size() > 1:
+            self.skipTest("Test requires a single MPI rank")
+        result, blocks = self.get_scheduler(schedule='STATIC_ND').run()
+        self.assertEquals(len(result), 1)
+        self.assertEquals(result[0], np.sum(self.data))
+
+    def test_run_dynamic_root_computes(self):
+        if mpi_helper.get_size() > 1:
+            self.skipTest("Test requires a single MPI rank")
+        for block_size in [1, 4]:
+            scheduler = self.get_scheduler(block_size)
+            result, blocks = scheduler.run()
+            self.assertEquals(len(result), len(blocks))
+            self.assertEquals(len(scheduler.block_times), len(blocks))
+            self.assertEquals(np.sum(result), np.sum(self.data))
+
+
+class test_collect_arrays(unittest.TestCase):
+
+    def setUp(self):
+        self.named_temporary_file = tempfile.NamedTemporaryFile(suffix='.h5')
+        h5py.File(self.named_temporary_file.name, 'w').close()
+        self.data = np.arange(20).reshape((10, 2))
+
+    def tearDown(self):
+        del self.named_temporary_file
+
+    def test_gather_array(self):
+        gathered, lengths = mpi_helper.gather_array(self.data)
+        if mpi_helper.get_rank() == 0:
+            self.assertEquals(gathered.shape, (10 * mpi_helper.get_size(), 2))
+            self.assertTrue(np.all(gathered[0:10] == self.data))
+            self.assertEquals(lengths, [10] * mpi_helper.get_size())
+        # Arrays without a corresponding MPI type are transferred as bytes
+        gathered, _ = mpi_helper.gather_array(np.asarray(['a', 'bc']))
+        if mpi_helper.get_rank() == 0:
+            self.assertEquals(gathered[1], 'bc')
+
+    @unittest.skipUnless(hasattr(h5py, 'VirtualLayout'), "h5py does not support virtual datasets")
+    def test_write_virtual_dataset(self):
+        import os
+        filename = self.named_temporary_file.name
+        lengths = mpi_helper.write_virtual_dataset(self.data, filename, 'data')
+        self.assertEquals(lengths, [10] * mpi_helper.get_size())
+        if mpi_helper.get_rank() == 0:
+            output_file = h5py.File(filename, 'r')
+            self.assertTrue(output_file['data'].is_virtual)
+            self.assertTrue(np.all(output_file['data'][0:10] == self.data))
+            output_file.close()
+        mpi_helper.barrier()
+        shard_filename = filename[:-3] + '_rank' + str(mpi_helper.get_rank()) + '.h5'
+        self.assertTrue(os.path.exists(shard_filename))
+        os.remove(shard_filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
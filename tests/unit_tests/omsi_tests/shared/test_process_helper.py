@@ -0,0 +1,92 @@
+"""
+Testing for the process pool backend of the parallel task scheduling.
+"""
+import unittest
+import tempfile
+import numpy as np
+import h5py
+from omsi.shared import process_helper
+from omsi.shared.mpi_helper import parallel_over_axes
+
+
+def block_sum(data):
+    """Task function used for testing"""
+    return np.sum(data)
+
+
+def block_copy(data, scale=1):
+    """Task function used for testing returning large arrays"""
+    return np.asarray(data, dtype='float64') * scale, data.shape
+
+
+class test_process_helper(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        self.named_temporary_file = tempfile.NamedTemporaryFile()
+        self.h5py_file = h5py.File(self.named_temporary_file.name, 'w')
+        self.data = np.arange(8 * 6 * 500).reshape((8, 6, 500))
+        self.dataset = self.h5py_file.create_dataset('data', data=self.data, chunks=(2, 3, 500))
+
+    def tearDown(self):
+        self.h5py_file.close()
+        del self.h5py_file
+        del self.named_temporary_file
+
+    def test_share_arrays(self):
+        directory = tempfile.mkdtemp()
+        result = (np.arange(100000), [np.arange(10), 'a'])
+        shared = process_helper.share_arrays(result, directory)
+        self.assertTrue(isinstance(shared[0], process_helper.shared_array))
+        self.assertTrue(isinstance(shared[1][0], np.ndarray))
+        loaded = process_helper.load_shared_arrays(shared)
+        self.assertTrue(np.all(loaded[0] == result[0]))
+        self.assertEquals(loaded[1][1], 'a')
+        # The loaded arrays are writable
+        loaded[0][0] = 5
+
+    def test_use_parallel_backend(self):
+        self.assertFalse(process_helper.use_parallel_backend('serial'))
+        self.assertTrue(process_helper.use_parallel_backend('processes', 2))
+        self.assertFalse(process_helper.use_parallel_backend('processes', 1))
+        with self.assertRaises(ValueError):
+            process_helper.use_parallel_backend('threads')
+
+    def test_run_schedules(self):
+        for main_data in [self.data, self.dataset]:
+            for schedule in parallel_over_axes.SCHEDULES.values():
+                scheduler = process_helper.parallel_over_axes_processes(task_function=block_sum,
+                                                                        task_function_params={},
+                                                                        main_data=main_data,
+                                                                        split_axes=[0, 1],
+                                                                        main_data_param_name='data',
+                                                                        schedule=schedule,
+                                                                        num_processes=3,
+                                                                        block_size=4)
+                result, blocks = scheduler.run()
+                self.assertEquals(len(result), len(blocks))
+                self.assertEquals(len(scheduler.block_times), len(blocks))
+                self.assertEquals(np.sum(result), np.sum(self.data))
+                if schedule != parallel_over_axes.SCHEDULES['DYNAMIC']:
+                    self.assertEquals(len(blocks), 3)
+
+    def test_run_shared_results(self):
+        scheduler = process_helper.create_scheduler(backend='processes',
+                                                    num_processes=2,
+                                                    task_function=block_copy,
+                                                    task_function_params={'scale': 2},
+                                                    main_data=self.dataset,
+                                                    split_axes=[0, 1],
+                                                    main_data_param_name='data',
+                                                    schedule=parallel_over_axes.SCHEDULES['STATIC_ND'])
+        result, blocks = scheduler.collect_data()
+        self.assertEquals(result, None)
+        result, blocks = scheduler.run()
+        for block_result, block in zip(result, blocks):
+            self.assertTrue(np.all(block_result[0] == self.data[block] * 2))
+            self.assertEquals(block_result[1], self.data[block].shape)
+
+
+if __name__ == '__main__':
+    unittest.main()
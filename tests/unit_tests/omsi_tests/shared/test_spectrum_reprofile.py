@@ -0,0 +1,59 @@
+"""
+Test the omsi.shared.spectrum_reprofile module
+"""
+import unittest
+import numpy as np
+
+from omsi.shared.spectrum_reprofile import spectrum_reprofiler
+
+
+class test_spectrum_reprofiler(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.mz_axis = np.sort(random_state.uniform(90, 1010, 3000))
+        self.mzs = []
+        self.intensities = []
+        for index in range(200):
+            num_peaks = random_state.randint(0, 60)
+            mz = np.sort(random_state.uniform(100 + index, 900, num_peaks))
+            if num_peaks > 10:
+                mz[5] = self.mz_axis[500]  # Peak located exactly at a bin edge
+                mz = np.sort(mz)
+            self.mzs.append(mz)
+            self.intensities.append(random_state.rand(num_peaks).astype('float32'))
+
+    def tearDown(self):
+        pass
+
+    def test_profile(self):
+        reprofiler = spectrum_reprofiler(mz_axis=self.mz_axis, mode='profile')
+        result = reprofiler.reprofile(mzs=self.mzs, intensities=self.intensities)
+        self.assertEquals(result.shape, (len(self.mzs), self.mz_axis.size))
+        for index, (mz, intensity) in enumerate(zip(self.mzs, self.intensities)):
+            expected = np.interp(self.mz_axis, mz, intensity, 0, 0) if mz.size > 0 else 0
+            self.assertTrue(np.array_equal(result[index], expected * np.ones(self.mz_axis.size)))
+
+    def test_centroid(self):
+        reprofiler = spectrum_reprofiler(mz_axis=self.mz_axis, mode='centroid')
+        result = reprofiler.reprofile(mzs=self.mzs, intensities=self.intensities)
+        for index, (mz, intensity) in enumerate(zip(self.mzs, self.intensities)):
+            expected = np.histogram(mz, bins=reprofiler.bin_edges, weights=intensity.astype('float64'))[0]
+            self.assertTrue(np.allclose(result[index], expected))
+
+    def test_reprofile_flat(self):
+        for mode in spectrum_reprofiler.available_modes.keys():
+            reprofiler = spectrum_reprofiler(mz_axis=self.mz_axis, mode=mode)
+            spectrum_lengths = [mz.size for mz in self.mzs]
+            result = reprofiler.reprofile_flat(flat_mz=np.concatenate(self.mzs),
+                                               flat_intensity=np.concatenate(self.intensities),
+                                               spectrum_lengths=spectrum_lengths,
+                                               out=np.zeros((len(self.mzs), self.mz_axis.size), dtype='float32'))
+            expected = reprofiler.reprofile(mzs=self.mzs, intensities=self.intensities)
+            self.assertTrue(np.allclose(result, expected))
+            self.assertTrue(np.allclose(reprofiler.reprofile_spectrum(self.mzs[-1], self.intensities[-1]),
+                                        expected[-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
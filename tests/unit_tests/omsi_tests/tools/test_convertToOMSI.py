@@ -0,0 +1,90 @@
+"""
+Test the pipelined multi-process data conversion of the omsi.tools.convertToOMSI module
+"""
+import unittest
+import tempfile
+import shutil
+import os
+import numpy as np
+import h5py
+from omsi.dataformat.img_file import img_file
+from omsi.tools.convertToOMSI import ConvertFiles
+
+
+class test_convertToOMSI(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        self.temp_dir = tempfile.mkdtemp()
+        # Write a small synthetic img file
+        self.shape = (5, 7, 30)
+        self.basename = os.path.join(self.temp_dir, 'test')
+        hdrdata = np.zeros((24,), dtype='int16')
+        hdrdata[22] = self.shape[1]
+        hdrdata[23] = self.shape[0]
+        hdrdata.tofile(self.basename + '.hdr')
+        np.linspace(100., 200., self.shape[2]).astype('float32').tofile(self.basename + '.t2m')
+        self.values = np.random.RandomState(0).randint(0, 1000, size=self.shape).astype('uint16')
+        self.values.tofile(self.basename + '.img')
+        self.input_dataset = {'basename': self.basename,
+                              'format': img_file.format_name(),
+                              'region': None,
+                              'dataset': None}
+        self.h5py_file = h5py.File(os.path.join(self.temp_dir, 'test.h5'), 'w')
+
+    def tearDown(self):
+        self.h5py_file.close()
+        shutil.rmtree(self.temp_dir)
+
+    def create_dataset(self, name, chunk_shape):
+        return self.h5py_file.create_dataset(name, shape=self.shape, dtype='uint16', chunks=chunk_shape)
+
+    def test_plan_tiles(self):
+        tiles = ConvertFiles.plan_tiles(shape=self.shape, chunk_shape=(2, 3, 30), itemsize=2, max_tile_bytes=400)
+        covered = np.zeros(self.shape[0:2], dtype='int')
+        for xstart, xend, ystart, yend in tiles:
+            covered[xstart:xend, ystart:yend] += 1
+        self.assertTrue(np.all(covered == 1))
+
+    def test_write_data_parallel(self):
+        chunk_shape = (2, 3, 30)
+        input_file = img_file(basename=self.basename)
+        serial_data = self.create_dataset('serial', chunk_shape)
+        ConvertFiles.write_data(input_file=input_file,
+                                data=serial_data,
+                                data_io_option='spectrum',
+                                chunk_shape=chunk_shape,
+                                write_progress=False)
+        parallel_data = self.create_dataset('parallel', chunk_shape)
+        # Use a small block size limit to split the data into many tiles
+        written = ConvertFiles.write_data_parallel(input_file=input_file,
+                                                   input_dataset=self.input_dataset,
+                                                   data=parallel_data,
+                                                   num_workers=2,
+                                                   chunk_shape=chunk_shape,
+                                                   block_size_limit=2000,
+                                                   write_progress=False)
+        input_file.close_file()
+        self.assertTrue(written)
+        self.assertTrue(np.array_equal(serial_data[:], self.values))
+        self.assertTrue(np.array_equal(parallel_data[:], serial_data[:]))
+
+    def test_write_data_parallel_without_format(self):
+        input_file = img_file(basename=self.basename)
+        parallel_data = self.create_dataset('parallel', None)
+        input_dataset = dict(self.input_dataset)
+        input_dataset['format'] = None
+        written = ConvertFiles.write_data_parallel(input_file=input_file,
+                                                   input_dataset=input_dataset,
+                                                   data=parallel_data,
+                                                   num_workers=2,
+                                                   chunk_shape=None,
+                                                   write_progress=False)
+        input_file.close_file()
+        self.assertFalse(written)
+        self.assertTrue(np.all(parallel_data[:] == 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""
+Testing for the dag_executor, i.e., execution of workflows based on their dependency graph.
+"""
+import unittest
+import numpy as np
+from omsi.analysis.generic import analysis_generic
+from omsi.workflow.executor.dag_executor import dag_executor
+
+
+def create_data(size):
+    """Root of the test workflow"""
+    import numpy as np
+    return np.arange(size, dtype='float64')
+
+
+def scale_data(data, scale):
+    """Branch of the test workflow"""
+    return data * scale
+
+
+def add_data(a, b):
+    """Join of the test workflow"""
+    return a + b
+
+
+class test_dag_executor(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        # Define a diamond-shaped workflow root -> (left, right) -> join
+        self.root = analysis_generic.from_function(create_data)
+        self.root['size'] = 100000
+        self.left = analysis_generic.from_function(scale_data)
+        self.left['data'] = self.root['output_0']
+        self.left['scale'] = 2
+        self.right = analysis_generic.from_function(scale_data)
+        self.right['data'] = self.root['output_0']
+        self.right['scale'] = 3
+        self.join = analysis_generic.from_function(add_data)
+        self.join['a'] = self.left['output_0']
+        self.join['b'] = self.right['output_0']
+
+    def check_workflow(self, executor):
+        self.assertTrue(np.all(self.join['output_0'] == np.arange(100000) * 5))
+        for analysis in [self.root, self.left, self.right, self.join]:
+            self.assertFalse(analysis.update_analysis)
+        # The critical path starts at the root and ends with the join
+        all_analyses = executor.get_analyses()
+        critical_path = [all_analyses[node_index] for node_index in executor.run_info['dag_critical_path']]
+        self.assertEquals(len(critical_path), 3)
+        self.assertIs(critical_path[0], self.root)
+        self.assertIs(critical_path[-1], self.join)
+        self.assertEquals(len(executor.run_info['dag_node_times']), 4)
+        self.assertTrue(all(node_time >= 0 for node_time in executor.run_info['dag_node_times']))
+        self.assertIsInstance(executor.run_info['dag_critical_path_time'], float)
+        self.assertGreaterEqual(executor.run_info['dag_critical_path_time'],
+                                max(executor.run_info['dag_node_times']))
+
+    def test_dependency_graph(self):
+        executor = dag_executor(self.join)
+        executor.add_analysis_dependencies()
+        graph = executor.build_dependency_graph()
+        node_indices = dict((id(analysis), index) for index, analysis in enumerate(executor.get_analyses()))
+        self.assertEquals(len(graph), 4)
+        self.assertEquals(graph[node_indices[id(self.root)]], [])
+        self.assertEquals(graph[node_indices[id(self.left)]], [node_indices[id(self.root)]])
+        self.assertEquals(graph[node_indices[id(self.join)]],
+                          sorted([node_indices[id(self.left)], node_indices[id(self.right)]]))
+
+    def test_execute_serial(self):
+        executor = dag_executor(self.join)
+        executor['backend'] = 'serial'
+        executor.execute()
+        self.check_workflow(executor)
+
+    def test_execute_processes(self):
+        executor = dag_executor(self.join)
+        executor['backend'] = 'processes'
+        executor['num_processes'] = 2
+        executor.execute()
+        self.check_workflow(executor)
+        # Large outputs are transferred via shared memory
+        self.assertEquals(self.left['output_0'].shape, (100000,))
+
+    def test_execute_memory_budget(self):
+        executor = dag_executor(self.join)
+        executor['backend'] = 'processes'
+        executor['num_processes'] = 2
+        executor['memory_budget'] = 1e-9
+        executor['reduce_memory_usage'] = True
+        executor.execute()
+        self.check_workflow(executor)
+        # The memory usage of all executed analyses is recorded in the memory model
+        self.assertEquals(sum(len(records) for records in executor.memory_model.records.values()), 4)
+        # The outputs of all analyses except the join have been released
+        node_indices = dict((id(analysis), index) for index, analysis in enumerate(executor.get_analyses()))
+        self.assertEquals(executor.released_nodes,
+                          set(node_indices[id(analysis)] for analysis in [self.root, self.left, self.right]))
+
+    def test_execute_processes_failure(self):
+        self.root['size'] = 'invalid'
+        executor = dag_executor(self.join)
+        executor['backend'] = 'processes'
+        executor['num_processes'] = 2
+        with self.assertRaises(RuntimeError):
+            executor.execute()
+        self.assertTrue(self.root.update_analysis)
+
+
+if __name__ == '__main__':
+    unittest.main()
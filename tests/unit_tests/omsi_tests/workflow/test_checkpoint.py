@@ -0,0 +1,105 @@
+"""
+Testing for the checkpoint/restart of workflows.
+"""
+import unittest
+import tempfile
+import shutil
+import os
+import numpy as np
+from omsi.analysis.generic import analysis_generic
+from omsi.workflow.executor.greedy_executor import greedy_executor
+from omsi.workflow.executor.dag_executor import dag_executor
+
+EXECUTION_COUNT = {'create_data': 0, 'scale_data': 0}
+FAIL_SCALE = [False]
+
+
+def create_data(size):
+    """First step of the test workflow"""
+    import numpy as np
+    EXECUTION_COUNT['create_data'] += 1
+    return np.arange(size, dtype='float64')
+
+
+def scale_data(data, scale):
+    """Second step of the test workflow"""
+    EXECUTION_COUNT['scale_data'] += 1
+    if FAIL_SCALE[0]:
+        raise RuntimeError('Simulated failure')
+    return data * scale
+
+
+class test_checkpoint(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+        self.checkpoint_directory = tempfile.mkdtemp()
+        self.checkpoint_file = os.path.join(self.checkpoint_directory, 'checkpoint.h5')
+        EXECUTION_COUNT['create_data'] = 0
+        EXECUTION_COUNT['scale_data'] = 0
+        FAIL_SCALE[0] = False
+
+    def tearDown(self):
+        shutil.rmtree(self.checkpoint_directory, ignore_errors=True)
+
+    def create_workflow(self, executor_class=greedy_executor):
+        create = analysis_generic.from_function(create_data)
+        create['size'] = 100
+        scale = analysis_generic.from_function(scale_data)
+        scale['data'] = create['output_0']
+        scale['scale'] = 2
+        executor = executor_class(scale)
+        executor['checkpoint_file'] = self.checkpoint_file
+        return executor, scale
+
+    def test_restart(self):
+        # The second step of the workflow fails
+        FAIL_SCALE[0] = True
+        executor, _ = self.create_workflow()
+        with self.assertRaises(RuntimeError):
+            executor.execute()
+        self.assertTrue(os.path.exists(self.checkpoint_file))
+        # The workflow resumes with the second step
+        FAIL_SCALE[0] = False
+        executor, scale = self.create_workflow()
+        executor.execute()
+        self.assertEquals(executor.run_info['checkpoint_restored'], 1)
+        self.assertEquals(EXECUTION_COUNT['create_data'], 1)
+        self.assertEquals(EXECUTION_COUNT['scale_data'], 2)
+        self.assertTrue(np.all(scale['output_0'] == np.arange(100) * 2))
+        # All analyses are restored when the completed workflow is executed again
+        executor, scale = self.create_workflow(executor_class=dag_executor)
+        executor['backend'] = 'serial'
+        executor.execute()
+        self.assertEquals(executor.run_info['checkpoint_restored'], 2)
+        self.assertEquals(EXECUTION_COUNT['scale_data'], 2)
+        self.assertFalse(scale.update_analysis)
+        self.assertTrue(np.all(scale['output_0'] == np.arange(100) * 2))
+
+    def test_changed_parameters(self):
+        executor, _ = self.create_workflow()
+        executor.execute()
+        executor, scale = self.create_workflow()
+        scale['scale'] = 3
+        executor.execute()
+        self.assertEquals(EXECUTION_COUNT['create_data'], 1)
+        self.assertEquals(EXECUTION_COUNT['scale_data'], 2)
+        self.assertTrue(np.all(scale['output_0'] == np.arange(100) * 3))
+
+    def test_save_after_checkpoint(self):
+        from omsi.dataformat.omsi_file.main_file import omsi_file
+        executor, scale = self.create_workflow()
+        executor.execute()
+        self.assertEquals(len(scale.get_omsi_analysis_storage()), 0)
+        # The outputs of the workflow can be saved to a different file after the checkpoint has been closed
+        output_filename = os.path.join(self.checkpoint_directory, 'output.h5')
+        output_file = omsi_file(output_filename, 'a')
+        experiment = output_file.create_experiment()
+        saved_analysis, _ = experiment.create_analysis(scale)
+        self.assertTrue(np.all(saved_analysis['output_0'][:] == np.arange(100) * 2))
+        output_file.close_file()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""
+Testing for the model of the peak memory usage of analyses used by the workflow executors.
+"""
+import unittest
+import numpy as np
+from omsi.analysis.generic import analysis_generic
+from omsi.workflow.memory_model import analysis_memory_model, get_input_size, get_data_size
+
+
+def scale_data(data, scale=1):
+    """Analysis function used for testing"""
+    return data * scale
+
+
+class test_memory_model(unittest.TestCase):
+
+    def setUp(self):
+        from omsi.shared.log import log_helper
+        log_helper.set_log_level('WARNING')
+
+    def test_get_input_size(self):
+        data = np.arange(100, dtype='float64')
+        self.assertEquals(get_data_size(data), 800)
+        self.assertEquals(get_data_size([data, data]), 1600)
+        self.assertEquals(get_data_size('data'), 0)
+        analysis = analysis_generic.from_function(scale_data)
+        analysis['data'] = data
+        analysis['scale'] = 2
+        self.assertEquals(get_input_size(analysis), 800 + np.asarray(2).nbytes)
+        # Dependencies that are not ready are ignored
+        downstream = analysis_generic.from_function(scale_data)
+        downstream['data'] = analysis['output_0']
+        self.assertEquals(get_input_size(downstream), 0)
+
+    def test_predict(self):
+        memory_model = analysis_memory_model(safety_factor=1.0)
+        self.assertIsNone(memory_model.predict('test', 100))
+        # A single input size scales proportionally
+        memory_model.add_record('test', 100, 400)
+        self.assertEquals(memory_model.predict('test', 200), 800)
+        # Multiple input sizes are fit by a line that covers all observations
+        memory_model.add_record('test', 200, 500)
+        memory_model.add_record('test', 300, 700)
+        prediction = memory_model.predict('test', 400)
+        self.assertGreaterEqual(prediction, 800)
+        self.assertLess(prediction, 1000)
+        self.assertEquals(analysis_memory_model(default_memory=10).predict('test', 100), 10)
+
+    def test_add_run_info(self):
+        memory_model = analysis_memory_model(safety_factor=1.0)
+        self.assertFalse(memory_model.add_run_info('test', {'start_memory': 100}))
+        self.assertFalse(memory_model.add_run_info('test', {'max_memory': 500, 'cache_hit': True}))
+        self.assertTrue(memory_model.add_run_info('test', {'start_memory': 100,
+                                                          'max_memory': [300, 500],
+                                                          'input_size': '100'}))
+        self.assertEquals(memory_model.records['test'], [(100.0, 400.0)])
+
+    def test_add_analysis(self):
+        analysis = analysis_generic.from_function(scale_data)
+        analysis['data'] = np.arange(1000)
+        analysis.execute()
+        self.assertIn('max_memory', analysis.run_info)
+        memory_model = analysis_memory_model()
+        self.assertTrue(memory_model.add_analysis(analysis))
+        self.assertIsNotNone(memory_model.predict_analysis(analysis))
+
+
+if __name__ == '__main__':
+    unittest.main()